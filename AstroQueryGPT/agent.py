@@ -0,0 +1,559 @@
+"""
+UI-free agent engine: the generate → validate → execute → verify → correct loop.
+
+This module includes functionalities for:
+- Running one user question end to end with `Agent.run` and returning a plain
+  result dict that carries the per-attempt log (the same entries the Streamlit
+  app shows in its "Agent Run Log").
+- Reporting progress through an optional `on_event(name, payload)` callback, so
+  a UI can show status messages, probe previews and pages as they arrive.
+- The probe, pagination and result verification helpers used by the loop.
+
+The engine is used in-process by `streamlit_app` and behind an HTTP job queue by
+`agent_service`; it never touches Streamlit state.
+"""
+import time
+import logging
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import pandas as pd
+
+import config
+from rag_core import (
+    retrieve_relevant_schema,
+    build_rag_prompt_for_sql_generation,
+    generate_and_correct_sql,
+    explain_sql_query,
+    get_schema_index,
+    get_schema,
+    SQL_GENERATION_SYSTEM_PROMPT,
+)
+from sql_validator import validate_sql, format_validation_errors
+from sql_repair import repair_sql, enforce_top_n_clause
+from prompt_packing import count_tokens
+from sql_pagination import plan_keyset_pagination
+from model_router import select_model_tier, record_attempt_outcome
+from request_context import RequestContext, RequestCancelled, DeadlineExceeded, PRIORITY_BULK
+from single_flight import SingleFlight
+from metrics import AGENT_STAGE_SECONDS, AGENT_ATTEMPTS, AGENT_CORRECTIONS, classify_execution_error, record_cache_lookup
+from profiling import profile_run
+from log_utils import log_payload
+from result_profiler import profile_result, format_result_profile, unusable_column_fraction, unusable_measurement_columns
+from tracing import start_trace, span, set_span_attributes, export_trace
+
+logger = logging.getLogger(__name__)
+
+AgentEventCallback = Callable[[str, Dict[str, Any]], None]
+"""Progress callback: `on_event(name, payload)`. See `Agent.run` for the event names."""
+
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+STATUS_NO_SCHEMA = "no_schema"
+STATUS_CANCELLED = "cancelled"
+STATUS_DEADLINE_EXCEEDED = "deadline_exceeded"
+
+AGENT_STAGES = ("retrieval", "prompt", "generation", "validation", "execution", "verification", "explanation")
+"""Pipeline stages timed in a result's 'stage_ms' (summed over attempts)."""
+
+
+def normalize_question(user_query: str) -> str:
+    """Normalizes a question for single-flight matching: case, surrounding punctuation and whitespace are ignored."""
+    return " ".join(user_query.lower().split()).strip(" ?.!")
+
+
+def make_probe_sql(sql_query: str, top_n_results: int) -> Optional[str]:
+    """
+    Rewrites a query into a cheap probe that only fetches `config.PROBE_TOP_N` rows.
+
+    Args:
+        sql_query: The validated SQL query.
+        top_n_results: The TOP N requested by the user.
+
+    Returns:
+        The probe SQL, or None if probing is disabled or would not be cheaper than the query itself.
+    """
+    if not config.ENABLE_PROBE_EXECUTION or top_n_results <= config.PROBE_TOP_N:
+        return None
+    return enforce_top_n_clause(sql_query, config.PROBE_TOP_N)
+
+
+def make_pagination_plan(sql_query: str, top_n_results: int) -> Optional[dict]:
+    """
+    Returns a keyset pagination plan for a large verified query, or None to run it in one request.
+
+    Args:
+        sql_query: The verified SQL query.
+        top_n_results: The TOP N requested by the user.
+    """
+    if not config.ENABLE_PAGINATED_FETCH or top_n_results <= config.PAGINATION_PAGE_SIZE:
+        return None
+    return plan_keyset_pagination(sql_query, get_schema_index(), get_schema(), config.PAGINATION_PAGE_SIZE)
+
+
+def verify_data_structure(df: pd.DataFrame, profile: Optional[Dict[str, Any]] = None) -> bool:
+    """
+    Performs basic verification of the structure of the DataFrame returned by a query.
+
+    This helps catch cases where the LLM might generate SQL that returns
+    a single long string, an error message, an empty/malformed result, rows
+    whose columns hold only NULL or SDSS sentinel values (e.g. -9999), or a
+    requested measurement that is missing for every row, even if the ID and
+    coordinate columns next to it are filled.
+
+    Args:
+        df: The Pandas DataFrame to verify.
+        profile: The result's profile from `result_profiler.profile_result`, if already computed.
+
+    Returns:
+        True if the data structure seems valid, False otherwise.
+    """
+    logger.info("Verifying data structure. Shape: %s", df.shape)
+    logger.debug("Data to verify (head):\n%s", log_payload(df, render=lambda frame: frame.head().to_string()))
+    if df.empty:
+        logger.warning("Data Verification: Failed because DataFrame is empty.")
+        return False
+    if len(df.columns) == 0:
+        logger.warning("Data Verification: Failed because DataFrame has no columns.")
+        return False
+
+    # Check for a common failure mode: a single cell containing a long string or error message
+    if len(df) == 1 and len(df.columns) == 1:
+        first_cell_value = str(df.iloc[0,0])
+        # Heuristic: very long string with few spaces might be a concatenated error or unparsed data
+        if len(first_cell_value) > 200 and first_cell_value.count(' ') < 5:
+            logger.warning(f"Data Verification: Failed because it looks like a single long string. Preview: {first_cell_value[:100]}...")
+            return False
+        # Heuristic: common error phrases in the single cell
+        error_phrases = ["error", "failed", "unable", "cannot", "syntax", "invalid", "incorrect"]
+        if any(phrase in first_cell_value.lower() for phrase in error_phrases) and len(first_cell_value) < 150: # Arbitrary length for short errors
+            logger.warning(f"Data Verification: Failed because first cell contains potential error message: {first_cell_value[:100]}...")
+            return False
+
+    if profile is None:
+        profile = profile_result(df)
+    if unusable_column_fraction(profile) > config.VERIFY_MAX_UNUSABLE_COLUMN_FRACTION:
+        logger.warning(
+            "Data Verification: Failed because %d of %d columns hold only NULL or sentinel values: %s",
+            len(profile["unusable_columns"]), len(profile["columns"]), ", ".join(profile["unusable_columns"][:10]),
+        )
+        return False
+    dead_measurements = unusable_measurement_columns(profile)
+    if dead_measurements:
+        logger.warning(
+            "Data Verification: Failed because measurement columns hold only NULL or sentinel values: %s",
+            ", ".join(dead_measurements[:10]),
+        )
+        return False
+
+    logger.info("Data Verification: Basic structure appears valid.")
+    return True
+
+
+class Agent:
+    """
+    Runs user questions through the RAG → SQL → SkyServer loop with local repair and LLM correction.
+
+    An Agent holds no per-request state, so one instance can serve many questions
+    concurrently (e.g. from the `agent_service` worker pool). Concurrent identical
+    questions on the same Agent share one run (see `config.ENABLE_SINGLE_FLIGHT`).
+    """
+
+    def __init__(
+        self,
+        query_fn: Optional[Callable[..., pd.DataFrame]] = None,
+        pages_fn: Optional[Callable[..., Any]] = None,
+    ):
+        """
+        Args:
+            query_fn: Executes SQL and returns a DataFrame: `query_fn(sql, ctx=ctx)`, or
+                `query_fn(sql, ctx=ctx, priority=PRIORITY_BULK)` for full fetches after a
+                probe. Defaults to `sdss_db.query_sdss`.
+            pages_fn: Iterates the pages of a pagination plan: `pages_fn(plan, ctx=ctx)`.
+                Defaults to `sdss_db.iter_query_pages`.
+        """
+        if query_fn is None or pages_fn is None:
+            from sdss_db import query_sdss, iter_query_pages
+            query_fn = query_fn or query_sdss
+            pages_fn = pages_fn or iter_query_pages
+        self.query_fn = query_fn
+        self.pages_fn = pages_fn
+        self.question_flights = SingleFlight("agent run")
+
+    def run(
+        self,
+        user_query: str,
+        top_n_results: int = config.DEFAULT_TOP_N_RESULTS,
+        max_retries: int = config.MAX_AGENT_RETRIES,
+        ctx: Optional[RequestContext] = None,
+        on_event: Optional[AgentEventCallback] = None,
+        explain: bool = True,
+        profile: Optional[bool] = None,
+    ) -> Dict[str, Any]:
+        """
+        Answers one question, retrying with local repairs or LLM corrections on failures.
+
+        Events passed to `on_event` (payload keys in brackets):
+        - "status" (level, message): a human-readable status; level is info/warning/error/success.
+        - "progress" (value, text): overall progress from 0 to 100.
+        - "attempt" (entry): a new per-attempt log entry (the same dict is updated in place later).
+        - "rag_context" (tables, prompt_tokens): the retrieved `(table_schema, score)` pairs.
+        - "probe_preview" (rows): the probe's rows, before the full query runs.
+        - "page" (rows, total_rows): all rows fetched so far by a paginated fetch.
+        - "results" (rows): verified results, before the explanation is requested.
+
+        Args:
+            user_query: The natural language question.
+            top_n_results: The TOP N the query must return.
+            max_retries: Maximum number of correction attempts after the first one.
+            ctx: Request context for deadline and cancellation. A context without a
+                deadline is created if not given.
+            on_event: Optional progress callback.
+            explain: Whether to request an LLM explanation of the successful SQL.
+            profile: Whether to profile the run (see `profiling`). Defaults to
+                `config.ENABLE_PROFILING`.
+
+        If an identical question (same normalized text, TOP N, retries and `explain`) is
+        already running, this call waits for it and returns the same result object; its
+        events are then replayed from the finished result ("attempt", "rag_context" and
+        "results"). Shared results must not be modified.
+
+        Returns:
+            A dict with 'request_id', 'status' (one of the STATUS_* constants), 'message',
+            'sql', 'results' (DataFrame or None), 'partial_results' (rows fetched before a
+            cancellation, or None), 'explanation', 'attempts' (the per-attempt log),
+            'rag_tables', 'prompt_tokens', 'elapsed_ms', 'stage_ms' (milliseconds spent
+            in each of AGENT_STAGES that ran, summed over attempts), 'trace' (the run's
+            spans, see `tracing`; empty if tracing is disabled) and 'profile' (the
+            profile summary with its file paths and top functions, or None).
+        """
+        ctx = ctx or RequestContext()
+        if profile is None:
+            profile = config.ENABLE_PROFILING
+
+        def emit(name: str, **payload: Any) -> None:
+            if on_event:
+                on_event(name, payload)
+
+        def run_once() -> Dict[str, Any]:
+            return self._run_request(user_query, top_n_results, max_retries, ctx, emit, explain, profile)
+
+        if not config.ENABLE_SINGLE_FLIGHT:
+            return run_once()
+        key = (normalize_question(user_query), top_n_results, max_retries, explain, profile)
+        try:
+            result, shared = self.question_flights.do(
+                key, run_once, ctx=ctx,
+                abandoned=lambda r: r["status"] in (STATUS_CANCELLED, STATUS_DEADLINE_EXCEEDED),
+            )
+        except (RequestCancelled, DeadlineExceeded) as e:
+            # This caller's own request ended while it waited for an identical run.
+            return self._aborted_result(self._new_result(ctx), ctx, e)
+        record_cache_lookup("question_coalescing", hit=shared)
+        if shared:
+            logger.info(f"Request {ctx.request_id} shared the run of identical request {result['request_id']}.")
+            emit("status", level="info", message="An identical question was already being answered. Sharing its result.")
+            if result["rag_tables"]:
+                emit("rag_context", tables=result["rag_tables"], prompt_tokens=result["prompt_tokens"])
+            for entry in result["attempts"]:
+                emit("attempt", entry=entry)
+            if result["status"] == STATUS_SUCCESS:
+                emit("results", rows=result["results"])
+        return result
+
+    def get_coalescing_stats(self) -> Dict[str, Any]:
+        """Returns the single-flight counters of questions answered by this agent."""
+        return self.question_flights.get_stats()
+
+    @staticmethod
+    def _new_result(ctx: RequestContext) -> Dict[str, Any]:
+        """Returns an empty result for a request."""
+        return {
+            "request_id": ctx.request_id, "status": STATUS_FAILED, "message": "", "sql": None,
+            "results": None, "partial_results": None, "explanation": None, "attempts": [],
+            "rag_tables": [], "prompt_tokens": None, "elapsed_ms": None, "stage_ms": {},
+            "trace": [], "profile": None,
+        }
+
+    @staticmethod
+    @contextmanager
+    def _timed(result: Dict[str, Any], stage: str, **attributes: Any) -> Iterator[None]:
+        """Adds the time spent in the `with` block to `result['stage_ms'][stage]`, the stage histogram and an `agent.<stage>` span."""
+        start = time.perf_counter()
+        try:
+            with span(f"agent.{stage}", **attributes):
+                yield
+        finally:
+            elapsed_s = time.perf_counter() - start
+            result["stage_ms"][stage] = result["stage_ms"].get(stage, 0.0) + elapsed_s * 1000
+            AGENT_STAGE_SECONDS.observe(elapsed_s, stage=stage)
+
+    @staticmethod
+    def _aborted_result(result: Dict[str, Any], ctx: RequestContext, error: Exception) -> Dict[str, Any]:
+        """Marks a result as cancelled or out of time."""
+        if isinstance(error, RequestCancelled):
+            logger.info(f"Request {ctx.request_id} stopped: {error}")
+            result["status"] = STATUS_CANCELLED
+            result["message"] = f"Request stopped ({ctx.cancel_reason})."
+        else:
+            logger.warning(f"Request {ctx.request_id} ran out of time: {error}")
+            result["status"] = STATUS_DEADLINE_EXCEEDED
+            result["message"] = "The request exceeded its time budget. Try a simpler question or a smaller TOP N."
+        return result
+
+    def _run_request(
+        self, user_query: str, top_n_results: int, max_retries: int, ctx: RequestContext,
+        emit: Callable[..., None], explain: bool, profile: bool,
+    ) -> Dict[str, Any]:
+        """Runs the agent loop for one request, timing, tracing and optionally profiling it."""
+        start = time.perf_counter()
+        result = self._new_result(ctx)
+        with start_trace("agent.run", request_id=ctx.request_id, question=user_query, top_n=top_n_results) as trace:
+            with profile_run(ctx.request_id, enabled=profile) as profiler:
+                try:
+                    self._run_loop(user_query, top_n_results, max_retries, ctx, emit, explain, result)
+                except (RequestCancelled, DeadlineExceeded) as e:
+                    self._aborted_result(result, ctx, e)
+            set_span_attributes(status=result["status"], attempts=len(result["attempts"]))
+        if profiler is not None:
+            result["profile"] = profiler.profile
+        result["elapsed_ms"] = (time.perf_counter() - start) * 1000
+        AGENT_ATTEMPTS.observe(len(result["attempts"]), status=result["status"])
+        if trace is not None:
+            result["trace"] = trace.spans
+            export_trace(trace)
+        logger.info(f"Request {ctx.request_id} finished with status '{result['status']}' in {result['elapsed_ms']:.0f} ms.")
+        return result
+
+    def _fetch_pages(self, plan: dict, ctx: RequestContext, emit: Callable[..., None], result: Dict[str, Any]) -> pd.DataFrame:
+        """Fetches a paginated query page by page, emitting the rows fetched so far after each page."""
+        pages: List[pd.DataFrame] = []
+        for page in self.pages_fn(plan, ctx=ctx):
+            pages.append(page)
+            df_so_far = pd.concat(pages, ignore_index=True)
+            result["partial_results"] = df_so_far # Kept if the request is cancelled mid-fetch.
+            emit("page", rows=df_so_far, total_rows=plan["total_rows"])
+        result["partial_results"] = None
+        return pd.concat(pages, ignore_index=True) if pages else pd.DataFrame()
+
+    def _execute(
+        self, sql_query: str, top_n_results: int, ctx: RequestContext, emit: Callable[..., None],
+        result: Dict[str, Any], log_entry: Dict[str, Any],
+    ) -> pd.DataFrame:
+        """Executes a validated query: probe first, then the full query (paginated when possible)."""
+        probe_sql = make_probe_sql(sql_query, top_n_results)
+        if not probe_sql:
+            return self.query_fn(sql_query, ctx=ctx)
+
+        # Probe with a few rows first so errors and bad result shapes surface quickly.
+        emit("status", level="info", message=f"Probing SQL with TOP {config.PROBE_TOP_N}...")
+        df_probe = self.query_fn(probe_sql, ctx=ctx)
+        log_entry["probe_rows"] = len(df_probe)
+        if not verify_data_structure(df_probe):
+            logger.warning("Probe result failed verification. Skipping the full query.")
+            return df_probe # Fails verification in the caller, without running the full query.
+
+        pagination_plan = make_pagination_plan(sql_query, top_n_results)
+        if pagination_plan:
+            # Large result: fetch keyset-ordered pages and report rows as they arrive.
+            logger.info(f"Probe passed ({len(df_probe)} rows). Fetching results page by page.")
+            log_entry["paginated_by"] = pagination_plan["key_expr"]
+            return self._fetch_pages(pagination_plan, ctx, emit, result)
+        logger.info(f"Probe passed ({len(df_probe)} rows). Running the full query.")
+        emit("probe_preview", rows=df_probe)
+        return self.query_fn(sql_query, ctx=ctx, priority=PRIORITY_BULK) # The probe already answered interactively.
+
+    def _run_loop(
+        self, user_query: str, top_n_results: int, max_retries: int, ctx: RequestContext,
+        emit: Callable[..., None], explain: bool, result: Dict[str, Any],
+    ) -> None:
+        """The agent loop. Fills in `result`; cancellation and deadline errors propagate to `run`."""
+        attempts: List[Dict[str, Any]] = result["attempts"]
+        current_sql_query: Optional[str] = None
+        db_error_message: Optional[str] = None
+        data_structure_ok: bool = False
+        last_failed_data_sample: Optional[str] = None
+        attempted_sqls: set = set() # SQL already tried in this run, so local repairs never loop
+
+        # --- Step 1: Retrieve RAG Context ---
+        ctx.check("schema retrieval")
+        emit("status", level="info", message="🔍 Step 1/4: Retrieving relevant schema context (RAG)...")
+        emit("progress", value=10, text="RAG: Retrieving schema...")
+        with self._timed(result, "retrieval"):
+            top_tables_for_rag = retrieve_relevant_schema(user_query, ctx=ctx)
+            set_span_attributes(tables=",".join(table.get("name", "") for table, _ in top_tables_for_rag))
+        if not top_tables_for_rag:
+            logger.warning("RAG could not determine relevant table schema for the query.")
+            result["status"] = STATUS_NO_SCHEMA
+            result["message"] = (
+                "Could not determine relevant table schema for your query using RAG. "
+                "Please try rephrasing your question or check if the schema is loaded correctly."
+            )
+            return
+        logger.info(f"RAG retrieved {len(top_tables_for_rag)} table(s) for context.")
+        result["rag_tables"] = top_tables_for_rag
+
+        # --- Step 2: Build RAG Prompt & LLM Interaction Loop ---
+        with self._timed(result, "prompt"):
+            rag_llm_prompt = build_rag_prompt_for_sql_generation(user_query, top_tables_for_rag, top_n_results)
+            rag_prompt_tokens = count_tokens(SQL_GENERATION_SYSTEM_PROMPT) + count_tokens(rag_llm_prompt)
+            set_span_attributes(prompt_tokens=rag_prompt_tokens)
+        result["prompt_tokens"] = rag_prompt_tokens
+        logger.info(f"RAG prompt for this request: {rag_prompt_tokens} tokens (context budget: {config.PROMPT_CONTEXT_TOKEN_BUDGET}).")
+        emit("rag_context", tables=top_tables_for_rag, prompt_tokens=rag_prompt_tokens)
+
+        max_attempts = max_retries + 1
+        for attempt in range(max_attempts):
+            attempt_num = attempt + 1
+            ctx.check(f"attempt {attempt_num}")
+            logger.info(f"Attempt {attempt_num}/{max_attempts} for query: '{user_query[:50]}...'")
+            emit("status", level="info", message=f"🛠️ Step 2/4: LLM Generating SQL (Attempt {attempt_num}/{max_attempts})...")
+            progress_value_llm_start = 20 + int(60 * (attempt / max_attempts)) # Progress for LLM stage
+            emit("progress", value=progress_value_llm_start, text=f"LLM: Generating SQL (Attempt {attempt_num})")
+
+            prior_sql = attempts[-1]["sql"] if attempts and attempt > 0 else None
+
+            # --- Step 2a: Try a deterministic local repair before asking the LLM again ---
+            repair = None
+            if config.ENABLE_LOCAL_SQL_REPAIR and db_error_message and prior_sql:
+                with self._timed(result, "generation", attempt=attempt_num, local_repair=True):
+                    repair = repair_sql(prior_sql, db_error_message, get_schema_index(), top_n_results, attempted_sqls)
+
+            attempt_tier = None # Model tier that produced this attempt's SQL (None if repaired locally)
+            if repair:
+                current_sql_query = repair["sql"]
+                emit("status", level="info", message=f"🔧 Attempt {attempt_num}: Repaired SQL locally ({', '.join(repair['rules'])}), no LLM call needed.")
+            else:
+                data_verification_failed = not data_structure_ok and attempt > 0 # If prev verification failed
+                attempt_tier = select_model_tier(correction=bool(db_error_message) or data_verification_failed)
+                with self._timed(result, "generation", attempt=attempt_num, model_tier=attempt_tier):
+                    current_sql_query = generate_and_correct_sql(
+                        original_user_query=user_query,
+                        rag_prompt_for_llm=rag_llm_prompt, # Also resent on corrections as a cacheable prefix
+                        top_n_results=top_n_results,
+                        error_message=db_error_message, # From previous failed attempt
+                        prior_sql=prior_sql,
+                        data_verification_failed=data_verification_failed,
+                        failed_data_sample=last_failed_data_sample,
+                        model_tier=attempt_tier,
+                        ctx=ctx
+                    )
+
+            # Reset error/data states for this new attempt
+            db_error_message = None
+            data_structure_ok = False
+            last_failed_data_sample = None
+            result["results"] = None
+
+            if not current_sql_query:
+                logger.error(f"LLM failed to generate SQL on attempt {attempt_num}.")
+                emit("status", level="error", message=f"😔 Attempt {attempt_num}: LLM failed to generate SQL. Check logs for details.")
+                attempts.append({"attempt": attempt_num, "sql": "LLM failed to generate SQL", "status": "LLM Error", "error": "No SQL returned by LLM.", "model_tier": attempt_tier})
+                emit("attempt", entry=attempts[-1])
+                if attempt_tier:
+                    record_attempt_outcome(attempt_tier, success=False)
+                AGENT_CORRECTIONS.inc(reason="no_sql")
+                result["message"] = "The LLM failed to generate SQL."
+                continue
+
+            attempted_sqls.add(current_sql_query)
+            result["sql"] = current_sql_query
+            log_entry = {"attempt": attempt_num, "sql": current_sql_query, "status": "Generated by LLM"}
+            if repair:
+                log_entry["status"] = "Repaired Locally"
+                log_entry["repair_rules"] = repair["rules"]
+            else:
+                log_entry["prompt_tokens"] = rag_prompt_tokens
+                log_entry["model_tier"] = attempt_tier
+            attempts.append(log_entry)
+            emit("attempt", entry=log_entry) # Updated in place as the attempt progresses
+            logger.debug("Attempt %d generated SQL: %s", attempt_num, log_payload(current_sql_query))
+
+            # --- Step 2b: Validate SQL locally against the schema (no network round trip) ---
+            if config.ENABLE_LOCAL_SQL_VALIDATION:
+                with self._timed(result, "validation", attempt=attempt_num):
+                    validation_errors = validate_sql(current_sql_query, get_schema_index())
+                if validation_errors:
+                    db_error_message = format_validation_errors(validation_errors)
+                    logger.warning(f"Attempt {attempt_num}: Local SQL validation failed: {db_error_message}")
+                    log_entry["status"] = "Local Validation Error"
+                    log_entry["error"] = db_error_message
+                    if attempt_tier:
+                        record_attempt_outcome(attempt_tier, success=False)
+                    AGENT_CORRECTIONS.inc(reason="validation_error")
+                    result["message"] = f"Final SQL failed local validation: {db_error_message}"
+                    if attempt < max_retries:
+                        emit("status", level="warning", message=f"Attempt {attempt_num}: SQL references unknown tables or columns. The agent will try to correct it. Retrying...")
+                    continue
+
+            # --- Step 3: Execute SQL ---
+            emit("status", level="info", message=f"Executing SQL (Attempt {attempt_num})...")
+            emit("progress", value=progress_value_llm_start + int(10 / max_attempts), text=f"DB: Executing SQL (Attempt {attempt_num})")
+            try:
+                with self._timed(result, "execution", attempt=attempt_num):
+                    df_results = self._execute(current_sql_query, top_n_results, ctx, emit, result, log_entry)
+            except (RequestCancelled, DeadlineExceeded):
+                raise # Not a SQL error: reported by `run`.
+            except Exception as e:
+                logger.error(f"Attempt {attempt_num}: SQL execution failed: {e}", exc_info=True)
+                db_error_message = str(e)
+                log_entry["status"] = "Execution Error"
+                log_entry["error"] = db_error_message
+                if attempt_tier:
+                    record_attempt_outcome(attempt_tier, success=False)
+                AGENT_CORRECTIONS.inc(reason=classify_execution_error(db_error_message))
+                result["message"] = f"Final SQL execution failed: {db_error_message}"
+                if attempt < max_retries:
+                    emit("status", level="warning", message=f"Attempt {attempt_num}: SQL execution failed: {db_error_message}. The agent will try to correct it. Retrying...")
+                    ctx.sleep(1) # Brief pause
+                continue
+            log_entry["status"] = "Executed Successfully"
+            logger.info(f"Attempt {attempt_num} SQL executed. Result shape: {df_results.shape}")
+
+            # --- Step 4: Verify Data Structure ---
+            emit("status", level="info", message=f"Verifying data structure (Attempt {attempt_num})...")
+            emit("progress", value=progress_value_llm_start + int(20 / max_attempts), text=f"Agent: Verifying data (Attempt {attempt_num})")
+            with self._timed(result, "verification", attempt=attempt_num, rows=len(df_results)):
+                result_profile = profile_result(df_results)
+                data_structure_ok = verify_data_structure(df_results, profile=result_profile)
+                set_span_attributes(ok=data_structure_ok)
+            if attempt_tier:
+                record_attempt_outcome(attempt_tier, success=data_structure_ok)
+            result["results"] = df_results
+
+            if data_structure_ok:
+                logger.info(f"Attempt {attempt_num}: Data structure verified successfully.")
+                log_entry["status"] = "Success & Verified"
+                log_entry["data_preview"] = df_results.head(config.MAX_DF_PREVIEW_ROWS).to_markdown(index=False)
+                result["status"] = STATUS_SUCCESS
+                result["message"] = "Query successful and data structure looks good!"
+                emit("results", rows=df_results)
+                if explain:
+                    emit("status", level="info", message="Getting SQL explanation from LLM...")
+                    with self._timed(result, "explanation", attempt=attempt_num):
+                        result["explanation"] = explain_sql_query(current_sql_query, ctx=ctx)
+                    log_entry["explanation"] = result["explanation"]
+                emit("status", level="success", message="✅ Query successful and data structure looks good!")
+                emit("progress", value=100, text="Completed!")
+                return
+
+            logger.warning(f"Attempt {attempt_num}: Data structure verification failed.")
+            log_entry["status"] = "Executed, Data Structure Issue"
+            if df_results.empty:
+                AGENT_CORRECTIONS.inc(reason="empty_result")
+            elif result_profile["unusable_columns"]:
+                AGENT_CORRECTIONS.inc(reason="sentinel_result")
+            else:
+                AGENT_CORRECTIONS.inc(reason="verification_failure")
+            log_entry["error"] = "Returned data structure seems invalid, empty, like an error message, or without usable values."
+            # The LLM gets the compact column profile instead of a text dump of the rows.
+            last_failed_data_sample = format_result_profile(result_profile)
+            log_entry["data_preview"] = last_failed_data_sample
+            result["message"] = "Data structure issue: the returned data seems invalid, empty, like an error message, or holds only NULL/sentinel values."
+            if attempt < max_retries:
+                emit("status", level="warning", message=f"⚠️ Data structure verification failed for attempt {attempt_num}. The agent will try to correct the SQL. Retrying...")
+                ctx.sleep(1) # Brief pause for user to see message
+
+        logger.error(f"Max retries reached: {result['message']}")
+        result["message"] = f"Max retries reached. {result['message']}".strip()
+        emit("progress", value=100, text="Processing complete.")
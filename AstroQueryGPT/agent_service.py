@@ -0,0 +1,550 @@
+"""
+Headless HTTP service for the agent engine.
+
+Exposes `agent.Agent` as a small ASGI application, so clients other than the
+Streamlit app can use it. Run it with any ASGI server, e.g.
+`uvicorn agent_service:app` or `python agent_service.py`:
+
+- POST /v1/queries: submits a question. Returns 202 with the queued job, or 200
+  with the finished job if the body has `"wait": true`.
+- GET /v1/queries/{job_id}: polls a job's status and result.
+- GET /v1/queries/{job_id}/trace?format=otlp: the finished job's tracing spans
+  (`{"trace_id": ..., "spans": [...]}`, or OTLP/JSON with `format=otlp`).
+- DELETE /v1/queries/{job_id}: cancels a queued or running job.
+- POST /v1/extracts: submits a long-running SQL extract as a CasJobs-style job
+  (`{"sql": ...}`); GET /v1/extracts/{job_id} polls it, DELETE cancels it and
+  GET /v1/extracts/{job_id}/rows?after=<cursor>&limit=<n> reads its rows in chunks.
+- GET /health: worker pool, queue, SkyServer scheduler, endpoint (circuit breaker) and local replica status.
+- GET /metrics: the process's `metrics` in the Prometheus text format (the only non-JSON response).
+
+Questions are processed by a fixed pool of worker threads fed from a bounded
+queue; when the queue is full, submissions are rejected with 503 and a
+`Retry-After` hint. Responses are JSON and carry the agent's per-attempt log.
+"""
+import re
+import json
+import time
+import queue
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import pandas as pd
+import requests
+
+import config
+from agent import Agent, STATUS_FAILED
+from request_context import RequestContext, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from skyserver_scheduler import get_scheduler_stats
+from sdss_db import get_endpoint_stats
+from local_replica import get_replica_stats
+from query_jobs import QueryJobManager, JobNotReady, get_query_job_manager
+from tracing import spans_to_otlp
+from metrics import PROMETHEUS_CONTENT_TYPE, render_metrics
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+
+MAX_REQUEST_BODY_BYTES = 64 * 1024
+"""Largest accepted request body."""
+
+_JOB_PATH_RE = re.compile(r"^/v1/queries/(?P<job_id>[A-Za-z0-9_-]+)(?P<trace>/trace)?/?$")
+_EXTRACT_PATH_RE = re.compile(r"^/v1/extracts/(?P<job_id>[A-Za-z0-9_-]+)(?P<rows>/rows)?/?$")
+
+
+class QueueFull(Exception):
+    """Raised when the job queue has no room for another question."""
+
+
+class JobManager:
+    """
+    Bounded job queue and worker pool that runs questions through an `Agent`.
+
+    Jobs are plain dicts; finished jobs are kept for `job_ttl_s` seconds so clients can poll them.
+    """
+
+    def __init__(
+        self,
+        agent: Agent,
+        workers: int = config.AGENT_SERVICE_WORKERS,
+        queue_size: int = config.AGENT_SERVICE_QUEUE_SIZE,
+        job_ttl_s: float = config.AGENT_SERVICE_JOB_TTL_S,
+    ):
+        """
+        Args:
+            agent: The agent engine shared by all workers.
+            workers: Number of questions processed concurrently.
+            queue_size: Maximum number of questions waiting for a worker.
+            job_ttl_s: Seconds a finished job is kept.
+        """
+        self.agent = agent
+        self.workers = workers
+        self.job_ttl_s = job_ttl_s
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=queue_size)
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        """Starts the worker threads (once)."""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"agent-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Agent service started {self.workers} worker(s), queue size {self._queue.maxsize}.")
+
+    def shutdown(self) -> None:
+        """Cancels unfinished jobs and stops the workers after their current job."""
+        with self._lock:
+            for job in self._jobs.values():
+                if job["status"] != JOB_DONE:
+                    job["ctx"].cancel("service shutting down")
+        for _ in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+    def submit(
+        self,
+        question: str,
+        top_n_results: int,
+        max_retries: int,
+        timeout_s: float,
+        user_id: Optional[str] = None,
+        priority: str = PRIORITY_INTERACTIVE,
+    ) -> Dict[str, Any]:
+        """
+        Queues a question.
+
+        Args:
+            question: The natural language question.
+            top_n_results: The TOP N the query must return.
+            max_retries: Maximum number of correction attempts.
+            timeout_s: Time budget in seconds, counted from submission (queue time included).
+            user_id: The user to charge SkyServer queries to for fair scheduling.
+            priority: PRIORITY_INTERACTIVE, or PRIORITY_BULK for batch clients.
+
+        Returns:
+            The new job.
+
+        Raises:
+            QueueFull: If the queue has no room for the job.
+        """
+        self._prune()
+        ctx = RequestContext(timeout_s=timeout_s, user_id=user_id, priority=priority)
+        job = {
+            "job_id": ctx.request_id, "status": JOB_QUEUED, "question": question,
+            "top_n": top_n_results, "max_retries": max_retries, "submitted_at": time.time(),
+            "started_at": None, "finished_at": None, "result": None,
+            "ctx": ctx, "done": threading.Event(),
+        }
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job["job_id"]]
+            raise QueueFull(f"The agent queue is full ({self._queue.maxsize} questions waiting).")
+        logger.info(f"Job {job['job_id']} queued: '{question[:50]}...' (TOP {top_n_results}).")
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Returns a job, or None if it is unknown or expired."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Cancels a job. A queued job finishes as cancelled as soon as a worker picks it up."""
+        job = self.get(job_id)
+        if job is not None and job["status"] != JOB_DONE:
+            job["ctx"].cancel("cancelled by client")
+        return job
+
+    def get_stats(self) -> Dict[str, int]:
+        """Returns the number of workers and of queued, running and retained jobs."""
+        with self._lock:
+            statuses = [job["status"] for job in self._jobs.values()]
+        return {
+            "workers": len(self._threads),
+            "queued": statuses.count(JOB_QUEUED),
+            "running": statuses.count(JOB_RUNNING),
+            "jobs": len(statuses),
+        }
+
+    def _prune(self) -> None:
+        """Drops finished jobs older than the TTL."""
+        cutoff = time.time() - self.job_ttl_s
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items() if job["finished_at"] and job["finished_at"] < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def _worker_loop(self) -> None:
+        """Runs queued jobs until a `None` sentinel is received."""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job["status"] = JOB_RUNNING
+            job["started_at"] = time.time()
+            try:
+                job["result"] = self.agent.run(
+                    job["question"], job["top_n"], job["max_retries"], ctx=job["ctx"]
+                )
+            except Exception as e:
+                logger.error(f"Job {job['job_id']} failed unexpectedly: {e}", exc_info=True)
+                job["result"] = {"status": STATUS_FAILED, "message": f"Internal error: {e}", "attempts": []}
+            job["finished_at"] = time.time()
+            job["status"] = JOB_DONE
+            job["done"].set()
+
+
+def _frame_to_json(df: Optional[pd.DataFrame]) -> Optional[Dict[str, Any]]:
+    """Renders a DataFrame as `{"columns": [...], "data": [[...], ...]}` (NaN becomes null)."""
+    if df is None:
+        return None
+    return json.loads(df.to_json(orient="split", index=False))
+
+
+def job_to_json(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Renders a job as a JSON-serializable dict.
+
+    Args:
+        job: A job from `JobManager`.
+
+    Returns:
+        The job's id, status, request, timings and, once done, the agent result with its per-attempt log.
+    """
+    payload = {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "question": job["question"],
+        "top_n": job["top_n"],
+        "max_retries": job["max_retries"],
+        "queue_wait_ms": (job["started_at"] - job["submitted_at"]) * 1000 if job["started_at"] else None,
+        "result": None,
+    }
+    result = job["result"]
+    if result is not None:
+        payload["result"] = {
+            "status": result["status"],
+            "message": result.get("message"),
+            "sql": result.get("sql"),
+            "explanation": result.get("explanation"),
+            "results": _frame_to_json(result.get("results")),
+            "partial_results": _frame_to_json(result.get("partial_results")),
+            "attempts": result.get("attempts", []),
+            "rag_tables": [
+                {"name": table.get("name"), "score": round(float(score), 4)} for table, score in result.get("rag_tables", [])
+            ],
+            "prompt_tokens": result.get("prompt_tokens"),
+            "elapsed_ms": result.get("elapsed_ms"),
+            "stage_ms": result.get("stage_ms"),
+            "profile": result.get("profile"), # Set when the service runs with ENABLE_PROFILING.
+        }
+    return payload
+
+
+def trace_to_json(spans: List[Dict[str, Any]], export_format: str = "jsonl") -> Dict[str, Any]:
+    """
+    Renders a job's tracing spans.
+
+    Args:
+        spans: The result's 'trace'.
+        export_format: "otlp" for an OTLP/JSON export request; otherwise the span dicts.
+
+    Returns:
+        The OTLP/JSON payload, or `{"trace_id": ..., "spans": [...]}`.
+    """
+    if export_format == "otlp":
+        return spans_to_otlp(spans)
+    return {"trace_id": spans[0]["trace_id"] if spans else None, "spans": json.loads(json.dumps(spans, default=str))}
+
+
+def extract_job_to_json(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Renders a query job record from `query_jobs` as a JSON-serializable dict."""
+    return {
+        "job_id": job["job_id"],
+        "status": job["state"],
+        "message": job["message"],
+        "sql": job["sql"],
+        "submitted_at": job["submitted_at"],
+        "finished_at": job["finished_at"],
+        "polls": job["polls"],
+    }
+
+
+def parse_submission(body: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Validates a POST /v1/queries body.
+
+    Args:
+        body: The decoded JSON body: `question` (required), and optional `top_n`,
+            `max_retries`, `timeout_s`, `user_id`, `priority` and `wait`.
+
+    Returns:
+        The validated submission with defaults filled in.
+
+    Raises:
+        ValueError: If a field is missing or out of range.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Request body must be a JSON object.")
+    question = body.get("question")
+    if not isinstance(question, str) or not question.strip():
+        raise ValueError("'question' must be a non-empty string.")
+    top_n = body.get("top_n", config.DEFAULT_TOP_N_RESULTS)
+    if not isinstance(top_n, int) or isinstance(top_n, bool) or not 1 <= top_n <= config.MAX_QUERY_RESULTS_LIMIT:
+        raise ValueError(f"'top_n' must be an integer between 1 and {config.MAX_QUERY_RESULTS_LIMIT}.")
+    max_retries = body.get("max_retries", config.MAX_AGENT_RETRIES)
+    if not isinstance(max_retries, int) or isinstance(max_retries, bool) or not 0 <= max_retries <= 5:
+        raise ValueError("'max_retries' must be an integer between 0 and 5.")
+    timeout_s = body.get("timeout_s", config.REQUEST_DEADLINE_S)
+    if not isinstance(timeout_s, (int, float)) or isinstance(timeout_s, bool) or not 0 < timeout_s <= config.REQUEST_DEADLINE_S:
+        raise ValueError(f"'timeout_s' must be a number between 0 and {config.REQUEST_DEADLINE_S:.0f}.")
+    user_id = body.get("user_id")
+    if user_id is not None and (not isinstance(user_id, str) or not 0 < len(user_id) <= 64):
+        raise ValueError("'user_id' must be a string of 1 to 64 characters.")
+    priority = body.get("priority", PRIORITY_INTERACTIVE)
+    if priority not in (PRIORITY_INTERACTIVE, PRIORITY_BULK):
+        raise ValueError(f"'priority' must be '{PRIORITY_INTERACTIVE}' or '{PRIORITY_BULK}'.")
+    return {
+        "question": question.strip(), "top_n_results": top_n, "max_retries": max_retries,
+        "timeout_s": float(timeout_s), "user_id": user_id, "priority": priority,
+        "wait": bool(body.get("wait", False)),
+    }
+
+
+class AgentService:
+    """
+    ASGI application serving the agent over HTTP.
+
+    Without an explicit `manager`, the RAG schema is loaded and the worker pool is
+    started on ASGI lifespan startup (or on the first request if the server does
+    not send lifespan events).
+    """
+
+    def __init__(self, manager: Optional[JobManager] = None, extract_jobs: Optional[QueryJobManager] = None):
+        """
+        Args:
+            manager: The job manager to serve. Created on startup if not given.
+            extract_jobs: The query job manager for /v1/extracts. Defaults to
+                `query_jobs.get_query_job_manager()` (None if CasJobs is not configured).
+        """
+        self.manager = manager
+        self.extract_jobs = extract_jobs
+        self._init_lock = threading.Lock()
+
+    def _ensure_manager(self) -> JobManager:
+        """Creates and starts the job manager on first use."""
+        with self._init_lock:
+            if self.manager is None:
+                from rag_core import initialize_rag_schema
+                initialize_rag_schema()
+                self.manager = JobManager(Agent())
+            self.manager.start()
+            return self.manager
+
+    async def __call__(self, scope: Dict[str, Any], receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            if scope["path"] == "/metrics" and scope["method"] == "GET":
+                await _send_body(send, 200, render_metrics().encode("utf-8"), PROMETHEUS_CONTENT_TYPE, [])
+                return
+            status, payload, headers = await self._handle(scope, receive)
+            await _send_json(send, status, payload, headers)
+
+    async def _lifespan(self, receive, send) -> None:
+        """Handles ASGI lifespan startup/shutdown."""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await asyncio.to_thread(self._ensure_manager)
+                except Exception as e:
+                    logger.critical(f"Agent service failed to start: {e}", exc_info=True)
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.manager is not None:
+                    self.manager.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _handle(self, scope: Dict[str, Any], receive) -> Tuple[int, Dict[str, Any], List[Tuple[bytes, bytes]]]:
+        """Routes a request. Returns the status code, the JSON payload and extra headers."""
+        method, path = scope["method"], scope["path"]
+        manager = self.manager or await asyncio.to_thread(self._ensure_manager)
+
+        if path == "/health" and method == "GET":
+            skyserver = get_scheduler_stats()
+            skyserver.pop("users") # Per-user counts can be large; totals are enough for health checks.
+            stats = {
+                **manager.get_stats(),
+                "coalesced_questions": manager.agent.get_coalescing_stats()["coalesced"],
+                "skyserver": skyserver,
+                "skyserver_endpoints": get_endpoint_stats(),
+                "local_replica": get_replica_stats(),
+            }
+            return 200, {"status": "ok", **stats}, []
+
+        if path.rstrip("/") == "/v1/queries":
+            if method != "POST":
+                return 405, {"error": "Method not allowed."}, []
+            try:
+                submission = parse_submission(json.loads(await _read_body(receive)))
+            except (ValueError, UnicodeDecodeError) as e: # json.JSONDecodeError is a ValueError
+                return 400, {"error": str(e)}, []
+            try:
+                job = manager.submit(
+                    submission["question"], submission["top_n_results"],
+                    submission["max_retries"], submission["timeout_s"],
+                    # Without an explicit user, fair-share by client address.
+                    user_id=submission["user_id"] or (scope.get("client") or ("anonymous",))[0],
+                    priority=submission["priority"],
+                )
+            except QueueFull as e:
+                return 503, {"error": str(e)}, [(b"retry-after", b"5")]
+            if not submission["wait"]:
+                return 202, job_to_json(job), [(b"location", f"/v1/queries/{job['job_id']}".encode())]
+            await asyncio.to_thread(job["done"].wait) # Bounded by the job's own deadline.
+            return 200, job_to_json(job), []
+
+        if path.startswith("/v1/extracts"):
+            return await self._handle_extract(scope, receive, method, path)
+
+        match = _JOB_PATH_RE.match(path)
+        if match and match.group("trace"):
+            if method != "GET":
+                return 405, {"error": "Method not allowed."}, []
+            job = manager.get(match.group("job_id"))
+            if job is None:
+                return 404, {"error": "Unknown or expired job."}, []
+            if job["result"] is None:
+                return 409, {"error": "The job has not finished yet."}, []
+            export_format = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("format", ["jsonl"])[0]
+            return 200, trace_to_json(job["result"].get("trace", []), export_format), []
+        if match:
+            if method == "GET":
+                job = manager.get(match.group("job_id"))
+            elif method == "DELETE":
+                job = manager.cancel(match.group("job_id"))
+            else:
+                return 405, {"error": "Method not allowed."}, []
+            if job is None:
+                return 404, {"error": "Unknown or expired job."}, []
+            return 200, job_to_json(job), []
+
+        return 404, {"error": "Not found."}, []
+
+
+    async def _handle_extract(
+        self, scope: Dict[str, Any], receive, method: str, path: str
+    ) -> Tuple[int, Dict[str, Any], List[Tuple[bytes, bytes]]]:
+        """Routes /v1/extracts requests to the query job manager."""
+        jobs = self.extract_jobs or await asyncio.to_thread(get_query_job_manager)
+        if jobs is None:
+            return 503, {"error": "Query jobs are not configured (set CASJOBS_TOKEN)."}, []
+
+        if path.rstrip("/") == "/v1/extracts":
+            if method != "POST":
+                return 405, {"error": "Method not allowed."}, []
+            try:
+                body = json.loads(await _read_body(receive))
+                sql = body.get("sql") if isinstance(body, dict) else None
+                if not isinstance(sql, str) or not sql.strip():
+                    raise ValueError("'sql' must be a non-empty string.")
+                user_id = body.get("user_id") or (scope.get("client") or ("anonymous",))[0]
+                job = await asyncio.to_thread(jobs.submit, sql.strip(), user_id)
+            except (ValueError, UnicodeDecodeError) as e:
+                return 400, {"error": str(e)}, []
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Submitting query job failed: {e}")
+                return 502, {"error": f"The job service rejected the submission: {e}"}, []
+            return 202, extract_job_to_json(job), [(b"location", f"/v1/extracts/{job['job_id']}".encode())]
+
+        match = _EXTRACT_PATH_RE.match(path)
+        if not match:
+            return 404, {"error": "Not found."}, []
+        job_id = match.group("job_id")
+        if match.group("rows"):
+            if method != "GET":
+                return 405, {"error": "Method not allowed."}, []
+            query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+            try:
+                after = int(query.get("after", ["0"])[0])
+                limit = int(query.get("limit", [str(config.QUERY_JOB_CHUNK_ROWS)])[0])
+                if after < 0 or not 1 <= limit <= config.QUERY_JOB_CHUNK_ROWS:
+                    raise ValueError
+            except ValueError:
+                return 400, {"error": f"'after' must be >= 0 and 'limit' between 1 and {config.QUERY_JOB_CHUNK_ROWS}."}, []
+            try:
+                chunk, next_after = await asyncio.to_thread(jobs.fetch_chunk, job_id, after, limit)
+            except KeyError:
+                return 404, {"error": "Unknown or expired job."}, []
+            except JobNotReady as e:
+                return 409, {"error": str(e)}, []
+            return 200, {"rows": _frame_to_json(chunk), "next_after": next_after, "done": len(chunk) < limit}, []
+
+        if method == "GET":
+            job = jobs.get(job_id)
+        elif method == "DELETE":
+            job = await asyncio.to_thread(jobs.cancel, job_id)
+        else:
+            return 405, {"error": "Method not allowed."}, []
+        if job is None:
+            return 404, {"error": "Unknown or expired job."}, []
+        return 200, extract_job_to_json(job), []
+
+
+async def _read_body(receive) -> str:
+    """Reads the full HTTP request body."""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_REQUEST_BODY_BYTES:
+            raise ValueError("Request body too large.")
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks).decode("utf-8")
+
+
+async def _send_json(send, status: int, payload: Dict[str, Any], headers: List[Tuple[bytes, bytes]]) -> None:
+    """Sends a JSON response."""
+    await _send_body(send, status, json.dumps(payload, default=str).encode("utf-8"), "application/json", headers)
+
+
+async def _send_body(send, status: int, body: bytes, content_type: str, headers: List[Tuple[bytes, bytes]]) -> None:
+    """Sends a response with the given body and content type."""
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+app = AgentService()
+"""The ASGI application, e.g. `uvicorn agent_service:app`."""
+
+
+if __name__ == "__main__":
+    from log_utils import configure_logging
+    configure_logging(logging.INFO) # LOG_MODE=async writes logs from a listener thread.
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("Running the agent service requires an ASGI server: pip install uvicorn")
+    uvicorn.run(app, host=config.AGENT_SERVICE_HOST, port=config.AGENT_SERVICE_PORT)
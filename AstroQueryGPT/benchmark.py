@@ -0,0 +1,398 @@
+"""
+End-to-end latency benchmark of the agent pipeline against local stand-ins.
+
+Starts a `benchmark_stubs.StubLLMServer` (canned SQL, configurable latency) and a
+`benchmark_stubs.StubSkyServer` (CSV fixtures), points the agent at them and drives
+a fixed question set (`benchmarks/questions.json`) through `Agent.run`:
+retrieval -> prompt -> generation -> validation -> execution -> verification -> explanation.
+
+The report is JSON with per-stage p50/p95/p99 latencies (from each result's
+'stage_ms'), total latency, throughput and peak RSS, so runs on different commits
+can be compared:
+
+    python benchmark.py --iterations 5 --concurrency 4 --output before.json
+    python benchmark.py --iterations 5 --concurrency 4 --baseline before.json
+
+`--log-mode sync|async`, `--log-level` and `--log-file` run the pipeline under a given
+logging setup (see `log_utils`), and `--logging-overhead` adds a micro-benchmark of
+the logging call patterns used on the request path (`measure_logging_overhead`).
+
+Retrieval uses the real embedding model, which must be available locally (it is
+downloaded on first use). Both stubs run in the benchmark process, so the peak RSS
+includes their (small) footprint.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import queue
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import resource
+except ImportError: # Not available on Windows.
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+"""Directory of the question set and its fixtures."""
+
+DEFAULT_QUESTIONS_PATH = os.path.join(BENCHMARK_DIR, "questions.json")
+"""The fixed question set: fixture tables plus questions with their canned SQL answers."""
+
+REPORT_PERCENTILES = (50, 95, 99)
+"""Percentiles reported for each stage."""
+
+LOGGING_OVERHEAD_ITERATIONS = 2000
+"""Calls per scenario in the logging overhead micro-benchmark."""
+
+SLOW_LOG_SINK_DELAY_S = 0.001
+"""Per-record write latency of the simulated slow log sink (a busy terminal or a network log shipper)."""
+
+
+def load_question_set(path: str = DEFAULT_QUESTIONS_PATH) -> Dict[str, Any]:
+    """
+    Loads a question set.
+
+    The file holds 'tables' (SDSS table name -> CSV fixture, relative to the file) and
+    'questions', each with 'question', 'top_n' and 'sql' (the canned answers, one per attempt).
+
+    Returns:
+        The question set with fixture paths made absolute.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        question_set = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    question_set["tables"] = {
+        table_name: os.path.join(base_dir, fixture) for table_name, fixture in question_set["tables"].items()
+    }
+    return question_set
+
+
+def percentile_summary(values_ms: List[float]) -> Dict[str, float]:
+    """Summarizes latencies: count, mean and the `REPORT_PERCENTILES`, in milliseconds."""
+    if not values_ms:
+        return {"count": 0}
+    summary = {"count": len(values_ms), "mean_ms": round(float(np.mean(values_ms)), 2)}
+    for percentile, value in zip(REPORT_PERCENTILES, np.percentile(values_ms, REPORT_PERCENTILES)):
+        summary[f"p{percentile}_ms"] = round(float(value), 2)
+    return summary
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Returns the peak resident set size of this process in MiB, or None if unavailable."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return round(max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize_runs(runs: List[Dict[str, Any]], wall_s: float, stage_order: Sequence[str] = ()) -> Dict[str, Any]:
+    """
+    Aggregates benchmark runs.
+
+    Args:
+        runs: One entry per `Agent.run` with 'question', 'status', 'message', 'elapsed_ms' and 'stage_ms'.
+        wall_s: Wall-clock time of all runs.
+        stage_order: Stages to list first, in pipeline order (e.g. `agent.AGENT_STAGES`).
+
+    Returns:
+        'runs', 'wall_s', 'throughput_qps', 'status_counts', 'stages' (per-stage latency
+        summaries, plus 'total' for whole runs) and 'failures' (distinct failure messages per question).
+    """
+    stage_values: Dict[str, List[float]] = {}
+    status_counts: Dict[str, int] = {}
+    failures: Dict[str, List[str]] = {}
+    for run in runs:
+        status_counts[run["status"]] = status_counts.get(run["status"], 0) + 1
+        for stage, elapsed_ms in (run.get("stage_ms") or {}).items():
+            stage_values.setdefault(stage, []).append(elapsed_ms)
+        if run.get("elapsed_ms") is not None:
+            stage_values.setdefault("total", []).append(run["elapsed_ms"])
+        if run["status"] != "success":
+            messages = failures.setdefault(run["question"], [])
+            if run.get("message") not in messages:
+                messages.append(run.get("message"))
+    ordered_stages = [stage for stage in stage_order if stage in stage_values]
+    ordered_stages += sorted(stage for stage in stage_values if stage not in ordered_stages and stage != "total")
+    if "total" in stage_values:
+        ordered_stages.append("total")
+    return {
+        "runs": len(runs),
+        "wall_s": round(wall_s, 3),
+        "throughput_qps": round(len(runs) / wall_s, 3) if wall_s > 0 else None,
+        "status_counts": status_counts,
+        "stages": {stage: percentile_summary(stage_values[stage]) for stage in ordered_stages},
+        "failures": failures,
+    }
+
+
+def compare_reports(report: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compares a report with a baseline report (e.g. from the previous commit).
+
+    Returns:
+        The baseline's commit, and the relative change in percent of each stage percentile
+        and of the throughput (positive means slower stages / higher throughput).
+    """
+    def change(new: Optional[float], old: Optional[float]) -> Optional[float]:
+        return round((new - old) / old * 100, 1) if new is not None and old else None
+
+    stages = {}
+    for stage, summary in report["stages"].items():
+        old_summary = baseline.get("stages", {}).get(stage, {})
+        stages[stage] = {
+            f"p{percentile}_change_pct": change(summary.get(f"p{percentile}_ms"), old_summary.get(f"p{percentile}_ms"))
+            for percentile in REPORT_PERCENTILES
+        }
+    return {
+        "baseline_commit": baseline.get("commit"),
+        "stages": stages,
+        "throughput_change_pct": change(report.get("throughput_qps"), baseline.get("throughput_qps")),
+    }
+
+
+def measure_logging_overhead(iterations: int = LOGGING_OVERHEAD_ITERATIONS) -> Dict[str, float]:
+    """
+    Measures the request-thread cost of logging call patterns, in microseconds per call.
+
+    A dedicated logger at INFO writes to a temporary file, with a prompt-sized message
+    list and a 20-column DataFrame as payloads. Scenarios:
+    - 'debug_off_eager_fstring' / 'debug_off_lazy_payload': a DEBUG record (disabled)
+      built as an f-string versus with `log_payload`.
+    - 'info_eager_dataframe_head' / 'debug_off_lazy_dataframe_head': the DataFrame
+      preview of `verify_data_structure`, formatted eagerly at INFO (as it used to be)
+      versus as a `log_payload` at DEBUG (disabled).
+    - 'info_sync' / 'info_async': a short INFO record written by a file handler on the
+      calling thread versus queued for a listener thread (`log_utils` 'async' mode).
+    - 'info_sync_slow_sink' / 'info_async_slow_sink': the same with a sink that takes
+      `SLOW_LOG_SINK_DELAY_S` per record.
+
+    Returns:
+        Microseconds per call for each scenario.
+    """
+    import pandas as pd
+    from log_utils import LOG_FORMAT, log_payload
+
+    messages = [
+        {"role": "system", "content": "You write T-SQL for SDSS SkyServer. " * 40},
+        {"role": "user", "content": "PhotoObj: objID, ra, dec, u, g, r, i, z, type, clean. " * 60},
+    ]
+    frame = pd.DataFrame(np.random.default_rng(0).random((50, 20)), columns=[f"col{i}" for i in range(20)])
+    bench_logger = logging.getLogger("benchmark.logging_overhead")
+    bench_logger.propagate = False
+    bench_logger.setLevel(logging.INFO)
+
+    def per_call_us(fn: Any, calls: int = iterations) -> float:
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        return round((time.perf_counter() - start) / calls * 1e6, 3)
+
+    def log_short() -> None:
+        bench_logger.info("Attempt %d SQL executed. Result shape: %s", 1, frame.shape)
+
+    class SlowSink(logging.Handler):
+        def emit(self, record: logging.LogRecord) -> None:
+            self.format(record)
+            time.sleep(SLOW_LOG_SINK_DELAY_S)
+
+    def compare_modes(sink: logging.Handler, calls: int) -> Tuple[float, float]:
+        """Returns the per-call cost of `log_short` with `sink` called directly and through a queue."""
+        bench_logger.addHandler(sink)
+        try:
+            sync_us = per_call_us(log_short, calls)
+        finally:
+            bench_logger.removeHandler(sink)
+        log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        listener = QueueListener(log_queue, sink)
+        queue_handler = QueueHandler(log_queue)
+        bench_logger.addHandler(queue_handler)
+        listener.start()
+        try:
+            async_us = per_call_us(log_short, calls)
+        finally:
+            bench_logger.removeHandler(queue_handler)
+            listener.stop()
+        return sync_us, async_us
+
+    slow_calls = max(1, iterations // 20) # For scenarios that take milliseconds per call
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_handler = logging.FileHandler(os.path.join(tmp_dir, "overhead.log"), encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        bench_logger.addHandler(file_handler)
+        try:
+            results["debug_off_eager_fstring"] = per_call_us(lambda: bench_logger.debug(f"LLM API call messages: {messages}"))
+            results["debug_off_lazy_payload"] = per_call_us(lambda: bench_logger.debug("LLM API call messages: %s", log_payload(messages)))
+            results["info_eager_dataframe_head"] = per_call_us(
+                lambda: bench_logger.info(f"Verifying data structure. Shape: {frame.shape}, Head:\n{frame.head().to_string()}"),
+                slow_calls,
+            )
+            results["debug_off_lazy_dataframe_head"] = per_call_us(
+                lambda: bench_logger.debug("Data to verify (head):\n%s", log_payload(frame, render=lambda df: df.head().to_string()))
+            )
+        finally:
+            bench_logger.removeHandler(file_handler)
+        results["info_sync"], results["info_async"] = compare_modes(file_handler, iterations)
+        file_handler.close()
+    results["info_sync_slow_sink"], results["info_async_slow_sink"] = compare_modes(SlowSink(), slow_calls)
+    return results
+
+
+def run_benchmark(
+    agent: Any, questions: List[Dict[str, Any]], iterations: int = 1, concurrency: int = 1, explain: bool = True,
+) -> Tuple[List[Dict[str, Any]], float]:
+    """
+    Runs every question `iterations` times through the agent.
+
+    Args:
+        agent: The `agent.Agent` to benchmark.
+        questions: Question entries with 'question' and 'top_n'.
+        iterations: Passes over the question set.
+        concurrency: Questions run at the same time.
+        explain: Whether runs request an explanation (one more LLM call per success).
+
+    Returns:
+        The runs (see `summarize_runs`) and the wall-clock time in seconds.
+    """
+    def run_one(entry: Dict[str, Any]) -> Dict[str, Any]:
+        result = agent.run(entry["question"], top_n_results=entry["top_n"], explain=explain)
+        return {
+            "question": entry["question"],
+            "status": result["status"],
+            "message": result["message"],
+            "elapsed_ms": result["elapsed_ms"],
+            "stage_ms": result["stage_ms"],
+            "attempts": len(result["attempts"]),
+        }
+
+    workload = [entry for _ in range(iterations) for entry in questions]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="benchmark") as executor:
+        runs = list(executor.map(run_one, workload))
+    return runs, time.perf_counter() - start
+
+
+def _git_commit() -> Optional[str]:
+    """Returns the current git commit of the checkout, or None outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Runs the benchmark from the command line and writes the JSON report."""
+    import argparse
+
+    from benchmark_stubs import StubLLMServer, StubSkyServer
+
+    parser = argparse.ArgumentParser(description="End-to-end latency benchmark of the agent with local LLM and SkyServer stubs.")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS_PATH, help="Question set JSON (default: benchmarks/questions.json).")
+    parser.add_argument("--iterations", type=int, default=3, help="Measured passes over the question set.")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured passes first (loads the embedding model and schema).")
+    parser.add_argument("--concurrency", type=int, default=1, help="Questions run at the same time.")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Stub LLM latency per call (seconds).")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="Maximum extra stub LLM latency (seconds).")
+    parser.add_argument("--skyserver-latency", type=float, default=0.3, help="Stub SkyServer latency per query (seconds).")
+    parser.add_argument("--skyserver-jitter", type=float, default=0.1, help="Maximum extra stub SkyServer latency (seconds).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the stub latency jitter.")
+    parser.add_argument("--no-explain", action="store_true", help="Skip the explanation stage.")
+    parser.add_argument("--baseline", help="Earlier report to compare with.")
+    parser.add_argument("--output", help="Write the report to this file instead of stdout.")
+    parser.add_argument("--log-level", default="WARNING", help="Logging level (default: WARNING).")
+    parser.add_argument("--log-mode", choices=("sync", "async"), default="sync", help="Write logs on the request thread or from a listener thread.")
+    parser.add_argument("--log-file", help="Write logs to this file instead of stderr.")
+    parser.add_argument("--logging-overhead", action="store_true", help="Add a micro-benchmark of logging call patterns to the report.")
+    args = parser.parse_args(argv)
+    from log_utils import LOG_FORMAT, configure_logging
+    handler = None
+    if args.log_file:
+        handler = logging.FileHandler(args.log_file, encoding="utf-8")
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    configure_logging(args.log_level, mode=args.log_mode, handler=handler, force=True)
+
+    question_set = load_question_set(args.questions)
+    llm = StubLLMServer(
+        {entry["question"]: entry["sql"] for entry in question_set["questions"]},
+        latency_s=args.llm_latency, jitter_s=args.llm_jitter, seed=args.seed,
+    )
+    skyserver = StubSkyServer(
+        question_set["tables"], latency_s=args.skyserver_latency, jitter_s=args.skyserver_jitter, seed=args.seed,
+    )
+    # The agent modules read these at import: point them at the stubs, keep queries off the
+    # local replica, and let the SkyServer scheduler run without throttling the benchmark.
+    os.environ["OPENAI_BASE_URL"] = llm.url
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["SKYSERVER_URLS"] = skyserver.url
+    os.environ["ENABLE_LOCAL_REPLICA"] = "false"
+    os.environ.setdefault("SKYSERVER_RATE_PER_S", "1000")
+    os.environ.setdefault("SKYSERVER_BURST", "1000")
+    from agent import Agent, AGENT_STAGES
+
+    try:
+        agent = Agent()
+        explain = not args.no_explain
+        if args.warmup:
+            run_benchmark(agent, question_set["questions"], args.warmup, args.concurrency, explain)
+        llm_before, skyserver_before = llm.get_stats(), skyserver.get_stats()
+        runs, wall_s = run_benchmark(agent, question_set["questions"], args.iterations, args.concurrency, explain)
+        llm_stats, skyserver_stats = llm.get_stats(), skyserver.get_stats()
+    finally:
+        llm.close()
+        skyserver.close()
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "settings": {
+            "questions": len(question_set["questions"]),
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "llm_latency_s": args.llm_latency,
+            "llm_jitter_s": args.llm_jitter,
+            "skyserver_latency_s": args.skyserver_latency,
+            "skyserver_jitter_s": args.skyserver_jitter,
+            "explain": explain,
+            "log_level": args.log_level.upper(),
+            "log_mode": args.log_mode,
+        },
+        **summarize_runs(runs, wall_s, stage_order=AGENT_STAGES),
+        "llm_requests": llm_stats["requests"] - llm_before["requests"],
+        "skyserver_requests": skyserver_stats["requests"] - skyserver_before["requests"],
+        "skyserver_errors": skyserver_stats["errors"] - skyserver_before["errors"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if args.logging_overhead:
+        report["logging_overhead_us"] = measure_logging_overhead()
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["comparison"] = compare_reports(report, json.load(f))
+
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report_json + "\n")
+        logger.info(f"Benchmark report written to {args.output}.")
+    else:
+        print(report_json)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Local stand-ins for the LLM provider and SkyServer, used by `benchmark`.
+
+- `StubLLMServer` speaks the OpenAI chat completions API. It answers SQL generation
+  prompts with canned SQL for the question found in the prompt (`User's Request: "..."`)
+  and explanation prompts with a fixed text, after a configurable latency.
+- `StubSkyServer` speaks the SkyServer `x_sql.aspx` API. It loads CSV fixtures into an
+  in-memory SQLite database and runs the (translated, see `sql_dialect`) T-SQL on them,
+  so probes, TOP N and keyset pagination behave as on SkyServer. Failing queries
+  get an "Error near ..." text response, like SkyServer syntax errors.
+
+Both run a `ThreadingHTTPServer` on a background thread; `close()` stops them.
+"""
+import re
+import csv
+import json
+import time
+import random
+import sqlite3
+import logging
+import threading
+from io import StringIO
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from sql_dialect import UnsupportedDialect, register_tsql_functions, translate_tsql_to_sqlite
+
+logger = logging.getLogger(__name__)
+
+USER_REQUEST_RE = re.compile(r"User's Request: \"(?P<question>.*?)\"\s*SQL Query:", re.DOTALL)
+"""Finds the user's question in the SQL generation prompt built by `rag_core`."""
+
+EXPLANATION_MARKER = "explain this SDSS SQL query"
+"""Text identifying the explanation prompt of `rag_core.explain_sql_query`."""
+
+DEFAULT_EXPLANATION = "This query selects the requested objects from the SDSS catalog and returns the listed columns."
+"""Canned answer to explanation prompts."""
+
+
+def _normalize_question(question: str) -> str:
+    """Normalizes a question for lookup: lowercase with single spaces."""
+    return " ".join(question.lower().split())
+
+
+class _StubServer:
+    """A `ThreadingHTTPServer` on a background daemon thread with a latency model."""
+
+    def __init__(self, handler_class: type, latency_s: float, jitter_s: float, seed: Optional[int], host: str, port: int):
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"requests": 0, "errors": 0}
+        self.server = ThreadingHTTPServer((host, port), handler_class)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def _sleep(self) -> None:
+        """Simulates the service time: `latency_s` plus a uniform jitter of up to `jitter_s`."""
+        with self._lock:
+            jitter = self._random.uniform(0, self.jitter_s) if self.jitter_s else 0.0
+        time.sleep(self.latency_s + jitter)
+
+    def get_stats(self) -> Dict[str, int]:
+        """Returns a copy of the request counters."""
+        with self._lock:
+            return dict(self.stats)
+
+    def close(self) -> None:
+        """Stops the server and closes its socket."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real services behind the pooled clients.
+
+    def _reply(self, status: int, body: str, content_type: str) -> None:
+        payload = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except OSError:
+            pass # The client gave up (e.g. a cancelled or hedged request).
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+class _LLMHandler(_StubHandler):
+    def do_POST(self) -> None:
+        stub: StubLLMServer = self.server.stub
+        stub._count("requests")
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not urlparse(self.path).path.endswith("/chat/completions"):
+            stub._count("errors")
+            self._reply(404, json.dumps({"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}}), "application/json")
+            return
+        stub._sleep()
+        content = stub.answer(body.get("messages", []))
+        if content is None:
+            stub._count("errors")
+            self._reply(404, json.dumps({"error": {"message": "No canned answer for this prompt.", "type": "invalid_request_error"}}), "application/json")
+            return
+        prompt_chars = sum(len(str(message.get("content", ""))) for message in body.get("messages", []))
+        prompt_tokens, completion_tokens = prompt_chars // 4, len(content) // 4
+        self._reply(200, json.dumps({
+            "id": f"chatcmpl-stub-{stub.stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }), "application/json")
+
+
+class StubLLMServer(_StubServer):
+    """
+    OpenAI-compatible chat completions endpoint with canned SQL answers.
+
+    Attributes:
+        url: The base URL for the OpenAI client (`OPENAI_BASE_URL`), ending in `/v1`.
+    """
+
+    def __init__(
+        self, answers: Dict[str, List[str]], latency_s: float = 0.5, jitter_s: float = 0.0,
+        explanation: str = DEFAULT_EXPLANATION, seed: Optional[int] = None, host: str = "127.0.0.1", port: int = 0,
+    ):
+        """
+        Args:
+            answers: Question -> SQL answers. The n-th answer is returned to the n-th attempt
+                of a run (the number of earlier assistant messages in the prompt), the last one
+                to all later attempts. Questions are matched case- and whitespace-insensitively.
+            latency_s: Time to answer each request.
+            jitter_s: Maximum extra time, drawn uniformly per request.
+            explanation: Answer to explanation prompts.
+            seed: Seed of the jitter, for repeatable runs.
+            host, port: Address to listen on (port 0 picks a free port).
+        """
+        self.answers = {_normalize_question(question): list(sqls) for question, sqls in answers.items()}
+        self.explanation = explanation
+        super().__init__(_LLMHandler, latency_s, jitter_s, seed, host, port)
+        self.url = f"{self.base_url}/v1"
+
+    def answer(self, messages: List[Dict[str, Any]]) -> Optional[str]:
+        """Returns the canned reply to a chat, or None if the prompt is not recognised."""
+        contents = [str(message.get("content", "")) for message in messages]
+        for content in contents:
+            match = USER_REQUEST_RE.search(content)
+            if match:
+                sqls = self.answers.get(_normalize_question(match.group("question")))
+                if not sqls:
+                    return None
+                attempt = sum(1 for message in messages if message.get("role") == "assistant")
+                return f"```sql\n{sqls[min(attempt, len(sqls) - 1)]}\n```"
+        if contents and EXPLANATION_MARKER in contents[-1]:
+            return self.explanation
+        return None
+
+
+class _SkyServerHandler(_StubHandler):
+    def do_GET(self) -> None:
+        stub: StubSkyServer = self.server.stub
+        stub._count("requests")
+        sql_query = parse_qs(urlparse(self.path).query).get("cmd", [""])[0]
+        stub._sleep()
+        try:
+            body = stub.execute(sql_query)
+        except (UnsupportedDialect, sqlite3.Error) as e:
+            stub._count("errors")
+            body = f"Error near line 1: {e}\n"
+        self._reply(200, body, "text/plain")
+
+
+class StubSkyServer(_StubServer):
+    """
+    SkyServer `x_sql.aspx` stand-in that runs queries on CSV fixtures.
+
+    Attributes:
+        url: The query URL (for `SKYSERVER_URLS`).
+    """
+
+    def __init__(
+        self, tables: Dict[str, str], latency_s: float = 0.3, jitter_s: float = 0.0,
+        seed: Optional[int] = None, host: str = "127.0.0.1", port: int = 0,
+    ):
+        """
+        Args:
+            tables: SDSS table name -> CSV fixture with its rows (header row with column names).
+            latency_s: Time to answer each request, on top of running the query.
+            jitter_s: Maximum extra time, drawn uniformly per request.
+            seed: Seed of the jitter, for repeatable runs.
+            host, port: Address to listen on (port 0 picks a free port).
+        """
+        self._connection = sqlite3.connect(":memory:", check_same_thread=False)
+        register_tsql_functions(self._connection)
+        self._db_lock = threading.Lock()
+        for table_name, csv_path in tables.items():
+            pd.read_csv(csv_path).to_sql(table_name, self._connection, index=False)
+            logger.info(f"Stub SkyServer loaded {csv_path} as {table_name}.")
+        super().__init__(_SkyServerHandler, latency_s, jitter_s, seed, host, port)
+        self.url = f"{self.base_url}/x_sql.aspx"
+
+    def execute(self, sql_query: str) -> str:
+        """
+        Runs a T-SQL query on the fixtures.
+
+        Returns:
+            The result as SkyServer CSV (a `#Table1` line, then a header row and the rows).
+
+        Raises:
+            UnsupportedDialect, sqlite3.Error: If the query cannot run on the fixtures.
+        """
+        local_sql = translate_tsql_to_sqlite(sql_query)
+        with self._db_lock:
+            cursor = self._connection.execute(local_sql)
+            rows = cursor.fetchall()
+        out = StringIO()
+        out.write("#Table1\n")
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow([column[0] for column in cursor.description])
+        writer.writerows(rows)
+        return out.getvalue()
+
+    def close(self) -> None:
+        super().close()
+        self._connection.close()
@@ -21,9 +21,120 @@ SCHEMA_FILE_PATH = "sdss_schema_dr16.json"
 LLM_PROVIDER_MODEL = os.getenv("OPENAI_MODEL", "openai/gpt-3.5-turbo")
 """Model identifier for the LLM provider. Can be set via OPENAI_MODEL env var."""
 
+LLM_FAST_MODEL = os.getenv("OPENAI_FAST_MODEL", LLM_PROVIDER_MODEL)
+"""Small, fast model used for first-attempt SQL generation. Env: OPENAI_FAST_MODEL (defaults to LLM_PROVIDER_MODEL)."""
+
+LLM_STRONG_MODEL = os.getenv("OPENAI_STRONG_MODEL", LLM_PROVIDER_MODEL)
+"""Stronger model used when correcting a failed query. Env: OPENAI_STRONG_MODEL (defaults to LLM_PROVIDER_MODEL)."""
+
 # Note: OPENAI_API_KEY and OPENAI_BASE_URL are typically loaded from .env
 # in initialize_client.py and used there.
 
+# --- LLM Gateway (connection pool, concurrency and retries) ---
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+"""Maximum number of in-flight LLM requests per process. Env: LLM_MAX_CONCURRENCY."""
+
+LLM_REQUEST_TIMEOUT_S = float(os.getenv("LLM_REQUEST_TIMEOUT_S", "30"))
+"""Per-call timeout (seconds) for reading an LLM response. Env: LLM_REQUEST_TIMEOUT_S."""
+
+LLM_CONNECT_TIMEOUT_S = float(os.getenv("LLM_CONNECT_TIMEOUT_S", "5"))
+"""Timeout (seconds) for establishing a connection to the LLM endpoint. Env: LLM_CONNECT_TIMEOUT_S."""
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+"""Retries per LLM call on rate limits (429), server errors (5xx) and connection failures. Env: LLM_MAX_RETRIES."""
+
+LLM_RETRY_BASE_DELAY_S = float(os.getenv("LLM_RETRY_BASE_DELAY_S", "0.5"))
+"""Base delay (seconds) of the exponential, fully jittered retry backoff. Env: LLM_RETRY_BASE_DELAY_S."""
+
+LLM_RETRY_MAX_DELAY_S = float(os.getenv("LLM_RETRY_MAX_DELAY_S", "8"))
+"""Upper bound (seconds) for a single retry delay, including server Retry-After hints. Env: LLM_RETRY_MAX_DELAY_S."""
+
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20"))
+"""Maximum number of pooled HTTP connections to the LLM endpoint. Env: LLM_POOL_MAX_CONNECTIONS."""
+
+LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10"))
+"""Maximum number of idle keep-alive connections kept in the pool. Env: LLM_POOL_MAX_KEEPALIVE."""
+
+LLM_POOL_KEEPALIVE_EXPIRY_S = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY_S", "60"))
+"""Seconds an idle keep-alive connection is kept open. Env: LLM_POOL_KEEPALIVE_EXPIRY_S."""
+
+# --- SkyServer Endpoints ---
+SKYSERVER_URLS = [
+    url.strip() for url in os.getenv(
+        "SKYSERVER_URLS", "https://skyserver.sdss.org/dr16/en/tools/search/x_sql.aspx"
+    ).split(",") if url.strip()
+]
+"""Equivalent SkyServer `x_sql.aspx` endpoints (DR16, mirrors, a local replica), in order of preference. Env: SKYSERVER_URLS (comma-separated)."""
+
+SKYSERVER_HEDGE_ENABLED = os.getenv("SKYSERVER_HEDGE_ENABLED", "true").lower() in ("1", "true", "yes")
+"""Send a hedged request to the next endpoint when the first one is slower than its recent p95. Env: SKYSERVER_HEDGE_ENABLED."""
+
+SKYSERVER_HEDGE_MIN_DELAY_S = 0.5
+"""Lower bound of the hedge delay in seconds."""
+
+SKYSERVER_HEDGE_INITIAL_DELAY_S = 5.0
+"""Hedge delay in seconds until an endpoint has SKYSERVER_HEDGE_MIN_SAMPLES latency samples."""
+
+SKYSERVER_HEDGE_MIN_SAMPLES = 20
+"""Successful requests needed before an endpoint's p95 latency is used as its hedge delay."""
+
+SKYSERVER_BREAKER_FAILURE_THRESHOLD = 5
+"""Consecutive failures (connection errors, timeouts, 5xx) that open an endpoint's circuit."""
+
+SKYSERVER_BREAKER_RESET_TIMEOUT_S = 30.0
+"""Seconds an open circuit waits before letting a trial request through."""
+
+SKYSERVER_ROW_LIMIT = 500000
+"""SkyServer truncates larger results, so a result of this many rows may be incomplete."""
+
+# --- Local Replica ---
+ENABLE_LOCAL_REPLICA = os.getenv("ENABLE_LOCAL_REPLICA", "true").lower() in ("1", "true", "yes")
+"""Answer queries covered by the local replica of hot SDSS tables without calling SkyServer. Env: ENABLE_LOCAL_REPLICA."""
+
+LOCAL_REPLICA_PATH = os.getenv("LOCAL_REPLICA_PATH", "sdss_replica.sqlite")
+"""SQLite file with the materialized table extracts (see `local_replica.py`). Env: LOCAL_REPLICA_PATH."""
+
+# --- Query Jobs (CasJobs) ---
+CASJOBS_URL = os.getenv("CASJOBS_URL", "https://skyserver.sdss.org/CasJobs/RestApi")
+"""Root of the CasJobs REST API used for long-running query jobs. Env: CASJOBS_URL."""
+
+CASJOBS_TOKEN = os.getenv("CASJOBS_TOKEN", "")
+"""SciServer authentication token for CasJobs; job mode is disabled without it. Env: CASJOBS_TOKEN."""
+
+CASJOBS_CONTEXT = os.getenv("CASJOBS_CONTEXT", "DR16")
+"""CasJobs context (data release) that query jobs run against. Env: CASJOBS_CONTEXT."""
+
+QUERY_JOBS_STATE_PATH = os.getenv("QUERY_JOBS_STATE_PATH", "query_jobs.json")
+"""File where query job state is persisted across restarts. Env: QUERY_JOBS_STATE_PATH."""
+
+QUERY_JOB_POLL_INITIAL_S = 2.0
+"""First interval (seconds) between status polls of a query job."""
+
+QUERY_JOB_POLL_MAX_S = 60.0
+"""Longest interval (seconds) between status polls of a query job."""
+
+QUERY_JOB_POLL_BACKOFF = 1.5
+"""Factor the poll interval grows by after each poll."""
+
+QUERY_JOB_CHUNK_ROWS = 5000
+"""Rows fetched per chunk from a finished job's output table."""
+
+QUERY_JOB_RETENTION_S = 7 * 24 * 3600
+"""How long records and MyDB output tables of finished query jobs are kept (seconds)."""
+
+# --- SkyServer Scheduling ---
+ENABLE_SKYSERVER_SCHEDULER = os.getenv("ENABLE_SKYSERVER_SCHEDULER", "true").lower() in ("1", "true", "yes")
+"""Send SkyServer queries through the rate-limited, fair-share scheduler. Env: ENABLE_SKYSERVER_SCHEDULER."""
+
+SKYSERVER_RATE_PER_S = float(os.getenv("SKYSERVER_RATE_PER_S", "1.0"))
+"""Sustained SkyServer queries per second for the whole process (SkyServer throttles clients above ~60 queries/minute). Env: SKYSERVER_RATE_PER_S."""
+
+SKYSERVER_BURST = int(os.getenv("SKYSERVER_BURST", "5"))
+"""Queries that may be sent back to back before the rate limit applies. Env: SKYSERVER_BURST."""
+
+SKYSERVER_MAX_CONCURRENT = int(os.getenv("SKYSERVER_MAX_CONCURRENT", "4"))
+"""Maximum number of SkyServer queries in flight at once. Env: SKYSERVER_MAX_CONCURRENT."""
+
 # --- RAG Configuration ---
 DEFAULT_TOP_N_RESULTS = 10
 """Default number of results to request from the database (TOP N)."""
@@ -34,11 +145,118 @@ MIN_SEMANTIC_SCORE_THRESHOLD = 0.35
 MAX_RAG_TABLES_CONTEXT = 2
 """Maximum number of top-scoring table schemas to include in the RAG context prompt."""
 
+PROMPT_CONTEXT_TOKEN_BUDGET = int(os.getenv("PROMPT_CONTEXT_TOKEN_BUDGET", "1500"))
+"""Token budget for the schema context in the RAG prompt (0 disables packing). Env: PROMPT_CONTEXT_TOKEN_BUDGET."""
+
+COLLAPSE_BAND_FAMILIES = os.getenv("COLLAPSE_BAND_FAMILIES", "true").lower() in ("1", "true", "yes")
+"""Render per-filter column families (e.g. psfMag_u..psfMag_z) as one entry in the corpus and prompt. Env: COLLAPSE_BAND_FAMILIES."""
+
 # --- Agent Configuration ---
 MAX_AGENT_RETRIES = 2
 """Maximum number of retries the agent will attempt to correct a failed SQL query."""
 
+ENABLE_LOCAL_SQL_VALIDATION = os.getenv("ENABLE_LOCAL_SQL_VALIDATION", "true").lower() in ("1", "true", "yes")
+"""Validate generated SQL against the local schema before sending it to SkyServer. Env: ENABLE_LOCAL_SQL_VALIDATION."""
+
+ENABLE_PROBE_EXECUTION = os.getenv("ENABLE_PROBE_EXECUTION", "true").lower() in ("1", "true", "yes")
+"""Run each query as a cheap `TOP PROBE_TOP_N` probe before the full TOP N query. Env: ENABLE_PROBE_EXECUTION."""
+
+PROBE_TOP_N = 5
+"""Number of rows requested by the probe execution."""
+
+ENABLE_PAGINATED_FETCH = os.getenv("ENABLE_PAGINATED_FETCH", "true").lower() in ("1", "true", "yes")
+"""Fetch large verified results in keyset-ordered pages, showing rows as they arrive. Env: ENABLE_PAGINATED_FETCH."""
+
+PAGINATION_PAGE_SIZE = int(os.getenv("PAGINATION_PAGE_SIZE", "200"))
+"""Rows per page in paginated fetching. Env: PAGINATION_PAGE_SIZE."""
+
+ENABLE_LOCAL_SQL_REPAIR = os.getenv("ENABLE_LOCAL_SQL_REPAIR", "true").lower() in ("1", "true", "yes")
+"""Try deterministic rule-based repairs of failed SQL before asking the LLM for a correction. Env: ENABLE_LOCAL_SQL_REPAIR."""
+
+ENABLE_SINGLE_FLIGHT = os.getenv("ENABLE_SINGLE_FLIGHT", "true").lower() in ("1", "true", "yes")
+"""Share one agent run among concurrent identical questions, and one SkyServer request among concurrent identical SQL. Env: ENABLE_SINGLE_FLIGHT."""
+
+REQUEST_DEADLINE_S = float(os.getenv("REQUEST_DEADLINE_S", "180"))
+"""Overall time budget in seconds for one question (retrieval, generation, execution and explanation). Env: REQUEST_DEADLINE_S."""
+
+RESULT_SENTINEL_VALUES = tuple(float(v) for v in os.getenv("RESULT_SENTINEL_VALUES", "-9999,-1000,-999").split(",") if v.strip())
+"""Values SDSS stores for missing measurements; result verification counts them like NULLs. Env: RESULT_SENTINEL_VALUES (comma-separated)."""
+
+NORMALIZE_RESULT_DTYPES = os.getenv("NORMALIZE_RESULT_DTYPES", "false").lower() in ("1", "true", "yes")
+"""Map sentinel values to missing values and downcast numeric columns (float32, small integers) when results are parsed. Env: NORMALIZE_RESULT_DTYPES."""
+
+VERIFY_MAX_UNUSABLE_COLUMN_FRACTION = float(os.getenv("VERIFY_MAX_UNUSABLE_COLUMN_FRACTION", "0.5"))
+"""A result fails verification if more than this share of its columns hold only NULL or sentinel values. Env: VERIFY_MAX_UNUSABLE_COLUMN_FRACTION."""
+
+RESULT_PROFILE_MAX_COLUMNS = 20
+"""Maximum number of columns listed in the result profile kept in the agent log and fed back to the LLM."""
+
+# --- Tracing Configuration ---
+ENABLE_TRACING = os.getenv("ENABLE_TRACING", "true").lower() in ("1", "true", "yes")
+"""Record nested timing spans (retrieval, embeddings, LLM calls, SkyServer HTTP, CSV parsing, ...) for every agent run. Env: ENABLE_TRACING."""
+
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+"""File each finished agent run's trace is appended to (empty: not exported). Env: TRACE_EXPORT_PATH."""
+
+TRACE_EXPORT_FORMAT = os.getenv("TRACE_EXPORT_FORMAT", "jsonl")
+"""Format of TRACE_EXPORT_PATH: 'jsonl' (one span per line) or 'otlp' (one OTLP/JSON trace export request per line). Env: TRACE_EXPORT_FORMAT."""
+
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "astroquerygpt")
+"""`service.name` resource attribute of exported OpenTelemetry spans. Env: TRACE_SERVICE_NAME."""
+
+# --- Metrics Configuration ---
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+"""Interface the Prometheus metrics endpoint of the Streamlit app binds to. Env: METRICS_HOST."""
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+"""Port serving Prometheus metrics at /metrics from the Streamlit app (0: not served). Env: METRICS_PORT."""
+
+# --- Logging Configuration ---
+LOG_MODE = os.getenv("LOG_MODE", "sync")
+"""'sync' (handlers write on the logging thread) or 'async' (records are queued and written by a listener thread, off the request path). Env: LOG_MODE."""
+
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+"""Cap on the characters of a logged payload (LLM messages, DataFrame previews, raw responses). Env: LOG_PAYLOAD_MAX_CHARS."""
+
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+"""Share (0-1) of emitted records that include their payload; the others log a placeholder. Env: LOG_PAYLOAD_SAMPLE_RATE."""
+
+# --- Profiling Configuration ---
+ENABLE_PROFILING = os.getenv("ENABLE_PROFILING", "false").lower() in ("1", "true", "yes")
+"""Profile every agent run (the Streamlit app also has a per-question toggle). Env: ENABLE_PROFILING."""
+
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sample")
+"""'sample' (wall-clock stack sampling, writes collapsed stacks for flamegraphs) or 'cprofile' (deterministic, writes a pstats file). Env: PROFILE_MODE."""
+
+PROFILE_OUTPUT_DIR = os.getenv("PROFILE_OUTPUT_DIR", "profiles")
+"""Directory the per-run profile files are written to. Env: PROFILE_OUTPUT_DIR."""
+
+PROFILE_SAMPLE_INTERVAL_S = float(os.getenv("PROFILE_SAMPLE_INTERVAL_S", "0.005"))
+"""Seconds between stack samples in 'sample' mode. Env: PROFILE_SAMPLE_INTERVAL_S."""
+
+PROFILE_TOP_N = 25
+"""Number of functions listed in a profile's top-function stats."""
+
+# --- Agent Service Configuration ---
+AGENT_SERVICE_HOST = os.getenv("AGENT_SERVICE_HOST", "127.0.0.1")
+"""Interface the headless agent service binds to. Env: AGENT_SERVICE_HOST."""
+
+AGENT_SERVICE_PORT = int(os.getenv("AGENT_SERVICE_PORT", "8600"))
+"""Port of the headless agent service. Env: AGENT_SERVICE_PORT."""
+
+AGENT_SERVICE_WORKERS = int(os.getenv("AGENT_SERVICE_WORKERS", "4"))
+"""Number of questions the service processes concurrently. Env: AGENT_SERVICE_WORKERS."""
+
+AGENT_SERVICE_QUEUE_SIZE = int(os.getenv("AGENT_SERVICE_QUEUE_SIZE", "32"))
+"""Maximum number of queued questions; further submissions are rejected with HTTP 503. Env: AGENT_SERVICE_QUEUE_SIZE."""
+
+AGENT_SERVICE_JOB_TTL_S = 900
+"""Seconds a finished job's result is kept for polling before it is discarded."""
+
 # --- UI Configuration ---
+MAX_QUERY_RESULTS_LIMIT = 1000
+"""Maximum TOP N a user can request in the Streamlit UI and the agent service."""
+
 MAX_DF_PREVIEW_ROWS = 10
 """Maximum number of rows to display in DataFrame previews in the Streamlit UI."""
 
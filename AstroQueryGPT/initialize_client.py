@@ -2,12 +2,15 @@
 Initializes and configures the OpenAI client for the AstroQueryGPT application.
 
 This module loads necessary environment variables (API key and base URL)
-from a .env file or the environment. It then instantiates the OpenAI client,
-making it available for use in other parts of the application.
+from a .env file or the environment. It provides factory functions for the
+sync and asyncio OpenAI clients; the application does not use them directly
+but goes through the pooled, concurrency-limited gateway in `llm_gateway`.
+No client is created at import time.
 """
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import os
 import logging
+from typing import Any
 from dotenv import load_dotenv
 
 # Initialize logger for this module
@@ -33,23 +36,43 @@ if not BASE_URL:
         "OPENAI_BASE_URL not found in environment. "
         "Using default OpenAI API endpoint."
     )
+
+
+def _client_kwargs(client_kwargs: dict) -> dict:
+    """Fills in the API key and base URL from the environment unless given explicitly."""
+    client_kwargs.setdefault("api_key", API_KEY)
     # When base_url is not provided, the OpenAI client defaults to the official OpenAI API.
-    llm_client = OpenAI(api_key=API_KEY)
-    logger.info("OpenAI client initialized with default base URL.")
-else:
-    llm_client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
-    logger.info(f"OpenAI client initialized with custom base URL: {BASE_URL}")
-
-# Optional: Test basic connectivity.
-# This can be useful for immediate feedback during startup, but might add slight overhead.
-# Consider enabling it during development or if connection issues are common.
-# try:
-#     logger.debug("Attempting to list models to test LLM client connectivity...")
-#     llm_client.models.list()
-#     logger.info("LLM client initialized and connection tested successfully.")
-# except Exception as e:
-#     logger.error(f"LLM client initialized, but connection test failed: {e}", exc_info=True)
-#     logger.error(
-#         "Ensure your API key (if required) and base URL are correct, "
-#         "and the LLM endpoint is reachable."
-#     )
\ No newline at end of file
+    if BASE_URL:
+        client_kwargs.setdefault("base_url", BASE_URL)
+    return client_kwargs
+
+
+def create_llm_client(**client_kwargs: Any) -> OpenAI:
+    """
+    Creates a synchronous OpenAI client.
+
+    Args:
+        **client_kwargs: Extra arguments for `OpenAI` (e.g. `http_client`, `timeout`,
+            `max_retries`, or an explicit `api_key`/`base_url`).
+
+    Returns:
+        The configured OpenAI client.
+    """
+    client = OpenAI(**_client_kwargs(client_kwargs))
+    logger.info(f"OpenAI client initialized with base URL: {client.base_url}")
+    return client
+
+
+def create_async_llm_client(**client_kwargs: Any) -> AsyncOpenAI:
+    """
+    Creates an asyncio OpenAI client.
+
+    Args:
+        **client_kwargs: Extra arguments for `AsyncOpenAI` (see `create_llm_client`).
+
+    Returns:
+        The configured AsyncOpenAI client.
+    """
+    client = AsyncOpenAI(**_client_kwargs(client_kwargs))
+    logger.info(f"Async OpenAI client initialized with base URL: {client.base_url}")
+    return client
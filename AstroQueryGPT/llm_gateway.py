@@ -0,0 +1,319 @@
+"""
+Pooled, concurrency-limited gateway for all LLM calls.
+
+This module includes functionalities for:
+- Owning tuned HTTP connection pools (keep-alive, pool size, connect/read timeouts)
+  for the sync and asyncio OpenAI clients.
+- Capping the number of in-flight LLM requests per process with a semaphore. A slot
+  is held until the HTTP request really ends, also when the agent request that
+  made it was cancelled or ran out of time and stopped waiting for it.
+- Retrying rate-limited (429), server-error (5xx) and connection-failed calls with
+  exponential, fully jittered backoff that honours `Retry-After` hints.
+- Recording call latency and token usage (including prompt-cache hits) in `metrics`.
+- A lazily created, process-wide gateway (`get_llm_gateway`) used by `rag_core`.
+"""
+import time
+import random
+import asyncio
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+import openai
+
+try:
+    import httpx
+except ImportError:  # Some openai releases ship the httpx2 fork instead of httpx.
+    import httpx2 as httpx
+
+import config
+from request_context import RequestContext, CANCEL_POLL_INTERVAL_S
+from tracing import span, set_span_attributes
+from metrics import LLM_REQUEST_SECONDS, LLM_TOKENS
+from initialize_client import create_llm_client, create_async_llm_client
+
+logger = logging.getLogger(__name__)
+
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Returns True for rate limits, 5xx responses, timeouts and connection failures."""
+    if isinstance(error, _RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """Reads a `Retry-After` header (in seconds) from an API error response, if present."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _usage_attributes(response: Any) -> Dict[str, int]:
+    """Returns the token usage of a chat completion as span attributes (missing counts are left out)."""
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    counts = {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+        "cached_tokens": getattr(details, "cached_tokens", None),
+    }
+    return {key: value for key, value in counts.items() if isinstance(value, int)}
+
+
+def _record_call_metrics(model: Optional[str], start: float, response: Any) -> None:
+    """Observes a gateway call's duration (with retries) and token usage; `response` is None for failed calls."""
+    LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, model=model or "", outcome="error" if response is None else "ok")
+    if response is not None:
+        for key, value in _usage_attributes(response).items():
+            LLM_TOKENS.inc(value, type=key[:-len("_tokens")])
+
+
+class LLMGateway:
+    """
+    Thread-safe entry point for chat completions with pooling, a concurrency cap and retries.
+
+    The OpenAI clients' own retries are disabled; the gateway retries instead so that
+    backoff sleeps happen outside the concurrency slot and are counted in `stats`.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = config.LLM_MAX_CONCURRENCY,
+        request_timeout_s: float = config.LLM_REQUEST_TIMEOUT_S,
+        connect_timeout_s: float = config.LLM_CONNECT_TIMEOUT_S,
+        max_retries: int = config.LLM_MAX_RETRIES,
+        retry_base_delay_s: float = config.LLM_RETRY_BASE_DELAY_S,
+        retry_max_delay_s: float = config.LLM_RETRY_MAX_DELAY_S,
+        max_connections: int = config.LLM_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections: int = config.LLM_POOL_MAX_KEEPALIVE,
+        keepalive_expiry_s: float = config.LLM_POOL_KEEPALIVE_EXPIRY_S,
+        **client_kwargs: Any,
+    ):
+        """
+        Args:
+            max_concurrency: Maximum number of in-flight requests (sync and async counted separately).
+            request_timeout_s: Per-call read/write timeout in seconds.
+            connect_timeout_s: Connection timeout in seconds.
+            max_retries: Retries on 429/5xx/connection errors.
+            retry_base_delay_s: Base delay of the exponential backoff.
+            retry_max_delay_s: Cap for a single backoff delay.
+            max_connections: HTTP connection pool size.
+            max_keepalive_connections: Idle keep-alive connections kept in the pool.
+            keepalive_expiry_s: Seconds an idle connection is kept open.
+            **client_kwargs: Passed to the OpenAI client factories (e.g. `api_key`, `base_url`).
+        """
+        self.max_concurrency = max_concurrency
+        self.request_timeout_s = request_timeout_s
+        self.max_retries = max_retries
+        self.retry_base_delay_s = retry_base_delay_s
+        self.retry_max_delay_s = retry_max_delay_s
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry_s,
+        )
+        self._timeout = httpx.Timeout(request_timeout_s, connect=connect_timeout_s)
+        self._client_kwargs = client_kwargs
+        self._client = create_llm_client(
+            http_client=httpx.Client(limits=self._limits, timeout=self._timeout),
+            timeout=self._timeout, max_retries=0, **client_kwargs,
+        )
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        # Calls made for a request context run here. Each holds a slot until it ends, so
+        # abandoned calls never queue new ones behind them.
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm-call")
+        # httpx.AsyncClient connections and asyncio.Semaphore are bound to an event loop.
+        self._async_state: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[Any, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+        self._stats_lock = threading.Lock()
+        self.stats: Dict[str, float] = {"calls": 0, "retries": 0, "failures": 0, "queue_wait_ms": 0.0}
+        logger.info(
+            f"LLM gateway ready: concurrency {max_concurrency}, pool {max_connections} "
+            f"(keep-alive {max_keepalive_connections}), timeouts {connect_timeout_s}s connect / "
+            f"{request_timeout_s}s request, {max_retries} retries."
+        )
+
+    def _count(self, key: str, amount: float = 1) -> None:
+        """Increments a stats counter."""
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _backoff_delay(self, attempt: int, error: Exception) -> float:
+        """Returns the delay before retry `attempt` (0-based): full jitter, at least any Retry-After hint."""
+        delay = random.uniform(0, min(self.retry_max_delay_s, self.retry_base_delay_s * (2 ** attempt)))
+        retry_after = _retry_after_seconds(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return min(delay, self.retry_max_delay_s)
+
+    def _should_retry(self, attempt: int, error: Exception) -> bool:
+        """Decides whether a failed call is retried, recording the failure otherwise."""
+        if _is_retryable(error) and attempt < self.max_retries:
+            self._count("retries")
+            logger.warning(f"LLM call failed ({type(error).__name__}: {error}). Retrying (retry {attempt + 1}/{self.max_retries}).")
+            return True
+        self._count("failures")
+        return False
+
+    def _acquire_slot(self, ctx: Optional[RequestContext]) -> None:
+        """Waits for a concurrency slot; with a request context, cancellation and the deadline end the wait."""
+        if ctx is None:
+            self._semaphore.acquire()
+            return
+        while not self._semaphore.acquire(timeout=CANCEL_POLL_INTERVAL_S):
+            ctx.check("LLM call")
+
+    def _create_in_slot(self, ctx: Optional[RequestContext], kwargs: Dict[str, Any]) -> Any:
+        """
+        Makes one attempt in an acquired slot. The slot is released when the HTTP request ends,
+        which for an abandoned request (cancelled or out of time) is after this method returns.
+        """
+        if ctx is None:
+            try:
+                return self._client.chat.completions.create(**kwargs)
+            finally:
+                self._semaphore.release()
+        try:
+            call_timeout = ctx.timeout(self.request_timeout_s, stage="LLM call")
+        except Exception:
+            self._semaphore.release()
+            raise
+        return ctx.call(
+            self._client.chat.completions.create, stage="LLM call", on_done=self._semaphore.release,
+            executor=self._executor, **{**kwargs, "timeout": call_timeout},
+        )
+
+    def chat_completion(self, ctx: Optional[RequestContext] = None, **kwargs: Any) -> Any:
+        """
+        Creates a chat completion, blocking while the concurrency cap is reached.
+
+        Args:
+            ctx: Optional request context. Each attempt's timeout is shrunk to the remaining
+                budget, and cancellation interrupts the call and any backoff sleep.
+            **kwargs: Arguments for `chat.completions.create` (model, messages, temperature, ...).
+
+        Returns:
+            The chat completion response.
+
+        Raises:
+            openai.OpenAIError: If the call fails and is not retryable or retries are exhausted.
+            RequestCancelled, DeadlineExceeded: If `ctx` is cancelled or out of time.
+        """
+        with span("llm.chat_completion", model=kwargs.get("model")):
+            start = time.perf_counter()
+            completed = None
+            try:
+                attempt = 0
+                queue_wait_ms = 0.0
+                while True:
+                    wait_start = time.perf_counter()
+                    self._acquire_slot(ctx)
+                    waited_ms = (time.perf_counter() - wait_start) * 1000
+                    queue_wait_ms += waited_ms
+                    self._count("queue_wait_ms", waited_ms)
+                    self._count("calls")
+                    set_span_attributes(retries=attempt, queue_wait_ms=round(queue_wait_ms, 3))
+                    try:
+                        response = self._create_in_slot(ctx, kwargs)
+                        set_span_attributes(**_usage_attributes(response))
+                        completed = response
+                        return response
+                    except Exception as e:
+                        if not self._should_retry(attempt, e):
+                            raise
+                        delay = self._backoff_delay(attempt, e)
+                    if ctx is None:
+                        time.sleep(delay) # Sleep outside the concurrency slot.
+                    else:
+                        ctx.sleep(delay)
+                    attempt += 1
+            finally:
+                _record_call_metrics(kwargs.get("model"), start, completed)
+
+    def _get_async_state(self) -> Tuple[Any, asyncio.Semaphore]:
+        """Returns the async client and semaphore for the running event loop, creating them on first use."""
+        loop = asyncio.get_running_loop()
+        state = self._async_state.get(loop)
+        if state is None:
+            client = create_async_llm_client(
+                http_client=httpx.AsyncClient(limits=self._limits, timeout=self._timeout),
+                timeout=self._timeout, max_retries=0, **self._client_kwargs,
+            )
+            state = (client, asyncio.Semaphore(self.max_concurrency))
+            self._async_state[loop] = state
+        return state
+
+    async def achat_completion(self, ctx: Optional[RequestContext] = None, **kwargs: Any) -> Any:
+        """
+        Asyncio variant of `chat_completion`.
+
+        Args:
+            ctx: Optional request context; each attempt's timeout is shrunk to the remaining budget.
+            **kwargs: Arguments for `chat.completions.create`.
+
+        Returns:
+            The chat completion response.
+        """
+        client, semaphore = self._get_async_state()
+        with span("llm.chat_completion", model=kwargs.get("model")):
+            start = time.perf_counter()
+            completed = None
+            try:
+                attempt = 0
+                while True:
+                    wait_start = time.perf_counter()
+                    async with semaphore:
+                        self._count("queue_wait_ms", (time.perf_counter() - wait_start) * 1000)
+                        self._count("calls")
+                        set_span_attributes(retries=attempt)
+                        try:
+                            if ctx is not None:
+                                kwargs["timeout"] = ctx.timeout(self.request_timeout_s, stage="LLM call")
+                            response = await client.chat.completions.create(**kwargs)
+                            set_span_attributes(**_usage_attributes(response))
+                            completed = response
+                            return response
+                        except Exception as e:
+                            if not self._should_retry(attempt, e):
+                                raise
+                            delay = self._backoff_delay(attempt, e)
+                    await asyncio.sleep(delay)
+                    attempt += 1
+            finally:
+                _record_call_metrics(kwargs.get("model"), start, completed)
+
+    def close(self) -> None:
+        """Closes the sync connection pool. Async clients are closed with their event loop."""
+        self._executor.shutdown(wait=False)
+        self._client.close()
+
+
+_gateway: Optional[LLMGateway] = None
+_gateway_lock = threading.Lock()
+
+
+def get_llm_gateway() -> Optional[LLMGateway]:
+    """
+    Returns the process-wide LLM gateway, creating it on first use.
+
+    Returns:
+        The shared LLMGateway, or None if the client cannot be created (e.g. missing API key).
+    """
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                try:
+                    _gateway = LLMGateway()
+                except Exception as e:
+                    logger.error(f"Failed to initialize the LLM gateway: {e}", exc_info=True)
+                    return None
+    return _gateway
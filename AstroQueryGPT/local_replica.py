@@ -0,0 +1,560 @@
+"""
+Local SQLite replica of frequently queried SDSS tables.
+
+Most questions hit a few tables (PhotoObjAll/SpecObjAll/Galaxy subsets, zooSpec)
+over limited sky regions. This module keeps materialized extracts of such
+tables in a SQLite file (`config.LOCAL_REPLICA_PATH`) and runs eligible queries
+against it in milliseconds instead of a SkyServer round trip.
+
+A query is eligible only when the replica provably returns the same rows:
+- it translates to SQLite (see `sql_dialect`),
+- every table it references is an extract in the replica and every column it
+  references exists in that extract (checked with `sql_validator`); `SELECT *`
+  needs an extract with all columns of the table,
+- for extracts of a sky region, the query's top-level WHERE clause constrains
+  `ra` and `dec` of that table to lie inside the region with plain AND-ed
+  comparisons,
+- id columns too large for SQLite integers (stored as text, see `WIDE_ID_TYPE`)
+  are only selected, not compared, joined or sorted on.
+
+Extracts are registered in the `replica_coverage` table of the file, which is
+written by `LocalReplica.load_extract` (see the command line at the bottom of
+this module). Text columns use case-insensitive collation like SkyServer.
+"""
+import os
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import closing
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import pandas as pd
+
+import config
+from request_context import RequestContext
+from sql_dialect import UnsupportedDialect, register_tsql_functions, translate_tsql_to_sqlite
+from sql_validator import SchemaIndex, _is_keyword, extract_table_references, tokenize_sql, validate_sql
+
+logger = logging.getLogger(__name__)
+
+COVERAGE_TABLE = "replica_coverage"
+"""Table of the replica file that registers extracts and their sky regions."""
+
+_PROGRESS_HANDLER_OPS = 10000
+"""SQLite VM instructions between cancellation checks of a running local query."""
+
+Region = Tuple[float, float, float, float]
+"""Sky region of an extract: (ra_min, ra_max, dec_min, dec_max) in degrees."""
+
+WIDE_ID_TYPE = "VARCHAR(20)"
+"""
+Declared type of id columns with values beyond SQLite's 64-bit INTEGER (DR16 specObjIDs
+reach 2^64). They are stored as decimal text, so the replica only returns them: queries
+that compare, join, group or sort on them go to SkyServer (see `_wide_id_use`).
+"""
+
+_INT64_MAX = 2 ** 63 - 1
+
+
+def _integer_ids(values: pd.Series) -> Optional[pd.Series]:
+    """Converts decimal id strings to int64 (nullable Int64 with missing ids), or None if they do not all fit."""
+    present = values.dropna()
+    try:
+        numbers = pd.to_numeric(present)
+    except (ValueError, TypeError):
+        return None
+    if not pd.api.types.is_integer_dtype(numbers) or (len(numbers) and numbers.max() > _INT64_MAX):
+        return None
+    if len(present) == len(values):
+        return numbers.astype("int64")
+    return numbers.astype("Int64").reindex(values.index)
+
+
+def _is_wide_id_column(values: pd.Series) -> bool:
+    """Checks whether id strings are all unsigned decimal integers (some beyond int64, see `_integer_ids`)."""
+    present = values.dropna().astype(str)
+    return bool(len(present)) and bool(present.str.fullmatch(r"\d{1,20}").all())
+
+
+def _read_number(tokens: List[Tuple[str, Any]], idx: int) -> Tuple[Optional[float], int]:
+    """Reads an optionally signed number literal at `idx`. Returns (value or None, index after it)."""
+    sign = 1.0
+    if idx < len(tokens) and tokens[idx] in (("op", "-"), ("op", "+")):
+        sign = -1.0 if tokens[idx][1] == "-" else 1.0
+        idx += 1
+    if idx < len(tokens) and tokens[idx][0] == "number":
+        return sign * float(tokens[idx][1]), idx + 1
+    return None, idx
+
+
+def _is_arithmetic(tokens: List[Tuple[str, Any]], idx: int) -> bool:
+    """Checks whether the token at `idx` is an arithmetic operator (so a neighbouring operand is part of an expression)."""
+    return 0 <= idx < len(tokens) and tokens[idx][0] == "op" and tokens[idx][1] in ("+", "-", "*", "/", "%", "&", "|", "^")
+
+
+def selects_star(tokens: List[Tuple[str, Any]]) -> bool:
+    """Returns True if a select list contains `*` or `alias.*` (COUNT(*) does not count)."""
+    for idx, token in enumerate(tokens):
+        if token[0] == "name" and len(token[1]) > 1 and token[1][-1] == "*":
+            return True
+        if token == ("op", "*") and idx > 0:
+            prev = tokens[idx - 1]
+            if _is_keyword(prev, "select", "distinct", "all") or prev == ("op", ",") or (
+                prev[0] == "number" and idx > 1 and _is_keyword(tokens[idx - 2], "top")
+            ):
+                return True
+    return False
+
+
+def _wide_id_use(tokens: List[Tuple[str, Any]], wide_ids: Set[str]) -> Optional[str]:
+    """
+    Finds a reference to a `WIDE_ID_TYPE` column other than a plain item of the outer select list.
+
+    Text compares, sorts and groups differently from numbers (and SQLite reads literals
+    beyond int64 as REAL), so such a column may only be returned as is. Output aliases of
+    the column are checked like the column, and set operators (which compare rows) are
+    refused.
+
+    Args:
+        tokens: Tokens produced by `sql_validator.tokenize_sql`.
+        wide_ids: Lowercase names of the wide id columns of the referenced extracts.
+
+    Returns:
+        The first offending column name, or None.
+    """
+    wide_ids = set(wide_ids)
+    set_operator = any(_is_keyword(token, "union", "except", "intersect") for token in tokens)
+    alias_positions: Set[int] = set()
+    depth = 0
+    in_select_list = False
+    for idx, token in enumerate(tokens):
+        if token == ("op", "("):
+            depth += 1
+        elif token == ("op", ")"):
+            depth -= 1
+        elif depth == 0 and _is_keyword(token, "select"):
+            in_select_list = True
+        elif depth == 0 and _is_keyword(token, "from"):
+            in_select_list = False
+        if token[0] != "name" or token[1][-1].lower() not in wide_ids or idx in alias_positions:
+            continue
+        prev = tokens[idx - 1]
+        nxt = tokens[idx + 1] if idx + 1 < len(tokens) else ("op", "")
+        plain_item = (
+            not set_operator and depth == 0 and in_select_list
+            and (
+                _is_keyword(prev, "select", "distinct", "all") or prev == ("op", ",")
+                or (prev[0] == "number" and _is_keyword(tokens[idx - 2], "top"))
+            )
+            and (nxt == ("op", ",") or _is_keyword(nxt, "from", "as") or (nxt[0] == "name" and not _is_keyword(nxt)))
+        )
+        if not plain_item:
+            return token[1][-1]
+        alias_idx = idx + 2 if _is_keyword(nxt, "as") else idx + 1
+        if alias_idx < len(tokens) and tokens[alias_idx][0] == "name" and not _is_keyword(tokens[alias_idx]):
+            wide_ids.add(tokens[alias_idx][1][-1].lower())
+            alias_positions.add(alias_idx)
+    return None
+
+
+_WHERE_CLAUSE_END = ("group", "having", "order", "union", "except", "intersect", "option")
+"""Keywords that end a top-level WHERE clause."""
+
+_SKIPPED_SPAN = ("op", "(...)")
+"""Stands for a parenthesized or CASE ... END span removed by `where_clause_tokens`."""
+
+
+def where_clause_tokens(tokens: List[Tuple[str, Any]]) -> List[Tuple[str, Any]]:
+    """
+    Returns the predicates of the query's top-level WHERE clause.
+
+    Only these filter the rows of the outer query: a comparison in the select list (e.g.
+    inside `CASE ... END` or an aggregate) or in a subquery does not. Parenthesized spans
+    and `CASE ... END` inside the clause are replaced by a placeholder token, so their
+    predicates are not counted and their neighbours are not read as adjacent.
+
+    Args:
+        tokens: Tokens produced by `sql_validator.tokenize_sql`.
+
+    Returns:
+        The clause's tokens after WHERE, up to GROUP BY/HAVING/ORDER BY, a set operator or
+        the end of the query (empty without a top-level WHERE).
+    """
+    clause: List[Tuple[str, Any]] = []
+    depth = case_depth = 0
+    in_where = False
+    for token in tokens:
+        if token == ("op", "("):
+            depth += 1
+        elif token == ("op", ")"):
+            depth -= 1
+            if depth < 0:
+                break
+            if depth == 0 and case_depth == 0 and in_where:
+                clause.append(_SKIPPED_SPAN)
+            continue
+        elif depth == 0 and _is_keyword(token, "case"):
+            case_depth += 1
+        elif depth == 0 and case_depth and _is_keyword(token, "end"):
+            case_depth -= 1
+            if case_depth == 0 and in_where:
+                clause.append(_SKIPPED_SPAN)
+            continue
+        if depth or case_depth:
+            continue
+        if not in_where:
+            in_where = _is_keyword(token, "where")
+        elif _is_keyword(token, *_WHERE_CLAUSE_END) or token == ("op", ";"):
+            break
+        else:
+            clause.append(token)
+    return clause
+
+
+def constant_bounds(tokens: List[Tuple[str, Any]], column: str, qualifiers: List[str]) -> Tuple[float, float]:
+    """
+    Finds the tightest constant bounds a list of predicates puts on a column.
+
+    Recognizes `col BETWEEN a AND b`, `col <op> a` and `a <op> col` (op one of <, <=, >, >=, =),
+    where `col` is written unqualified or qualified with one of `qualifiers`. The caller
+    passes the WHERE clause (`where_clause_tokens`) and must make sure its predicates are
+    AND-ed (no OR/NOT in the query).
+
+    Args:
+        tokens: Tokens produced by `sql_validator.tokenize_sql`.
+        column: Lowercase column name.
+        qualifiers: Lowercase table names and aliases the column may be qualified with.
+
+    Returns:
+        (low, high); unconstrained sides are -inf/inf.
+    """
+    low, high = float("-inf"), float("inf")
+
+    def is_column(token: Tuple[str, Any]) -> bool:
+        if token[0] != "name" or token[1][-1].lower() != column:
+            return False
+        return len(token[1]) == 1 or token[1][-2].lower() in qualifiers
+
+    for idx, token in enumerate(tokens):
+        if is_column(token) and idx + 1 < len(tokens) and not _is_arithmetic(tokens, idx - 1):
+            nxt = tokens[idx + 1]
+            if _is_keyword(nxt, "between"):
+                first, after = _read_number(tokens, idx + 2)
+                if first is not None and after < len(tokens) and _is_keyword(tokens[after], "and"):
+                    second, after = _read_number(tokens, after + 1)
+                    if second is not None and not _is_arithmetic(tokens, after):
+                        low, high = max(low, first), min(high, second)
+            elif nxt[0] == "op" and nxt[1] in ("<", "<=", ">", ">=", "="):
+                value, after = _read_number(tokens, idx + 2)
+                if value is not None and not _is_arithmetic(tokens, after):
+                    if nxt[1] in (">", ">=", "="):
+                        low = max(low, value)
+                    if nxt[1] in ("<", "<=", "="):
+                        high = min(high, value)
+        elif token[0] == "number" and idx + 2 < len(tokens) and tokens[idx + 1][0] == "op":
+            op = tokens[idx + 1][1]
+            if (
+                op in ("<", "<=", ">", ">=", "=")
+                and is_column(tokens[idx + 2])
+                and not _is_arithmetic(tokens, idx - 1)
+                and not _is_arithmetic(tokens, idx + 3)
+            ):
+                value = float(token[1])
+                if op in ("<", "<=", "="):
+                    low = max(low, value)
+                if op in (">", ">=", "="):
+                    high = min(high, value)
+    return low, high
+
+
+class LocalReplica:
+    """
+    Read-only access to the replica file, coverage checks and local execution.
+
+    Attributes:
+        path: Path of the SQLite file.
+        stats: 'checked' (queries considered), 'local' (run locally), 'not_covered',
+            'untranslatable', 'errors' (local failures that fell back to SkyServer) and
+            'local_ms_total'.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Path of the SQLite replica file. A missing file disables the replica.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._loaded_mtime: Optional[float] = None
+        self._extracts: Dict[str, Dict[str, Any]] = {}
+        self._index: Optional[SchemaIndex] = None
+        self.stats: Dict[str, float] = {
+            "checked": 0, "local": 0, "not_covered": 0, "untranslatable": 0, "errors": 0, "local_ms_total": 0.0,
+        }
+
+    def _count(self, key: str, amount: float = 1) -> None:
+        """Increments a counter."""
+        with self._lock:
+            self.stats[key] += amount
+
+    def _connect(self, read_only: bool = True) -> sqlite3.Connection:
+        """Opens a connection with the T-SQL functions registered (one per query; connections are not shared between threads)."""
+        if read_only:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        else:
+            connection = sqlite3.connect(self.path)
+        register_tsql_functions(connection)
+        return connection
+
+    def _refresh(self) -> bool:
+        """Loads extract metadata when the file changed. Returns False if there is no usable replica."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        with self._lock:
+            if mtime == self._loaded_mtime:
+                return bool(self._extracts)
+        extracts: Dict[str, Dict[str, Any]] = {}
+        try:
+            with closing(self._connect()) as connection:
+                rows = connection.execute(
+                    f"SELECT table_name, ra_min, ra_max, dec_min, dec_max, all_columns FROM {COVERAGE_TABLE}"
+                ).fetchall()
+                for table_name, ra_min, ra_max, dec_min, dec_max, all_columns in rows:
+                    table_info = connection.execute(f'PRAGMA table_info("{table_name}")').fetchall()
+                    if not table_info:
+                        continue
+                    region = None if ra_min is None else (ra_min, ra_max, dec_min, dec_max)
+                    extracts[table_name.lower()] = {
+                        "name": table_name, "columns": [row[1] for row in table_info], "region": region,
+                        "all_columns": bool(all_columns),
+                        "wide_id_columns": {row[1].lower() for row in table_info if row[2] == WIDE_ID_TYPE},
+                    }
+        except sqlite3.Error as e:
+            logger.warning(f"Local replica {self.path} is not readable, disabling it: {e}")
+        index = SchemaIndex(
+            [{"name": e["name"], "fields": [{"name": c} for c in e["columns"]]} for e in extracts.values()],
+            view_base_tables={},
+        )
+        with self._lock:
+            self._loaded_mtime = mtime
+            self._extracts, self._index = extracts, index
+        logger.info(f"Local replica loaded with {len(extracts)} extract(s): {sorted(e['name'] for e in extracts.values())}")
+        return bool(extracts)
+
+    def uncovered_reason(self, sql_query: str) -> Optional[str]:
+        """
+        Checks whether the replica holds every row and column the query can touch.
+
+        Args:
+            sql_query: The T-SQL query.
+
+        Returns:
+            None if the query is covered, otherwise the reason it is not.
+        """
+        with self._lock:
+            extracts, index = self._extracts, self._index
+        tokens = tokenize_sql(sql_query)
+        sources, _ = extract_table_references(tokens)
+        regional = []
+        for source in sources:
+            if source["kind"] == "function":
+                return f"table-valued function {source['name']}"
+            if source["kind"] != "table" or not source["name"]:
+                continue
+            extract = extracts.get(source["name"].lower())
+            if extract is None:
+                if any(s["kind"] == "cte" and s["name"].lower() == source["name"].lower() for s in sources):
+                    continue
+                return f"table {source['name']} is not in the replica"
+            if extract["region"] is not None:
+                regional.append((source, extract))
+
+        errors = validate_sql(sql_query, index)
+        if errors:
+            return errors[0]["message"]
+        wide_ids = set().union(*(
+            extracts[s["name"].lower()]["wide_id_columns"] for s in sources if s["name"] and s["name"].lower() in extracts
+        ))
+        wide_id = _wide_id_use(tokens, wide_ids) if wide_ids else None
+        if wide_id:
+            return f"{wide_id} is stored as text in the replica and can only be selected, not compared or sorted"
+        if selects_star(tokens) and any(
+            not extracts[s["name"].lower()]["all_columns"] for s in sources if s["name"] and s["name"].lower() in extracts
+        ):
+            return "SELECT * over an extract that does not hold all columns"
+
+        if regional:
+            if any(_is_keyword(token, "or", "not", "union", "except", "intersect") for token in tokens):
+                return "cannot prove the query stays inside the extracted sky region (OR/NOT/set operators)"
+            if len(regional) != len([s for s in sources if s["kind"] == "table"]) or any(
+                s["kind"] in ("derived", "cte") for s in sources
+            ):
+                return "regional extracts are only used for queries over regional extracts without subqueries"
+            names = [source["name"].lower() for source, _ in regional]
+            if len(set(names)) != len(names):
+                return "a regional extract is referenced more than once"
+            where_tokens = where_clause_tokens(tokens)
+            for source, extract in regional:
+                qualifiers = [source["name"].lower()] + ([source["alias"].lower()] if source["alias"] else [])
+                ra_min, ra_max, dec_min, dec_max = extract["region"]
+                ra_low, ra_high = constant_bounds(where_tokens, "ra", qualifiers)
+                dec_low, dec_high = constant_bounds(where_tokens, "dec", qualifiers)
+                if not (ra_min <= ra_low and ra_high <= ra_max and dec_min <= dec_low and dec_high <= dec_max):
+                    return f"the query is not limited to the extracted sky region of {extract['name']}"
+        return None
+
+    def plan(self, sql_query: str) -> Optional[str]:
+        """
+        Returns the SQLite translation of a query if the replica can answer it, otherwise None.
+
+        Args:
+            sql_query: The T-SQL query.
+        """
+        if not self._refresh():
+            return None
+        self._count("checked")
+        try:
+            local_sql = translate_tsql_to_sqlite(sql_query)
+        except UnsupportedDialect as e:
+            self._count("untranslatable")
+            logger.debug(f"Local replica skipped (not translatable): {e}")
+            return None
+        reason = self.uncovered_reason(sql_query)
+        if reason:
+            self._count("not_covered")
+            logger.debug(f"Local replica skipped (not covered): {reason}")
+            return None
+        return local_sql
+
+    def execute(self, local_sql: str, ctx: Optional[RequestContext] = None) -> pd.DataFrame:
+        """
+        Runs a translated query on the replica.
+
+        Args:
+            local_sql: A query returned by `plan`.
+            ctx: Optional request context; a cancelled or expired request interrupts the query.
+
+        Returns:
+            The result rows.
+
+        Raises:
+            sqlite3.Error: If the query fails locally (callers fall back to SkyServer).
+            RequestCancelled, DeadlineExceeded: If `ctx` ends while the query runs.
+        """
+        start = time.perf_counter()
+        connection = self._connect()
+        try:
+            if ctx is not None:
+                connection.set_progress_handler(lambda: int(ctx.cancelled or ctx.remaining() == 0), _PROGRESS_HANDLER_OPS)
+            try:
+                df = pd.read_sql_query(local_sql, connection)
+            except (sqlite3.Error, pd.errors.DatabaseError):
+                if ctx is not None:
+                    ctx.check("local replica query")
+                self._count("errors")
+                raise
+        finally:
+            connection.close()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self._count("local")
+        self._count("local_ms_total", elapsed_ms)
+        logger.info(f"Local replica answered in {elapsed_ms:.1f} ms with {len(df)} rows.")
+        return df
+
+    def load_extract(
+        self,
+        table_name: str,
+        df: pd.DataFrame,
+        region: Optional[Region] = None,
+        all_columns: bool = False,
+        source_sql: Optional[str] = None,
+    ) -> None:
+        """
+        Stores (or replaces) an extract and registers its coverage.
+
+        Args:
+            table_name: SkyServer table or view name the extract answers for (e.g. 'Galaxy').
+            df: The extracted rows, with SkyServer column names.
+            region: The sky region the extract is complete for, or None for a complete table.
+            all_columns: Whether the extract holds every column of the table (allows `SELECT *`).
+            source_sql: The query the extract was built with (recorded for reference).
+        """
+        df = df.copy()
+        column_types: Dict[str, str] = {}
+        for column in df.columns:
+            if "id" in column.lower() and not pd.api.types.is_numeric_dtype(df[column]):
+                # `query_sdss` returns id columns as strings; store them as integers so comparisons work.
+                as_integers = _integer_ids(df[column])
+                if as_integers is not None:
+                    df[column] = as_integers
+                elif _is_wide_id_column(df[column]):
+                    column_types[column] = WIDE_ID_TYPE
+        for column in df.columns:
+            if column not in column_types and (
+                pd.api.types.is_string_dtype(df[column]) or pd.api.types.is_object_dtype(df[column])
+            ):
+                column_types[column] = "TEXT COLLATE NOCASE"
+        with closing(self._connect(read_only=False)) as connection, connection:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {COVERAGE_TABLE} (table_name TEXT PRIMARY KEY COLLATE NOCASE, "
+                "ra_min REAL, ra_max REAL, dec_min REAL, dec_max REAL, all_columns INTEGER, source_sql TEXT, rows INTEGER, "
+                "created_at TEXT)"
+            )
+            df.to_sql(table_name, connection, if_exists="replace", index=False, dtype=column_types)
+            ra_min, ra_max, dec_min, dec_max = region if region else (None, None, None, None)
+            connection.execute(
+                f"INSERT OR REPLACE INTO {COVERAGE_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    table_name, ra_min, ra_max, dec_min, dec_max, int(all_columns), source_sql, len(df),
+                    datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+        logger.info(f"Stored local extract {table_name} with {len(df)} rows (region: {region or 'full table'}).")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns a copy of the counters plus the registered extracts."""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["extracts"] = sorted(extract["name"] for extract in self._extracts.values())
+        stats["local_ms_mean"] = stats["local_ms_total"] / stats["local"] if stats["local"] else 0.0
+        return stats
+
+
+LOCAL_REPLICA = LocalReplica(config.LOCAL_REPLICA_PATH)
+"""The replica used by `sdss_db.query_sdss`."""
+
+
+def get_replica_stats() -> Dict[str, Any]:
+    """Returns how many queries the local replica answered or passed on to SkyServer."""
+    return LOCAL_REPLICA.get_stats()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from sdss_db import query_sdss
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Materialize an SDSS table extract into the local replica.")
+    parser.add_argument("table", help="SkyServer table or view, e.g. Galaxy, SpecObjAll, zooSpec.")
+    parser.add_argument("--columns", default="*", help="Comma-separated columns to extract (default: all).")
+    parser.add_argument("--ra", nargs=2, type=float, metavar=("MIN", "MAX"), help="RA range of the extract (degrees).")
+    parser.add_argument("--dec", nargs=2, type=float, metavar=("MIN", "MAX"), help="Dec range of the extract (degrees).")
+    args = parser.parse_args()
+    if bool(args.ra) != bool(args.dec):
+        parser.error("--ra and --dec must be given together.")
+
+    extract_sql = f"SELECT {args.columns} FROM {args.table}"
+    if args.ra:
+        extract_sql += f" WHERE ra BETWEEN {args.ra[0]} AND {args.ra[1]} AND dec BETWEEN {args.dec[0]} AND {args.dec[1]}"
+    extract = query_sdss(extract_sql, allow_local=False)
+    if len(extract) >= config.SKYSERVER_ROW_LIMIT:
+        parser.error(f"The extract hit SkyServer's {config.SKYSERVER_ROW_LIMIT} row limit and may be incomplete. Use a smaller region.")
+    LOCAL_REPLICA.load_extract(
+        args.table, extract, region=(*args.ra, *args.dec) if args.ra else None,
+        all_columns=args.columns.strip() == "*", source_sql=extract_sql,
+    )
@@ -0,0 +1,161 @@
+"""
+Low-overhead logging for the request path.
+
+This module includes functionalities for:
+- `configure_logging`: the entry points' logging setup. In 'async' mode
+  (`config.LOG_MODE`) loggers only put records on a queue; a `QueueListener`
+  thread formats them and does the I/O, so slow terminals, files or log shippers
+  do not stall a request. 'sync' mode writes from the calling thread, as
+  `logging.basicConfig` does.
+- `log_payload`: wraps large values (LLM messages, DataFrame previews, raw
+  responses) so they are rendered only when a record is actually emitted, capped
+  at `config.LOG_PAYLOAD_MAX_CHARS` and logged for a sample of records
+  (`config.LOG_PAYLOAD_SAMPLE_RATE`).
+
+Hot-path statements pass their arguments `%`-style (`logger.debug("... %s", x)`)
+rather than as f-strings, so nothing is formatted when the level is off. Note that
+in 'async' mode the message is still merged with its arguments on the calling
+thread (`QueueHandler.prepare`), so argument objects may change afterwards; only
+handler formatting and I/O move to the listener.
+"""
+import sys
+import queue
+import atexit
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+"""Record format of the application's log output."""
+
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+"""Timestamp format of the application's log output."""
+
+LOG_MODES = ("sync", "async")
+
+_listener: Optional[QueueListener] = None
+_installed_handler: Optional[logging.Handler] = None
+_configure_lock = threading.Lock()
+
+
+class LogPayload:
+    """
+    A value logged lazily: rendered, sampled and capped only when its record is formatted.
+
+    Pass it as a `%s` argument: `logger.debug("Messages: %s", log_payload(messages))`.
+    """
+
+    __slots__ = ("value", "render", "max_chars", "sample_rate")
+
+    def __init__(self, value: Any, render: Optional[Callable[[Any], str]], max_chars: int, sample_rate: float):
+        self.value = value
+        self.render = render
+        self.max_chars = max_chars
+        self.sample_rate = sample_rate
+
+    def __str__(self) -> str:
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return "<payload not sampled>"
+        text = self.render(self.value) if self.render is not None else str(self.value)
+        if len(text) > self.max_chars:
+            return f"{text[:self.max_chars]}... <{len(text) - self.max_chars} more chars>"
+        return text
+
+    __repr__ = __str__
+
+
+def log_payload(
+    value: Any,
+    render: Optional[Callable[[Any], str]] = None,
+    max_chars: Optional[int] = None,
+    sample_rate: Optional[float] = None,
+) -> LogPayload:
+    """
+    Wraps a large value for logging.
+
+    Args:
+        value: The value (e.g. a message list or a DataFrame).
+        render: Turns the value into text (default: `str`), e.g. `lambda df: df.head().to_string()`.
+        max_chars: Cap of the rendered text. Defaults to `config.LOG_PAYLOAD_MAX_CHARS`.
+        sample_rate: Share of emitted records that include the payload. Defaults to
+            `config.LOG_PAYLOAD_SAMPLE_RATE`.
+
+    Returns:
+        A `LogPayload` to pass as a logging argument.
+    """
+    return LogPayload(
+        value, render,
+        config.LOG_PAYLOAD_MAX_CHARS if max_chars is None else max_chars,
+        config.LOG_PAYLOAD_SAMPLE_RATE if sample_rate is None else sample_rate,
+    )
+
+
+def configure_logging(
+    level: Any = logging.INFO,
+    mode: str = config.LOG_MODE,
+    handler: Optional[logging.Handler] = None,
+    force: bool = False,
+) -> Optional[QueueListener]:
+    """
+    Sets up the root logger once per process (Streamlit reruns call it again).
+
+    Args:
+        level: Root logger level (name or number).
+        mode: 'sync' (handler called on the logging thread) or 'async' (queue and listener thread).
+        handler: The handler doing the output. Defaults to a stderr `StreamHandler`
+            with `LOG_FORMAT`.
+        force: Replace a setup made by an earlier call.
+
+    Returns:
+        The running `QueueListener` in 'async' mode, else None.
+
+    Raises:
+        ValueError: If `mode` is unknown.
+    """
+    global _listener, _installed_handler
+    if mode not in LOG_MODES:
+        raise ValueError(f"Unknown log mode '{mode}'. Use one of {LOG_MODES}.")
+    with _configure_lock:
+        if _installed_handler is not None and not force:
+            return _listener
+        root = logging.getLogger()
+        _uninstall(root)
+        if handler is None:
+            handler = logging.StreamHandler(sys.stderr)
+            handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+        if mode == "async":
+            log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+            _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+            _listener.start()
+            _installed_handler = QueueHandler(log_queue)
+        else:
+            _installed_handler = handler
+        root.addHandler(_installed_handler)
+        root.setLevel(level.upper() if isinstance(level, str) else level)
+        return _listener
+
+
+def _uninstall(root: logging.Logger) -> None:
+    """Removes the handler of an earlier setup, then lets its listener write the records still queued."""
+    global _listener, _installed_handler
+    if _installed_handler is not None:
+        root.removeHandler(_installed_handler)
+        _installed_handler = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def stop_logging() -> None:
+    """Removes the handler installed by `configure_logging` and flushes queued records. Registered to run at exit."""
+    with _configure_lock:
+        _uninstall(logging.getLogger())
+
+
+atexit.register(stop_logging)
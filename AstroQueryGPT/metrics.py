@@ -0,0 +1,360 @@
+"""
+In-process metrics with a Prometheus text-format exporter.
+
+Tracing (`tracing`) explains one run; these metrics aggregate all of them: latency
+histograms of LLM calls, SkyServer requests (and response sizes), CSV parsing and
+the agent stages (retrieval, generation, ...), the number of attempts per question,
+why attempts needed a correction, and hits and misses of the caches (request
+coalescing, the local replica, the schema preprocessing cache, the LLM provider's
+prompt cache in tokens).
+
+Recording is cheap enough for the hot path: a histogram observation is a bisect
+over fixed buckets plus a few additions under a per-metric lock (a few
+microseconds, against milliseconds or more for the work it measures); cumulative
+bucket counts are only computed when the metrics are rendered.
+
+Metrics are exposed in the Prometheus text format (version 0.0.4) by
+`render_metrics`, on `/metrics` of the agent service, and by a small HTTP server
+started with `start_metrics_server` (the Streamlit app starts it on
+`config.METRICS_PORT`). Ratios such as the cache hit ratio are left to the
+monitoring system, e.g. `rate(astroquerygpt_cache_requests_total{result="hit"}[5m])`
+divided by the rate over all results.
+"""
+import math
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "astroquerygpt_"
+"""Prefix of all metric names."""
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+"""Content type of the Prometheus text exposition format."""
+
+LATENCY_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+"""Upper bounds (seconds) of latency histogram buckets, from in-process steps to slow SkyServer queries."""
+
+BYTES_BUCKETS = tuple(float(1024 * 4 ** i) for i in range(10)) # 1 KiB .. 256 MiB
+"""Upper bounds (bytes) of response size histogram buckets."""
+
+ATTEMPT_BUCKETS = (1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 8.0, 10.0)
+"""Upper bounds of the attempts-per-question histogram buckets."""
+
+CORRECTION_REASONS = (
+    "no_sql", "validation_error", "error_near", "html_error", "timeout", "execution_error", "empty_result",
+    "sentinel_result", "verification_failure",
+)
+"""Reasons an agent attempt failed and needed a correction (label values of `AGENT_CORRECTIONS`)."""
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    """Formats a label set as `{a="x",b="y"}` (empty string without labels)."""
+    parts = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """Common parts of counters and histograms: name, help text, labels and a lock."""
+
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        """Returns the label values of a series in `labelnames` order."""
+        try:
+            key = tuple(str(labels[name]) for name in self.labelnames)
+        except KeyError as e:
+            raise ValueError(f"Metric {self.name} needs labels {self.labelnames}, got {sorted(labels)}.") from e
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"Metric {self.name} needs labels {self.labelnames}, got {sorted(labels)}.")
+        return key
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+
+
+class Counter(_Metric):
+    """A monotonically increasing count per label set."""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        """Adds `amount` (non-negative) to the series of `labels`."""
+        if amount < 0:
+            raise ValueError(f"Counter {self.name} can only increase.")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        """Returns the current count of the series of `labels` (0 if never incremented)."""
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> List[str]:
+        """Returns the exposition lines of this counter."""
+        with self._lock:
+            values = sorted(self._values.items())
+        return self._header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    """Observations counted into fixed buckets per label set, with their sum and count."""
+
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets if not math.isinf(b)))
+        # Per series: [per-bucket counts (last one is +Inf, not cumulative), sum, count]
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        """Records one observation in the series of `labels`."""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value) # First bucket whose upper bound is >= value.
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        """Observes the duration of the `with` block in seconds (also when it raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self, **labels: Any) -> Dict[str, Any]:
+        """
+        Returns the state of the series of `labels`.
+
+        Returns:
+            A dict with 'count', 'sum' and 'buckets' (cumulative counts keyed by upper
+            bound, ending with `math.inf`).
+        """
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            counts, total, count = (list(series[0]), series[1], series[2]) if series else ([0] * (len(self.buckets) + 1), 0.0, 0)
+        cumulative, running = {}, 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            running += bucket_count
+            cumulative[bound] = running
+        return {"count": count, "sum": total, "buckets": cumulative}
+
+    def render(self) -> List[str]:
+        """Returns the exposition lines of this histogram (cumulative `_bucket` series, `_sum` and `_count`)."""
+        with self._lock:
+            series = sorted((key, list(s[0]), s[1], s[2]) for key, s in self._series.items())
+        lines = self._header()
+        for key, counts, total, count in series:
+            running = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                running += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {running}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """A named collection of metrics that renders them together."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Adds a metric. Raises ValueError if its name is taken."""
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        """Creates and registers a counter."""
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float], labelnames: Sequence[str] = ()) -> Histogram:
+        """Creates and registers a histogram."""
+        return self.register(Histogram(name, documentation, buckets, labelnames))
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+"""The process-wide registry of the metrics below."""
+
+LLM_REQUEST_SECONDS = REGISTRY.histogram(
+    f"{METRIC_PREFIX}llm_request_duration_seconds",
+    "Duration of LLM chat completions through the gateway, including queueing and retries.",
+    LATENCY_BUCKETS_S, ("model", "outcome"),
+)
+LLM_TOKENS = REGISTRY.counter(
+    f"{METRIC_PREFIX}llm_tokens_total",
+    "LLM tokens by type; 'cached' prompt tokens were served from the provider's prompt cache.",
+    ("type",),
+)
+SKYSERVER_REQUEST_SECONDS = REGISTRY.histogram(
+    f"{METRIC_PREFIX}skyserver_request_duration_seconds",
+    "Duration of single SkyServer HTTP requests (hedged requests are observed separately).",
+    LATENCY_BUCKETS_S, ("endpoint", "outcome"),
+)
+SKYSERVER_RESPONSE_BYTES = REGISTRY.histogram(
+    f"{METRIC_PREFIX}skyserver_response_bytes",
+    "Body size of completed SkyServer HTTP responses.",
+    BYTES_BUCKETS, ("endpoint",),
+)
+CSV_PARSE_SECONDS = REGISTRY.histogram(
+    f"{METRIC_PREFIX}skyserver_csv_parse_duration_seconds",
+    "Time spent parsing SkyServer CSV responses into DataFrames.",
+    LATENCY_BUCKETS_S,
+)
+AGENT_STAGE_SECONDS = REGISTRY.histogram(
+    f"{METRIC_PREFIX}agent_stage_duration_seconds",
+    "Duration of agent stages (retrieval, prompt, generation, validation, execution, verification, explanation).",
+    LATENCY_BUCKETS_S, ("stage",),
+)
+AGENT_ATTEMPTS = REGISTRY.histogram(
+    f"{METRIC_PREFIX}agent_attempts_per_question",
+    "Number of SQL attempts the agent made per question, by final status.",
+    ATTEMPT_BUCKETS, ("status",),
+)
+AGENT_CORRECTIONS = REGISTRY.counter(
+    f"{METRIC_PREFIX}agent_corrections_total",
+    "Agent attempts that failed and needed a correction, by reason.",
+    ("reason",),
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    f"{METRIC_PREFIX}cache_requests_total",
+    "Cache lookups by cache and result (hit or miss).",
+    ("cache", "result"),
+)
+
+
+def classify_execution_error(message: str) -> str:
+    """
+    Returns the correction reason of a failed SQL execution from its error message.
+
+    SkyServer reports SQL errors as HTML or text pages containing "error near";
+    other HTML pages (maintenance, proxy errors) are 'html_error'.
+    """
+    lowered = message.lower()
+    if "error near" in lowered:
+        return "error_near"
+    if "html" in lowered:
+        return "html_error"
+    if "timed out" in lowered or "timeout" in lowered:
+        return "timeout"
+    return "execution_error"
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    """Counts one lookup of `cache` as a hit or a miss."""
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def render_metrics() -> str:
+    """Returns the process-wide metrics in the Prometheus text exposition format."""
+    return REGISTRY.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serves `GET /metrics` (and `/`) with the rendered registry."""
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"Metrics request from {self.address_string()}: {format % args}")
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_attempted = False
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int = config.METRICS_PORT, host: str = config.METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """
+    Serves the metrics over HTTP on a daemon thread.
+
+    Only the first call with a non-zero port tries to start a server, so the call is
+    safe on every Streamlit rerun.
+
+    Args:
+        port: Port to listen on; 0 disables the server.
+        host: Interface to bind (local only by default).
+
+    Returns:
+        The running server, or None if disabled or the port could not be bound.
+    """
+    global _server, _server_attempted
+    with _server_lock:
+        if _server_attempted or not port:
+            return _server
+        _server_attempted = True
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            logger.warning(f"Could not start the metrics server on {host}:{port}: {e}")
+            return None
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+        return _server
@@ -0,0 +1,132 @@
+"""
+Tiered LLM model routing for SQL generation.
+
+First-attempt generations are mostly simple single-table SELECTs that a small,
+fast model handles well, so they are sent to the "fast" tier. Corrections (after
+a database error, a local validation failure or a data structure issue) escalate
+to the "strong" tier. Per-tier call latency and attempt outcomes are recorded in
+`ROUTER_STATS` so the routing can be evaluated against a single-model setup.
+
+Both tiers default to `config.LLM_PROVIDER_MODEL`, so routing is a no-op until
+OPENAI_FAST_MODEL and/or OPENAI_STRONG_MODEL are set.
+"""
+import logging
+import threading
+import statistics
+from collections import deque
+from typing import Dict, Any
+
+import config
+
+logger = logging.getLogger(__name__)
+
+MODEL_TIER_FAST = "fast"
+"""Tier used for first-attempt SQL generation."""
+
+MODEL_TIER_STRONG = "strong"
+"""Tier used for SQL correction after a failed attempt."""
+
+MAX_LATENCY_SAMPLES = 500
+"""Number of most recent call latencies kept per tier for the median/p95 statistics."""
+
+
+def _new_tier_stats() -> Dict[str, Any]:
+    """Returns empty counters for one model tier."""
+    return {"calls": 0, "errors": 0, "successes": 0, "failures": 0, "latencies_ms": deque(maxlen=MAX_LATENCY_SAMPLES)}
+
+
+ROUTER_STATS: Dict[str, Dict[str, Any]] = {MODEL_TIER_FAST: _new_tier_stats(), MODEL_TIER_STRONG: _new_tier_stats()}
+"""Per-tier counters: LLM calls, call errors, attempt successes/failures and recent latencies."""
+
+_ROUTER_STATS_LOCK = threading.Lock()
+
+
+def _strip_provider_prefix(model: str) -> str:
+    """Strips a provider prefix such as 'openai/' from a model identifier."""
+    return model.split('/')[-1] if '/' in model else model
+
+
+def get_model_for_tier(tier: str) -> str:
+    """
+    Returns the model name to call for a tier.
+
+    Args:
+        tier: `MODEL_TIER_FAST` or `MODEL_TIER_STRONG`. Unknown tiers fall back to the strong tier.
+
+    Returns:
+        The model identifier, without a provider prefix.
+    """
+    if tier == MODEL_TIER_FAST:
+        return _strip_provider_prefix(config.LLM_FAST_MODEL)
+    return _strip_provider_prefix(config.LLM_STRONG_MODEL)
+
+
+def select_model_tier(correction: bool) -> str:
+    """
+    Chooses the model tier for an LLM call.
+
+    Args:
+        correction: True if the call corrects a previous attempt (database error,
+            local validation failure or data structure issue).
+
+    Returns:
+        `MODEL_TIER_STRONG` for corrections, otherwise `MODEL_TIER_FAST`.
+    """
+    return MODEL_TIER_STRONG if correction else MODEL_TIER_FAST
+
+
+def record_llm_call(tier: str, latency_ms: float, error: bool = False) -> None:
+    """
+    Records one LLM call for a tier.
+
+    Args:
+        tier: The tier the call was routed to.
+        latency_ms: Wall-clock latency of the call in milliseconds.
+        error: True if the call raised instead of returning a response.
+    """
+    with _ROUTER_STATS_LOCK:
+        stats = ROUTER_STATS.setdefault(tier, _new_tier_stats())
+        stats["calls"] += 1
+        stats["latencies_ms"].append(latency_ms)
+        if error:
+            stats["errors"] += 1
+
+
+def record_attempt_outcome(tier: str, success: bool) -> None:
+    """
+    Records whether SQL produced by a tier ended in a verified result.
+
+    Args:
+        tier: The tier that produced the SQL.
+        success: True if the SQL executed and its data passed verification.
+    """
+    with _ROUTER_STATS_LOCK:
+        stats = ROUTER_STATS.setdefault(tier, _new_tier_stats())
+        stats["successes" if success else "failures"] += 1
+
+
+def get_router_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Returns per-tier routing statistics.
+
+    Returns:
+        A dict keyed by tier with the model name, call/error counts, attempt
+        successes/failures, success rate and median/p95 call latency (ms).
+    """
+    with _ROUTER_STATS_LOCK:
+        snapshot = {tier: {**stats, "latencies_ms": sorted(stats["latencies_ms"])} for tier, stats in ROUTER_STATS.items()}
+    summary = {}
+    for tier, stats in snapshot.items():
+        latencies = stats["latencies_ms"]
+        outcomes = stats["successes"] + stats["failures"]
+        summary[tier] = {
+            "model": get_model_for_tier(tier),
+            "calls": stats["calls"],
+            "errors": stats["errors"],
+            "successes": stats["successes"],
+            "failures": stats["failures"],
+            "success_rate": stats["successes"] / outcomes if outcomes else None,
+            "median_latency_ms": statistics.median(latencies) if latencies else None,
+            "p95_latency_ms": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] if latencies else None,
+        }
+    return summary
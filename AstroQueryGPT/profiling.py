@@ -0,0 +1,258 @@
+"""
+Opt-in profiling of single agent runs.
+
+When a question is slow, `Agent.run(..., profile=True)` (or `config.ENABLE_PROFILING`
+for every run) wraps the run in a profiler, so schema retrieval
+(`retrieve_relevant_schema`), SkyServer execution (`query_sdss`) and the LLM calls
+show up with their callers. Two modes (`config.PROFILE_MODE`):
+
+- 'sample': a background thread samples the run's stack every
+  `config.PROFILE_SAMPLE_INTERVAL_S` (wall clock, so time spent waiting for the
+  LLM or SkyServer is attributed to the waiting call). Writes collapsed stacks
+  (`<request_id>.folded`, one "frame;frame;frame count" line per stack) for
+  flamegraph.pl, inferno or speedscope.
+- 'cprofile': the deterministic `cProfile` profiler on the run's thread. Writes
+  `<request_id>.prof` for pstats, snakeviz or flameprof.
+
+Both modes also write the top functions (`<request_id>.top.txt`) and return them in
+the run's result. Only the thread running the agent loop is profiled; work handed to
+helper threads (HTTP reads of hedged SkyServer requests, the LLM client call) appears
+as the time the loop waits for it. With profiling off, nothing is set up.
+"""
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from collections import Counter
+from contextlib import nullcontext
+from types import CodeType, FrameType
+from typing import Any, ContextManager, Dict, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ("sample", "cprofile")
+
+
+def _frame_label(code: CodeType, cache: Dict[CodeType, str]) -> str:
+    """Returns a frame's flamegraph label, "function (file.py:line)"."""
+    label = cache.get(code)
+    if label is None:
+        label = cache[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+def _stack_depth(frame: Optional[FrameType]) -> int:
+    depth = 0
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+class _StackSampler(threading.Thread):
+    """Samples one thread's stack at a fixed interval and counts identical stacks."""
+
+    def __init__(self, thread_id: int, base_depth: int, interval_s: float):
+        """
+        Args:
+            thread_id: The `threading.get_ident()` of the sampled thread.
+            base_depth: Number of outermost frames left out of every stack (the
+                frames below the profiled block, e.g. the UI framework).
+            interval_s: Seconds between samples.
+        """
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.base_depth = base_depth
+        self.interval_s = interval_s
+        self.stacks: Counter = Counter()
+        self._stop_event = threading.Event()
+        self._labels: Dict[CodeType, str] = {}
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code, self._labels))
+                frame = frame.f_back
+            labels.reverse()
+            if len(labels) >= self.base_depth:
+                self.stacks[";".join(labels[self.base_depth - 1:])] += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+def collapsed_stacks(stacks: Counter) -> str:
+    """Returns sampled stacks in the collapsed ("folded") flamegraph format."""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def top_sampled_functions(stacks: Counter, seconds_per_sample: float, top_n: int) -> List[Dict[str, Any]]:
+    """
+    Ranks functions by the wall time of the samples they appear in.
+
+    Returns:
+        Up to `top_n` dicts with 'function', 'calls' (None: not known when sampling),
+        'self_s' (samples where the function was running) and 'total_s' (samples
+        where it was on the stack), ordered by 'total_s' and then 'self_s'.
+    """
+    self_samples: Counter = Counter()
+    total_samples: Counter = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        self_samples[frames[-1]] += count
+        for function in set(frames):
+            total_samples[function] += count
+    ranked = sorted(total_samples, key=lambda f: (-total_samples[f], -self_samples[f], f))[:top_n]
+    return [
+        {
+            "function": function, "calls": None,
+            "self_s": round(self_samples[function] * seconds_per_sample, 4),
+            "total_s": round(total_samples[function] * seconds_per_sample, 4),
+        }
+        for function in ranked
+    ]
+
+
+def top_profiled_functions(stats: pstats.Stats, top_n: int) -> List[Dict[str, Any]]:
+    """Ranks `cProfile` functions by cumulative time (same keys as `top_sampled_functions`)."""
+    rows = []
+    for (filename, line, name), (_, calls, self_s, total_s, _) in stats.stats.items():
+        rows.append({
+            "function": f"{name} ({os.path.basename(filename)}:{line})", "calls": calls,
+            "self_s": round(self_s, 4), "total_s": round(total_s, 4),
+        })
+    rows.sort(key=lambda row: (-row["total_s"], -row["self_s"], row["function"]))
+    return rows[:top_n]
+
+
+def format_top_functions(top: List[Dict[str, Any]]) -> str:
+    """Formats top functions as a fixed-width text table."""
+    lines = [f"{'total_s':>10} {'self_s':>10} {'calls':>8}  function"]
+    for row in top:
+        calls = "-" if row["calls"] is None else str(row["calls"])
+        lines.append(f"{row['total_s']:>10.4f} {row['self_s']:>10.4f} {calls:>8}  {row['function']}")
+    return "\n".join(lines) + "\n"
+
+
+class RunProfiler:
+    """
+    Context manager profiling the `with` block on the current thread.
+
+    After the block, `profile` holds the summary that goes into the run's result:
+    'mode', 'path' (the flamegraph or pstats file), 'stats_path' (the top functions
+    as text), 'elapsed_s', 'samples' (sampling mode) and 'top' (see
+    `top_sampled_functions`). It stays None if the profiler could not start.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        mode: str = config.PROFILE_MODE,
+        output_dir: str = config.PROFILE_OUTPUT_DIR,
+        interval_s: float = config.PROFILE_SAMPLE_INTERVAL_S,
+        top_n: int = config.PROFILE_TOP_N,
+    ):
+        """
+        Args:
+            name: Base name of the output files (e.g. the request ID).
+            mode: 'sample' or 'cprofile'.
+            output_dir: Directory for the output files; created if missing.
+            interval_s: Seconds between stack samples (sampling mode).
+            top_n: Number of functions in the top list.
+
+        Raises:
+            ValueError: If `mode` is unknown.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}'. Use one of {PROFILE_MODES}.")
+        self.name = name
+        self.mode = mode
+        self.output_dir = output_dir
+        self.interval_s = interval_s
+        self.top_n = top_n
+        self.profile: Optional[Dict[str, Any]] = None
+        self._sampler: Optional[_StackSampler] = None
+        self._profiler: Optional[cProfile.Profile] = None
+        self._start = 0.0
+
+    def __enter__(self) -> "RunProfiler":
+        if self.mode == "sample":
+            # Stacks start at the frame that entered the profiler.
+            base_depth = _stack_depth(sys._getframe(1))
+            self._sampler = _StackSampler(threading.get_ident(), base_depth, self.interval_s)
+            self._sampler.start()
+        else:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e: # Another profiler is active on this thread (or interpreter, on 3.12+).
+                logger.warning(f"Could not profile run {self.name}: {e}")
+                return self
+            self._profiler = profiler
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        elapsed_s = time.perf_counter() - self._start
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._write_sampled(self._sampler.stacks, elapsed_s)
+        elif self._profiler is not None:
+            self._profiler.disable()
+            self._write_profiled(self._profiler, elapsed_s)
+
+    def _paths(self, extension: str) -> Dict[str, str]:
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, self.name)
+        return {"path": f"{base}{extension}", "stats_path": f"{base}.top.txt"}
+
+    def _write(self, paths: Dict[str, str], top: List[Dict[str, Any]], **summary: Any) -> None:
+        self.profile = {"mode": self.mode, **paths, **summary, "top": top}
+        try:
+            with open(paths["stats_path"], "w", encoding="utf-8") as f:
+                f.write(format_top_functions(top))
+        except OSError as e:
+            logger.warning(f"Could not write profile stats to {paths['stats_path']}: {e}")
+        logger.info(f"Profile of run {self.name} ({self.mode}, {summary['elapsed_s']:.2f}s) written to {paths['path']}")
+
+    def _write_sampled(self, stacks: Counter, elapsed_s: float) -> None:
+        samples = sum(stacks.values())
+        seconds_per_sample = elapsed_s / samples if samples else self.interval_s
+        paths = self._paths(".folded")
+        try:
+            with open(paths["path"], "w", encoding="utf-8") as f:
+                f.write(collapsed_stacks(stacks))
+        except OSError as e:
+            logger.warning(f"Could not write profile to {paths['path']}: {e}")
+        top = top_sampled_functions(stacks, seconds_per_sample, self.top_n)
+        self._write(paths, top, elapsed_s=round(elapsed_s, 4), samples=samples)
+
+    def _write_profiled(self, profiler: cProfile.Profile, elapsed_s: float) -> None:
+        paths = self._paths(".prof")
+        try:
+            profiler.dump_stats(paths["path"])
+        except OSError as e:
+            logger.warning(f"Could not write profile to {paths['path']}: {e}")
+        top = top_profiled_functions(pstats.Stats(profiler), self.top_n)
+        self._write(paths, top, elapsed_s=round(elapsed_s, 4), samples=None)
+
+
+def profile_run(name: str, enabled: bool) -> ContextManager[Optional[RunProfiler]]:
+    """
+    Returns a `RunProfiler` for the block if `enabled`, else a no-op context yielding None.
+
+    Args:
+        name: Base name of the output files (e.g. the request ID).
+        enabled: Whether to profile.
+    """
+    if not enabled:
+        return nullcontext()
+    return RunProfiler(name)
@@ -0,0 +1,182 @@
+"""
+Token-budgeted packing of schema context for the RAG prompt.
+
+This module includes functionalities for:
+- Counting tokens with a local tokenizer (tiktoken when installed, otherwise a
+  fast regex approximation), cached per string.
+- Scoring individual fields of the retrieved tables by relevance to the user query.
+- Greedily filling a configurable token budget with the most relevant fields
+  across all retrieved tables.
+"""
+import re
+import logging
+from functools import lru_cache
+from typing import List, Dict, Any, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # Optional dependency; the regex approximation is used instead.
+    tiktoken = None
+
+TIKTOKEN_ENCODING = "cl100k_base"
+"""tiktoken encoding used for token counting when tiktoken is available."""
+
+LEXICAL_MATCH_WEIGHT = 0.5
+"""Weight of query/field term overlap in a field's relevance score."""
+
+KEY_FIELD_BONUS = 0.15
+"""Relevance bonus for identifier and position fields (primary keys, ra, dec) that most queries need."""
+
+FIELD_POSITION_WEIGHT = 0.05
+"""Small prior favouring fields listed early in a table (SDSS lists the most used columns first)."""
+
+_APPROX_TOKEN_RE = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+_TERM_RE = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+_KEY_FIELD_NAMES = {"ra", "dec", "objid", "specobjid", "bestobjid"}
+_BAND_TERMS = {"u", "g", "r", "i", "z"}
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "find", "get", "give", "has", "have",
+    "in", "is", "it", "list", "me", "of", "on", "or", "show", "than", "that", "the", "their", "them",
+    "there", "these", "this", "to", "top", "what", "which", "with", "all", "any", "some", "objects",
+    "band", "bands", "filter",
+}
+
+_encoding = None
+
+
+def _get_encoding():
+    """Returns the tiktoken encoding, or None if tiktoken (or its encoding file) is unavailable."""
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        except Exception as e:
+            logger.warning(f"tiktoken encoding '{TIKTOKEN_ENCODING}' unavailable ({e}). Using approximate token counts.")
+            return None
+    return _encoding
+
+
+@lru_cache(maxsize=16384)
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens in a string. Results are cached per string.
+
+    Uses tiktoken if available; otherwise approximates BPE behaviour by counting
+    words (long words count one token per 4 characters), numbers and punctuation.
+
+    Args:
+        text: The text to measure.
+
+    Returns:
+        The (approximate) number of tokens.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return sum((len(piece) + 3) // 4 if piece.isalpha() else 1 for piece in _APPROX_TOKEN_RE.findall(text))
+
+
+def _terms(text: str) -> set:
+    """Splits text (including camelCase and snake_case identifiers) into lowercase terms, dropping stopwords."""
+    terms = {t.lower() for t in _TERM_RE.findall(text or "")}
+    return {t for t in terms if t not in _STOPWORDS and (len(t) > 1 or t in _BAND_TERMS)}
+
+
+def format_field_line(field: Dict[str, Any]) -> str:
+    """Renders one schema field as a prompt line."""
+    return (
+        f"- {field.get('name', 'N/A')} "
+        f"(Type: {field.get('type', 'N/A')}, "
+        f"Description: {field.get('description', 'N/A')})"
+    )
+
+
+def score_fields(
+    user_query: str,
+    table_schema: Dict[str, Any],
+    table_score: float,
+    fields: List[Dict[str, Any]],
+) -> List[Tuple[float, int]]:
+    """
+    Scores every field of a table by relevance to the user query.
+
+    The score combines the table's retrieval score, the overlap between query terms
+    and the field's name/description terms, a bonus for key fields and a small
+    position prior.
+
+    Args:
+        user_query: The user's natural language query.
+        table_schema: The table the fields belong to.
+        table_score: Semantic relevance score of the table.
+        fields: The fields to score (as rendered in the prompt).
+
+    Returns:
+        A list of (score, field_index) tuples.
+    """
+    query_terms = _terms(user_query)
+    # Band letters alone are weak evidence (every PhotoObjAll column has one).
+    term_weights = {t: (0.25 if t in _BAND_TERMS else 1.0) for t in query_terms}
+    total_weight = sum(term_weights.values())
+    num_fields = max(len(fields), 1)
+    scored = []
+    for idx, field in enumerate(fields):
+        field_terms = _terms(field.get("name", "")) | _terms(field.get("description", ""))
+        overlap = sum(term_weights[t] for t in query_terms & field_terms) / total_weight if total_weight else 0.0
+        name = field.get("name", "").lower()
+        is_key = name in _KEY_FIELD_NAMES or "primary key" in field.get("description", "").lower()
+        score = (
+            table_score
+            + LEXICAL_MATCH_WEIGHT * overlap
+            + (KEY_FIELD_BONUS if is_key else 0.0)
+            + FIELD_POSITION_WEIGHT * (1 - idx / num_fields)
+        )
+        scored.append((score, idx))
+    return scored
+
+
+def pack_schema_context(
+    user_query: str,
+    tables: List[Tuple[Dict[str, Any], float, List[Dict[str, Any]]]],
+    token_budget: int = config.PROMPT_CONTEXT_TOKEN_BUDGET,
+    header_tokens: int = 0,
+) -> Tuple[List[List[Dict[str, Any]]], int]:
+    """
+    Selects fields across all retrieved tables greedily by relevance until the token budget is used.
+
+    Args:
+        user_query: The user's natural language query.
+        tables: (table_schema, table_score, fields) triples for the retrieved tables.
+        token_budget: Total tokens available for the schema context.
+        header_tokens: Tokens already committed to table headers (name/description lines).
+
+    Returns:
+        A tuple of (selected_fields_per_table, used_tokens). Selected fields keep the
+        table's original field order so the rendered context is stable.
+    """
+    candidates = []
+    for table_idx, (table_schema, table_score, fields) in enumerate(tables):
+        for score, field_idx in score_fields(user_query, table_schema, table_score, fields):
+            candidates.append((score, table_idx, field_idx))
+    candidates.sort(key=lambda c: (-c[0], c[1], c[2]))
+
+    used_tokens = header_tokens
+    selected = [set() for _ in tables]
+    for _, table_idx, field_idx in candidates:
+        line_tokens = count_tokens(format_field_line(tables[table_idx][2][field_idx])) + 1  # +1 for the newline
+        if used_tokens + line_tokens > token_budget:
+            continue  # A shorter, less relevant field may still fit.
+        selected[table_idx].add(field_idx)
+        used_tokens += line_tokens
+
+    packed = [[fields[i] for i in sorted(chosen)] for (_, _, fields), chosen in zip(tables, selected)]
+    logger.debug(
+        f"Packed {sum(len(p) for p in packed)} of {sum(len(t[2]) for t in tables)} fields "
+        f"into {used_tokens}/{token_budget} context tokens."
+    )
+    return packed, used_tokens
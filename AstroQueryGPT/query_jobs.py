@@ -0,0 +1,575 @@
+"""
+Asynchronous long-running SkyServer queries as tracked jobs (CasJobs-style).
+
+The synchronous `x_sql.aspx` path of `sdss_db.query_sdss` fails on anything that
+runs longer than the server limit or `sdss_db.REQUEST_TIMEOUT`. Large extracts
+instead run as batch jobs:
+
+- Submit: the query is rewritten to `SELECT IDENTITY(bigint, 1, 1) AS _job_row, ...
+  INTO mydb.<table> FROM ...` and submitted to a `JobBackend` (CasJobs by default).
+- Poll: one background thread polls every active job with exponential backoff,
+  so waiting jobs hold no worker thread.
+- Fetch: results are read from the output table in keyset-ordered chunks of
+  `_job_row`.
+- Clean up: output tables of failed and cancelled jobs are dropped right away,
+  those of finished jobs when their record expires (`config.QUERY_JOB_RETENTION_S`),
+  so MyDB quota is not used by tables nothing refers to any more. A record is
+  only forgotten once its table is dropped.
+
+Job state is persisted to `config.QUERY_JOBS_STATE_PATH`, so jobs submitted
+before an app restart are resumed and their results can still be fetched.
+"""
+import os
+import abc
+import json
+import time
+import uuid
+import logging
+import threading
+from io import StringIO
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+import requests
+
+import config
+from request_context import RequestContext, CANCEL_POLL_INTERVAL_S
+from sdss_db import convert_id_columns
+from sql_validator import _TOKEN_RE
+
+logger = logging.getLogger(__name__)
+
+JOB_SUBMITTED = "submitted"
+JOB_RUNNING = "running"
+JOB_FINISHED = "finished"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+ACTIVE_JOB_STATES = (JOB_SUBMITTED, JOB_RUNNING)
+
+JOB_ROW_COLUMN = "_job_row"
+"""Identity column added to job output tables; result chunks are keyed on it."""
+
+_CASJOBS_STATES = {
+    0: JOB_SUBMITTED, 1: JOB_RUNNING, 2: JOB_RUNNING, 3: JOB_CANCELLED, 4: JOB_FAILED, 5: JOB_FINISHED,
+}
+"""CasJobs job status codes (ready, started, canceling, cancelled, failed, finished)."""
+
+
+class JobNotReady(RuntimeError):
+    """Raised when results of a job that has not finished are requested."""
+
+
+def make_job_sql(sql_query: str, output_table: str) -> str:
+    """
+    Rewrites a SELECT query to store its rows, numbered, in a MyDB output table.
+
+    Args:
+        sql_query: The T-SQL SELECT query (may start with a WITH clause).
+        output_table: Name of the MyDB table to create.
+
+    Returns:
+        The query with `IDENTITY(bigint, 1, 1) AS _job_row` added to the outer select
+        list and `INTO mydb.<output_table>` before its FROM.
+
+    Raises:
+        ValueError: If the query cannot be rewritten (not a single SELECT, DISTINCT,
+            set operators, an existing INTO, or no FROM clause).
+    """
+    matches = [m for m in _TOKEN_RE.finditer(sql_query) if m.lastgroup not in ("ws", "comment")]
+    depth = 0
+    select_end: Optional[int] = None
+    from_start: Optional[int] = None
+    idx = 0
+    while idx < len(matches):
+        match = matches[idx]
+        text = match.group().lower()
+        if text == "(":
+            depth += 1
+        elif text == ")":
+            depth -= 1
+        elif depth == 0 and match.lastgroup == "word":
+            if text in ("union", "except", "intersect", "into"):
+                raise ValueError(f"Queries with {text.upper()} cannot run as jobs.")
+            if text == "select" and select_end is None:
+                select_end = match.end()
+                nxt = matches[idx + 1].group().lower() if idx + 1 < len(matches) else ""
+                if nxt in ("distinct", "all"):
+                    if nxt == "distinct":
+                        raise ValueError("SELECT DISTINCT cannot run as a job (the row number would make every row distinct).")
+                    idx += 1
+                    select_end = matches[idx].end()
+                if idx + 1 < len(matches) and matches[idx + 1].group().lower() == "top":
+                    idx += 2
+                    if idx < len(matches) and matches[idx].group() == "(":
+                        idx += 2 # `TOP (n)`: skip the number and the closing parenthesis.
+                    select_end = matches[idx].end()
+                    if idx + 1 < len(matches) and matches[idx + 1].group().lower() in ("percent", "with"):
+                        raise ValueError("TOP ... PERCENT / WITH TIES cannot run as a job.")
+            elif text == "from" and select_end is not None and from_start is None:
+                from_start = match.start()
+        idx += 1
+    if select_end is None or from_start is None:
+        raise ValueError("Only SELECT ... FROM queries can run as jobs.")
+    return (
+        f"{sql_query[:select_end]} IDENTITY(bigint, 1, 1) AS {JOB_ROW_COLUMN},"
+        f"{sql_query[select_end:from_start]}INTO mydb.{output_table} {sql_query[from_start:]}"
+    )
+
+
+class JobBackend(abc.ABC):
+    """
+    Interface of a batch query service.
+
+    Implementations submit rewritten queries (see `make_job_sql`), report job states
+    (one of the JOB_* constants) and read output tables in chunks. A backend missing
+    one of the methods cannot be instantiated.
+    """
+
+    @abc.abstractmethod
+    def submit(self, job_sql: str, task_name: str) -> str:
+        """Submits a job. Returns the backend's job id."""
+
+    @abc.abstractmethod
+    def status(self, backend_job_id: str) -> Tuple[str, str]:
+        """Returns the job state (JOB_*) and the backend's status message."""
+
+    @abc.abstractmethod
+    def cancel(self, backend_job_id: str) -> None:
+        """Cancels a submitted or running job."""
+
+    @abc.abstractmethod
+    def fetch_rows(self, output_table: str, after_row: int, limit: int) -> pd.DataFrame:
+        """Returns up to `limit` output rows with `_job_row` > `after_row`, ordered by `_job_row`."""
+
+    @abc.abstractmethod
+    def drop_output(self, output_table: str) -> None:
+        """Deletes a job's output table. Does nothing if the table does not exist (e.g. the job failed early)."""
+
+
+class CasJobsBackend(JobBackend):
+    """`JobBackend` for the SciServer CasJobs REST API."""
+
+    def __init__(
+        self,
+        base_url: str = config.CASJOBS_URL,
+        token: str = config.CASJOBS_TOKEN,
+        context: str = config.CASJOBS_CONTEXT,
+        timeout_s: float = 60.0,
+    ):
+        """
+        Args:
+            base_url: Root of the REST API, e.g. 'https://skyserver.sdss.org/CasJobs/RestApi'.
+            token: SciServer authentication token.
+            context: Database the jobs run against, e.g. 'DR16'.
+            timeout_s: Timeout of each REST call (the jobs themselves are not bounded by it).
+        """
+        self.base_url = base_url.rstrip("/")
+        self.context = context
+        self.timeout_s = timeout_s
+        self.session = requests.Session()
+        self.session.headers.update({"X-Auth-Token": token})
+
+    def submit(self, job_sql: str, task_name: str) -> str:
+        response = self.session.put(
+            f"{self.base_url}/contexts/{self.context}/jobs",
+            json={"Query": job_sql, "TaskName": task_name},
+            timeout=self.timeout_s,
+        )
+        response.raise_for_status()
+        return response.text.strip().strip('"')
+
+    def status(self, backend_job_id: str) -> Tuple[str, str]:
+        response = self.session.get(f"{self.base_url}/jobs/{backend_job_id}", timeout=self.timeout_s)
+        response.raise_for_status()
+        info = response.json()
+        state = _CASJOBS_STATES.get(info.get("Status"), JOB_RUNNING)
+        return state, info.get("Error") or info.get("Message") or ""
+
+    def cancel(self, backend_job_id: str) -> None:
+        self.session.delete(f"{self.base_url}/jobs/{backend_job_id}", timeout=self.timeout_s).raise_for_status()
+
+    def _quick_query(self, sql_query: str) -> str:
+        """Runs a short query in the MyDB context and returns the CSV text."""
+        response = self.session.post(
+            f"{self.base_url}/contexts/MyDB/query",
+            json={"Query": sql_query, "TaskName": "AstroQueryGPT"},
+            headers={"Accept": "text/plain"},
+            timeout=self.timeout_s,
+        )
+        response.raise_for_status()
+        return response.text
+
+    def fetch_rows(self, output_table: str, after_row: int, limit: int) -> pd.DataFrame:
+        text = self._quick_query(
+            f"SELECT TOP {int(limit)} * FROM {output_table} WHERE {JOB_ROW_COLUMN} > {int(after_row)} ORDER BY {JOB_ROW_COLUMN}"
+        )
+        if not text.strip():
+            return pd.DataFrame()
+        return pd.read_csv(StringIO(text), comment="#")
+
+    def drop_output(self, output_table: str) -> None:
+        self._quick_query(f"IF OBJECT_ID('{output_table}') IS NOT NULL DROP TABLE {output_table}")
+
+
+class QueryJobManager:
+    """
+    Tracks query jobs, persists their state and polls them from one background thread.
+
+    Attributes:
+        backend: The batch query service.
+        state_path: JSON file holding the job records.
+        stats: 'submitted', 'finished', 'failed', 'cancelled', 'polls', 'poll_errors',
+            'outputs_dropped' and 'drop_errors'.
+    """
+
+    def __init__(
+        self,
+        backend: JobBackend,
+        state_path: str = config.QUERY_JOBS_STATE_PATH,
+        poll_initial_s: float = config.QUERY_JOB_POLL_INITIAL_S,
+        poll_max_s: float = config.QUERY_JOB_POLL_MAX_S,
+        poll_backoff: float = config.QUERY_JOB_POLL_BACKOFF,
+        retention_s: float = config.QUERY_JOB_RETENTION_S,
+    ):
+        """
+        Args:
+            backend: The batch query service.
+            state_path: JSON file holding the job records (created on first submit).
+            poll_initial_s: First poll interval of a job.
+            poll_max_s: Longest poll interval.
+            poll_backoff: Factor the poll interval grows by after each poll.
+            retention_s: How long records (and output tables) of finished jobs are kept.
+        """
+        self.backend = backend
+        self.state_path = state_path
+        self.poll_initial_s = poll_initial_s
+        self.poll_max_s = poll_max_s
+        self.poll_backoff = poll_backoff
+        self.retention_s = retention_s
+        self._cond = threading.Condition()
+        self._jobs: Dict[str, Dict[str, Any]] = self._load()
+        self._poller: Optional[threading.Thread] = None
+        self._stopping = False
+        self.stats: Dict[str, int] = {
+            "submitted": 0, "finished": 0, "failed": 0, "cancelled": 0, "polls": 0, "poll_errors": 0,
+            "outputs_dropped": 0, "drop_errors": 0,
+        }
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        """Reads persisted job records. Expired ones are cleaned up by the poller (see `_clean_up`)."""
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                jobs = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read query job state from {self.state_path}: {e}")
+            return {}
+        for job in jobs.values():
+            if job["state"] not in ACTIVE_JOB_STATES:
+                job.setdefault("output_dropped", False)
+                job.setdefault("cleanup_at", self._cleanup_time(job))
+        active = sum(job["state"] in ACTIVE_JOB_STATES for job in jobs.values())
+        logger.info(f"Loaded {len(jobs)} query job(s) from {self.state_path} ({active} still active).")
+        return jobs
+
+    def _cleanup_time(self, job: Dict[str, Any]) -> float:
+        """When an ended job is cleaned up next: now for failed and cancelled jobs with a table, else on expiry."""
+        if job["state"] != JOB_FINISHED and not job.get("output_dropped"):
+            return time.time()
+        return self._expiry_time(job)
+
+    def _expiry_time(self, job: Dict[str, Any]) -> float:
+        """When an ended job's record expires."""
+        return (job.get("finished_at") or job["submitted_at"]) + self.retention_s
+
+    def _save(self) -> None:
+        """Writes all job records atomically. Caller holds the lock."""
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._jobs, f, indent=1)
+        os.replace(tmp_path, self.state_path)
+
+    def start(self) -> None:
+        """Starts the poller thread (idempotent). Active jobs from a previous run are resumed."""
+        with self._cond:
+            if self._poller is not None:
+                return
+            self._stopping = False
+            self._poller = threading.Thread(target=self._poll_loop, name="query-job-poller", daemon=True)
+            self._poller.start()
+
+    def shutdown(self) -> None:
+        """Stops the poller. Jobs keep running on the backend and are resumed by the next `start`."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            poller, self._poller = self._poller, None
+        if poller is not None:
+            poller.join(timeout=5)
+
+    def submit(self, sql_query: str, user_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Submits a query as a job.
+
+        Args:
+            sql_query: The T-SQL SELECT query.
+            user_id: Who submitted it (recorded only).
+
+        Returns:
+            A copy of the job record.
+
+        Raises:
+            ValueError: If the query cannot run as a job (see `make_job_sql`).
+            requests.exceptions.RequestException: If the backend rejects the submission.
+        """
+        job_id = uuid.uuid4().hex
+        output_table = f"aqg_{job_id[:16]}"
+        job_sql = make_job_sql(sql_query, output_table)
+        backend_job_id = self.backend.submit(job_sql, task_name=f"AstroQueryGPT {job_id[:8]}")
+        now = time.time()
+        job = {
+            "job_id": job_id,
+            "backend_job_id": backend_job_id,
+            "sql": sql_query,
+            "output_table": output_table,
+            "user_id": user_id,
+            "state": JOB_SUBMITTED,
+            "message": "",
+            "submitted_at": now,
+            "finished_at": None,
+            "polls": 0,
+            "poll_interval_s": self.poll_initial_s,
+            "next_poll_at": now + self.poll_initial_s,
+        }
+        with self._cond:
+            self._jobs[job_id] = job
+            self.stats["submitted"] += 1
+            self._save()
+            self._cond.notify_all()
+        logger.info(f"Submitted query job {job_id} (backend job {backend_job_id}): {sql_query[:100]}...")
+        self.start()
+        return dict(job)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Returns a copy of a job record, or None if unknown."""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list_jobs(self, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Returns copies of all job records (of one user, if given), newest first."""
+        with self._cond:
+            jobs = [dict(job) for job in self._jobs.values() if user_id is None or job["user_id"] == user_id]
+        return sorted(jobs, key=lambda job: job["submitted_at"], reverse=True)
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Cancels an active job. Returns a copy of its record, or None if unknown."""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job["state"] not in ACTIVE_JOB_STATES:
+                return dict(job) if job else None
+        self.backend.cancel(job["backend_job_id"])
+        self._update(job_id, JOB_CANCELLED, "Cancelled by the user.")
+        return self.get(job_id)
+
+    def _update(self, job_id: str, state: str, message: str) -> None:
+        """Records a job's new state, persists it and wakes waiters."""
+        with self._cond:
+            job = self._jobs[job_id]
+            if job["state"] == state and job["message"] == message:
+                return
+            previous, job["state"], job["message"] = job["state"], state, message
+            if state not in ACTIVE_JOB_STATES and previous in ACTIVE_JOB_STATES:
+                job["finished_at"] = time.time()
+                job["output_dropped"] = False
+                job["cleanup_at"] = self._cleanup_time(job)
+                self.stats[state] += 1
+                logger.info(f"Query job {job_id} {state} after {job['finished_at'] - job['submitted_at']:.0f}s. {message}")
+            self._save()
+            self._cond.notify_all()
+
+    def _poll_loop(self) -> None:
+        """Polls due jobs and cleans up ended ones, sleeping until the next one is due."""
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                now = time.time()
+                wake_times = [
+                    job["next_poll_at"] if job["state"] in ACTIVE_JOB_STATES else job["cleanup_at"]
+                    for job in self._jobs.values()
+                ]
+                due = [dict(job) for job, wake_at in zip(self._jobs.values(), wake_times) if wake_at <= now]
+                if not due:
+                    next_at = min(wake_times, default=None)
+                    self._cond.wait(None if next_at is None else next_at - now)
+                    continue
+            for job in due:
+                try:
+                    if job["state"] in ACTIVE_JOB_STATES:
+                        self._poll(job)
+                    else:
+                        self._clean_up(job)
+                except Exception:
+                    # E.g. an unwritable state file or an unexpected backend reply: keep the poller alive.
+                    logger.exception(f"Unexpected error while handling query job {job['job_id']}.")
+                    self._retry_later(job)
+
+    def _retry_later(self, job: Dict[str, Any]) -> None:
+        """Counts an unexpected poll or clean-up error and schedules the job's next try with backoff."""
+        with self._cond:
+            record = self._jobs.get(job["job_id"])
+            if record is None:
+                return
+            if record["state"] in ACTIVE_JOB_STATES:
+                self.stats["poll_errors"] += 1
+                record["poll_interval_s"] = min(self.poll_max_s, record["poll_interval_s"] * self.poll_backoff)
+                record["next_poll_at"] = time.time() + record["poll_interval_s"]
+            else:
+                self.stats["drop_errors"] += 1
+                record["cleanup_at"] = time.time() + self.poll_max_s
+
+    def _clean_up(self, job: Dict[str, Any]) -> None:
+        """
+        Drops an ended job's output table and forgets the record once it expired. Failed drops are retried.
+
+        The table is dropped again on expiry, since a job cancelled while running may still create it.
+        """
+        dropped = False
+        try:
+            self.backend.drop_output(job["output_table"])
+            dropped = True
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Dropping output table {job['output_table']} of query job {job['job_id']} failed: {e}")
+        with self._cond:
+            record = self._jobs.get(job["job_id"])
+            if record is None or record["state"] in ACTIVE_JOB_STATES:
+                return
+            if not dropped:
+                self.stats["drop_errors"] += 1
+                record["cleanup_at"] = time.time() + self.poll_max_s
+            else:
+                if not record["output_dropped"]:
+                    record["output_dropped"] = True
+                    self.stats["outputs_dropped"] += 1
+                    logger.info(f"Dropped output table {record['output_table']} of {record['state']} query job {job['job_id']}.")
+                if self._expiry_time(record) <= time.time():
+                    del self._jobs[job["job_id"]]
+                else:
+                    record["cleanup_at"] = self._expiry_time(record)
+            self._save()
+
+    def _poll(self, job: Dict[str, Any]) -> None:
+        """Polls one job and schedules its next poll with backoff."""
+        try:
+            state, message = self.backend.status(job["backend_job_id"])
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Polling query job {job['job_id']} failed: {e}")
+            state, message = job["state"], job["message"]
+            with self._cond:
+                self.stats["poll_errors"] += 1
+        with self._cond:
+            record = self._jobs[job["job_id"]]
+            if record["state"] not in ACTIVE_JOB_STATES:
+                return # Cancelled while the poll was in flight.
+            record["polls"] += 1
+            self.stats["polls"] += 1
+            record["poll_interval_s"] = min(self.poll_max_s, record["poll_interval_s"] * self.poll_backoff)
+            record["next_poll_at"] = time.time() + record["poll_interval_s"]
+        self._update(job["job_id"], state, message)
+
+    def wait(self, job_id: str, ctx: Optional[RequestContext] = None, timeout_s: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Blocks until a job is no longer active (for callers that want to wait in-process).
+
+        Args:
+            job_id: The job.
+            ctx: Optional request context; waiting stops when it is cancelled or out of time.
+            timeout_s: Optional limit on the wait.
+
+        Returns:
+            A copy of the job record (still active if `timeout_s` passed).
+
+        Raises:
+            KeyError: If the job is unknown.
+            RequestCancelled, DeadlineExceeded: If `ctx` ends while waiting.
+        """
+        deadline = None if timeout_s is None else time.monotonic() + timeout_s
+        with self._cond:
+            while self._jobs[job_id]["state"] in ACTIVE_JOB_STATES:
+                if ctx is not None:
+                    ctx.check("query job")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(CANCEL_POLL_INTERVAL_S if remaining is None else min(remaining, CANCEL_POLL_INTERVAL_S))
+            return dict(self._jobs[job_id])
+
+    def fetch_chunk(self, job_id: str, after_row: int = 0, limit: int = config.QUERY_JOB_CHUNK_ROWS) -> Tuple[pd.DataFrame, int]:
+        """
+        Reads one chunk of a finished job's results.
+
+        Args:
+            job_id: The job.
+            after_row: Cursor returned by the previous chunk (0 for the first).
+            limit: Maximum rows.
+
+        Returns:
+            The rows (without the row number column) and the cursor for the next chunk.
+            An empty DataFrame means all rows were read.
+
+        Raises:
+            KeyError: If the job is unknown.
+            JobNotReady: If the job has not finished successfully.
+        """
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        if job["state"] != JOB_FINISHED:
+            raise JobNotReady(f"Query job {job_id} is {job['state']}. {job['message']}".strip())
+        chunk = self.backend.fetch_rows(job["output_table"], after_row, limit)
+        if chunk.empty or JOB_ROW_COLUMN not in chunk.columns:
+            return pd.DataFrame(), after_row
+        next_row = int(chunk[JOB_ROW_COLUMN].max())
+        return convert_id_columns(chunk.drop(columns=[JOB_ROW_COLUMN]).reset_index(drop=True)), next_row
+
+    def iter_results(self, job_id: str, chunk_rows: int = config.QUERY_JOB_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+        """Yields all result chunks of a finished job. See `fetch_chunk`."""
+        after_row = 0
+        while True:
+            chunk, after_row = self.fetch_chunk(job_id, after_row, chunk_rows)
+            if chunk.empty:
+                return
+            yield chunk
+            if len(chunk) < chunk_rows:
+                return
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns a copy of the counters plus the number of active jobs."""
+        with self._cond:
+            return {
+                **self.stats,
+                "active": sum(job["state"] in ACTIVE_JOB_STATES for job in self._jobs.values()),
+            }
+
+
+_JOB_MANAGER: Optional[QueryJobManager] = None
+_JOB_MANAGER_LOCK = threading.Lock()
+
+
+def get_query_job_manager() -> Optional[QueryJobManager]:
+    """
+    Returns the process-wide job manager (started, with persisted jobs resumed).
+
+    Returns:
+        The manager, or None if job mode is not configured (no `CASJOBS_TOKEN`).
+    """
+    global _JOB_MANAGER
+    if not config.CASJOBS_TOKEN:
+        return None
+    with _JOB_MANAGER_LOCK:
+        if _JOB_MANAGER is None:
+            _JOB_MANAGER = QueryJobManager(CasJobsBackend())
+            _JOB_MANAGER.start()
+        return _JOB_MANAGER
@@ -11,21 +11,45 @@ This module includes functionalities for:
 import json
 import os
 import re
+import time
 import logging
+import threading
 from typing import List, Dict, Any, Optional, Tuple
 
 import numpy as np
 from sentence_transformers import SentenceTransformer, util
 
 import config # Import shared configurations
-from initialize_client import llm_client # Import the initialized LLM client
+from llm_gateway import LLMGateway, get_llm_gateway
+from request_context import RequestContext, RequestCancelled, DeadlineExceeded
+from sql_validator import SchemaIndex, build_schema_index
+from sql_repair import enforce_top_n_clause
+from prompt_packing import count_tokens, format_field_line, pack_schema_context
+from model_router import select_model_tier, get_model_for_tier, record_llm_call
+from schema_preprocessing import preprocess_schema, get_prompt_fields, get_corpus_text
+from tracing import span, set_span_attributes
+from log_utils import log_payload
 
 logger = logging.getLogger(__name__)
 
+# --- LLM Gateway ---
+llm_gateway: Optional[LLMGateway] = None
+"""Gateway used for all LLM calls (pooled, concurrency-limited, with retries). Created on first use."""
+
+def _get_llm_gateway() -> Optional[LLMGateway]:
+    """Returns the LLM gateway, creating the process-wide one on first use."""
+    global llm_gateway
+    if llm_gateway is None:
+        llm_gateway = get_llm_gateway()
+    return llm_gateway
+
 # --- Schema Loading ---
 SDSS_SCHEMA_GLOBAL: List[Dict[str, Any]] = []
 """Global variable to store the loaded SDSS schema. Initialized by `initialize_rag_schema`."""
 
+SDSS_SCHEMA_INDEX: Optional[SchemaIndex] = None
+"""Hash-set index of table/column names used for local SQL validation. Built alongside the schema."""
+
 # Default path for the schema file, can be overridden by config.SCHEMA_FILE_PATH
 DEFAULT_SCHEMA_MODEL = "all-MiniLM-L6-v2"
 """Default SentenceTransformer model for schema embedding and retrieval."""
@@ -34,7 +58,30 @@ MAX_FIELDS_PER_TABLE_IN_CORPUS = 30
 """Maximum number of fields from a single table to include in the semantic search corpus text."""
 
 MAX_FIELDS_PER_TABLE_IN_PROMPT = 20
-"""Maximum number of fields from a single table to include in the LLM prompt context."""
+"""Maximum number of fields from a single table to include in the LLM prompt context when no token budget is set."""
+
+# --- Static Prompt Prefixes ---
+# These strings must stay byte-identical between requests so that OpenAI-compatible
+# providers can serve them from their prompt (prefix) cache. Anything that varies per
+# request (TOP N, relevance scores, the user's question) goes at the end of the prompt.
+SQL_GENERATION_SYSTEM_PROMPT = """You are an expert SDSS SQL query writer. Your task is to generate a single, valid, executable SQL query for the SDSS SkyServer (Transact-SQL dialect) based on the provided table schema(s) and the user's request.
+
+Strictly follow these rules:
+1. Analyze the user's request and the provided table schema(s) carefully.
+2. **Prioritize using the table(s) and field(s) from the provided context that are most relevant to the user's request.**
+3. **Only use table names and field names explicitly listed in the provided schema context.** Do not invent tables or fields. If crucial information seems missing from the context for a complete query, construct the best possible query using ONLY the provided information. Avoid making assumptions about fields not listed. A field written as `psfMag_{u,g,r,i,z}` stands for the real columns `psfMag_u`, `psfMag_g`, `psfMag_r`, `psfMag_i` and `psfMag_z`; always use the real column names in SQL.
+4. Construct a single, executable SQL query.
+5. **Include a `TOP N` clause in the SELECT clause, using the result limit N given at the end of the request.** This is crucial.
+6. If the user asks for specific columns, SELECT those. Otherwise, if the request is general, you can use `SELECT TOP N *`.
+7. Pay close attention to field types for correct WHERE clause conditions (e.g., strings in quotes, numeric types not in quotes).
+8. Return ONLY the SQL query. No explanations, comments, or markdown formatting (like ```sql).
+9. When asked to correct a previous query, return ONLY the corrected SQL query, still following all rules above."""
+"""Static system prompt shared by SQL generation and correction calls."""
+
+LLM_USAGE_STATS: Dict[str, int] = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "latency_ms": 0}
+"""Cumulative LLM token usage (including provider prefix-cache hits) and latency for SQL generation/correction."""
+
+_LLM_USAGE_STATS_LOCK = threading.Lock()
 
 
 def load_sdss_schema(file_path: str = config.SCHEMA_FILE_PATH) -> List[Dict[str, Any]]:
@@ -67,22 +114,42 @@ def initialize_rag_schema():
     Raises:
         RuntimeError: If the SDSS schema cannot be loaded, as it's critical for RAG.
     """
-    global SDSS_SCHEMA_GLOBAL
+    global SDSS_SCHEMA_GLOBAL, SDSS_SCHEMA_INDEX
     if not SDSS_SCHEMA_GLOBAL: # Load only if not already loaded
         logger.info("Initializing RAG schema...")
-        SDSS_SCHEMA_GLOBAL = load_sdss_schema()
-        if not SDSS_SCHEMA_GLOBAL:
-            logger.critical("RAG Core: SDSS Schema could not be loaded. Application may not function correctly.")
-            # This error should be handled by the calling application (e.g., Streamlit UI)
-            raise RuntimeError("RAG Core: SDSS Schema could not be loaded.")
+        with span("rag.schema_load", path=config.SCHEMA_FILE_PATH):
+            SDSS_SCHEMA_GLOBAL = load_sdss_schema()
+            if not SDSS_SCHEMA_GLOBAL:
+                logger.critical("RAG Core: SDSS Schema could not be loaded. Application may not function correctly.")
+                # This error should be handled by the calling application (e.g., Streamlit UI)
+                raise RuntimeError("RAG Core: SDSS Schema could not be loaded.")
+            SDSS_SCHEMA_INDEX = build_schema_index(SDSS_SCHEMA_GLOBAL)
+            preprocess_schema(SDSS_SCHEMA_GLOBAL, MAX_FIELDS_PER_TABLE_IN_CORPUS, collapse=config.COLLAPSE_BAND_FAMILIES)
+            set_span_attributes(tables=len(SDSS_SCHEMA_GLOBAL))
         logger.info("RAG schema initialized successfully.")
 
+def get_schema_index() -> Optional[SchemaIndex]:
+    """
+    Returns the schema index used for local SQL validation, building it on first use.
+
+    Returns:
+        The SchemaIndex for the loaded schema, or None if the schema is not available.
+    """
+    global SDSS_SCHEMA_INDEX
+    if SDSS_SCHEMA_INDEX is None and SDSS_SCHEMA_GLOBAL:
+        SDSS_SCHEMA_INDEX = build_schema_index(SDSS_SCHEMA_GLOBAL)
+    return SDSS_SCHEMA_INDEX
+
+def get_schema() -> List[Dict[str, Any]]:
+    """Returns the loaded SDSS schema (empty until `initialize_rag_schema` has run)."""
+    return SDSS_SCHEMA_GLOBAL
+
 # --- Semantic Retriever ---
 def _embed_texts(texts: List[str], model: SentenceTransformer) -> np.ndarray:
     """Helper function to embed a list of texts using the provided SentenceTransformer model."""
     if not texts:
         return np.array([])
-    logger.debug(f"Embedding {len(texts)} texts...")
+    logger.debug("Embedding %d texts...", len(texts))
     embeddings = model.encode(texts, convert_to_tensor=False, show_progress_bar=False)
     logger.debug("Texts embedded successfully.")
     return embeddings
@@ -110,10 +177,79 @@ def get_retriever_model() -> Optional[SentenceTransformer]:
             return None
     return _retriever_model
 
+def build_schema_corpus(
+    schema: List[Dict[str, Any]],
+    max_fields: int = MAX_FIELDS_PER_TABLE_IN_CORPUS,
+    collapse: bool = config.COLLAPSE_BAND_FAMILIES
+) -> List[str]:
+    """
+    Builds the semantic search corpus: one text per table, describing the table and its first fields.
+
+    Args:
+        schema: The tables to describe.
+        max_fields: Maximum number of fields per table included in its text.
+        collapse: Whether band families (e.g. `psfMag_{u,g,r,i,z}`) are collapsed to one entry.
+
+    Returns:
+        The corpus texts, in the order of `schema`.
+    """
+    logger.debug(f"Building RAG corpus from {len(schema)} tables...")
+    # Corpus text is cached per table (and settings) at schema load time.
+    corpus = [get_corpus_text(table, max_fields, collapse=collapse) for table in schema]
+    logger.debug(f"RAG corpus built with {len(corpus)} entries.")
+    return corpus
+
+def rank_tables_by_similarity(
+    similarities: np.ndarray,
+    table_refs: List[Dict[str, Any]],
+    min_score_threshold: float = config.MIN_SEMANTIC_SCORE_THRESHOLD,
+    top_k: int = config.MAX_RAG_TABLES_CONTEXT
+) -> List[Tuple[Dict[str, Any], float]]:
+    """
+    Selects the tables to put in the prompt from their similarity to the query.
+
+    Keeps the `top_k` best tables scoring at least `min_score_threshold`; if none does,
+    falls back to the single best match.
+
+    Args:
+        similarities: Cosine similarity of the query to each corpus entry.
+        table_refs: The table schema of each corpus entry.
+        min_score_threshold: Minimum cosine similarity score for a table to be considered relevant.
+        top_k: The maximum number of relevant tables to return.
+
+    Returns:
+        (table schema, score) tuples in descending score order.
+    """
+    num_candidates = min(top_k, len(similarities))
+    top_indices_sorted = np.array([], dtype=int)
+
+    if num_candidates > 0 and len(similarities) > 0:
+        # Get indices of top_k highest scores, then reverse to descending order
+        top_indices_sorted = np.argsort(similarities)[-num_candidates:][::-1]
+
+    results = []
+    for i in top_indices_sorted:
+        score = float(similarities[i])
+        if score >= min_score_threshold:
+            results.append((table_refs[i], score))
+            logger.debug("Found relevant table '%s' with score %.2f", table_refs[i]['name'], score)
+
+    # If no tables meet the threshold, fall back to the single best match.
+    if not results and len(similarities) > 0:
+        best_idx = int(np.argmax(similarities))
+        best_score = float(similarities[best_idx])
+        logger.info(
+            f"No tables met RAG threshold {min_score_threshold}. "
+            f"Falling back to best match: '{table_refs[best_idx]['name']}' (Score: {best_score:.2f})."
+        )
+        results = [(table_refs[best_idx], best_score)]
+    return results
+
 def retrieve_relevant_schema(
     user_query: str,
     min_score_threshold: float = config.MIN_SEMANTIC_SCORE_THRESHOLD,
-    top_k: int = config.MAX_RAG_TABLES_CONTEXT
+    top_k: int = config.MAX_RAG_TABLES_CONTEXT,
+    ctx: Optional[RequestContext] = None
 ) -> List[Tuple[Dict[str, Any], float]]:
     """
     Retrieves relevant table schemas from the SDSS schema based on semantic similarity to the user query.
@@ -122,11 +258,17 @@ def retrieve_relevant_schema(
         user_query: The user's natural language query.
         min_score_threshold: Minimum cosine similarity score for a table to be considered relevant.
         top_k: The maximum number of relevant tables to return.
+        ctx: Optional request context, checked for cancellation and deadline before the search.
 
     Returns:
         A list of tuples, where each tuple contains a table schema (dict) and its similarity score (float).
         Returns an empty list if the schema is not loaded or no relevant tables are found.
+
+    Raises:
+        RequestCancelled, DeadlineExceeded: If `ctx` is cancelled or out of time.
     """
+    if ctx:
+        ctx.check("schema retrieval")
     if not SDSS_SCHEMA_GLOBAL:
         logger.warning("SDSS_SCHEMA_GLOBAL is not initialized. Attempting to initialize...")
         try:
@@ -145,33 +287,17 @@ def retrieve_relevant_schema(
         return []
 
     # Prepare corpus of table and field descriptions for semantic search
-    corpus = []
-    table_refs = [] # To map corpus entries back to original schema dicts
-    logger.debug(f"Building RAG corpus from {len(SDSS_SCHEMA_GLOBAL)} tables...")
-    for table in SDSS_SCHEMA_GLOBAL:
-        table_name = table.get('name', 'UnnamedTable')
-        table_desc = table.get('description', 'No description.')
-        table_text = f"Table Name: {table_name}. Description: {table_desc}"
-        
-        field_texts = []
-        for f_idx, f in enumerate(table.get('fields', [])):
-            if f_idx >= MAX_FIELDS_PER_TABLE_IN_CORPUS:
-                field_texts.append(f"... (and {len(table.get('fields', [])) - MAX_FIELDS_PER_TABLE_IN_CORPUS} more fields)")
-                break
-            field_texts.append(
-                f"Field: {f.get('name', 'N/A')} (Type: {f.get('type', 'N/A')}) Description: {f.get('description', 'N/A')}"
-            )
-        full_text = table_text + ". Fields: " + "; ".join(field_texts)
-        corpus.append(full_text)
-        table_refs.append(table)
-    logger.debug(f"RAG corpus built with {len(corpus)} entries.")
+    table_refs = SDSS_SCHEMA_GLOBAL # Corpus entry i describes table_refs[i]
+    corpus = build_schema_corpus(table_refs)
 
     if not corpus:
         logger.warning("RAG corpus is empty. No schema information to search.")
         return []
 
-    corpus_embeddings = _embed_texts(corpus, model)
-    query_embedding = _embed_texts([user_query], model)
+    with span("rag.embed_corpus", texts=len(corpus)):
+        corpus_embeddings = _embed_texts(corpus, model)
+    with span("rag.embed_query"):
+        query_embedding = _embed_texts([user_query], model)
 
     if query_embedding.size == 0 or corpus_embeddings.size == 0:
         logger.error("Failed to generate embeddings for query or corpus.")
@@ -179,31 +305,7 @@ def retrieve_relevant_schema(
         
     similarities = util.cos_sim(query_embedding, corpus_embeddings)[0].numpy()
 
-    num_candidates = min(top_k, len(similarities))
-    top_indices_sorted = np.array([], dtype=int)
-
-    if num_candidates > 0 and len(similarities) > 0:
-        # Get indices of top_k highest scores, then reverse to descending order
-        top_indices_sorted = np.argsort(similarities)[-num_candidates:][::-1] 
-    
-    results = []
-    for i in top_indices_sorted:
-        score = float(similarities[i])
-        if score >= min_score_threshold:
-            results.append((table_refs[i], score))
-            logger.debug(f"Found relevant table '{table_refs[i]['name']}' with score {score:.2f}")
-    
-    # If no tables meet the threshold, fall back to the single best match if configured to do so (or if desired)
-    # Current implementation (from previous step) falls back to best match if results is empty.
-    if not results and corpus and len(similarities) > 0:
-        best_idx = int(np.argmax(similarities))
-        best_score = float(similarities[best_idx])
-        logger.info(
-            f"No tables met RAG threshold {min_score_threshold}. "
-            f"Falling back to best match: '{table_refs[best_idx]['name']}' (Score: {best_score:.2f})."
-        )
-        results = [(table_refs[best_idx], best_score)]
-        
+    results = rank_tables_by_similarity(similarities, table_refs, min_score_threshold, top_k)
     if not results:
         logger.warning(f"No relevant schema found for query: '{user_query[:100]}...'")
 
@@ -213,7 +315,8 @@ def retrieve_relevant_schema(
 def build_rag_prompt_for_sql_generation(
     user_query: str,
     table_schemas_with_scores: List[Tuple[Dict[str, Any], float]],
-    top_n_results: int = config.DEFAULT_TOP_N_RESULTS
+    top_n_results: int = config.DEFAULT_TOP_N_RESULTS,
+    token_budget: Optional[int] = config.PROMPT_CONTEXT_TOKEN_BUDGET
 ) -> str:
     """
     Constructs the prompt for the LLM to generate an SQL query.
@@ -222,11 +325,16 @@ def build_rag_prompt_for_sql_generation(
         user_query: The user's natural language query.
         table_schemas_with_scores: A list of relevant table schemas and their similarity scores.
         top_n_results: The number of results (TOP N) to include in the SQL query.
+        token_budget: Token budget for the schema context. Fields from all tables are packed
+            greedily by relevance until it is used. If None or 0, the first
+            `MAX_FIELDS_PER_TABLE_IN_PROMPT` fields of each table are included instead.
 
     Returns:
-        A string representing the formatted prompt for the LLM.
+        A string representing the user message for the LLM. The schema context comes first
+        (tables sorted by name) and request-specific parts last; it is sent after the static
+        `SQL_GENERATION_SYSTEM_PROMPT`.
     """
-    logger.debug(f"Building RAG prompt for user query: '{user_query[:100]}...'")
+    logger.debug("Building RAG prompt for user query: '%.100s...'", user_query)
     context_blocks = []
     if not table_schemas_with_scores:
         logger.warning("No table schema context provided for RAG prompt. Using general knowledge.")
@@ -236,52 +344,113 @@ def build_rag_prompt_for_sql_generation(
             "PhotoObjAll or SpecObjAll if appropriate."
         )
     else:
+        table_fields = [
+            get_prompt_fields(table_schema, MAX_FIELDS_PER_TABLE_IN_CORPUS, collapse=config.COLLAPSE_BAND_FAMILIES)
+            for table_schema, _ in table_schemas_with_scores
+        ]
+        table_headers = [
+            f"Table Name: {table_schema.get('name', 'UnnamedTable')}\n"
+            f"Table Description: {table_schema.get('description', 'No description.')}\n"
+            for table_schema, _ in table_schemas_with_scores
+        ]
+        if token_budget:
+            packed_fields, context_tokens = pack_schema_context(
+                user_query,
+                [
+                    (table_schema, score, fields)
+                    for (table_schema, score), fields in zip(table_schemas_with_scores, table_fields)
+                ],
+                token_budget=token_budget,
+                header_tokens=sum(count_tokens(header) for header in table_headers),
+            )
+            logger.info(f"Schema context packed into {context_tokens}/{token_budget} tokens.")
+        else:
+            packed_fields = [fields[:MAX_FIELDS_PER_TABLE_IN_PROMPT] for fields in table_fields]
+        # Render tables in a stable (name) order so the schema context forms a reusable prefix;
+        # relevance scores are per query and are listed after the context.
+        relevance_lines = []
+        for (table_schema, score), header, fields, all_fields in sorted(
+            zip(table_schemas_with_scores, table_headers, packed_fields, table_fields),
+            key=lambda block: block[0][0].get('name', 'UnnamedTable'),
+        ):
+            num_fields = len(all_fields)
+            field_lines = [format_field_line(f) for f in fields]
+            if len(fields) < num_fields:
+                field_lines.append(f"- ... (and {num_fields - len(fields)} more fields)")
+            fields_str = "\n".join(field_lines) if fields else "No detailed field information available for this table."
+            context_blocks.append(f"{header}Fields:\n{fields_str}")
         for table_schema, score in table_schemas_with_scores:
-            field_lines = []
-            num_fields = len(table_schema.get("fields", []))
-            for f_idx, f in enumerate(table_schema.get("fields", [])):
-                if f_idx < MAX_FIELDS_PER_TABLE_IN_PROMPT:
-                     field_info = (
-                         f"- {f.get('name', 'N/A')} "
-                         f"(Type: {f.get('type', 'N/A')}, "
-                         f"Description: {f.get('description', 'N/A')})"
-                     )
-                     field_lines.append(field_info)
-                elif f_idx == MAX_FIELDS_PER_TABLE_IN_PROMPT:
-                    field_lines.append(f"- ... (and {num_fields - MAX_FIELDS_PER_TABLE_IN_PROMPT} more fields)")
-                    break
-            fields_str = "\n".join(field_lines) if field_lines else "No detailed field information available for this table."
-            context_blocks.append(
-                f"Table Name: {table_schema.get('name', 'UnnamedTable')}\n"
-                f"Table Description: {table_schema.get('description', 'No description.')}\n"
-                f"Fields:\n{fields_str}\n"
-                f"(Semantic Relevance Score to user query: {score:.2f})"
+            relevance_lines.append(
+                f"- {table_schema.get('name', 'UnnamedTable')} (Semantic Relevance Score to user query: {score:.2f})"
             )
     full_context = "\n\n---\n\n".join(context_blocks)
-    
-    # This is the core prompt structure for the LLM.
-    # It guides the LLM on how to behave and what kind of output is expected.
-    prompt = f"""You are an expert SDSS SQL query writer. Your task is to generate a single, valid, executable SQL query for the SDSS SkyServer (Transact-SQL dialect) based on the provided table schema(s) and the user's request.
 
-Strictly follow these rules:
-1. Analyze the user's request and the provided table schema(s) carefully.
-2. **Prioritize using the table(s) and field(s) from the provided context that are most relevant to the user's request.**
-3. **Only use table names and field names explicitly listed in the provided schema context.** Do not invent tables or fields. If crucial information seems missing from the context for a complete query, construct the best possible query using ONLY the provided information. Avoid making assumptions about fields not listed.
-4. Construct a single, executable SQL query.
-5. **Include `TOP {top_n_results}` in the SELECT clause.** For example: `SELECT TOP {top_n_results} ra, dec FROM PhotoObjAll`. This is crucial.
-6. If the user asks for specific columns, SELECT those. Otherwise, if the request is general, you can use `SELECT TOP {top_n_results} *`.
-7. Pay close attention to field types for correct WHERE clause conditions (e.g., strings in quotes, numeric types not in quotes).
-8. Return ONLY the SQL query. No explanations, comments, or markdown formatting (like ```sql).
-
-Provided Table Schema Context:
+    # Only the request-specific part of the prompt is built here; the static rules are
+    # sent separately as `SQL_GENERATION_SYSTEM_PROMPT` ahead of it.
+    variable_tail = []
+    if table_schemas_with_scores:
+        variable_tail.append("Table relevance for this request:\n" + "\n".join(relevance_lines))
+    variable_tail.append(
+        f"Result limit: N = {top_n_results}. Include `TOP {top_n_results}` in the SELECT clause, "
+        f"for example: `SELECT TOP {top_n_results} ra, dec FROM PhotoObjAll`."
+    )
+    variable_tail_str = "\n\n".join(variable_tail)
+    prompt = f"""Provided Table Schema Context:
 {full_context}
 
+{variable_tail_str}
+
 User's Request: "{user_query}"
 
 SQL Query:"""
-    logger.debug(f"Generated RAG prompt. Length: {len(prompt)}")
+    logger.info(
+        f"Generated RAG prompt. Length: {len(prompt)} chars, "
+        f"{count_tokens(SQL_GENERATION_SYSTEM_PROMPT) + count_tokens(prompt)} tokens (including system prompt)."
+    )
     return prompt.strip()
 
+# --- LLM Usage Accounting ---
+def _usage_count(obj: Any, attr: str) -> int:
+    """Reads an integer token count from a `usage` object, treating missing values as 0."""
+    value = getattr(obj, attr, None) if obj is not None else None
+    return value if isinstance(value, int) else 0
+
+def _record_llm_usage(response: Any, mode: str, latency_ms: float) -> None:
+    """
+    Records token usage from an OpenAI-compatible response, including prefix-cache hits.
+
+    Args:
+        response: The chat completion response.
+        mode: "generation" or "correction", for logging.
+        latency_ms: Wall-clock latency of the call in milliseconds.
+    """
+    usage = getattr(response, "usage", None)
+    prompt_tokens = _usage_count(usage, "prompt_tokens")
+    cached_tokens = _usage_count(getattr(usage, "prompt_tokens_details", None), "cached_tokens")
+    completion_tokens = _usage_count(usage, "completion_tokens")
+    with _LLM_USAGE_STATS_LOCK:
+        LLM_USAGE_STATS["calls"] += 1
+        LLM_USAGE_STATS["prompt_tokens"] += prompt_tokens
+        LLM_USAGE_STATS["cached_tokens"] += cached_tokens
+        LLM_USAGE_STATS["completion_tokens"] += completion_tokens
+        LLM_USAGE_STATS["latency_ms"] += int(latency_ms)
+    logger.info(
+        f"LLM ({mode}) usage: {prompt_tokens} prompt tokens ({cached_tokens} cached), "
+        f"{completion_tokens} completion tokens, {latency_ms:.0f} ms."
+    )
+
+def get_llm_usage_stats() -> Dict[str, Any]:
+    """
+    Returns cumulative LLM usage for SQL generation/correction.
+
+    Returns:
+        A copy of the usage counters plus the share of prompt tokens served from the provider's cache.
+    """
+    with _LLM_USAGE_STATS_LOCK:
+        stats = dict(LLM_USAGE_STATS)
+    stats["cached_token_ratio"] = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+    return stats
+
 # --- Unified SQL Generation & Correction ---
 def generate_and_correct_sql(
     original_user_query: str,
@@ -290,66 +459,83 @@ def generate_and_correct_sql(
     error_message: Optional[str] = None,
     prior_sql: Optional[str] = None,
     data_verification_failed: bool = False,
-    failed_data_sample: Optional[str] = None
+    failed_data_sample: Optional[str] = None,
+    model_tier: Optional[str] = None,
+    ctx: Optional[RequestContext] = None
 ) -> Optional[str]:
     """
     Generates an SQL query using the LLM, or corrects a previous one based on errors.
 
     Args:
         original_user_query: The initial user query.
-        rag_prompt_for_llm: The RAG-constructed prompt for initial SQL generation.
+        rag_prompt_for_llm: The RAG-constructed prompt. Sent on generation and repeated unchanged on correction
+            so the shared message prefix can be served from the provider's prompt cache.
         top_n_results: The number of results (TOP N) to include in the SQL query.
         error_message: Database error from a previous execution attempt.
         prior_sql: The previously executed SQL query that failed.
         data_verification_failed: Flag indicating if previous data structure verification failed.
-        failed_data_sample: A string sample of the data that failed verification.
+        failed_data_sample: A compact profile of the data that failed verification
+            (see `result_profiler.format_result_profile`).
+        model_tier: Model tier to call (see `model_router`). If None, generation uses the
+            fast tier and correction escalates to the strong tier.
+        ctx: Optional request context; the LLM call's timeout is shrunk to the remaining budget.
 
     Returns:
         A string containing the generated or corrected SQL query, or None if generation fails.
+
+    Raises:
+        RequestCancelled, DeadlineExceeded: If `ctx` is cancelled or out of time.
     """
-    if not llm_client:
+    gateway = _get_llm_gateway()
+    if not gateway:
         logger.error("RAG Core: LLM client not initialized. Cannot generate/correct SQL.")
         return None
 
     messages = []
-    # Determine the model to use from config, stripping potential provider prefixes if needed by the client.
-    model_to_call = config.LLM_PROVIDER_MODEL.split('/')[-1] if '/' in config.LLM_PROVIDER_MODEL else config.LLM_PROVIDER_MODEL
-    
+    # Generation and correction share the same leading messages (static system prompt, then the
+    # RAG prompt with the schema context), so correction calls hit the provider's prefix cache.
+    messages.append({"role": "system", "content": SQL_GENERATION_SYSTEM_PROMPT})
+    messages.append({"role": "user", "content": rag_prompt_for_llm})
+
     current_mode = "generation"
     if error_message or data_verification_failed:
         current_mode = "correction"
-        logger.info(f"Entering SQL correction mode. Error: '{error_message}', Data issue: {data_verification_failed}")
-        system_correction_prompt = (
-            f"You are an expert SDSS SQL query writer. Your task is to correct a previously generated SQL query "
-            f"based on the provided database error message or data structure issue. "
-            f"Ensure the corrected query strictly adheres to the SDSS SkyServer (Transact-SQL dialect) syntax. "
-            f"The corrected query MUST include `TOP {top_n_results}` in the SELECT clause. "
-            f"Return ONLY the corrected SQL query, with no additional text, comments, or markdown."
-        )
-        messages.append({"role": "system", "content": system_correction_prompt})
-        messages.append({"role": "user", "content": f"Original user request to inform the correction: \"{original_user_query}\""})
+        logger.info("Entering SQL correction mode. Error: '%s', Data issue: %s", log_payload(error_message), data_verification_failed)
         if prior_sql:
-            messages.append({"role": "user", "content": f"The following SQL query needs correction:\n```sql\n{prior_sql}\n```"})
+            messages.append({"role": "assistant", "content": prior_sql})
+        correction_parts = [f"Original user request to inform the correction: \"{original_user_query}\""]
         if error_message:
-            messages.append({"role": "user", "content": f"The database returned this error:\n{error_message}"})
+            correction_parts.append(f"The database returned this error for the previous SQL query:\n{error_message}")
         if data_verification_failed:
-            messages.append({"role": "user", "content": "The data returned by the previous query was not well-structured, seemed empty, or like a single long string instead of tabular data."})
+            correction_parts.append("The data returned by the previous query was not well-structured, seemed empty, like a single long string instead of tabular data, or held only NULL or sentinel values.")
             if failed_data_sample:
-                messages.append({"role": "user", "content": f"Here's a sample of the problematic data (first few rows/chars):\n{failed_data_sample}"})
-        messages.append({"role": "user", "content": "Please provide a corrected SQL query that addresses these issues."})
+                correction_parts.append(f"Here's a profile of the problematic data:\n{failed_data_sample}")
+        correction_parts.append(
+            f"Please provide a corrected SQL query that addresses these issues. "
+            f"The corrected query MUST include `TOP {top_n_results}` in the SELECT clause. "
+            f"Return ONLY the corrected SQL query, with no additional text, comments, or markdown."
+        )
+        messages.append({"role": "user", "content": "\n\n".join(correction_parts)})
     else:
         logger.info("Entering SQL generation mode.")
-        # For initial generation, the user role directly contains the RAG prompt.
-        messages.append({"role": "user", "content": rag_prompt_for_llm})
 
-    logger.debug(f"LLM API call messages for {current_mode}: {messages}")
+    if model_tier is None:
+        model_tier = select_model_tier(correction=current_mode == "correction")
+    model_to_call = get_model_for_tier(model_tier)
+    logger.info(f"Routing SQL {current_mode} to the '{model_tier}' model tier ({model_to_call}).")
+    logger.debug("LLM API call messages for %s: %s", current_mode, log_payload(messages))
 
+    start_time = time.perf_counter()
+    response = None
     try:
-        response = llm_client.chat.completions.create(
-            model=model_to_call, messages=messages, temperature=0.1, max_tokens=400 # Temperature is low for more deterministic SQL
+        response = gateway.chat_completion(
+            ctx=ctx, model=model_to_call, messages=messages, temperature=0.1, max_tokens=400 # Temperature is low for more deterministic SQL
         )
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        record_llm_call(model_tier, latency_ms)
+        _record_llm_usage(response, current_mode, latency_ms)
         raw_sql_query = response.choices[0].message.content.strip()
-        logger.info(f"LLM ({current_mode}) raw response: '{raw_sql_query[:300]}...'")
+        logger.info("LLM (%s) raw response: '%s'", current_mode, log_payload(raw_sql_query, max_chars=300))
         
         # --- SQL Cleaning Logic ---
         # This aims to extract the core SQL query if the LLM includes markdown or other text.
@@ -358,7 +544,7 @@ def generate_and_correct_sql(
         sql_markdown_match = re.search(r"```(?:sql)?\s*(SELECT .*?)\s*```", cleaned_sql, re.IGNORECASE | re.DOTALL)
         if sql_markdown_match:
             cleaned_sql = sql_markdown_match.group(1).strip()
-            logger.debug(f"Extracted SQL from markdown block: '{cleaned_sql[:200]}...'")
+            logger.debug("Extracted SQL from markdown block: '%.200s...'", cleaned_sql)
         else:
             # If not in a markdown block, try to find the "SELECT" statement,
             # allowing for some leading/trailing non-SQL text if it's not a correction flow.
@@ -367,7 +553,7 @@ def generate_and_correct_sql(
             if select_direct_match:
                 cleaned_sql = select_direct_match.group(1).strip()
                 if cleaned_sql != raw_sql_query: # Log if changes were made
-                     logger.debug(f"Extracted SQL by direct SELECT search: '{cleaned_sql[:200]}...'")
+                     logger.debug("Extracted SQL by direct SELECT search: '%.200s...'", cleaned_sql)
             elif not (error_message or data_verification_failed): # Not in correction flow & no SELECT found
                 logger.warning(f"RAG Core: LLM response for generation doesn't appear to contain a SQL SELECT statement. Response: '{raw_sql_query[:300]}...'")
                 # Return None as this is likely not a valid SQL query.
@@ -377,88 +563,35 @@ def generate_and_correct_sql(
             # Ideally, the LLM should always return SQL or a clear "cannot do" that's still SQL-like.
 
         # --- Safer TOP N Clause Enforcement ---
-        # Pattern to find "SELECT TOP N", "SELECT DISTINCT TOP N"
-        top_n_pattern_search = r"SELECT\s+(DISTINCT\s+)?TOP\s+\d+"
-        # Pattern to replace existing "TOP N" or insert it.
-        # It targets "SELECT" or "SELECT DISTINCT" to insert "TOP N" after it.
-        select_prefix_pattern = r"SELECT(\s+DISTINCT)?"
-        
-        existing_top_n_match = re.search(top_n_pattern_search, cleaned_sql, re.IGNORECASE)
-
-        if existing_top_n_match:
-            # A TOP N clause exists. Check if its value is correct.
-            current_top_value_match = re.search(r"TOP\s+(\d+)", existing_top_n_match.group(0), re.IGNORECASE)
-            if current_top_value_match and int(current_top_value_match.group(1)) == top_n_results:
-                logger.debug(f"Correct TOP {top_n_results} clause already exists in LLM output.")
-            else:
-                # Incorrect TOP N value. Replace it.
-                logger.debug(f"Incorrect TOP clause found: '{existing_top_n_match.group(0)}'. Replacing with TOP {top_n_results}.")
-                # Remove old "TOP <number>"
-                cleaned_sql = re.sub(r"TOP\s+\d+\s*", "", cleaned_sql, count=1, flags=re.IGNORECASE).strip()
-                # Re-insert correct "TOP N" after "SELECT" or "SELECT DISTINCT"
-                cleaned_sql = re.sub(select_prefix_pattern, rf"SELECT\1 TOP {top_n_results}", cleaned_sql, count=1, flags=re.IGNORECASE).strip()
-                # The strip() and regex ensure spaces are handled.
-        else:
-            # No TOP N clause found. Add it.
-            logger.debug(f"No TOP N clause found. Adding TOP {top_n_results}.")
-            # Insert "TOP N" after "SELECT" or "SELECT DISTINCT"
-            match_select_prefix = re.match(select_prefix_pattern, cleaned_sql, re.IGNORECASE)
-            if match_select_prefix:
-                # This is the most common case.
-                prefix = match_select_prefix.group(0) # "SELECT" or "SELECT DISTINCT"
-                rest_of_query = cleaned_sql[len(prefix):].strip()
-                cleaned_sql = f"{prefix} TOP {top_n_results} {rest_of_query}"
-            elif cleaned_sql.upper().startswith("WITH"): # Handle Common Table Expressions (CTEs)
-                # For CTEs, TOP N should be in the final SELECT statement.
-                # This is a simplified assumption; complex CTEs might need more nuanced handling.
-                # We'll assume the LLM produces a CTE where TOP N can be added to the final SELECT.
-                # A more robust solution might involve parsing the SQL structure.
-                logger.warning("Query starts with 'WITH' (CTE). Attempting to add TOP N to the final SELECT. This might be fragile.")
-                # This is a heuristic: find the last SELECT and try to inject TOP N.
-                # This could fail for complex CTEs with multiple SELECTs in the final part.
-                last_select_match = list(re.finditer(r"SELECT", cleaned_sql, re.IGNORECASE))
-                if last_select_match:
-                    last_select_pos = last_select_match[-1].start()
-                    # Check if it's "SELECT DISTINCT"
-                    is_distinct_match = re.match(r"SELECT\s+DISTINCT", cleaned_sql[last_select_pos:], re.IGNORECASE)
-                    if is_distinct_match:
-                        insert_pos = last_select_pos + len(is_distinct_match.group(0))
-                        cleaned_sql = cleaned_sql[:insert_pos] + f" TOP {top_n_results} " + cleaned_sql[insert_pos:].strip()
-                    else: # Just "SELECT"
-                        insert_pos = last_select_pos + len("SELECT")
-                        cleaned_sql = cleaned_sql[:insert_pos] + f" TOP {top_n_results} " + cleaned_sql[insert_pos:].strip()
-                else: # No SELECT found in CTE (highly unlikely for valid SQL)
-                    logger.error("CTE detected, but no SELECT found to add TOP N clause. Query may be invalid.")
-                    return None # Or return as is, if we prefer to let the DB catch it.
-            else:
-                # If the query doesn't start with SELECT or WITH (e.g., it's just a comment or invalid),
-                # then this query is likely malformed.
-                logger.warning(f"LLM output after cleaning ('{cleaned_sql[:100]}...') does not start with SELECT or WITH. Cannot reliably enforce TOP N. Returning as is or None.")
-                # Depending on strictness, either return None or the cleaned_sql and let the DB handle it.
-                # Given the prompt's emphasis on a single SELECT, this indicates a problem.
-                if not cleaned_sql.upper().startswith("SELECT"): # If it's not even a SELECT, it's bad.
-                     return None
-
-
-        logger.info(f"Final cleaned SQL ({current_mode}): '{cleaned_sql.strip()[:300]}...'")
+        cleaned_sql = enforce_top_n_clause(cleaned_sql, top_n_results)
+        if cleaned_sql is None:
+            return None
+
+        logger.info("Final cleaned SQL (%s): '%.300s...'", current_mode, cleaned_sql)
         return cleaned_sql.strip() if cleaned_sql else None
 
+    except (RequestCancelled, DeadlineExceeded):
+        raise
     except Exception as e:
+        if response is None:
+            record_llm_call(model_tier, (time.perf_counter() - start_time) * 1000, error=True)
         logger.error(f"RAG Core: Error calling LLM or processing its response for {current_mode}: {e}", exc_info=True)
         return None
 
 # --- SQL Explanation ---
-def explain_sql_query(sql_query: str) -> Optional[str]:
+def explain_sql_query(sql_query: str, ctx: Optional[RequestContext] = None) -> Optional[str]:
     """
     Uses the LLM to generate a natural language explanation of an SQL query.
 
     Args:
         sql_query: The SQL query to explain.
+        ctx: Optional request context; the LLM call's timeout is shrunk to the remaining budget.
 
     Returns:
         A string containing the explanation, or a default message if explanation fails or is unavailable.
     """
-    if not llm_client:
+    gateway = _get_llm_gateway()
+    if not gateway:
         logger.warning("LLM client not available. Cannot explain SQL query.")
         return "LLM client not available, so I cannot provide an explanation for the SQL query."
     if not sql_query:
@@ -474,12 +607,14 @@ def explain_sql_query(sql_query: str) -> Optional[str]:
     ]
     
     try:
-        response = llm_client.chat.completions.create(
-            model=model_to_call, messages=messages, temperature=0.3, max_tokens=300 # Slightly higher temp for more descriptive explanation
+        response = gateway.chat_completion(
+            ctx=ctx, model=model_to_call, messages=messages, temperature=0.3, max_tokens=300 # Slightly higher temp for more descriptive explanation
         )
         explanation = response.choices[0].message.content.strip()
-        logger.info(f"LLM explanation received: '{explanation[:100]}...'")
+        logger.info("LLM explanation received: '%.100s...'", explanation)
         return explanation
+    except (RequestCancelled, DeadlineExceeded):
+        raise
     except Exception as e:
         logger.error(f"RAG Core: Error getting SQL explanation from LLM: {e}", exc_info=True)
         return "An error occurred while trying to generate an explanation for the SQL query."
\ No newline at end of file
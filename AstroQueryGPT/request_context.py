@@ -0,0 +1,177 @@
+"""
+Request-scoped deadline and cancellation for the agent pipeline.
+
+A `RequestContext` is created per user question and passed through every stage
+(schema retrieval, LLM generation/correction, SkyServer execution, explanation).
+Each stage shrinks its own timeout to the remaining budget with `timeout()` and
+calls `check()` at stage boundaries; blocking calls can be wrapped in `call()`
+so that a cancelled request (e.g. superseded by a new question) returns promptly
+instead of waiting for the network.
+"""
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from concurrent.futures import Executor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+CANCEL_POLL_INTERVAL_S = 0.1
+"""How often a blocking `RequestContext.call` checks for cancellation."""
+
+PRIORITY_INTERACTIVE = "interactive"
+"""Priority class of latency-sensitive work (probes, small queries a user is waiting on)."""
+
+PRIORITY_BULK = "bulk"
+"""Priority class of bulk extracts (full TOP N fetches, pagination pages, batch clients)."""
+
+_BLOCKING_CALL_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="request-call")
+"""Default worker threads of `RequestContext.call`. Callers that bound their own concurrency pass their own executor."""
+
+
+class RequestCancelled(Exception):
+    """Raised when a request was cancelled (e.g. the user submitted a new question)."""
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a request's overall time budget is used up."""
+
+
+class RequestContext:
+    """
+    Deadline and cancellation token for one agent request.
+
+    Attributes:
+        request_id: Identifier used in logs.
+        deadline: `time.monotonic()` value after which the request fails, or None for no budget.
+        user_id: The user (or session) the request belongs to, for fair scheduling of SkyServer calls.
+        priority: PRIORITY_INTERACTIVE, or PRIORITY_BULK to schedule all of the request's queries as bulk work.
+    """
+
+    def __init__(
+        self,
+        timeout_s: Optional[float] = None,
+        request_id: Optional[str] = None,
+        user_id: Optional[str] = None,
+        priority: str = PRIORITY_INTERACTIVE,
+    ):
+        """
+        Args:
+            timeout_s: Overall time budget in seconds, or None for no deadline.
+            request_id: Identifier for logs. Generated if not given.
+            user_id: The user or session the request belongs to. Defaults to the request id.
+            priority: The request's priority class.
+        """
+        self.request_id = request_id or uuid.uuid4().hex[:12]
+        self.user_id = user_id or self.request_id
+        self.priority = priority
+        self.deadline: Optional[float] = time.monotonic() + timeout_s if timeout_s else None
+        self.cancel_reason: Optional[str] = None
+        self._cancelled = threading.Event()
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        """Cancels the request. Stages notice it at their next check or while waiting in `call`/`sleep`."""
+        if not self._cancelled.is_set():
+            self.cancel_reason = reason
+            self._cancelled.set()
+            logger.info(f"Request {self.request_id} cancelled: {reason}")
+
+    @property
+    def cancelled(self) -> bool:
+        """True once `cancel` has been called."""
+        return self._cancelled.is_set()
+
+    def remaining(self) -> Optional[float]:
+        """Returns the seconds left in the budget (never negative), or None if there is no deadline."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self, stage: str = "request") -> None:
+        """
+        Raises if the request is cancelled or out of time.
+
+        Args:
+            stage: Name of the stage about to run, for the error message.
+
+        Raises:
+            RequestCancelled: If the request was cancelled.
+            DeadlineExceeded: If the deadline has passed.
+        """
+        if self._cancelled.is_set():
+            raise RequestCancelled(f"Request cancelled before {stage}: {self.cancel_reason}")
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise DeadlineExceeded(f"Request time budget exhausted before {stage}.")
+
+    def timeout(self, default_s: float, stage: str = "request") -> float:
+        """
+        Returns the timeout a stage should use: its own default, shrunk to the remaining budget.
+
+        Args:
+            default_s: The stage's normal timeout in seconds.
+            stage: Name of the stage, for error messages.
+
+        Raises:
+            RequestCancelled, DeadlineExceeded: See `check`.
+        """
+        self.check(stage)
+        remaining = self.remaining()
+        return default_s if remaining is None else min(default_s, remaining)
+
+    def sleep(self, seconds: float) -> None:
+        """Sleeps for up to `seconds`, waking immediately on cancellation; never sleeps past the deadline."""
+        remaining = self.remaining()
+        self._cancelled.wait(seconds if remaining is None else min(seconds, remaining))
+        self.check("retry")
+
+    def call(
+        self,
+        func: Callable[..., Any],
+        *args: Any,
+        stage: str = "request",
+        on_done: Optional[Callable[[], None]] = None,
+        executor: Optional[Executor] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        Runs a blocking call, returning as soon as it finishes or the request is cancelled/out of time.
+
+        The call itself keeps running in a worker thread until its own (budget-shrunk)
+        timeout; its result is discarded if the request was abandoned.
+
+        Args:
+            func: The blocking function.
+            *args, **kwargs: Its arguments.
+            stage: Name of the stage, for error messages.
+            on_done: Called once when `func` has really finished (or was never started), also
+                after the request abandoned it, e.g. to release a concurrency slot held for it.
+            executor: Worker threads to run `func` on. Defaults to a shared pool of 16.
+
+        Returns:
+            The function's return value.
+        """
+        try:
+            self.check(stage)
+        except (RequestCancelled, DeadlineExceeded):
+            if on_done is not None:
+                on_done()
+            raise
+        # Run in a copy of the caller's context so tracing spans opened by `func` nest under the caller's.
+        future = (executor or _BLOCKING_CALL_EXECUTOR).submit(contextvars.copy_context().run, func, *args, **kwargs)
+        if on_done is not None:
+            future.add_done_callback(lambda _: on_done())
+        while True:
+            remaining = self.remaining()
+            wait_s = CANCEL_POLL_INTERVAL_S if remaining is None else min(CANCEL_POLL_INTERVAL_S, remaining)
+            try:
+                return future.result(timeout=wait_s)
+            except FutureTimeoutError:
+                pass
+            if self._cancelled.is_set():
+                future.cancel()
+                raise RequestCancelled(f"Request cancelled during {stage}: {self.cancel_reason}")
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                future.cancel()
+                raise DeadlineExceeded(f"Request time budget exhausted during {stage}.")
@@ -0,0 +1,143 @@
+"""
+Sentinel-aware compact dtypes for parsed SkyServer results.
+
+`pd.read_csv` turns every non-integer column of a SkyServer CSV into float64 and keeps
+SDSS's missing-value sentinels (-9999, -1000, ..., `config.RESULT_SENTINEL_VALUES`) as
+numbers, so results take twice the memory they need and statistics or plots of a
+column are dragged towards -9999. With `config.NORMALIZE_RESULT_DTYPES`,
+`normalize_result_dtypes` rewrites a parsed result in place:
+
+- sentinels become missing values: NaN in float columns, `pd.NA` (nullable `Int8`..
+  `Int64` dtypes) in integer columns;
+- float columns whose values have at most `FLOAT32_SIGNIFICANT_DIGITS` significant
+  digits (how SkyServer prints `real` columns) become float32. Columns printed with
+  more digits (`float` columns such as ra, dec or TAI) keep float64;
+- integer columns (flags, counts, run/camcol/field numbers) are downcast to the
+  smallest integer width that holds their range.
+
+Columns with "id" in their name are left alone; `sdss_db.convert_id_columns` turns
+them into strings. All checks run column-wise on 2-D NumPy blocks, without string
+conversion. The memory before and after is logged and returned, and stored in the
+result's `DataFrame.attrs["dtype_normalization"]`.
+"""
+import logging
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+import config
+
+logger = logging.getLogger(__name__)
+
+FLOAT32_SIGNIFICANT_DIGITS = 7
+"""Significant digits SkyServer prints for `real` (single precision) columns."""
+
+_INT_WIDTHS = (np.int8, np.int16, np.int32, np.int64)
+_FLOAT32_MAX = float(np.finfo(np.float32).max)
+_FLOAT32_TINY = float(np.finfo(np.float32).tiny)
+
+
+def _fits_float32(values: np.ndarray, usable: np.ndarray) -> np.ndarray:
+    """
+    Tells per column whether all usable values have at most `FLOAT32_SIGNIFICANT_DIGITS`
+    significant digits and lie in float32's normal range.
+
+    Args:
+        values: 2-D float64 array (rows x columns).
+        usable: Mask of the values to check (not NaN, not a sentinel).
+    """
+    magnitude = np.abs(values)
+    finite = usable & np.isfinite(values) & (magnitude > 0)
+    in_range = ~finite | ((magnitude <= _FLOAT32_MAX) & (magnitude >= _FLOAT32_TINY))
+    exponent = np.floor(np.log10(magnitude, out=np.zeros_like(values), where=finite))
+    scale = 10.0 ** (FLOAT32_SIGNIFICANT_DIGITS - 1 - exponent)
+    rounded = np.round(values * scale) / scale
+    # Rounding to the digit grid is exact up to a few ulps of float64 arithmetic.
+    same = ~finite | (np.abs(rounded - values) <= 1e-12 * magnitude)
+    return (in_range & same).all(axis=0)
+
+
+def _smallest_int_width(low: np.ndarray, high: np.ndarray) -> List[type]:
+    """Returns per column the smallest NumPy integer type holding [low, high]."""
+    widths = []
+    for column_low, column_high in zip(low.tolist(), high.tolist()):
+        widths.append(next(
+            width for width in _INT_WIDTHS
+            if np.iinfo(width).min <= column_low and column_high <= np.iinfo(width).max
+        ))
+    return widths
+
+
+def normalize_result_dtypes(df: pd.DataFrame, sentinels: Sequence[float] = config.RESULT_SENTINEL_VALUES) -> Dict[str, Any]:
+    """
+    Maps sentinels to missing values and downcasts numeric columns, in place.
+
+    Args:
+        df: A parsed result. Its numeric non-ID columns are replaced.
+        sentinels: Values meaning "not measured".
+
+    Returns:
+        The report, also stored in `df.attrs["dtype_normalization"]`: 'bytes_before',
+        'bytes_after', 'sentinels_replaced' (number of values), 'float32_columns' and
+        'int_columns' (column name -> new dtype).
+    """
+    bytes_before = int(df.memory_usage(index=True, deep=False).sum())
+    report: Dict[str, Any] = {
+        "bytes_before": bytes_before, "bytes_after": bytes_before,
+        "sentinels_replaced": 0, "float32_columns": [], "int_columns": {},
+    }
+    numpy_dtypes = [
+        (name, dtype) for name, dtype in df.dtypes.items()
+        if isinstance(dtype, np.dtype) and "id" not in str(name).lower()
+    ]
+    float_columns = [name for name, dtype in numpy_dtypes if dtype.kind == "f"]
+    int_columns = [name for name, dtype in numpy_dtypes if dtype.kind == "i"]
+    replacements: Dict[Any, Any] = {}
+
+    if float_columns and len(df):
+        values = df[float_columns].to_numpy(dtype=np.float64, copy=True)
+        sentinel_mask = np.isin(values, sentinels)
+        report["sentinels_replaced"] += int(sentinel_mask.sum())
+        values[sentinel_mask] = np.nan
+        fits = _fits_float32(values, ~np.isnan(values))
+        for j, name in enumerate(float_columns):
+            if fits[j]:
+                replacements[name] = values[:, j].astype(np.float32)
+                report["float32_columns"].append(name)
+            elif sentinel_mask[:, j].any():
+                replacements[name] = values[:, j]
+
+    if int_columns and len(df):
+        values = df[int_columns].to_numpy(dtype=np.int64)
+        sentinel_mask = np.isin(values, sentinels)
+        report["sentinels_replaced"] += int(sentinel_mask.sum())
+        info = np.iinfo(np.int64)
+        low = values.min(axis=0, initial=info.max, where=~sentinel_mask)
+        high = values.max(axis=0, initial=info.min, where=~sentinel_mask)
+        all_sentinel = sentinel_mask.all(axis=0)
+        widths = _smallest_int_width(np.where(all_sentinel, 0, low), np.where(all_sentinel, 0, high))
+        for j, name in enumerate(int_columns):
+            column = values[:, j].astype(widths[j])
+            if sentinel_mask[:, j].any():
+                replacements[name] = pd.arrays.IntegerArray(column, sentinel_mask[:, j].copy())
+            elif widths[j] is not np.int64:
+                replacements[name] = column
+            else:
+                continue
+            report["int_columns"][name] = str(replacements[name].dtype)
+
+    if replacements:
+        old_dtypes = dict(numpy_dtypes)
+        df[list(replacements)] = pd.DataFrame(replacements, index=df.index)
+        # Only the replaced columns changed size; this avoids a second `memory_usage` pass.
+        report["bytes_after"] = bytes_before + sum(
+            column.nbytes - old_dtypes[name].itemsize * len(df) for name, column in replacements.items()
+        )
+    df.attrs["dtype_normalization"] = report
+    logger.info(
+        "Normalized result dtypes: %d -> %d bytes, %d sentinels replaced, %d float32 and %d downcast integer columns.",
+        report["bytes_before"], report["bytes_after"], report["sentinels_replaced"],
+        len(report["float32_columns"]), len(report["int_columns"]),
+    )
+    return report
@@ -0,0 +1,210 @@
+"""
+Vectorized profiling of query results.
+
+SDSS marks missing measurements with sentinel values (-9999, -1000, ...,
+`config.RESULT_SENTINEL_VALUES`) rather than NULLs, so a query can return well-formed
+rows whose measurement columns carry no information at all. `profile_result` summarizes
+a result in one pass per dtype block: the numeric columns are taken as 2-D NumPy arrays
+and their null and sentinel fractions, usable min/max and constant columns are computed
+column-wise, without converting values to strings. Integer columns stay integers, so
+large IDs (objID, specObjID) are compared exactly.
+
+The profile drives `agent.verify_data_structure` (results whose columns are mostly
+null or sentinel fail, as do results with a measurement column that has no usable
+value) and `format_result_profile` turns it into the compact text kept
+in the agent log and fed back to the LLM when it has to correct the query.
+"""
+import logging
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+import config
+
+logger = logging.getLogger(__name__)
+
+COORDINATE_COLUMNS = frozenset({"ra", "dec", "l", "b", "cx", "cy", "cz", "glon", "glat", "elon", "elat"})
+"""Position columns (lower case) that are always measured, so they do not show that a result is usable."""
+
+
+def _numeric_block_stats(values: np.ndarray, sentinels: Sequence[float]) -> Dict[str, np.ndarray]:
+    """
+    Computes column-wise statistics of a 2-D numeric array (rows x columns).
+
+    Returns:
+        A dict of 1-D arrays: 'nulls', 'sentinels' and 'usable' (counts), 'min' and 'max'
+        (over usable values; meaningless where 'usable' is 0).
+    """
+    if values.dtype.kind == "f":
+        null_mask = np.isnan(values)
+        low, high = np.inf, -np.inf
+    else:
+        null_mask = np.zeros(values.shape, dtype=bool)
+        info = np.iinfo(values.dtype)
+        low, high = info.max, info.min
+    sentinel_mask = np.isin(values, sentinels) & ~null_mask
+    usable_mask = ~(null_mask | sentinel_mask)
+    return {
+        "nulls": null_mask.sum(axis=0),
+        "sentinels": sentinel_mask.sum(axis=0),
+        "usable": usable_mask.sum(axis=0),
+        "min": values.min(axis=0, initial=low, where=usable_mask),
+        "max": values.max(axis=0, initial=high, where=usable_mask),
+    }
+
+
+def _is_exact_integer(dtype: np.dtype) -> bool:
+    """True for NumPy integer dtypes that convert to int64 without loss."""
+    return isinstance(dtype, np.dtype) and (dtype.kind == "i" or (dtype.kind == "u" and dtype.itemsize < 8))
+
+
+def profile_result(df: pd.DataFrame, sentinels: Sequence[float] = config.RESULT_SENTINEL_VALUES) -> Dict[str, Any]:
+    """
+    Profiles a query result column by column.
+
+    Args:
+        df: The result DataFrame.
+        sentinels: Values counted as missing besides NULL/NaN.
+
+    Returns:
+        A dict with 'rows', 'sentinel_values', 'columns' (one dict per column, in result
+        order: 'name', 'dtype', 'numeric', 'null_frac', 'sentinel_frac', 'min', 'max' (None for
+        non-numeric columns or without usable values) and 'constant' (more than one row
+        and a single distinct usable value)), 'unusable_columns' (only NULL or sentinel
+        values; none for an empty result) and 'constant_columns'.
+    """
+    n_rows = len(df)
+    stats: Dict[int, Dict[str, Any]] = {}
+
+    def add_block(positions: List[int], block: Dict[str, np.ndarray], numeric: bool) -> None:
+        for j, position in enumerate(positions):
+            usable = int(block["usable"][j])
+            has_range = numeric and usable > 0
+            stats[position] = {
+                "numeric": numeric,
+                "null_frac": float(block["nulls"][j]) / n_rows if n_rows else 0.0,
+                "sentinel_frac": float(block["sentinels"][j]) / n_rows if n_rows else 0.0,
+                "min": block["min"][j].item() if has_range else None,
+                "max": block["max"][j].item() if has_range else None,
+                "usable": usable,
+                "constant": n_rows > 1 and usable > 0 and bool(block["distinct_one"][j]),
+            }
+
+    dtypes = list(df.dtypes)
+    int_positions = [i for i, dtype in enumerate(dtypes) if _is_exact_integer(dtype)]
+    float_positions = [
+        i for i, dtype in enumerate(dtypes)
+        if not _is_exact_integer(dtype) and pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+    ]
+    other_positions = sorted(set(range(len(dtypes))) - set(int_positions) - set(float_positions))
+
+    if int_positions:
+        block = _numeric_block_stats(df.iloc[:, int_positions].to_numpy(dtype=np.int64), sentinels)
+        block["distinct_one"] = block["min"] == block["max"]
+        add_block(int_positions, block, numeric=True)
+    if float_positions:
+        # Nullable extension dtypes (Int64, Float64) become NaN-holding float64.
+        values = df.iloc[:, float_positions].to_numpy(dtype=np.float64, na_value=np.nan)
+        block = _numeric_block_stats(values, sentinels)
+        block["distinct_one"] = block["min"] == block["max"]
+        add_block(float_positions, block, numeric=True)
+    if other_positions:
+        others = df.iloc[:, other_positions]
+        nulls = others.isna().to_numpy().sum(axis=0)
+        block = {
+            "nulls": nulls,
+            "sentinels": np.zeros(len(other_positions), dtype=np.int64),
+            "usable": n_rows - nulls,
+            "min": None, "max": None,
+            "distinct_one": others.nunique(dropna=True).to_numpy() == 1,
+        }
+        add_block(other_positions, block, numeric=False)
+
+    columns = [{"name": str(name), "dtype": str(dtypes[i]), **stats[i]} for i, name in enumerate(df.columns)]
+    return {
+        "rows": n_rows,
+        "sentinel_values": list(sentinels),
+        "columns": columns,
+        "unusable_columns": [column["name"] for column in columns if n_rows and column["usable"] == 0],
+        "constant_columns": [column["name"] for column in columns if column["constant"]],
+    }
+
+
+def unusable_column_fraction(profile: Dict[str, Any]) -> float:
+    """Returns the share of a profiled result's columns holding only NULL or sentinel values."""
+    if not profile["columns"]:
+        return 0.0
+    return len(profile["unusable_columns"]) / len(profile["columns"])
+
+
+def unusable_measurement_columns(profile: Dict[str, Any]) -> List[str]:
+    """
+    Returns the numeric measurement columns of a profiled result that hold only NULL or sentinel values.
+
+    ID columns (name containing "id", as in `sdss_db.convert_id_columns`) and
+    COORDINATE_COLUMNS are not measurements: they are filled for every object, so
+    they cannot make up for a requested measurement that is missing.
+    """
+    unusable = set(profile["unusable_columns"])
+    return [
+        column["name"] for column in profile["columns"]
+        if column["name"] in unusable and column["numeric"]
+        and "id" not in column["name"].lower() and column["name"].lower() not in COORDINATE_COLUMNS
+    ]
+
+
+def _format_number(value: Any) -> str:
+    return str(value) if isinstance(value, int) else f"{value:.6g}"
+
+
+def _format_names(names: List[str], max_columns: int) -> str:
+    text = ", ".join(names[:max_columns])
+    return f"{text} (+{len(names) - max_columns} more)" if len(names) > max_columns else text
+
+
+def format_result_profile(profile: Dict[str, Any], max_columns: Optional[int] = None) -> str:
+    """
+    Formats a result profile as compact text for the agent log and correction prompts.
+
+    Columns without usable values are listed first, then constant columns, then the rest.
+
+    Args:
+        profile: A profile from `profile_result`.
+        max_columns: Maximum number of columns listed. Defaults to `config.RESULT_PROFILE_MAX_COLUMNS`.
+
+    Returns:
+        The profile as a few lines of text.
+    """
+    if max_columns is None:
+        max_columns = config.RESULT_PROFILE_MAX_COLUMNS
+    columns = profile["columns"]
+    sentinel_text = ", ".join(_format_number(value) for value in profile["sentinel_values"])
+    lines = [f"Result: {profile['rows']} rows x {len(columns)} columns."]
+    if not profile["rows"]:
+        lines.append("The query returned no rows; its conditions may be too strict or contradictory.")
+        return "\n".join(lines)
+    if profile["unusable_columns"]:
+        lines.append(
+            f"Columns with only NULL or sentinel values ({sentinel_text}, SDSS markers for missing measurements): "
+            f"{_format_names(profile['unusable_columns'], max_columns)}. Filter these values out (e.g. `WHERE col > -9999`) "
+            f"or select columns that are measured for these objects."
+        )
+    if profile["constant_columns"]:
+        lines.append(f"Constant columns: {_format_names(profile['constant_columns'], max_columns)}.")
+    if columns:
+        ranked = sorted(columns, key=lambda column: (column["usable"] > 0, not column["constant"]))
+        lines.append("Per column (NULL %, sentinel %, usable min..max):")
+        for column in ranked[:max_columns]:
+            if column["usable"] == 0:
+                value_range = "no usable values"
+            elif column["min"] is None:
+                value_range = column["dtype"]
+            else:
+                value_range = f"{_format_number(column['min'])}..{_format_number(column['max'])}"
+            lines.append(
+                f"- {column['name']}: {column['null_frac']:.0%} null, {column['sentinel_frac']:.0%} sentinel, {value_range}"
+            )
+        if len(columns) > max_columns:
+            lines.append(f"... and {len(columns) - max_columns} more columns.")
+    return "\n".join(lines)
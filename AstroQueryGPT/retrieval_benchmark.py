@@ -0,0 +1,357 @@
+"""
+Quality and speed benchmark of schema retrieval against a gold question set.
+
+`benchmarks/retrieval_gold.json` holds astronomy questions labelled by hand with the
+DR16 tables (and columns) a correct query needs. For every retrieval configuration
+in the grid (embedding model x corpus fields per table x band-family collapsing) this
+reports:
+
+- 'recall@k': mean fraction of a question's gold tables among the k best-scoring tables.
+- 'mrr': mean reciprocal rank of the best-ranked gold table.
+- 'column_coverage@k': fraction of gold columns whose table is in the top k and which
+  are described in that table's corpus text (the first `max_fields` field entries).
+- 'thresholds': for each score threshold, the recall and mean number of the tables
+  `rag_core.rank_tables_by_similarity` actually hands to the prompt (top_k plus fallback).
+- model load and corpus build time (corpus text + embeddings), corpus embedding size,
+  per-query latency (query embedding + scoring + ranking) and peak RSS.
+
+`retrieve_relevant_schema` currently re-embeds the corpus on every call; 'corpus_build_s'
+is what that costs per question. Compare runs like `benchmark`:
+
+    python retrieval_benchmark.py --max-fields 20 30 50 --output before.json
+    python retrieval_benchmark.py --max-fields 20 30 50 --baseline before.json
+
+Embedding models must be available locally (they are downloaded on first use).
+"""
+import os
+import json
+import time
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+import numpy as np
+
+from benchmark import BENCHMARK_DIR, percentile_summary, peak_rss_mb, _git_commit
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GOLD_PATH = os.path.join(BENCHMARK_DIR, "retrieval_gold.json")
+"""Gold question set: questions with the tables and `Table.column` names they need."""
+
+DEFAULT_K_VALUES = (1, 2, 3, 5, 10)
+"""Cut-offs for recall@k and column_coverage@k."""
+
+DEFAULT_THRESHOLDS = (0.25, 0.3, 0.35, 0.4, 0.45)
+"""Score thresholds evaluated with `rag_core.rank_tables_by_similarity`."""
+
+
+def load_gold_set(path: str = DEFAULT_GOLD_PATH) -> List[Dict[str, Any]]:
+    """
+    Loads a gold question set.
+
+    Returns:
+        The 'questions' entries, each with 'question', 'tables' and 'columns' (`Table.column`).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["questions"]
+
+
+def validate_gold_set(questions: List[Dict[str, Any]], schema: List[Dict[str, Any]]) -> List[str]:
+    """
+    Checks gold labels against the schema.
+
+    Returns:
+        One message per problem: unknown tables, unknown columns (case-insensitive, like
+        SkyServer), columns of tables not listed in 'tables', and duplicate questions.
+    """
+    columns_by_table = {
+        table["name"]: {field["name"].lower() for field in table.get("fields", [])} for table in schema
+    }
+    problems = []
+    seen = set()
+    for entry in questions:
+        question = entry["question"]
+        if question in seen:
+            problems.append(f"Duplicate question: '{question}'")
+        seen.add(question)
+        for table_name in entry["tables"]:
+            if table_name not in columns_by_table:
+                problems.append(f"'{question}': unknown table {table_name}")
+        for column in entry.get("columns", []):
+            table_name, _, column_name = column.partition(".")
+            if table_name not in entry["tables"]:
+                problems.append(f"'{question}': column {column} of a table not in 'tables'")
+            elif table_name in columns_by_table and column_name.lower() not in columns_by_table[table_name]:
+                problems.append(f"'{question}': unknown column {column}")
+    return problems
+
+
+def ranking_metrics(
+    rankings: List[List[str]], questions: List[Dict[str, Any]], k_values: Sequence[int] = DEFAULT_K_VALUES,
+) -> Dict[str, float]:
+    """
+    Computes recall@k and MRR of table rankings.
+
+    Args:
+        rankings: For each question, table names in descending score order.
+        questions: The gold entries, in the same order.
+        k_values: Cut-offs for recall@k.
+
+    Returns:
+        'recall@k' for each k, and 'mrr'.
+    """
+    recalls = {k: [] for k in k_values}
+    reciprocal_ranks = []
+    for ranking, entry in zip(rankings, questions):
+        gold = set(entry["tables"])
+        for k in k_values:
+            recalls[k].append(len(gold & set(ranking[:k])) / len(gold))
+        first_rank = next((rank for rank, name in enumerate(ranking, start=1) if name in gold), None)
+        reciprocal_ranks.append(1.0 / first_rank if first_rank else 0.0)
+    metrics = {f"recall@{k}": round(float(np.mean(values)), 4) for k, values in recalls.items()}
+    metrics["mrr"] = round(float(np.mean(reciprocal_ranks)), 4)
+    return metrics
+
+
+def corpus_columns(schema: List[Dict[str, Any]], max_fields: int, collapse: bool) -> Dict[str, Set[str]]:
+    """
+    Returns the (lowercase) columns described in each table's corpus text.
+
+    These are the first `max_fields` field entries of `schema_preprocessing.get_prompt_fields`,
+    with collapsed band families expanded to their member columns.
+    """
+    from schema_preprocessing import get_prompt_fields
+
+    described = {}
+    for table in schema:
+        names = set()
+        for field in get_prompt_fields(table, max_fields, collapse=collapse)[:max_fields]:
+            names.update(member.lower() for member in field.get("members", [field["name"]]))
+        described[table["name"]] = names
+    return described
+
+
+def column_coverage(
+    rankings: List[List[str]], questions: List[Dict[str, Any]], described: Dict[str, Set[str]],
+    k_values: Sequence[int] = DEFAULT_K_VALUES,
+) -> Dict[str, Optional[float]]:
+    """
+    Computes column_coverage@k: the fraction of gold columns retrieved and described in the corpus.
+
+    Args:
+        rankings: For each question, table names in descending score order.
+        questions: The gold entries, in the same order.
+        described: Columns described per table (see `corpus_columns`).
+        k_values: Cut-offs.
+
+    Returns:
+        'column_coverage@k' for each k (None if no question lists columns).
+    """
+    covered = {k: 0 for k in k_values}
+    total = 0
+    for ranking, entry in zip(rankings, questions):
+        for column in entry.get("columns", []):
+            table_name, _, column_name = column.partition(".")
+            total += 1
+            if column_name.lower() not in described.get(table_name, ()):
+                continue
+            for k in k_values:
+                if table_name in ranking[:k]:
+                    covered[k] += 1
+    return {f"column_coverage@{k}": round(covered[k] / total, 4) if total else None for k in k_values}
+
+
+def threshold_metrics(
+    similarities: List[np.ndarray], schema: List[Dict[str, Any]], questions: List[Dict[str, Any]],
+    thresholds: Sequence[float] = DEFAULT_THRESHOLDS, top_k: Optional[int] = None,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Evaluates the tables `rag_core.rank_tables_by_similarity` would return at each threshold.
+
+    Args:
+        similarities: For each question, its similarity to every table of `schema`.
+        schema: The tables, in corpus order.
+        questions: The gold entries, in the same order.
+        thresholds: Score thresholds to evaluate.
+        top_k: Tables per prompt (default: `config.MAX_RAG_TABLES_CONTEXT`).
+
+    Returns:
+        Threshold -> 'recall' (mean fraction of gold tables returned) and 'mean_tables'.
+    """
+    import config
+    from rag_core import rank_tables_by_similarity
+
+    top_k = config.MAX_RAG_TABLES_CONTEXT if top_k is None else top_k
+    results = {}
+    for threshold in thresholds:
+        recalls, counts = [], []
+        for scores, entry in zip(similarities, questions):
+            returned = {table["name"] for table, _ in rank_tables_by_similarity(scores, schema, threshold, top_k)}
+            recalls.append(len(set(entry["tables"]) & returned) / len(entry["tables"]))
+            counts.append(len(returned))
+        results[str(threshold)] = {
+            "recall": round(float(np.mean(recalls)), 4),
+            "mean_tables": round(float(np.mean(counts)), 3),
+        }
+    return results
+
+
+def evaluate_configuration(
+    model: Any, schema: List[Dict[str, Any]], questions: List[Dict[str, Any]], max_fields: int, collapse: bool,
+    k_values: Sequence[int] = DEFAULT_K_VALUES, thresholds: Sequence[float] = DEFAULT_THRESHOLDS,
+    top_k: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Benchmarks one retrieval configuration on the gold set.
+
+    Args:
+        model: The SentenceTransformer model.
+        schema: The loaded SDSS schema.
+        questions: The gold entries.
+        max_fields: Fields per table in the corpus text.
+        collapse: Whether band families are collapsed.
+        k_values, thresholds, top_k: See `ranking_metrics` and `threshold_metrics`.
+
+    Returns:
+        Corpus build time and size, query latency summary and all quality metrics.
+    """
+    import config
+    from sentence_transformers import util
+    from rag_core import _embed_texts, build_schema_corpus, rank_tables_by_similarity
+
+    top_k = config.MAX_RAG_TABLES_CONTEXT if top_k is None else top_k
+    start = time.perf_counter()
+    corpus = build_schema_corpus(schema, max_fields, collapse=collapse)
+    corpus_text_s = time.perf_counter() - start
+    corpus_embeddings = _embed_texts(corpus, model)
+    corpus_build_s = time.perf_counter() - start
+
+    rankings, similarities, latencies_ms = [], [], []
+    for entry in questions:
+        query_start = time.perf_counter()
+        query_embedding = _embed_texts([entry["question"]], model)
+        scores = util.cos_sim(query_embedding, corpus_embeddings)[0].numpy()
+        rank_tables_by_similarity(scores, schema, top_k=top_k)
+        latencies_ms.append((time.perf_counter() - query_start) * 1000)
+        similarities.append(scores)
+        rankings.append([schema[i]["name"] for i in np.argsort(-scores, kind="stable")])
+
+    return {
+        "corpus_text_s": round(corpus_text_s, 4),
+        "corpus_build_s": round(corpus_build_s, 3),
+        "corpus_chars": sum(len(text) for text in corpus),
+        "corpus_embeddings_mb": round(np.asarray(corpus_embeddings).nbytes / (1024 * 1024), 3),
+        "query_latency": percentile_summary(latencies_ms),
+        **ranking_metrics(rankings, questions, k_values),
+        **column_coverage(rankings, questions, corpus_columns(schema, max_fields, collapse), k_values),
+        "thresholds": threshold_metrics(similarities, schema, questions, thresholds, top_k),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare_reports(report: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compares the configurations of a report with the same configurations in a baseline.
+
+    Returns:
+        The baseline's commit and, per configuration found in both, the absolute change of
+        each recall/coverage metric and MRR, and the relative change in percent of the
+        corpus build time and query p50/p95 latency.
+    """
+    def pct(new: Optional[float], old: Optional[float]) -> Optional[float]:
+        return round((new - old) / old * 100, 1) if new is not None and old else None
+
+    baseline_configs = baseline.get("configurations", {})
+    changes = {}
+    for config_name, result in report["configurations"].items():
+        old = baseline_configs.get(config_name)
+        if old is None:
+            continue
+        quality = {
+            metric: round(value - old[metric], 4)
+            for metric, value in result.items()
+            if (metric == "mrr" or "@" in metric) and value is not None and old.get(metric) is not None
+        }
+        changes[config_name] = {
+            **quality,
+            "corpus_build_change_pct": pct(result["corpus_build_s"], old.get("corpus_build_s")),
+            **{
+                f"query_{key}_change_pct": pct(result["query_latency"].get(key), old.get("query_latency", {}).get(key))
+                for key in ("p50_ms", "p95_ms")
+            },
+        }
+    return {"baseline_commit": baseline.get("commit"), "configurations": changes}
+
+
+def configuration_name(model_name: str, max_fields: int, collapse: bool) -> str:
+    """Returns the report key of a configuration, e.g. 'all-MiniLM-L6-v2|fields=30|collapse'."""
+    return f"{model_name}|fields={max_fields}|{'collapse' if collapse else 'raw'}"
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Runs the retrieval benchmark grid from the command line and writes the JSON report."""
+    import argparse
+
+    import config
+    import rag_core
+
+    parser = argparse.ArgumentParser(description="Recall/MRR/latency benchmark of schema retrieval on a gold question set.")
+    parser.add_argument("--gold", default=DEFAULT_GOLD_PATH, help="Gold question set JSON (default: benchmarks/retrieval_gold.json).")
+    parser.add_argument("--models", nargs="+", default=[rag_core.DEFAULT_SCHEMA_MODEL], help="SentenceTransformer models to compare.")
+    parser.add_argument("--max-fields", nargs="+", type=int, default=[rag_core.MAX_FIELDS_PER_TABLE_IN_CORPUS], help="Fields per table in the corpus text.")
+    parser.add_argument("--collapse", nargs="+", choices=("on", "off"), default=["on" if config.COLLAPSE_BAND_FAMILIES else "off"], help="Band-family collapsing settings to compare.")
+    parser.add_argument("--thresholds", nargs="+", type=float, default=list(DEFAULT_THRESHOLDS), help="Score thresholds to evaluate.")
+    parser.add_argument("--k", nargs="+", type=int, default=list(DEFAULT_K_VALUES), help="Cut-offs for recall@k.")
+    parser.add_argument("--top-k", type=int, default=config.MAX_RAG_TABLES_CONTEXT, help="Tables per prompt for the threshold metrics.")
+    parser.add_argument("--baseline", help="Earlier report to compare with.")
+    parser.add_argument("--output", help="Write the report to this file instead of stdout.")
+    parser.add_argument("--log-level", default="WARNING", help="Logging level (default: WARNING).")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    from sentence_transformers import SentenceTransformer
+
+    questions = load_gold_set(args.gold)
+    rag_core.initialize_rag_schema()
+    schema = rag_core.get_schema()
+    problems = validate_gold_set(questions, schema)
+    if problems:
+        raise SystemExit("Gold set does not match the schema:\n" + "\n".join(problems))
+
+    configurations = {}
+    for model_name in args.models:
+        start = time.perf_counter()
+        model = SentenceTransformer(model_name)
+        model_load_s = round(time.perf_counter() - start, 3)
+        for max_fields in args.max_fields:
+            for collapse in (setting == "on" for setting in args.collapse):
+                name = configuration_name(model_name, max_fields, collapse)
+                logger.info(f"Evaluating {name} on {len(questions)} questions...")
+                configurations[name] = {
+                    "model_load_s": model_load_s,
+                    **evaluate_configuration(model, schema, questions, max_fields, collapse, args.k, args.thresholds, args.top_k),
+                }
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "settings": {"questions": len(questions), "tables": len(schema), "top_k": args.top_k},
+        "configurations": configurations,
+    }
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["comparison"] = compare_reports(report, json.load(f))
+
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report_json + "\n")
+        logger.info(f"Retrieval benchmark report written to {args.output}.")
+    else:
+        print(report_json)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Preprocessing of the SDSS schema for retrieval and prompting.
+
+Photometric tables such as PhotoObjAll repeat most measurements once per SDSS
+filter (`psfMag_u`, `psfMag_g`, ..., `psfMag_z`). This module collapses such
+band families into a single rendered entry (`psfMag_{u,g,r,i,z}`) with a shared
+description, and caches the rendered per-table text used for the semantic
+search corpus, so near-duplicate columns do not dominate embedding and prompt
+budgets. The raw schema is left untouched (SQL validation still needs every
+real column name).
+"""
+import re
+import logging
+from typing import List, Dict, Any, Optional
+
+from metrics import record_cache_lookup
+
+logger = logging.getLogger(__name__)
+
+SDSS_BANDS = ("u", "g", "r", "i", "z")
+"""SDSS imaging filters, in wavelength order."""
+
+MIN_BAND_FAMILY_SIZE = 2
+"""Minimum number of band variants of a column for them to be rendered as one family."""
+
+_BAND_SUFFIX_RE = re.compile(r"^(?P<prefix>.+)_(?P<band>[ugriz])$")
+_BAND_MENTION_RE = re.compile(r"\b[ugriz](?=[- ]band\b)")
+
+_PREPROCESSED_TABLES: Dict[str, Dict[str, Any]] = {}
+"""Cache of collapsed fields and corpus text per table name. Filled by `preprocess_schema`."""
+
+
+def _shared_description(members: List[Dict[str, Any]]) -> str:
+    """Returns one description for a band family, generalising band mentions like 'r-band'."""
+    descriptions = [_BAND_MENTION_RE.sub("<band>", m.get("description", "")) for m in members]
+    if all(d == descriptions[0] for d in descriptions):
+        return descriptions[0]
+    return f"{members[0].get('description', '')} (per band)"
+
+
+def collapse_band_families(fields: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Collapses `<prefix>_u ... <prefix>_z` columns into one rendered field per family.
+
+    Args:
+        fields: The table's field dicts, in schema order.
+
+    Returns:
+        A new list of field dicts. Each family is placed at the position of its first
+        member, named `<prefix>_{bands}` (e.g. `psfMag_{u,g,r,i,z}`) and carries a
+        'members' list with the real column names. Other fields are returned unchanged.
+    """
+    families: Dict[str, List[Dict[str, Any]]] = {}
+    for field in fields:
+        match = _BAND_SUFFIX_RE.match(field.get("name", ""))
+        if match:
+            families.setdefault(match.group("prefix"), []).append(field)
+
+    collapsed: List[Dict[str, Any]] = []
+    emitted = set()
+    for field in fields:
+        match = _BAND_SUFFIX_RE.match(field.get("name", ""))
+        prefix = match.group("prefix") if match else None
+        members = families.get(prefix) if prefix else None
+        if not members or len(members) < MIN_BAND_FAMILY_SIZE:
+            collapsed.append(field)
+            continue
+        if prefix in emitted:
+            continue
+        emitted.add(prefix)
+        bands = [b for b in SDSS_BANDS if any(m["name"] == f"{prefix}_{b}" for m in members)]
+        collapsed.append({
+            **members[0],
+            "name": f"{prefix}_{{{','.join(bands)}}}",
+            "description": _shared_description(members),
+            "members": [m["name"] for m in members],
+        })
+    return collapsed
+
+
+def render_table_corpus_text(table: Dict[str, Any], fields: List[Dict[str, Any]], max_fields: int) -> str:
+    """
+    Renders the semantic-search corpus text for one table.
+
+    Args:
+        table: The table schema dict.
+        fields: The (possibly collapsed) fields to describe.
+        max_fields: Maximum number of field entries to include.
+
+    Returns:
+        The corpus text for the table.
+    """
+    table_name = table.get('name', 'UnnamedTable')
+    table_desc = table.get('description', 'No description.')
+    table_text = f"Table Name: {table_name}. Description: {table_desc}"
+    field_texts = []
+    for f_idx, f in enumerate(fields):
+        if f_idx >= max_fields:
+            field_texts.append(f"... (and {len(fields) - max_fields} more fields)")
+            break
+        field_texts.append(
+            f"Field: {f.get('name', 'N/A')} (Type: {f.get('type', 'N/A')}) Description: {f.get('description', 'N/A')}"
+        )
+    return table_text + ". Fields: " + "; ".join(field_texts)
+
+
+def _preprocess_table(table: Dict[str, Any], max_corpus_fields: int, collapse: bool) -> Dict[str, Any]:
+    """Builds the cached entry (collapsed fields and corpus text) for one table."""
+    raw_fields = table.get("fields", [])
+    fields = collapse_band_families(raw_fields) if collapse else raw_fields
+    return {
+        "source_fields": raw_fields,
+        "collapse": collapse,
+        "fields": fields,
+        "corpus_text": render_table_corpus_text(table, fields, max_corpus_fields),
+        "max_corpus_fields": max_corpus_fields,
+    }
+
+
+def preprocess_schema(schema: List[Dict[str, Any]], max_corpus_fields: int, collapse: bool = True) -> None:
+    """
+    Collapses band families and renders corpus text for every table, caching the results.
+
+    Args:
+        schema: The loaded SDSS schema.
+        max_corpus_fields: Maximum number of field entries in each table's corpus text.
+        collapse: Whether band families should be collapsed.
+    """
+    raw_count = rendered_count = 0
+    for table in schema:
+        entry = _preprocess_table(table, max_corpus_fields, collapse)
+        _PREPROCESSED_TABLES[table.get("name", "UnnamedTable")] = entry
+        raw_count += len(entry["source_fields"])
+        rendered_count += len(entry["fields"])
+    logger.info(f"Preprocessed schema: {raw_count} columns rendered as {rendered_count} field entries.")
+
+
+def _get_entry(table: Dict[str, Any], max_corpus_fields: int, collapse: bool) -> Dict[str, Any]:
+    """Returns the cached entry for a table, rebuilding it if the table or settings changed."""
+    name = table.get("name", "UnnamedTable")
+    entry: Optional[Dict[str, Any]] = _PREPROCESSED_TABLES.get(name)
+    if (
+        entry is None
+        or entry["source_fields"] is not table.get("fields", [])
+        or entry["collapse"] != collapse
+        or entry["max_corpus_fields"] != max_corpus_fields
+    ):
+        record_cache_lookup("schema_preprocessing", hit=False)
+        entry = _preprocess_table(table, max_corpus_fields, collapse)
+        _PREPROCESSED_TABLES[name] = entry
+    else:
+        record_cache_lookup("schema_preprocessing", hit=True)
+    return entry
+
+
+def get_prompt_fields(table: Dict[str, Any], max_corpus_fields: int, collapse: bool = True) -> List[Dict[str, Any]]:
+    """Returns the (cached) field entries of a table as they should be rendered in prompts."""
+    return _get_entry(table, max_corpus_fields, collapse)["fields"]
+
+
+def get_corpus_text(table: Dict[str, Any], max_corpus_fields: int, collapse: bool = True) -> str:
+    """Returns the (cached) semantic-search corpus text of a table."""
+    return _get_entry(table, max_corpus_fields, collapse)["corpus_text"]
@@ -6,25 +6,163 @@ SDSS SkyServer, retrieve results, and perform basic data processing
 such as type conversions for compatibility with downstream tools.
 """
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Iterator, List, Optional
+import sqlite3
 import pandas as pd
 import requests
 import logging
+import contextvars
 # import time # No longer used directly, can be removed if not needed by config
-# import config # No longer used directly, can be removed if not needed by config
+
+import config
+from sql_pagination import PAGE_KEY_ALIAS, build_page_sql
+from request_context import RequestContext, RequestCancelled, DeadlineExceeded, PRIORITY_BULK
+from single_flight import SingleFlight
+from skyserver_scheduler import SKYSERVER_SCHEDULER, SkyServerScheduler
+from sdss_endpoints import EndpointPool
+from local_replica import LOCAL_REPLICA
+from tracing import span, set_span_attributes
+from metrics import CSV_PARSE_SECONDS, record_cache_lookup
+from log_utils import log_payload
+from result_dtypes import normalize_result_dtypes
 
 logger = logging.getLogger(__name__)
 
-# SDSS SkyServer Query URL
-SDSS_API_URL = "https://skyserver.sdss.org/dr16/en/tools/search/x_sql.aspx"
+# SDSS SkyServer Query URL (the preferred endpoint; mirrors are listed in config.SKYSERVER_URLS)
+SDSS_API_URL = config.SKYSERVER_URLS[0]
 # Timeout for the HTTP request in seconds
 REQUEST_TIMEOUT = 60
 
-def query_sdss(sql_query: str) -> pd.DataFrame:
+PAGE_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sdss-page")
+"""Fetches the next result page while the current one is being displayed."""
+
+SKYSERVER_ENDPOINTS = EndpointPool(config.SKYSERVER_URLS)
+"""Hedging, failover and circuit breaking across the configured SkyServer endpoints."""
+
+SQL_FLIGHTS = SingleFlight("SkyServer query")
+"""Coalesces concurrent executions of identical SQL into one SkyServer request."""
+
+def query_sdss(
+    sql_query: str,
+    str_columns: Optional[List[str]] = None,
+    ctx: Optional[RequestContext] = None,
+    priority: Optional[str] = None,
+    allow_local: bool = True,
+) -> pd.DataFrame:
+    """
+    Executes an SQL query against SkyServer, sharing one request among concurrent identical queries.
+
+    With `config.ENABLE_LOCAL_REPLICA` and `allow_local`, a query that the `local_replica`
+    fully covers (tables, columns and sky region) runs on the local SQLite extracts
+    instead; if it fails there, it falls back to SkyServer.
+
+    With `config.ENABLE_SINGLE_FLIGHT`, callers that submit the same SQL (and `str_columns`)
+    while it is already running receive the same DataFrame object instead of sending
+    another request. The returned DataFrame must therefore not be modified in place.
+
+    With `config.ENABLE_SKYSERVER_SCHEDULER`, the request waits for a slot from the
+    rate-limited, fair-share `skyserver_scheduler` before it is sent. `priority`
+    (PRIORITY_INTERACTIVE by default, PRIORITY_BULK for large fetches) and the user
+    of `ctx` decide its place in the queue; hedged and failover requests are charged
+    to the same scheduler. See `_execute_sdss_query` for the other
+    arguments, the return value and errors.
+    """
+    if allow_local and config.ENABLE_LOCAL_REPLICA:
+        local_sql = LOCAL_REPLICA.plan(sql_query)
+        if local_sql is not None:
+            try:
+                with span("local_replica.query", sql=local_sql[:200]):
+                    df = _finish_local_result(LOCAL_REPLICA.execute(local_sql, ctx=ctx), str_columns)
+                record_cache_lookup("local_replica", hit=True)
+                return df
+            except (sqlite3.Error, pd.errors.DatabaseError) as e:
+                logger.warning(f"Local replica failed ({e}). Falling back to SkyServer.")
+        record_cache_lookup("local_replica", hit=False)
+
+    def execute() -> pd.DataFrame:
+        with span("skyserver.query", sql=sql_query[:200], priority=priority):
+            if not config.ENABLE_SKYSERVER_SCHEDULER:
+                return _execute_sdss_query(sql_query, str_columns, ctx)
+            with SKYSERVER_SCHEDULER.slot(ctx=ctx, priority=priority):
+                return _execute_sdss_query(sql_query, str_columns, ctx, scheduler=SKYSERVER_SCHEDULER)
+
+    if not config.ENABLE_SINGLE_FLIGHT:
+        return execute()
+    key = (sql_query.strip(), tuple(str_columns or ()))
+    df, shared = SQL_FLIGHTS.do(key, execute, ctx=ctx)
+    record_cache_lookup("skyserver_query_coalescing", hit=shared)
+    return df
+
+def _finish_local_result(df: pd.DataFrame, str_columns: Optional[List[str]]) -> pd.DataFrame:
+    """Gives a local replica result the same column types as a parsed SkyServer CSV."""
+    for col in str_columns or ():
+        if col in df.columns:
+            df[col] = df[col].astype(str)
+    if not df.empty:
+        _normalize_dtypes(df)
+        convert_id_columns(df)
+    return df
+
+def _normalize_dtypes(df: pd.DataFrame) -> None:
+    """Applies `result_dtypes.normalize_result_dtypes` to a parsed result if enabled."""
+    if not config.NORMALIZE_RESULT_DTYPES:
+        return
+    with span("skyserver.normalize_dtypes"):
+        report = normalize_result_dtypes(df)
+        set_span_attributes(
+            bytes_before=report["bytes_before"], bytes_after=report["bytes_after"],
+            sentinels_replaced=report["sentinels_replaced"],
+        )
+
+def get_endpoint_stats() -> Dict[str, Any]:
+    """Returns hedging, failover and circuit breaker state of the SkyServer endpoints."""
+    return SKYSERVER_ENDPOINTS.get_stats()
+
+def get_sql_coalescing_stats() -> Dict[str, Any]:
+    """Returns the single-flight counters of SkyServer queries."""
+    return SQL_FLIGHTS.get_stats()
+
+def convert_id_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts numeric columns containing "id" (case-insensitive) to strings, in place.
+
+    This is crucial for compatibility with Streamlit, which can have issues
+    with large integer IDs due to JavaScript's number precision limits.
+    """
+    converted_cols = []
+    for col in df.columns:
+        if "id" in col.lower():
+            if df[col].dtype != 'object' and df[col].dtype != 'str':
+                if pd.api.types.is_numeric_dtype(df[col]):
+                    converted_cols.append(col)
+                    try:
+                        df[col] = df[col].astype(str)
+                    except Exception as e:
+                        logger.warning(f"Failed to convert column '{col}' (dtype: {df[col].dtype}) to string: {e}", exc_info=True)
+    if converted_cols:
+        logger.info(f"Converted 'id' columns to string: {', '.join(converted_cols)}")
+    return df
+
+def _execute_sdss_query(
+    sql_query: str,
+    str_columns: Optional[List[str]] = None,
+    ctx: Optional[RequestContext] = None,
+    scheduler: Optional[SkyServerScheduler] = None,
+) -> pd.DataFrame:
     """
     Executes an SQL query against the SDSS SkyServer DR16.
 
     Args:
         sql_query: The SQL query string to execute.
+        str_columns: Columns to parse as strings verbatim (e.g. large keys that must not lose precision).
+        ctx: Optional request context. The HTTP timeout is shrunk to the remaining budget and
+            cancellation returns immediately instead of waiting for SkyServer.
+        scheduler: The scheduler whose slot the caller holds. Hedged and failover requests
+            are charged to it.
+
+    The request goes through `SKYSERVER_ENDPOINTS`, which hedges slow requests to a
+    mirror and skips endpoints whose circuit is open.
 
     Returns:
         A Pandas DataFrame containing the query results.
@@ -35,19 +173,23 @@ def query_sdss(sql_query: str) -> pd.DataFrame:
         ValueError: If SDSS returns an HTML error page or a detectable SQL error message.
         requests.exceptions.Timeout: If the query times out.
         requests.exceptions.HTTPError: For other HTTP-related errors.
+        RequestCancelled, DeadlineExceeded: If `ctx` is cancelled or out of time.
         Exception: For other unexpected errors during parsing or processing.
 
     Notes:
+        - With `config.NORMALIZE_RESULT_DTYPES`, maps SDSS sentinel values to missing
+          values and downcasts numeric columns (see `result_dtypes`).
         - Converts columns with "id" in their name (case-insensitive) to strings
           to prevent JavaScript number precision issues in Streamlit.
         - Detects common SDSS error messages and HTML responses.
     """
     params = {"cmd": sql_query, "format": "csv"}
     
-    logger.info(f"Executing SQL against SDSS SkyServer: {sql_query[:250]}...") # Log more of the query
+    logger.info("Executing SQL against SDSS SkyServer: %.250s...", sql_query)
     
+    timeout = ctx.timeout(REQUEST_TIMEOUT, stage="SkyServer query") if ctx else REQUEST_TIMEOUT
     try:
-        response = requests.get(SDSS_API_URL, params=params, timeout=REQUEST_TIMEOUT)
+        response = SKYSERVER_ENDPOINTS.get(params, timeout, ctx=ctx, scheduler=scheduler)
         response.raise_for_status() # Raises HTTPError for 4xx/5xx responses
 
         content_type = response.headers.get("Content-Type", "").lower()
@@ -78,7 +220,12 @@ def query_sdss(sql_query: str) -> pd.DataFrame:
         # Attempt to parse the CSV data
         # 'on_bad_lines' helps to skip rows that might be malformed,
         # 'comment=#' handles lines starting with # as comments (SDSS often includes these).
-        df = pd.read_csv(StringIO(response.text), on_bad_lines='warn', comment='#') # Changed to 'warn' for bad lines
+        with span("skyserver.parse_csv", bytes=len(response.content)), CSV_PARSE_SECONDS.time():
+            df = pd.read_csv(
+                StringIO(response.text), on_bad_lines='warn', comment='#', # Changed to 'warn' for bad lines
+                dtype={col: str for col in str_columns} if str_columns else None
+            )
+            set_span_attributes(rows=len(df), columns=len(df.columns))
         
         # Further check if DataFrame is empty after parsing,
         # which can happen if the CSV only contained comments or a header with no data.
@@ -86,32 +233,19 @@ def query_sdss(sql_query: str) -> pd.DataFrame:
              logger.warning("SDSS CSV seems to contain only a header or is empty after parsing. Response text: %s", response.text[:200])
              return pd.DataFrame()
 
-        # --- Convert columns containing "id" (case-insensitive) to string ---
-        # This is crucial for compatibility with Streamlit, which can have issues
-        # with large integer IDs due to JavaScript's number precision limits.
+        # Map sentinels to missing values and downcast numeric columns (if enabled),
+        # then convert columns containing "id" (case-insensitive) to string.
         if not df.empty:
-            converted_cols = []
-            for col in df.columns:
-                if "id" in col.lower():
-                    if df[col].dtype != 'object' and df[col].dtype != 'str':
-                        if pd.api.types.is_numeric_dtype(df[col]):
-                            converted_cols.append(col)
-                            try:
-                                df[col] = df[col].astype(str)
-                            except Exception as e:
-                                logger.warning(f"Failed to convert column '{col}' (dtype: {df[col].dtype}) to string: {e}", exc_info=True)
-                        # else:
-                            # logger.debug(f"Column '{col}' has 'id' in name but is not numeric (dtype: {df[col].dtype}). No conversion performed.")
-            if converted_cols:
-                logger.info(f"Converted 'id' columns to string: {', '.join(converted_cols)}")
-        # --- End of ID column conversion ---
+            _normalize_dtypes(df)
+            with span("skyserver.convert_ids"):
+                convert_id_columns(df)
         
         logger.info(f"Successfully queried SDSS and parsed {len(df)} rows.")
         return df
 
     except requests.exceptions.Timeout:
         logger.error(f"Timeout error while querying SDSS for: {sql_query[:100]}...", exc_info=True)
-        raise TimeoutError("SDSS query timed out after {REQUEST_TIMEOUT} seconds.") # Include timeout value
+        raise TimeoutError(f"SDSS query timed out after {timeout:.0f} seconds.") # Include timeout value
     except requests.exceptions.HTTPError as http_err:
         logger.error(f"HTTP error occurred: {http_err}. Response content (preview): {response.text[:500]}", exc_info=True)
         if "error near" in response.text.lower(): # Specific check for SQL syntax errors within HTTP error context
@@ -120,11 +254,55 @@ def query_sdss(sql_query: str) -> pd.DataFrame:
     except pd.errors.EmptyDataError:
         logger.error(f"Pandas EmptyDataError: No data or columns to parse in CSV response. Raw response text preview: {response.text[:500]}", exc_info=True)
         return pd.DataFrame() # Return empty DataFrame for this specific pandas error
+    except (RequestCancelled, DeadlineExceeded):
+        raise
     except ValueError as ve: # Catch specific ValueErrors raised above
         logger.error(f"ValueError during SDSS query processing: {ve}", exc_info=True)
         raise # Re-raise the ValueError
     except Exception as e:
         # Catch-all for any other unexpected errors
         logger.error(f"Unexpected error occurred for query: {sql_query[:100]}...", exc_info=True)
-        logger.debug(f"Raw response text preview (first 1000 chars) for unexpected error:\n{response.text[:1000] if 'response' in locals() else 'Response object not available.'}")
-        raise
\ No newline at end of file
+        if 'response' in locals():
+            logger.debug("Raw response text for unexpected error:\n%s", log_payload(response, render=lambda r: r.text, max_chars=1000))
+        raise
+
+def iter_query_pages(plan: Dict[str, Any], ctx: Optional[RequestContext] = None) -> Iterator[pd.DataFrame]:
+    """
+    Executes a keyset pagination plan page by page.
+
+    Pages are fetched sequentially (each page starts after the last key of the previous
+    one), but the next page is requested as soon as the current one arrives, so fetching
+    overlaps with whatever the caller does with the yielded page. Closing the generator
+    stops fetching.
+
+    Args:
+        plan: A plan from `sql_pagination.plan_keyset_pagination`.
+        ctx: Optional request context passed to every page query.
+
+    Yields:
+        DataFrames with the rows of each page (without the internal key column).
+    """
+    fetched = 0
+
+    def fetch(last_key: Optional[str], limit: int) -> pd.DataFrame:
+        return query_sdss(build_page_sql(plan, last_key, limit), str_columns=[PAGE_KEY_ALIAS], ctx=ctx, priority=PRIORITY_BULK)
+
+    limit = min(plan["page_size"], plan["total_rows"])
+    # Pages run in a copy of the caller's context so their tracing spans nest under the caller's.
+    future = PAGE_PREFETCH_EXECUTOR.submit(contextvars.copy_context().run, fetch, None, limit)
+    try:
+        while future is not None:
+            page = future.result()
+            future = None
+            if page.empty or PAGE_KEY_ALIAS not in page.columns:
+                break
+            fetched += len(page)
+            if len(page) == limit and fetched < plan["total_rows"]:
+                last_key = page[PAGE_KEY_ALIAS].iloc[-1]
+                limit = min(plan["page_size"], plan["total_rows"] - fetched)
+                future = PAGE_PREFETCH_EXECUTOR.submit(contextvars.copy_context().run, fetch, last_key, limit)
+            logger.info(f"Fetched page with {len(page)} rows ({fetched}/{plan['total_rows']}).")
+            yield page.drop(columns=[PAGE_KEY_ALIAS])
+    finally:
+        if future is not None:
+            future.cancel()
@@ -0,0 +1,396 @@
+"""
+Hedged requests and circuit breaking across equivalent SkyServer endpoints.
+
+`config.SKYSERVER_URLS` lists endpoints that answer the same queries (the public
+DR16 SkyServer, mirrors, or a local replica). `EndpointPool.get` sends each
+query to the first healthy endpoint and:
+
+- Hedges: if no response has arrived after the endpoint's recent p95 latency, the
+  same request is sent to the next healthy endpoint. The first usable response
+  wins and the other request is cancelled (its body download is abandoned; a
+  request still waiting for headers is left to finish in the background and its
+  result is discarded).
+- Fails over immediately when an endpoint errors (connection error, timeout, 5xx),
+  also when hedging is disabled.
+- Keeps a circuit breaker per endpoint: after repeated failures the endpoint is
+  skipped for a cool-down period, then a single trial request decides whether it
+  is used again.
+
+When a `SkyServerScheduler` is passed to `get` (the query holds one of its slots),
+every request after the first is charged to it as well: a hedge is only sent if
+the scheduler has a spare token and in-flight place, and a failover waits for a
+token. So hedging and failover never push SkyServer past the configured rate and
+concurrency limits.
+"""
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Any, Deque, Dict, List, Optional
+
+import requests
+
+import config
+from request_context import RequestContext, CANCEL_POLL_INTERVAL_S
+from skyserver_scheduler import SkyServerScheduler
+from tracing import span, set_span_attributes
+from metrics import SKYSERVER_REQUEST_SECONDS, SKYSERVER_RESPONSE_BYTES
+
+logger = logging.getLogger(__name__)
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+MAX_LATENCY_SAMPLES = 200
+"""Recent successful latencies kept per endpoint for the hedge delay."""
+
+_STREAM_CHUNK_BYTES = 64 * 1024
+_HTTP_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="skyserver-http")
+
+
+class EndpointUnavailable(requests.exceptions.ConnectionError):
+    """Raised when every SkyServer endpoint's circuit is open."""
+
+
+class _AttemptCancelled(Exception):
+    """Raised inside a losing attempt when its download is abandoned."""
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    Closed: requests pass. Open (after `failure_threshold` consecutive failures): requests
+    are refused for `reset_timeout_s`. Half-open: one trial request is let through;
+    its success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout_s: float):
+        """
+        Args:
+            failure_threshold: Consecutive failures that open the circuit.
+            reset_timeout_s: Seconds the circuit stays open before a trial request.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.state = BREAKER_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """Returns True if a request may be sent now (reserving the trial slot when half-open)."""
+        with self._lock:
+            if self.state == BREAKER_OPEN and time.monotonic() - self.opened_at >= self.reset_timeout_s:
+                self.state = BREAKER_HALF_OPEN
+            if self.state == BREAKER_CLOSED:
+                return True
+            if self.state == BREAKER_HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """Closes the circuit."""
+        with self._lock:
+            self.state = BREAKER_CLOSED
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self) -> bool:
+        """Counts a failure. Returns True if this failure opened the circuit."""
+        with self._lock:
+            self.consecutive_failures += 1
+            self._trial_in_flight = False
+            if self.state == BREAKER_HALF_OPEN or (
+                self.state == BREAKER_CLOSED and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = BREAKER_OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def release_trial(self) -> None:
+        """Frees the half-open trial slot of an attempt that was cancelled before it could tell anything."""
+        with self._lock:
+            self._trial_in_flight = False
+
+
+class SkyServerEndpoint:
+    """One SkyServer endpoint with its circuit breaker, recent latencies and counters."""
+
+    def __init__(self, url: str, breaker: CircuitBreaker):
+        """
+        Args:
+            url: The `x_sql.aspx` URL of the endpoint.
+            breaker: The endpoint's circuit breaker.
+        """
+        self.url = url
+        self.breaker = breaker
+        self.latencies_s: Deque[float] = deque(maxlen=MAX_LATENCY_SAMPLES)
+        self.stats: Dict[str, int] = {"requests": 0, "successes": 0, "failures": 0, "hedges_won": 0, "circuit_opened": 0}
+
+    def p95_latency_s(self) -> Optional[float]:
+        """Returns the 95th percentile of recent successful latencies, or None without samples."""
+        if not self.latencies_s:
+            return None
+        ordered = sorted(self.latencies_s)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+
+class EndpointPool:
+    """Sends SkyServer requests to a list of equivalent endpoints with hedging and circuit breaking."""
+
+    def __init__(
+        self,
+        urls: List[str],
+        hedge_enabled: bool = config.SKYSERVER_HEDGE_ENABLED,
+        hedge_min_delay_s: float = config.SKYSERVER_HEDGE_MIN_DELAY_S,
+        hedge_initial_delay_s: float = config.SKYSERVER_HEDGE_INITIAL_DELAY_S,
+        hedge_min_samples: int = config.SKYSERVER_HEDGE_MIN_SAMPLES,
+        failure_threshold: int = config.SKYSERVER_BREAKER_FAILURE_THRESHOLD,
+        reset_timeout_s: float = config.SKYSERVER_BREAKER_RESET_TIMEOUT_S,
+    ):
+        """
+        Args:
+            urls: Equivalent endpoints, in order of preference.
+            hedge_enabled: Whether to send hedged requests (needs at least two endpoints).
+            hedge_min_delay_s: Lower bound of the hedge delay.
+            hedge_initial_delay_s: Hedge delay used until an endpoint has enough latency samples.
+            hedge_min_samples: Samples needed before the p95 latency is trusted.
+            failure_threshold: Consecutive failures that open an endpoint's circuit.
+            reset_timeout_s: Seconds an open circuit waits before a trial request.
+        """
+        if not urls:
+            raise ValueError("At least one SkyServer endpoint URL is required.")
+        self.endpoints = [SkyServerEndpoint(url, CircuitBreaker(failure_threshold, reset_timeout_s)) for url in urls]
+        self.hedge_enabled = hedge_enabled and len(self.endpoints) > 1
+        self.hedge_min_delay_s = hedge_min_delay_s
+        self.hedge_initial_delay_s = hedge_initial_delay_s
+        self.hedge_min_samples = hedge_min_samples
+        self._stats_lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            "requests": 0, "hedges": 0, "hedges_throttled": 0, "failovers": 0, "cancelled_losers": 0, "rejected_all_open": 0,
+        }
+
+    def _count(self, counters: Dict[str, int], key: str) -> None:
+        """Increments a counter."""
+        with self._stats_lock:
+            counters[key] += 1
+
+    def hedge_delay_s(self, endpoint: SkyServerEndpoint) -> float:
+        """Returns how long to wait for `endpoint` before hedging: its recent p95 latency, at least the minimum."""
+        p95 = endpoint.p95_latency_s()
+        if p95 is None or len(endpoint.latencies_s) < self.hedge_min_samples:
+            return self.hedge_initial_delay_s
+        return max(self.hedge_min_delay_s, p95)
+
+    def _next_endpoint(self, exclude: List[SkyServerEndpoint]) -> Optional[SkyServerEndpoint]:
+        """Returns the first endpoint not in `exclude` whose circuit lets a request through."""
+        for endpoint in self.endpoints:
+            if endpoint not in exclude and endpoint.breaker.allow_request():
+                return endpoint
+        return None
+
+    def _attempt(
+        self, endpoint: SkyServerEndpoint, params: Dict[str, Any], timeout: float, cancel_event: threading.Event
+    ) -> requests.Response:
+        """Sends one request, streaming the body so a losing attempt can stop early. Records the outcome."""
+        self._count(endpoint.stats, "requests")
+        start = time.perf_counter()
+        with span("skyserver.http", endpoint=endpoint.url):
+            try:
+                response = requests.get(endpoint.url, params=params, timeout=timeout, stream=True)
+                try:
+                    chunks = []
+                    for chunk in response.iter_content(chunk_size=_STREAM_CHUNK_BYTES):
+                        if cancel_event.is_set():
+                            raise _AttemptCancelled()
+                        chunks.append(chunk)
+                finally:
+                    response.close()
+                response._content = b"".join(chunks) # Make `.text`/`.content` work after streaming.
+            except _AttemptCancelled:
+                set_span_attributes(cancelled=True)
+                endpoint.breaker.release_trial()
+                SKYSERVER_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint.url, outcome="cancelled")
+                raise
+            except requests.exceptions.RequestException:
+                if cancel_event.is_set():
+                    endpoint.breaker.release_trial()
+                else:
+                    self._record_failure(endpoint)
+                SKYSERVER_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint.url, outcome="failed")
+                raise
+            set_span_attributes(status_code=response.status_code, bytes=len(response._content))
+        elapsed_s = time.perf_counter() - start
+        SKYSERVER_RESPONSE_BYTES.observe(len(response._content), endpoint=endpoint.url)
+        if response.status_code >= 500:
+            self._record_failure(endpoint)
+            SKYSERVER_REQUEST_SECONDS.observe(elapsed_s, endpoint=endpoint.url, outcome="server_error")
+        else:
+            endpoint.breaker.record_success()
+            endpoint.latencies_s.append(elapsed_s)
+            self._count(endpoint.stats, "successes")
+            SKYSERVER_REQUEST_SECONDS.observe(elapsed_s, endpoint=endpoint.url, outcome="ok")
+        return response
+
+    def _record_failure(self, endpoint: SkyServerEndpoint) -> None:
+        """Counts an endpoint failure and logs when its circuit opens."""
+        self._count(endpoint.stats, "failures")
+        if endpoint.breaker.record_failure():
+            self._count(endpoint.stats, "circuit_opened")
+            logger.warning(
+                f"SkyServer endpoint {endpoint.url} failed {endpoint.breaker.consecutive_failures} time(s) in a row. "
+                f"Circuit open for {endpoint.breaker.reset_timeout_s:.0f}s."
+            )
+
+    def _admit_backup(
+        self,
+        backup: SkyServerEndpoint,
+        scheduler: Optional[SkyServerScheduler],
+        failover: bool,
+        ctx: Optional[RequestContext],
+    ) -> bool:
+        """
+        Charges a hedge or failover attempt to the scheduler.
+
+        Returns False if a hedge is refused, in which case the backup's half-open trial
+        slot (reserved by `_next_endpoint`) is released.
+        """
+        if scheduler is None:
+            return True
+        try:
+            if failover:
+                scheduler.take_token(ctx)
+                return True
+            admitted = scheduler.try_extra_attempt()
+        except BaseException:
+            backup.breaker.release_trial()
+            raise
+        if not admitted:
+            backup.breaker.release_trial()
+            self._count(self.stats, "hedges_throttled")
+        return admitted
+
+    def get(
+        self,
+        params: Dict[str, Any],
+        timeout: float,
+        ctx: Optional[RequestContext] = None,
+        scheduler: Optional[SkyServerScheduler] = None,
+    ) -> requests.Response:
+        """
+        Sends a GET request with hedging and failover, returning the first usable response.
+
+        Args:
+            params: Query parameters.
+            timeout: Per-request timeout in seconds (as for `requests.get`).
+            ctx: Optional request context; cancellation abandons all attempts.
+            scheduler: The scheduler whose slot the caller holds for this request. Hedges
+                and failovers are charged to it (see the module docstring).
+
+        Returns:
+            The winning response. If every attempt got a 5xx response, the last one is
+            returned so the caller's `raise_for_status` reports it.
+
+        Raises:
+            EndpointUnavailable: If every endpoint's circuit is open.
+            requests.exceptions.RequestException: The last error if no attempt got a response.
+            RequestCancelled, DeadlineExceeded: If `ctx` ends while waiting.
+        """
+        self._count(self.stats, "requests")
+        primary = self._next_endpoint([])
+        if primary is None:
+            self._count(self.stats, "rejected_all_open")
+            raise EndpointUnavailable("All SkyServer endpoints are failing (circuits open). Try again shortly.")
+
+        attempts: Dict[Future, Any] = {}
+        tried: List[SkyServerEndpoint] = []
+
+        def launch(endpoint: SkyServerEndpoint, extra_attempt: bool = False) -> None:
+            cancel_event = threading.Event()
+            tried.append(endpoint)
+            # The copied context makes the attempt's tracing span a child of the caller's span.
+            future = _HTTP_EXECUTOR.submit(
+                contextvars.copy_context().run, self._attempt, endpoint, params, timeout, cancel_event,
+            )
+            if extra_attempt:
+                # A hedge keeps its in-flight place until it really ends, also as an abandoned loser.
+                future.add_done_callback(lambda _: scheduler.finish_extra_attempt())
+            attempts[future] = (endpoint, cancel_event)
+
+        launch(primary)
+        hedge_at = time.monotonic() + self.hedge_delay_s(primary) if self.hedge_enabled else None
+        pending = set(attempts)
+        last_error: Optional[Exception] = None
+        last_response: Optional[requests.Response] = None
+        try:
+            while pending:
+                wait_s = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+                if ctx is not None:
+                    wait_s = CANCEL_POLL_INTERVAL_S if wait_s is None else min(wait_s, CANCEL_POLL_INTERVAL_S)
+                done, pending = wait(pending, timeout=wait_s, return_when=FIRST_COMPLETED)
+                for future in done:
+                    endpoint, _ = attempts[future]
+                    try:
+                        response = future.result()
+                    except _AttemptCancelled:
+                        continue
+                    except requests.exceptions.RequestException as e:
+                        logger.warning(f"SkyServer endpoint {endpoint.url} failed: {e}")
+                        last_error = e
+                        continue
+                    if response.status_code >= 500:
+                        logger.warning(f"SkyServer endpoint {endpoint.url} returned HTTP {response.status_code}.")
+                        last_response = response
+                        continue
+                    if endpoint is not primary:
+                        self._count(endpoint.stats, "hedges_won")
+                    return response
+                if ctx is not None:
+                    ctx.check("SkyServer query")
+
+                failed_fast = not pending
+                if failed_fast or (hedge_at is not None and time.monotonic() >= hedge_at):
+                    hedge_at = None # At most one hedge; failovers continue while untried endpoints remain.
+                    backup = self._next_endpoint(tried)
+                    if backup is not None and self._admit_backup(backup, scheduler, failed_fast, ctx):
+                        self._count(self.stats, "failovers" if failed_fast else "hedges")
+                        logger.info(
+                            f"SkyServer: {'failing over' if failed_fast else 'hedging'} to {backup.url} "
+                            f"(primary {primary.url})."
+                        )
+                        launch(backup, extra_attempt=scheduler is not None and not failed_fast)
+                        pending = {f for f in attempts if not f.done()}
+        finally:
+            for future, (endpoint, cancel_event) in attempts.items():
+                if not future.done():
+                    cancel_event.set() # Loser (or abandoned request): stop downloading its body.
+                    if future.cancel():
+                        endpoint.breaker.release_trial() # Never started, so it never reported back.
+                    self._count(self.stats, "cancelled_losers")
+
+        if last_response is not None:
+            return last_response
+        raise last_error if last_error else EndpointUnavailable("No SkyServer endpoint answered.")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns pool counters and, per endpoint, circuit state, p95 latency and counters."""
+        with self._stats_lock:
+            return {
+                **self.stats,
+                "endpoints": [
+                    {
+                        "url": endpoint.url,
+                        "circuit": endpoint.breaker.state,
+                        "p95_latency_ms": (endpoint.p95_latency_s() or 0.0) * 1000,
+                        **endpoint.stats,
+                    }
+                    for endpoint in self.endpoints
+                ],
+            }
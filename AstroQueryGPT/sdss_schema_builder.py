@@ -0,0 +1,233 @@
+"""
+Builds the SDSS schema knowledge base from SkyServer's own catalog tables.
+
+`sdss_schema_scraper.py` loads one schema-browser page per table in a headed
+Chromium (128 page loads, a second apart) and parses the HTML, which takes many
+minutes and breaks when the page layout changes. The DR16 database documents
+itself, so this builder gets the same information from three bulk queries through
+`sdss_db.query_sdss`:
+
+- `DBObjects`: the user tables and their one-line descriptions;
+- `DBColumns`: the unit, UCD and description of every column of every table;
+- `INFORMATION_SCHEMA.COLUMNS`: column order, data types and storage lengths.
+
+The result has the format of `sdss_schema_dr16.json` (`config.SCHEMA_FILE_PATH`): a
+list of `{"name", "description", "fields": [{"name", "type", "length", "unit", "ucd",
+"description"}]}`, with lengths in bytes as the schema browser shows them. If the
+bulk queries fail, the command line falls back to the Playwright scraper.
+
+SkyServer's CSV output does not quote text, so commas, double quotes and '#'
+(read as a comment by the CSV parser) in free text are replaced by control
+characters in SQL and restored after parsing.
+"""
+import re
+import html
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import pandas as pd
+
+import config
+from sdss_db import query_sdss
+
+logger = logging.getLogger(__name__)
+
+TEXT_ESCAPES = {",": 31, '"': 30, "#": 29}
+"""Characters of free text sent as `CHAR(code)`, since SkyServer's CSV output does not quote text."""
+
+FIXED_TYPE_LENGTHS = {
+    "bigint": 8, "int": 4, "smallint": 2, "tinyint": 1, "bit": 1, "float": 8, "real": 4,
+    "money": 8, "smallmoney": 4, "datetime": 8, "smalldatetime": 4, "date": 3, "uniqueidentifier": 16,
+}
+"""Storage bytes of SQL Server types without a declared length."""
+
+QueryFn = Callable[..., pd.DataFrame]
+
+
+def _escaped_text(expression: str, alias: str) -> str:
+    """Wraps a text column so it survives unquoted CSV: `TEXT_ESCAPES` characters and line breaks are replaced."""
+    for character, code in TEXT_ESCAPES.items():
+        quoted = character.replace("'", "''")
+        expression = f"REPLACE({expression}, '{quoted}', CHAR({code}))"
+    expression = f"REPLACE(REPLACE({expression}, CHAR(13), ' '), CHAR(10), ' ')"
+    return f"{expression} AS {alias}"
+
+
+def _restore_text(value: Any) -> str:
+    """Undoes `_escaped_text` and reduces documentation HTML to plain text, as the schema browser shows it."""
+    if not isinstance(value, str):
+        return ""
+    for character, code in TEXT_ESCAPES.items():
+        value = value.replace(chr(code), character)
+    value = html.unescape(re.sub(r"<[^>]+>", "", value))
+    return " ".join(value.split())
+
+
+TABLES_SQL = (
+    f"SELECT name, {_escaped_text('description', 'description')} "
+    "FROM DBObjects WHERE type = 'U' AND access = 'U' ORDER BY name"
+)
+"""The user tables and their descriptions."""
+
+COLUMN_DOCS_SQL = (
+    f"SELECT tablename, name, {_escaped_text('unit', 'unit')}, {_escaped_text('ucd', 'ucd')}, "
+    f"{_escaped_text('description', 'description')} FROM DBColumns"
+)
+"""Unit, UCD and description of every documented column."""
+
+COLUMN_TYPES_SQL = (
+    "SELECT TABLE_NAME AS tablename, COLUMN_NAME AS name, DATA_TYPE AS type, "
+    "CHARACTER_OCTET_LENGTH AS octets, NUMERIC_PRECISION AS num_precision, ORDINAL_POSITION AS position "
+    "FROM INFORMATION_SCHEMA.COLUMNS"
+)
+"""Order, type and length of every column (of tables and views)."""
+
+
+def storage_length(data_type: str, octets: Any, precision: Any) -> str:
+    """
+    Returns a column's storage length in bytes as the schema browser shows it ('-1' for `max` types).
+
+    Args:
+        data_type: SQL Server type name (e.g. 'real', 'varchar', 'numeric').
+        octets: `CHARACTER_OCTET_LENGTH` (character and binary types), else NaN/None.
+        precision: `NUMERIC_PRECISION` (numeric and decimal types), else NaN/None.
+    """
+    data_type = data_type.lower()
+    if data_type in FIXED_TYPE_LENGTHS:
+        return str(FIXED_TYPE_LENGTHS[data_type])
+    if pd.notna(octets):
+        return str(int(octets))
+    if data_type in ("numeric", "decimal") and pd.notna(precision):
+        precision = int(precision)
+        return str(5 if precision <= 9 else 9 if precision <= 19 else 13 if precision <= 28 else 17)
+    return ""
+
+
+def _run(query_fn: QueryFn, sql: str, str_columns: List[str]) -> pd.DataFrame:
+    df = query_fn(sql, str_columns=str_columns, allow_local=False)
+    if len(df) >= config.SKYSERVER_ROW_LIMIT:
+        raise ValueError(f"Schema query hit SkyServer's {config.SKYSERVER_ROW_LIMIT} row limit and may be incomplete: {sql[:80]}...")
+    return df
+
+
+def build_schema(query_fn: QueryFn = query_sdss, tables: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Builds the schema knowledge base with bulk catalog queries.
+
+    Args:
+        query_fn: Runs SQL on SkyServer (`sdss_db.query_sdss` signature).
+        tables: Restrict the schema to these tables (case-insensitive). Defaults to all user tables.
+
+    Returns:
+        The schema as a list of table dicts, in the format of `config.SCHEMA_FILE_PATH`.
+
+    Raises:
+        ValueError: If a query returns no tables or columns, or hits the row limit.
+        Exception: Errors of `query_fn` (HTTP errors, timeouts, SkyServer SQL errors).
+    """
+    start = time.perf_counter()
+    table_rows = _run(query_fn, TABLES_SQL, ["name", "description"])
+    docs = _run(query_fn, COLUMN_DOCS_SQL, ["tablename", "name", "unit", "ucd", "description"])
+    types = _run(query_fn, COLUMN_TYPES_SQL, ["tablename", "name", "type"])
+    if table_rows.empty or types.empty:
+        raise ValueError("Schema queries returned no tables or no columns.")
+
+    wanted = {name.lower() for name in tables} if tables else None
+    doc_by_column = {
+        (str(row.tablename).lower(), str(row.name).lower()): row
+        for row in docs.itertuples(index=False)
+    }
+    fields_by_table: Dict[str, List[Dict[str, str]]] = {}
+    for row in types.sort_values(["tablename", "position"]).itertuples(index=False):
+        doc = doc_by_column.pop((str(row.tablename).lower(), str(row.name).lower()), None)
+        fields_by_table.setdefault(str(row.tablename).lower(), []).append({
+            "name": str(row.name),
+            "type": str(row.type),
+            "length": storage_length(str(row.type), row.octets, row.num_precision),
+            "unit": _restore_text(doc.unit) if doc is not None else "",
+            "ucd": _restore_text(doc.ucd) if doc is not None else "",
+            "description": _restore_text(doc.description) if doc is not None else "",
+        })
+
+    schema = []
+    for row in table_rows.itertuples(index=False):
+        name = str(row.name)
+        if wanted is not None and name.lower() not in wanted:
+            continue
+        fields = fields_by_table.get(name.lower(), [])
+        if not fields:
+            logger.warning(f"No columns found for table {name}.")
+        schema.append({"name": name, "description": _restore_text(row.description), "fields": fields})
+    if wanted is not None and len(schema) < len(wanted):
+        missing = wanted - {table["name"].lower() for table in schema}
+        logger.warning(f"Tables not found in DBObjects: {', '.join(sorted(missing))}")
+
+    logger.info(
+        f"Built schema of {len(schema)} tables and {sum(len(table['fields']) for table in schema)} columns "
+        f"from 3 bulk queries in {time.perf_counter() - start:.1f}s."
+    )
+    return schema
+
+
+def _scrape_with_browser() -> List[Dict[str, Any]]:
+    """Runs the Playwright schema-browser scraper (imported here: it needs playwright and bs4)."""
+    from sdss_schema_scraper import scrape_schema
+
+    return asyncio.run(scrape_schema())
+
+
+def build_schema_with_fallback(
+    query_fn: QueryFn = query_sdss, tables: Optional[Sequence[str]] = None, fallback: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Builds the schema with bulk queries, falling back to the Playwright scraper if they fail.
+
+    Args:
+        query_fn: Runs SQL on SkyServer (`sdss_db.query_sdss` signature).
+        tables: Restrict the bulk-built schema to these tables. The scraper always covers its own table list.
+        fallback: Whether to fall back to the scraper.
+
+    Returns:
+        The schema as a list of table dicts.
+
+    Raises:
+        Exception: The bulk build's error if `fallback` is off.
+    """
+    try:
+        return build_schema(query_fn, tables)
+    except Exception as e:
+        if not fallback:
+            raise
+        logger.warning(f"Bulk schema queries failed ({e}). Falling back to the schema-browser scraper.")
+        return _scrape_with_browser()
+
+
+def main(argv: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """Builds the schema from the command line and writes it as JSON."""
+    import argparse
+
+    from log_utils import configure_logging
+
+    parser = argparse.ArgumentParser(description="Build the SDSS schema JSON from DBObjects/DBColumns with bulk SQL queries.")
+    parser.add_argument("--output", default=config.SCHEMA_FILE_PATH, help=f"Schema JSON to write (default: {config.SCHEMA_FILE_PATH}).")
+    parser.add_argument("--tables", help="Comma-separated tables to include (default: all user tables).")
+    parser.add_argument("--no-fallback", action="store_true", help="Fail instead of falling back to the Playwright scraper.")
+    parser.add_argument("--log-level", default="INFO", help="Logging level (default: INFO).")
+    args = parser.parse_args(argv)
+    configure_logging(args.log_level)
+
+    tables = [name.strip() for name in args.tables.split(",") if name.strip()] if args.tables else None
+    schema = build_schema_with_fallback(tables=tables, fallback=not args.no_fallback)
+    if not schema:
+        raise SystemExit("No schema was built.")
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(schema, f, indent=2)
+    logger.info(f"Schema of {len(schema)} tables written to {args.output}.")
+    return schema
+
+
+if __name__ == "__main__":
+    main()
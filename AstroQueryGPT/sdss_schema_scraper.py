@@ -320,11 +320,18 @@ async def fetch_table_schema_html(page, url: str, table_name: str) -> str | None
         return None
 
 
-async def main():
+async def scrape_schema() -> list[dict]:
+    """
+    Scrapes every table of `TABLES_TSV_DATA` from the SkyServer schema browser.
+
+    This is slow (one page load per table) and depends on the browser's page layout;
+    `sdss_schema_builder.py` builds the same JSON from a few bulk SQL queries and
+    only falls back to this scraper when those fail.
+    """
     all_tables_data = parse_table_list_from_tsv(TABLES_TSV_DATA)
     if not all_tables_data:
-        print("No table metadata parsed from TSV. Exiting.")
-        return
+        print("No table metadata parsed from TSV.")
+        return []
 
     full_schema_data = []
 
@@ -364,6 +371,15 @@ async def main():
 
         await browser.close()
 
+    return full_schema_data
+
+
+async def main():
+    full_schema_data = await scrape_schema()
+    if not full_schema_data:
+        print("No schema scraped. Exiting.")
+        return
+
     # Save the full schema to JSON
     try:
         with open(OUTPUT_SCHEMA_FILE, "w", encoding="utf-8") as f:
@@ -0,0 +1,132 @@
+"""
+Single-flight coalescing of identical concurrent work.
+
+When several sessions ask for the same thing at the same time (e.g. a class of
+students running the same question, or a dashboard refreshing the same SQL),
+`SingleFlight.do` runs the work once and hands the same result object (or the
+same exception) to every concurrent caller with the same key. Nothing is
+cached: a call that starts after the work finished runs it again.
+
+Used by `agent` (identical normalized questions share one agent run) and by
+`sdss_db` (identical SQL strings share one SkyServer request). Shared results
+must be treated as read-only by callers.
+"""
+import logging
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from request_context import RequestContext, RequestCancelled, DeadlineExceeded, CANCEL_POLL_INTERVAL_S
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """One in-flight execution and its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls with the same key.
+
+    Attributes:
+        name: Name used in logs and stats.
+        stats: 'calls' (all calls), 'executions' (calls that ran the work), 'coalesced'
+            (calls served by another caller's execution) and 'reruns' (waiters that ran the
+            work themselves because the execution they joined was abandoned).
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name: Name used in logs and stats.
+        """
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.stats: Dict[str, int] = {"calls": 0, "executions": 0, "coalesced": 0, "reruns": 0}
+
+    def do(
+        self,
+        key: Hashable,
+        fn: Callable[[], Any],
+        ctx: Optional[RequestContext] = None,
+        abandoned: Optional[Callable[[Any], bool]] = None,
+    ) -> Tuple[Any, bool]:
+        """
+        Runs `fn` unless an identical call is already in flight, in which case its outcome is shared.
+
+        The caller that runs `fn` uses its own request context. If that caller gives up
+        (its request is cancelled or out of time, or `abandoned(result)` is true), waiters
+        whose own requests are still live run the call again instead of inheriting that.
+
+        Args:
+            key: Identity of the work (e.g. normalized question or SQL text).
+            fn: The work; takes no arguments.
+            ctx: The caller's request context. A waiting caller stops waiting when it is
+                cancelled or out of time.
+            abandoned: Optional predicate on a shared result telling that the executing
+                caller gave up rather than finished.
+
+        Returns:
+            A tuple of the result and whether it came from another caller's execution.
+
+        Raises:
+            The exception raised by `fn` (shared with all waiters), or RequestCancelled /
+            DeadlineExceeded if the caller's own `ctx` ends while waiting.
+        """
+        with self._lock:
+            self.stats["calls"] += 1
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                    self.stats["executions"] += 1
+                else:
+                    flight.waiters += 1
+                    self.stats["coalesced"] += 1
+
+            if leader:
+                try:
+                    flight.result = fn()
+                except BaseException as e:
+                    flight.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        del self._flights[key]
+                    flight.done.set()
+                    if flight.waiters:
+                        logger.info(f"Single-flight '{self.name}': shared one execution with {flight.waiters} waiting caller(s).")
+                return flight.result, False
+
+            if ctx is None:
+                flight.done.wait()
+            else:
+                while not flight.done.wait(CANCEL_POLL_INTERVAL_S):
+                    ctx.check(f"{self.name} (waiting for an identical request)")
+
+            leader_gave_up = (
+                isinstance(flight.error, (RequestCancelled, DeadlineExceeded))
+                or (flight.error is None and abandoned is not None and abandoned(flight.result))
+            )
+            if leader_gave_up and (ctx is None or (not ctx.cancelled and ctx.remaining() != 0)):
+                with self._lock:
+                    self.stats["reruns"] += 1
+                logger.info(f"Single-flight '{self.name}': the shared execution was abandoned. Running it again.")
+                continue
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns a copy of the counters plus the number of executions currently in flight."""
+        with self._lock:
+            return {**self.stats, "in_flight": len(self._flights)}
@@ -0,0 +1,278 @@
+"""
+Fair-share scheduling and rate limiting of SkyServer queries.
+
+SkyServer throttles clients that send too many queries, so every query from
+this process goes through one `SkyServerScheduler` (see `sdss_db.query_sdss`):
+
+- A global token bucket bounds the sustained request rate (with a small burst),
+  and a concurrency cap bounds the number of queries in flight.
+- Waiting queries are dispatched interactive-first (probes and small queries a
+  user is waiting on) before bulk work (full TOP N fetches, pagination pages).
+- Within a priority class, users are served in start-time fair queueing order,
+  so one user's correction storm or paginated pull cannot starve the others.
+- A query's slot covers one HTTP attempt at a time. A hedged attempt sent while
+  the first is still running needs its own token and in-flight place and is only
+  admitted if both are free and nobody is queued (`try_extra_attempt`); a failover
+  after a failed attempt waits for a token (`take_token`).
+
+Queue wait times and throttling decisions are counted in the scheduler stats.
+"""
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import config
+from request_context import RequestContext, PRIORITY_INTERACTIVE, PRIORITY_BULK, CANCEL_POLL_INTERVAL_S
+
+logger = logging.getLogger(__name__)
+
+_PRIORITY_RANK = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 1}
+
+MAX_TRACKED_USERS = 1000
+"""Users kept in the per-user grant counts; the least recently served ones are dropped first."""
+
+
+def _new_priority_stats() -> Dict[str, float]:
+    """Returns zeroed counters for one priority class."""
+    return {"granted": 0, "queued": 0, "throttled": 0, "queue_wait_ms_total": 0.0, "queue_wait_ms_max": 0.0}
+
+
+class SkyServerScheduler:
+    """
+    Token bucket plus concurrency cap with per-user fair queues and two priority classes.
+
+    Attributes:
+        rate_per_s: Sustained dispatch rate (tokens added per second).
+        burst: Bucket capacity.
+        max_concurrent: Maximum number of queries in flight.
+        stats: Counters per priority class ('granted', 'queued' (had to wait), 'throttled'
+            (waited for the rate limit), 'queue_wait_ms_total', 'queue_wait_ms_max'),
+            plus 'cancelled_while_queued', 'extra_attempts' (hedges and failovers admitted),
+            'hedges_refused' and per-user grant counts in 'users' (the MAX_TRACKED_USERS
+            most recently served users; 'users_dropped' counts the others).
+    """
+
+    def __init__(
+        self,
+        rate_per_s: float = config.SKYSERVER_RATE_PER_S,
+        burst: int = config.SKYSERVER_BURST,
+        max_concurrent: int = config.SKYSERVER_MAX_CONCURRENT,
+    ):
+        """
+        Args:
+            rate_per_s: Sustained queries per second.
+            burst: Queries that may be dispatched back to back.
+            max_concurrent: Maximum number of queries in flight.
+        """
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._in_flight = 0
+        # Waiting tickets: (priority rank, fair-queueing start tag, arrival sequence).
+        self._waiting: List[Tuple[int, float, int]] = []
+        self._virtual_time = 0.0
+        self._user_finish_tags: Dict[str, float] = {}
+        # (finish tag, user) per issued tag, to forget tags the virtual time has passed.
+        self._finish_tag_heap: List[Tuple[float, str]] = []
+        self._sequence = itertools.count()
+        self.stats: Dict[str, Any] = {
+            PRIORITY_INTERACTIVE: _new_priority_stats(),
+            PRIORITY_BULK: _new_priority_stats(),
+            "cancelled_while_queued": 0,
+            "extra_attempts": 0,
+            "hedges_refused": 0,
+            "users": OrderedDict(),
+            "users_dropped": 0,
+        }
+
+    def _refill(self) -> None:
+        """Adds the tokens accumulated since the last refill."""
+        now = time.monotonic()
+        self._tokens = min(float(self.burst), self._tokens + (now - self._last_refill) * self.rate_per_s)
+        self._last_refill = now
+
+    @contextmanager
+    def slot(
+        self, ctx: Optional[RequestContext] = None, user_id: Optional[str] = None, priority: Optional[str] = None
+    ) -> Iterator[None]:
+        """
+        Waits for a dispatch slot and holds it for the duration of the `with` block.
+
+        Args:
+            ctx: The request context; waiting stops when it is cancelled or out of time.
+                Also supplies the user and priority when not given.
+            user_id: The user to charge the query to.
+            priority: PRIORITY_INTERACTIVE or PRIORITY_BULK. A request whose context is
+                bulk is always scheduled as bulk.
+
+        Raises:
+            RequestCancelled, DeadlineExceeded: If `ctx` ends while the query is queued.
+        """
+        user_id = user_id or (ctx.user_id if ctx else None) or "anonymous"
+        if priority is None or (ctx is not None and ctx.priority == PRIORITY_BULK):
+            priority = ctx.priority if ctx else PRIORITY_INTERACTIVE
+        self._acquire(ctx, user_id, priority)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def _acquire(self, ctx: Optional[RequestContext], user_id: str, priority: str) -> None:
+        """Queues a ticket and blocks until it is the next one and capacity and a token are available."""
+        with self._cond:
+            # Start-time fair queueing: a user's next query starts after its previous one,
+            # but never before the current virtual time (no credit for idle periods).
+            start_tag = max(self._virtual_time, self._user_finish_tags.get(user_id, 0.0))
+            self._user_finish_tags[user_id] = start_tag + 1.0
+            heapq.heappush(self._finish_tag_heap, (start_tag + 1.0, user_id))
+            ticket = (_PRIORITY_RANK[priority], start_tag, next(self._sequence))
+            self._waiting.append(ticket)
+            wait_start = time.perf_counter()
+            queued = throttled = False
+            try:
+                while True:
+                    if ctx is not None:
+                        ctx.check("SkyServer queue")
+                    self._refill()
+                    timeout: Optional[float] = None
+                    if min(self._waiting) == ticket and self._in_flight < self.max_concurrent:
+                        if self._tokens >= 1.0:
+                            break
+                        throttled = True
+                        timeout = (1.0 - self._tokens) / self.rate_per_s
+                    queued = True
+                    if ctx is not None:
+                        timeout = CANCEL_POLL_INTERVAL_S if timeout is None else min(timeout, CANCEL_POLL_INTERVAL_S)
+                    self._cond.wait(timeout)
+            except BaseException:
+                self._waiting.remove(ticket)
+                self.stats["cancelled_while_queued"] += 1
+                self._cond.notify_all()
+                raise
+            self._waiting.remove(ticket)
+            self._tokens -= 1.0
+            self._in_flight += 1
+            self._virtual_time = max(self._virtual_time, start_tag)
+            self._forget_finished_users()
+
+            wait_ms = (time.perf_counter() - wait_start) * 1000
+            priority_stats = self.stats[priority]
+            priority_stats["granted"] += 1
+            priority_stats["queued"] += int(queued)
+            priority_stats["throttled"] += int(throttled)
+            priority_stats["queue_wait_ms_total"] += wait_ms
+            priority_stats["queue_wait_ms_max"] = max(priority_stats["queue_wait_ms_max"], wait_ms)
+            self._count_user(user_id)
+            self._cond.notify_all()
+        if throttled:
+            logger.info(f"SkyServer rate limit: {priority} query of user '{user_id}' waited {wait_ms:.0f} ms for a token.")
+        elif queued:
+            logger.debug(f"SkyServer queue: {priority} query of user '{user_id}' waited {wait_ms:.0f} ms.")
+
+    def _forget_finished_users(self) -> None:
+        """
+        Drops finish tags the virtual time has reached; such a user's next query starts at the virtual time anyway.
+
+        With no query queued, the virtual time moves past every tag, so one-off users
+        (e.g. one per client address) do not accumulate.
+        """
+        if not self._waiting and self._user_finish_tags:
+            self._virtual_time = max(self._virtual_time, max(self._user_finish_tags.values()))
+        while self._finish_tag_heap and self._finish_tag_heap[0][0] <= self._virtual_time:
+            finish_tag, user_id = heapq.heappop(self._finish_tag_heap)
+            if self._user_finish_tags.get(user_id) == finish_tag:
+                del self._user_finish_tags[user_id]
+
+    def _count_user(self, user_id: str) -> None:
+        """Counts a grant for `user_id`, dropping the least recently served user beyond MAX_TRACKED_USERS."""
+        users = self.stats["users"]
+        users[user_id] = users.pop(user_id, 0) + 1
+        while len(users) > MAX_TRACKED_USERS:
+            users.popitem(last=False)
+            self.stats["users_dropped"] += 1
+
+    def try_extra_attempt(self) -> bool:
+        """
+        Admits a hedged HTTP attempt of a query that holds a slot, without waiting.
+
+        The attempt takes a token and an in-flight place. It is refused when either is
+        missing or another query is queued, so hedging never delays anyone's first
+        attempt. An admitted attempt must be ended with `finish_extra_attempt`.
+
+        Returns:
+            True if the attempt may be sent.
+        """
+        with self._cond:
+            self._refill()
+            if self._waiting or self._in_flight >= self.max_concurrent or self._tokens < 1.0:
+                self.stats["hedges_refused"] += 1
+                return False
+            self._tokens -= 1.0
+            self._in_flight += 1
+            self.stats["extra_attempts"] += 1
+            return True
+
+    def finish_extra_attempt(self) -> None:
+        """Frees the in-flight place of an attempt admitted by `try_extra_attempt`."""
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def take_token(self, ctx: Optional[RequestContext] = None) -> None:
+        """
+        Waits for a token for a failover attempt of a query that holds a slot.
+
+        The query's previous attempts have ended, so its slot covers the concurrency;
+        only the rate limit applies.
+
+        Args:
+            ctx: The request context; waiting stops when it is cancelled or out of time.
+
+        Raises:
+            RequestCancelled, DeadlineExceeded: If `ctx` ends while waiting.
+        """
+        with self._cond:
+            while True:
+                if ctx is not None:
+                    ctx.check("SkyServer failover")
+                self._refill()
+                if self._tokens >= 1.0:
+                    break
+                timeout = (1.0 - self._tokens) / self.rate_per_s
+                if ctx is not None:
+                    timeout = min(timeout, CANCEL_POLL_INTERVAL_S)
+                self._cond.wait(timeout)
+            self._tokens -= 1.0
+            self.stats["extra_attempts"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns a copy of the counters plus the current queue length, in-flight count and mean waits."""
+        with self._cond:
+            stats = {
+                key: dict(value) if isinstance(value, dict) else value for key, value in self.stats.items()
+            }
+            stats["waiting"] = len(self._waiting)
+            stats["in_flight"] = self._in_flight
+        for priority in (PRIORITY_INTERACTIVE, PRIORITY_BULK):
+            granted = stats[priority]["granted"]
+            stats[priority]["queue_wait_ms_mean"] = stats[priority]["queue_wait_ms_total"] / granted if granted else 0.0
+        return stats
+
+
+SKYSERVER_SCHEDULER = SkyServerScheduler()
+"""The process-wide scheduler used by `sdss_db.query_sdss`."""
+
+
+def get_scheduler_stats() -> Dict[str, Any]:
+    """Returns the SkyServer scheduler's queue wait and throttling metrics."""
+    return SKYSERVER_SCHEDULER.get_stats()
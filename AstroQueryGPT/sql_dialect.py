@@ -0,0 +1,205 @@
+"""
+Translation of SkyServer T-SQL queries to the SQLite dialect of the local replica.
+
+Only the subset of T-SQL that generated queries commonly use is translated:
+- `SELECT TOP n` / `TOP (n)` on the outermost query becomes a trailing `LIMIT n`.
+- Bracketed identifiers (`[name]`) become double-quoted identifiers, `dbo.`
+  prefixes, `N'...'` string prefixes and table hints (`WITH (NOLOCK)`) are dropped.
+- Common functions are renamed (`ISNULL` -> `IFNULL`, `LEN` -> `LENGTH`, ...) or
+  provided with T-SQL semantics by `register_tsql_functions` (e.g. `LOG` is the
+  natural logarithm, `ATN2`, `SQUARE`).
+
+Anything else (SkyServer functions such as `dbo.fGetNearbyObjEq`, variables,
+`CONVERT`, `TOP ... PERCENT`, `SELECT INTO`, TOP in subqueries, ...) raises
+`UnsupportedDialect`, so such queries keep going to SkyServer.
+"""
+import math
+import sqlite3
+import logging
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from sql_validator import SQL_KEYWORDS, _TOKEN_RE
+
+logger = logging.getLogger(__name__)
+
+RENAMED_FUNCTIONS: Dict[str, str] = {
+    "isnull": "IFNULL",
+    "len": "LENGTH",
+    "substring": "SUBSTR",
+    "count_big": "COUNT",
+    "ceiling": "TSQL_CEILING",
+    "log": "TSQL_LOG",
+}
+"""T-SQL functions whose SQLite counterpart has another name (or other semantics, see `register_tsql_functions`)."""
+
+SQLITE_NATIVE_FUNCTIONS: Set[str] = {
+    "cast", "count", "sum", "avg", "min", "max", "abs", "round", "coalesce", "nullif",
+    "upper", "lower", "ltrim", "rtrim", "replace",
+}
+"""Functions SQLite provides with the same name and meaning as T-SQL."""
+
+_UNSUPPORTED_KEYWORDS: Set[str] = {
+    "into", "offset", "fetch", "over", "pivot", "unpivot", "option", "for", "convert", "try_convert",
+    "declare", "exec", "execute", "insert", "update", "delete", "drop", "create", "alter", "truncate",
+}
+"""Words that make a query untranslatable (or not a read-only query)."""
+
+
+class UnsupportedDialect(ValueError):
+    """Raised when a T-SQL query uses a construct the local dialect cannot run with the same meaning."""
+
+
+def _float_or_none(func: Callable[..., float]) -> Callable[..., Optional[float]]:
+    """Wraps a math function so NULL arguments and domain errors yield NULL instead of an error."""
+    def wrapped(*args: Any) -> Optional[float]:
+        if any(arg is None for arg in args):
+            return None
+        try:
+            return func(*(float(arg) for arg in args))
+        except (ValueError, OverflowError, ZeroDivisionError):
+            return None
+    return wrapped
+
+
+def _tsql_log(x: float, base: Optional[float] = None) -> float:
+    """T-SQL LOG: the natural logarithm, or the logarithm to `base` with two arguments."""
+    return math.log(x) if base is None else math.log(x, base)
+
+
+TSQL_FUNCTIONS: Dict[str, Tuple[int, Callable[..., Any]]] = {
+    "TSQL_LOG": (-1, _float_or_none(_tsql_log)),
+    "TSQL_CEILING": (1, _float_or_none(math.ceil)),
+    "log10": (1, _float_or_none(math.log10)),
+    "power": (2, _float_or_none(math.pow)),
+    "sqrt": (1, _float_or_none(math.sqrt)),
+    "square": (1, _float_or_none(lambda x: x * x)),
+    "exp": (1, _float_or_none(math.exp)),
+    "floor": (1, _float_or_none(math.floor)),
+    "sign": (1, _float_or_none(lambda x: (x > 0) - (x < 0))),
+    "pi": (0, lambda: math.pi),
+    "radians": (1, _float_or_none(math.radians)),
+    "degrees": (1, _float_or_none(math.degrees)),
+    "sin": (1, _float_or_none(math.sin)),
+    "cos": (1, _float_or_none(math.cos)),
+    "tan": (1, _float_or_none(math.tan)),
+    "asin": (1, _float_or_none(math.asin)),
+    "acos": (1, _float_or_none(math.acos)),
+    "atan": (1, _float_or_none(math.atan)),
+    "atn2": (2, _float_or_none(math.atan2)),
+}
+"""Functions registered on replica connections: name -> (number of arguments, implementation).
+Registered even where SQLite has built-in math functions, whose semantics differ (e.g. LOG is log10 there)."""
+
+
+def register_tsql_functions(connection: sqlite3.Connection) -> None:
+    """Registers the T-SQL math functions used by translated queries on a SQLite connection."""
+    for name, (num_args, func) in TSQL_FUNCTIONS.items():
+        connection.create_function(name, num_args, func, deterministic=True)
+
+
+def translate_tsql_to_sqlite(sql_query: str) -> str:
+    """
+    Translates a SkyServer T-SQL SELECT query to SQLite.
+
+    Args:
+        sql_query: The T-SQL query.
+
+    Returns:
+        The equivalent SQLite query.
+
+    Raises:
+        UnsupportedDialect: If the query uses a construct without a faithful local equivalent.
+    """
+    pieces: List[Tuple[str, str]] = [(m.lastgroup, m.group()) for m in _TOKEN_RE.finditer(sql_query)]
+    significant = [i for i, (kind, _) in enumerate(pieces) if kind not in ("ws", "comment")]
+    out = [" " if kind == "comment" else text for kind, text in pieces]
+
+    def word(pos: int) -> Optional[str]:
+        if 0 <= pos < len(significant) and pieces[significant[pos]][0] == "word":
+            return pieces[significant[pos]][1].lower()
+        return None
+
+    def is_op(pos: int, op: str) -> bool:
+        return 0 <= pos < len(significant) and pieces[significant[pos]] == ("op", op)
+
+    def blank(first_pos: int, last_pos: int) -> None:
+        for pos in range(first_pos, last_pos + 1):
+            out[significant[pos]] = ""
+
+    if word(0) not in ("select", "with"):
+        raise UnsupportedDialect("Only SELECT queries can run on the local replica.")
+
+    limit: Optional[int] = None
+    has_set_operator = False
+    depth = 0
+    pos = 0
+    while pos < len(significant):
+        idx = significant[pos]
+        kind, text = pieces[idx]
+        lowered = text.lower()
+        if kind == "op":
+            if text == "(":
+                depth += 1
+            elif text == ")":
+                depth -= 1
+            elif text == ";" and pos == len(significant) - 1:
+                out[idx] = ""
+        elif kind == "variable":
+            raise UnsupportedDialect(f"Variables ({text}) cannot run on the local replica.")
+        elif kind == "string":
+            if is_op(pos - 1, "+") or is_op(pos + 1, "+"):
+                raise UnsupportedDialect("String concatenation with '+' has no SQLite equivalent.")
+            if lowered.startswith("n"):
+                out[idx] = text[1:]
+        elif kind in ("bracket", "quoted"):
+            if is_op(pos + 1, "("):
+                raise UnsupportedDialect(f"Function {text} has no local equivalent.")
+            out[idx] = '"' + text[1:-1].replace('"', '""') + '"'
+        elif kind == "word":
+            if lowered in _UNSUPPORTED_KEYWORDS:
+                raise UnsupportedDialect(f"'{text.upper()}' is not supported on the local replica.")
+            if lowered == "top":
+                if depth != 0 or word(pos - 1) not in ("select", "distinct", "all"):
+                    raise UnsupportedDialect("TOP is only translated on the outermost SELECT.")
+                end = pos + 1
+                if is_op(end, "(") and is_op(end + 2, ")"):
+                    number_pos, end = end + 1, end + 2
+                else:
+                    number_pos = end
+                number_kind, number_text = pieces[significant[number_pos]] if number_pos < len(significant) else ("", "")
+                if number_kind != "number" or not number_text.isdigit():
+                    raise UnsupportedDialect("TOP needs a constant row count to run locally.")
+                if word(end + 1) in ("percent", "with"):
+                    raise UnsupportedDialect("TOP ... PERCENT / WITH TIES is not supported on the local replica.")
+                limit = int(number_text)
+                blank(pos, end)
+                pos = end
+            elif lowered == "dbo" and is_op(pos + 1, "."):
+                blank(pos, pos + 1)
+                pos += 1
+            elif lowered == "with" and is_op(pos + 1, "("):
+                close = pos + 1
+                hint_depth = 0
+                while close < len(significant):
+                    hint_depth += is_op(close, "(") - is_op(close, ")")
+                    if hint_depth == 0:
+                        break
+                    close += 1
+                blank(pos, close) # Table hint such as WITH (NOLOCK).
+                pos = close
+            elif lowered in ("union", "except", "intersect") and depth == 0:
+                has_set_operator = True
+            elif is_op(pos + 1, "(") and lowered not in SQL_KEYWORDS:
+                if lowered in RENAMED_FUNCTIONS:
+                    out[idx] = RENAMED_FUNCTIONS[lowered]
+                elif lowered not in SQLITE_NATIVE_FUNCTIONS and lowered not in TSQL_FUNCTIONS:
+                    raise UnsupportedDialect(f"Function '{text}' has no local equivalent.")
+        pos += 1
+
+    if limit is not None and has_set_operator:
+        raise UnsupportedDialect("TOP combined with UNION/EXCEPT/INTERSECT is not supported on the local replica.")
+    translated = "".join(out).strip()
+    if limit is not None:
+        translated += f" LIMIT {limit}"
+    logger.debug(f"Translated T-SQL to SQLite: {translated[:250]}")
+    return translated
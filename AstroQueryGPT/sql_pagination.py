@@ -0,0 +1,168 @@
+"""
+Keyset pagination of verified SELECT queries.
+
+A simple single-table `SELECT TOP N ... FROM t WHERE ...` query is rewritten
+into a sequence of pages ordered by a unique key of the table (e.g. objID or
+specObjID):
+
+    SELECT TOP <page> <columns>, t.objID AS _page_key FROM t
+    WHERE (<original conditions>) AND t.objID > <last key> ORDER BY t.objID
+
+Each page is cheap for SkyServer (an index range seek on the key), so the first
+rows can be shown while the rest is still being fetched, and fetching can stop
+at any page. Queries whose semantics would change under re-ordering or
+splitting (ORDER BY, aggregates, DISTINCT, GROUP BY, joins, set operations,
+subqueries) are not paginated.
+"""
+import re
+import logging
+from typing import List, Dict, Any, Optional
+
+from sql_validator import SchemaIndex, tokenize_sql, extract_table_references, _is_keyword
+
+logger = logging.getLogger(__name__)
+
+PAGE_KEY_ALIAS = "_page_key"
+"""Column alias under which each page returns the pagination key (dropped before display)."""
+
+_UNPAGEABLE_KEYWORDS = (
+    "order", "group", "having", "union", "intersect", "except", "distinct",
+    "join", "apply", "into", "offset", "with", "percent",
+)
+_AGGREGATE_FUNCTIONS = {"count", "count_big", "sum", "avg", "min", "max", "stdev", "stdevp", "var", "varp"}
+_KEY_TYPES = {"bigint", "int", "numeric", "decimal", "smallint"}
+_SELECT_TOP_RE = re.compile(
+    r"^\s*SELECT\s+TOP\s+(?P<top>\d+)\s+(?P<columns>.+?)\s+FROM\s+(?P<rest>.+?)\s*;?\s*$", re.IGNORECASE | re.DOTALL
+)
+_WHERE_RE = re.compile(r"\bWHERE\b", re.IGNORECASE)
+_INTEGER_KEY_RE = re.compile(r"-?\d+")
+
+
+def find_table_key(table_schema: Dict[str, Any]) -> Optional[str]:
+    """
+    Resolves a unique key column of a table from the schema.
+
+    Uses a field described as "(Primary key)" if there is one. Otherwise falls back
+    to the SDSS convention that the first column is the table's unique identifier
+    (objID, specObjID, fieldID, ...) when it is an integer `...ID` column.
+
+    Args:
+        table_schema: The table's schema dict.
+
+    Returns:
+        The key column name, or None if no suitable key is found.
+    """
+    fields = table_schema.get("fields", [])
+    for field in fields:
+        if "primary key" in field.get("description", "").lower():
+            return field.get("name")
+    if fields:
+        first = fields[0]
+        if first.get("name", "").lower().endswith("id") and first.get("type", "").lower() in _KEY_TYPES:
+            return first["name"]
+    return None
+
+
+def plan_keyset_pagination(
+    sql_query: str,
+    schema_index: Optional[SchemaIndex],
+    schema: List[Dict[str, Any]],
+    page_size: int,
+) -> Optional[Dict[str, Any]]:
+    """
+    Builds a keyset pagination plan for a query, if it can be paginated safely.
+
+    Args:
+        sql_query: A validated `SELECT TOP N` query.
+        schema_index: Index used to resolve views (e.g. PhotoObj) to their base tables.
+        schema: The loaded SDSS schema, used to find the table's key column.
+        page_size: Rows per page.
+
+    Returns:
+        A plan dict with 'columns', 'from_clause', 'where', 'key_column', 'key_expr',
+        'total_rows' and 'page_size', or None if the query must run unpaginated.
+    """
+    if schema_index is None:
+        return None
+    match = _SELECT_TOP_RE.match(sql_query)
+    if not match:
+        return None
+    total_rows = int(match.group("top"))
+    if total_rows <= page_size:
+        return None
+
+    tokens = tokenize_sql(sql_query)
+    if sum(1 for t in tokens if _is_keyword(t, "select")) != 1:
+        logger.debug("Pagination: query has subqueries. Running it unpaginated.")
+        return None
+    for idx, token in enumerate(tokens):
+        if _is_keyword(token, *_UNPAGEABLE_KEYWORDS):
+            logger.debug(f"Pagination: '{token[1][0]}' prevents keyset pagination.")
+            return None
+        if (
+            token[0] == "name" and len(token[1]) == 1 and token[1][0].lower() in _AGGREGATE_FUNCTIONS
+            and idx + 1 < len(tokens) and tokens[idx + 1] == ("op", "(")
+        ):
+            logger.debug("Pagination: aggregate queries are not paginated.")
+            return None
+
+    sources, _ = extract_table_references(tokens)
+    if len(sources) != 1 or sources[0]["kind"] != "table":
+        return None
+    source = sources[0]
+    table_key = schema_index.resolve_table(source["name"])
+    if table_key is None:
+        return None
+    table_schema = next((t for t in schema if t.get("name", "").lower() == table_key), None)
+    key_column = find_table_key(table_schema) if table_schema else None
+    if not key_column:
+        logger.debug(f"Pagination: no unique key found for table '{source['name']}'.")
+        return None
+
+    rest = match.group("rest")
+    where_match = _WHERE_RE.search(rest)
+    from_clause = rest[:where_match.start()].strip() if where_match else rest.strip()
+    where = rest[where_match.end():].strip() if where_match else None
+    plan = {
+        "columns": match.group("columns").strip(),
+        "from_clause": from_clause,
+        "where": where,
+        "key_column": key_column,
+        "key_expr": f"{source['alias'] or source['name']}.{key_column}",
+        "total_rows": total_rows,
+        "page_size": page_size,
+    }
+    logger.info(f"Pagination: fetching {total_rows} rows in pages of {page_size} ordered by {plan['key_expr']}.")
+    return plan
+
+
+def _format_key(value: Any) -> str:
+    """Renders a key value as a SQL literal (integers unquoted, anything else as a quoted string)."""
+    text = str(value)
+    if _INTEGER_KEY_RE.fullmatch(text):
+        return text
+    return "'" + text.replace("'", "''") + "'"
+
+
+def build_page_sql(plan: Dict[str, Any], last_key: Optional[Any], limit: int) -> str:
+    """
+    Builds the SQL for the page after `last_key`.
+
+    Args:
+        plan: A plan from `plan_keyset_pagination`.
+        last_key: The key of the last row of the previous page, or None for the first page.
+        limit: Number of rows to fetch.
+
+    Returns:
+        The page SQL query.
+    """
+    conditions = []
+    if plan["where"]:
+        conditions.append(f"({plan['where']})")
+    if last_key is not None:
+        conditions.append(f"{plan['key_expr']} > {_format_key(last_key)}")
+    where_clause = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return (
+        f"SELECT TOP {limit} {plan['columns']}, {plan['key_expr']} AS {PAGE_KEY_ALIAS} "
+        f"FROM {plan['from_clause']}{where_clause} ORDER BY {plan['key_expr']}"
+    )
@@ -0,0 +1,650 @@
+"""
+Offline, schema-aware validation of generated SQL queries.
+
+This module checks the table and column references of a Transact-SQL query
+against the locally loaded SDSS schema before the query is sent to SkyServer.
+It includes functionalities for:
+- Building a hash-set index of table and column names from the schema.
+- Tokenizing T-SQL and resolving table aliases, CTEs and derived tables.
+- Reporting invalid tables/columns as structured errors with nearest-name
+  suggestions (bit-parallel edit distance over prefiltered candidates),
+  formatted like SkyServer's own error messages.
+
+Validation is deliberately conservative: references that cannot be resolved
+with certainty (columns of subqueries, CTEs or table-valued functions) are not
+reported, so a valid query is never rejected locally.
+"""
+import re
+import logging
+from itertools import chain
+from collections import Counter
+from typing import List, Dict, Any, FrozenSet, Iterable, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+SDSS_VIEW_BASE_TABLES: Dict[str, str] = {
+    "PhotoObj": "PhotoObjAll",
+    "PhotoPrimary": "PhotoObjAll",
+    "PhotoSecondary": "PhotoObjAll",
+    "PhotoFamily": "PhotoObjAll",
+    "PhotoTag": "PhotoObjAll",
+    "Galaxy": "PhotoObjAll",
+    "GalaxyTag": "PhotoObjAll",
+    "Star": "PhotoObjAll",
+    "StarTag": "PhotoObjAll",
+    "Sky": "PhotoObjAll",
+    "Unknown": "PhotoObjAll",
+    "SpecObj": "SpecObjAll",
+    "SpecPhoto": "SpecPhotoAll",
+    "PlateX": "PlateX",
+    "Tile": "sdssTileAll",
+    "TiledTarget": "sdssTiledTargetAll",
+    "segueTarget": "segueTargetAll",
+}
+"""Common SkyServer views mapped to the base table whose columns they expose (a superset is used)."""
+
+SQL_KEYWORDS: Set[str] = {
+    "select", "top", "distinct", "percent", "ties", "from", "where", "and", "or", "not",
+    "in", "is", "null", "like", "between", "as", "on", "join", "inner", "left", "right",
+    "full", "outer", "cross", "apply", "group", "by", "order", "asc", "desc", "having",
+    "union", "all", "except", "intersect", "case", "when", "then", "else", "end", "with",
+    "into", "exists", "any", "some", "escape", "collate", "over", "partition", "rows",
+    "range", "offset", "fetch", "next", "first", "row", "only", "nolock", "limit",
+    "true", "false", "unbounded", "preceding", "following", "current",
+}
+"""Reserved words that are never treated as table or column references."""
+
+SQL_TYPE_NAMES: Set[str] = {
+    "bigint", "int", "smallint", "tinyint", "bit", "float", "real", "decimal", "numeric",
+    "money", "char", "varchar", "nchar", "nvarchar", "text", "binary", "varbinary",
+    "datetime", "date", "time", "max",
+}
+"""Data type names that can appear as bare words inside CAST/CONVERT expressions."""
+
+DATEPART_FUNCTIONS: Set[str] = {"dateadd", "datediff", "datediff_big", "datepart", "datename", "datetrunc", "date_bucket"}
+"""Functions whose first argument is a bare datepart name (day, month, dd, ...), not a column."""
+
+MAX_NAME_SUGGESTIONS = 3
+"""Maximum number of nearest-name suggestions attached to a validation error."""
+
+_MAX_CACHED_CANDIDATE_SETS = 256
+"""Column name sets (single tables and joined combinations) kept prepared for suggestions."""
+
+_TOKEN_RE = re.compile(
+    r"""
+      (?P<ws>\s+)
+    | (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<string>N?'(?:[^']|'')*')
+    | (?P<bracket>\[[^\]]*\])
+    | (?P<quoted>"[^"]*")
+    | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<variable>@@?\w+)
+    | (?P<word>[A-Za-z_#][\w$#]*)
+    | (?P<op><>|!=|>=|<=|[-+*/%=<>(),.;&|^~!])
+    | (?P<other>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+class SchemaIndex:
+    """
+    Precomputed, case-insensitive hash-set index of the SDSS schema.
+
+    Attributes:
+        tables: Maps lowercase table names to their canonical names.
+        columns: Maps lowercase table names to a dict of lowercase column name -> canonical name.
+        views: Maps lowercase view names to the lowercase base table they resolve to.
+    """
+
+    def __init__(self, schema: List[Dict[str, Any]], view_base_tables: Optional[Dict[str, str]] = None):
+        """
+        Args:
+            schema: List of table dicts with 'name' and 'fields'.
+            view_base_tables: Views resolved to base tables (SDSS_VIEW_BASE_TABLES by default).
+        """
+        if view_base_tables is None:
+            view_base_tables = SDSS_VIEW_BASE_TABLES
+        self.tables: Dict[str, str] = {}
+        self.columns: Dict[str, Dict[str, str]] = {}
+        for table in schema:
+            name = table.get("name")
+            if not name:
+                continue
+            key = name.lower()
+            self.tables[key] = name
+            self.columns[key] = {
+                f["name"].lower(): f["name"] for f in table.get("fields", []) if f.get("name")
+            }
+        self.views: Dict[str, str] = {
+            view.lower(): base.lower()
+            for view, base in view_base_tables.items()
+            if base.lower() in self.tables and view.lower() not in self.tables
+        }
+        self.object_names: Dict[str, str] = dict(self.tables)
+        self.object_names.update(
+            {view.lower(): view for view in view_base_tables if view.lower() in self.views}
+        )
+        self._object_candidates: Optional["NameCandidates"] = None
+        self._column_candidates: Dict[Tuple[str, ...], "NameCandidates"] = {}
+
+    def resolve_table(self, name: str) -> Optional[str]:
+        """Returns the lowercase base table key for a table or view name, or None if unknown."""
+        key = name.lower()
+        if key in self.tables:
+            return key
+        return self.views.get(key)
+
+    def canonical_table_name(self, table_key: str) -> str:
+        """Returns the schema spelling of a lowercase table key."""
+        return self.tables.get(table_key, table_key)
+
+    def object_candidates(self) -> "NameCandidates":
+        """Returns the table and view names prepared for `closest_names` (built on first use)."""
+        if self._object_candidates is None:
+            self._object_candidates = NameCandidates(self.object_names.values())
+        return self._object_candidates
+
+    def column_candidates(self, *table_keys: str) -> "NameCandidates":
+        """Returns the column names of one or more tables prepared for `closest_names` (built on first use)."""
+        candidates = self._column_candidates.get(table_keys)
+        if candidates is None:
+            if len(self._column_candidates) >= _MAX_CACHED_CANDIDATE_SETS:
+                self._column_candidates.clear()
+            candidates = NameCandidates(chain.from_iterable(self.columns.get(key, {}).values() for key in table_keys))
+            self._column_candidates[table_keys] = candidates
+        return candidates
+
+
+def build_schema_index(schema: List[Dict[str, Any]]) -> SchemaIndex:
+    """
+    Builds the hash-set index used for local SQL validation.
+
+    Args:
+        schema: The loaded SDSS schema (list of table dicts with 'name' and 'fields').
+
+    Returns:
+        A SchemaIndex instance.
+    """
+    index = SchemaIndex(schema)
+    logger.debug(f"Built schema index with {len(index.tables)} tables and {len(index.views)} view aliases.")
+    return index
+
+
+# --- Tokenization ---
+def tokenize_sql(sql_query: str) -> List[Tuple[str, Any]]:
+    """
+    Splits a T-SQL query into tokens, folding dotted identifiers into a single name token.
+
+    Args:
+        sql_query: The SQL query string.
+
+    Returns:
+        A list of (kind, value) tuples. Kind is one of 'name', 'string', 'number',
+        'variable' or 'op'. For 'name' tokens the value is a tuple of identifier parts
+        (e.g. ('p', 'ra') for `p.ra`); a trailing `*` part is kept as '*'.
+    """
+    raw_tokens: List[Tuple[str, str]] = []
+    for match in _TOKEN_RE.finditer(sql_query):
+        kind = match.lastgroup
+        value = match.group()
+        if kind in ("ws", "comment"):
+            continue
+        if kind == "bracket":
+            kind, value = "word", value[1:-1]
+        elif kind == "quoted":
+            kind, value = "word", value[1:-1]
+        raw_tokens.append((kind, value))
+
+    tokens: List[Tuple[str, Any]] = []
+    i = 0
+    while i < len(raw_tokens):
+        kind, value = raw_tokens[i]
+        if kind != "word":
+            tokens.append(("op" if kind == "other" else kind, value))
+            i += 1
+            continue
+        parts = [value]
+        i += 1
+        # Fold `a.b.c` and `alias.*` into one name token.
+        while (
+            i + 1 < len(raw_tokens)
+            and raw_tokens[i] == ("op", ".")
+            and (raw_tokens[i + 1][0] == "word" or raw_tokens[i + 1] == ("op", "*"))
+        ):
+            parts.append(raw_tokens[i + 1][1])
+            i += 2
+            if parts[-1] == "*":
+                break
+        tokens.append(("name", tuple(parts)))
+    return tokens
+
+
+def _is_keyword(token: Tuple[str, Any], *words: str) -> bool:
+    """Checks whether a token is an unqualified keyword (optionally one of `words`)."""
+    if token[0] != "name" or len(token[1]) != 1:
+        return False
+    word = token[1][0].lower()
+    return word in words if words else word in SQL_KEYWORDS
+
+
+def _find_closing_paren(tokens: List[Tuple[str, Any]], open_idx: int) -> int:
+    """Returns the index of the parenthesis matching the one at `open_idx` (or the last index)."""
+    depth = 0
+    for idx in range(open_idx, len(tokens)):
+        if tokens[idx] == ("op", "("):
+            depth += 1
+        elif tokens[idx] == ("op", ")"):
+            depth -= 1
+            if depth == 0:
+                return idx
+    return len(tokens) - 1
+
+
+# --- Reference extraction ---
+def extract_table_references(
+    tokens: List[Tuple[str, Any]]
+) -> Tuple[List[Dict[str, Any]], Set[int]]:
+    """
+    Finds every table source in FROM/JOIN/APPLY clauses and CTE definitions.
+
+    Args:
+        tokens: Tokens produced by `tokenize_sql`.
+
+    Returns:
+        A tuple of (sources, consumed_indices). Each source is a dict with keys
+        'name' (object name or None for derived tables), 'alias', 'kind'
+        ('table', 'derived', 'function' or 'cte') and 'token_index'.
+        consumed_indices holds token positions that are table names or aliases
+        and must not be treated as column references.
+    """
+    sources: List[Dict[str, Any]] = []
+    consumed: Set[int] = set()
+    n = len(tokens)
+
+    # CTE names: `name AS (` at the start of a WITH list.
+    for idx in range(n - 2):
+        if (
+            tokens[idx][0] == "name"
+            and len(tokens[idx][1]) == 1
+            and not _is_keyword(tokens[idx])
+            and _is_keyword(tokens[idx + 1], "as")
+            and tokens[idx + 2] == ("op", "(")
+            and idx > 0
+            and (_is_keyword(tokens[idx - 1], "with") or tokens[idx - 1] == ("op", ","))
+        ):
+            sources.append({"name": tokens[idx][1][0], "alias": None, "kind": "cte", "token_index": idx})
+            consumed.add(idx)
+
+    for idx, token in enumerate(tokens):
+        if not _is_keyword(token, "from", "join", "apply"):
+            continue
+        allow_list = _is_keyword(token, "from")
+        j = idx + 1
+        while j < n:
+            source: Dict[str, Any] = {"name": None, "alias": None, "kind": "table", "token_index": j}
+            if tokens[j] == ("op", "("):
+                source["kind"] = "derived"
+                j = _find_closing_paren(tokens, j) + 1
+            elif tokens[j][0] == "name" and not _is_keyword(tokens[j]):
+                parts = tokens[j][1]
+                source["name"] = parts[-1]
+                consumed.add(j)
+                if j + 1 < n and tokens[j + 1] == ("op", "("):
+                    source["kind"] = "function"
+                    j = _find_closing_paren(tokens, j + 1) + 1
+                else:
+                    j += 1
+            else:
+                break
+            # Optional alias, with or without AS.
+            if j < n and _is_keyword(tokens[j], "as"):
+                j += 1
+            if j < n and tokens[j][0] == "name" and len(tokens[j][1]) == 1 and not _is_keyword(tokens[j]):
+                source["alias"] = tokens[j][1][0]
+                consumed.add(j)
+                j += 1
+            # Table hints such as WITH (NOLOCK).
+            if j + 1 < n and _is_keyword(tokens[j], "with") and tokens[j + 1] == ("op", "("):
+                j = _find_closing_paren(tokens, j + 1) + 1
+            sources.append(source)
+            if allow_list and j < n and tokens[j] == ("op", ","):
+                j += 1
+                continue
+            break
+    return sources, consumed
+
+
+# --- Suggestions ---
+def _char_mask(text: str) -> int:
+    """Returns a bit mask of the characters in `text` (non-ASCII characters may share bits)."""
+    mask = 0
+    for character in text:
+        mask |= 1 << (ord(character) & 127)
+    return mask
+
+
+def _bigrams(text: str) -> FrozenSet[str]:
+    return frozenset(text[i:i + 2] for i in range(len(text) - 1))
+
+
+class NameCandidates:
+    """
+    Names prepared for `closest_names`, so a lookup does not compare against every name.
+
+    Attributes:
+        names: (lowercase name, name, character mask, bigrams) per distinct name.
+        by_length: Maps a name length to the positions of names of that length.
+        by_bigram: Maps a bigram to the positions of names containing it.
+    """
+
+    def __init__(self, names: Iterable[str]):
+        """
+        Args:
+            names: Candidate names; duplicates (case-insensitive) keep their first spelling.
+        """
+        self.names: List[Tuple[str, str, int, FrozenSet[str]]] = []
+        self.by_length: Dict[int, List[int]] = {}
+        self.by_bigram: Dict[str, List[int]] = {}
+        seen: Set[str] = set()
+        for name in names:
+            lowered = name.lower()
+            if lowered in seen:
+                continue
+            seen.add(lowered)
+            position = len(self.names)
+            bigrams = _bigrams(lowered)
+            self.names.append((lowered, name, _char_mask(lowered), bigrams))
+            self.by_length.setdefault(len(lowered), []).append(position)
+            for bigram in bigrams:
+                self.by_bigram.setdefault(bigram, []).append(position)
+
+
+def _pattern_bits(pattern: str) -> Dict[str, int]:
+    """Maps each character of `pattern` to the bit mask of its positions (for `_bit_parallel_distance`)."""
+    bits: Dict[str, int] = {}
+    for i, character in enumerate(pattern):
+        bits[character] = bits.get(character, 0) | (1 << i)
+    return bits
+
+
+def _bit_parallel_distance(pattern_bits: Dict[str, int], pattern_length: int, text: str) -> int:
+    """
+    Levenshtein distance between a pattern and `text` with Myers' bit-vector algorithm.
+
+    One column of the dynamic programming matrix is a pair of bit vectors (Python ints),
+    so each character of `text` costs a few integer operations instead of a row of cells.
+    """
+    if not pattern_length:
+        return len(text)
+    full = (1 << pattern_length) - 1
+    last = 1 << (pattern_length - 1)
+    plus, minus, score = full, 0, pattern_length
+    for character in text:
+        equal = pattern_bits.get(character, 0)
+        vertical = equal | minus
+        horizontal = (((equal & plus) + plus) ^ plus) | equal
+        h_plus = minus | (~(horizontal | plus) & full)
+        h_minus = plus & horizontal
+        if h_plus & last:
+            score += 1
+        elif h_minus & last:
+            score -= 1
+        h_plus = ((h_plus << 1) | 1) & full
+        h_minus = (h_minus << 1) & full
+        plus = h_minus | (~(vertical | h_plus) & full)
+        minus = h_plus & vertical
+    return score
+
+
+def edit_distance(a: str, b: str, max_distance: Optional[int] = None) -> int:
+    """
+    Computes the case-insensitive Levenshtein distance between two strings.
+
+    Args:
+        a: First string.
+        b: Second string.
+        max_distance: If given, returns max_distance + 1 for any distance above it
+            (and skips the computation when the lengths already differ by more).
+
+    Returns:
+        The edit distance (or max_distance + 1 if the bound was exceeded).
+    """
+    a, b = a.lower(), b.lower()
+    if a == b:
+        return 0
+    if max_distance is not None and abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    distance = _bit_parallel_distance(_pattern_bits(a), len(a), b)
+    return distance if max_distance is None else min(distance, max_distance + 1)
+
+
+def closest_names(name: str, candidates: NameCandidates, max_suggestions: int = MAX_NAME_SUGGESTIONS) -> List[str]:
+    """
+    Returns the candidates closest to `name` by edit distance.
+
+    Only candidates within max(2, len(name) // 3) edits are considered, ordered by
+    distance and then alphabetically. Before computing distances, candidates are
+    filtered with bounds that never exceed the edit distance: one edit changes at most
+    two bigrams, so a candidate must share enough bigrams with `name` (counted over the
+    bigram lookup table); its length, and the distinct characters only one of the names
+    has, may differ by at most the allowed distance.
+    """
+    lowered = name.lower()
+    length = len(lowered)
+    max_distance = max(2, length // 3)
+    bigrams = _bigrams(lowered)
+    min_shared = len(bigrams) - 2 * max_distance
+    if min_shared > 0:
+        shared = Counter(chain.from_iterable(candidates.by_bigram.get(bigram, ()) for bigram in bigrams))
+    else:
+        # Too short for the bigram bound: every candidate of a close enough length qualifies.
+        shared = Counter({
+            position: len(bigrams & candidates.names[position][3])
+            for size in range(max(0, length - max_distance), length + max_distance + 1)
+            for position in candidates.by_length.get(size, ())
+        })
+    mask = _char_mask(lowered)
+    pattern_bits = _pattern_bits(lowered)
+    scored = []
+    # Most shared bigrams first: once enough names are found, the distance bound tightens
+    # to the worst of them and the remaining, less similar names are cut off early.
+    cutoff = max_distance
+    for position, shared_bigrams in shared.most_common():
+        if shared_bigrams < len(bigrams) - 2 * cutoff:
+            break
+        candidate, original, candidate_mask, candidate_bigrams = candidates.names[position]
+        if (
+            abs(len(candidate) - length) > cutoff
+            or shared_bigrams < len(candidate_bigrams) - 2 * cutoff
+            or bin(mask & ~candidate_mask).count("1") > cutoff
+            or bin(candidate_mask & ~mask).count("1") > cutoff
+        ):
+            continue
+        distance = _bit_parallel_distance(pattern_bits, length, candidate)
+        if distance <= cutoff:
+            scored.append((distance, candidate, original))
+            if len(scored) >= max_suggestions:
+                cutoff = sorted(scored)[max_suggestions - 1][0]
+    scored.sort()
+    return [original for _, _, original in scored[:max_suggestions]]
+
+
+def suggest_names(name: str, candidates: List[str], max_suggestions: int = MAX_NAME_SUGGESTIONS) -> List[str]:
+    """Returns the names closest to `name` (see `closest_names`), for candidates not prepared in advance."""
+    return closest_names(name, NameCandidates(candidates), max_suggestions)
+
+
+def _with_suggestions(message: str, suggestions: List[str]) -> str:
+    """Appends a 'Did you mean' hint to an error message when suggestions exist."""
+    if suggestions:
+        return f"{message} Did you mean: {', '.join(suggestions)}?"
+    return message
+
+
+# --- Validation ---
+def validate_sql(sql_query: str, schema_index: Optional[SchemaIndex]) -> List[Dict[str, Any]]:
+    """
+    Validates the table and column references of a T-SQL query against the schema.
+
+    Args:
+        sql_query: The SQL query to validate.
+        schema_index: The index built by `build_schema_index`. If None, validation is skipped.
+
+    Returns:
+        A list of structured errors (empty if no problems were found). Each error is a dict with:
+        - 'type': 'invalid_object', 'invalid_column' or 'unbound_identifier'.
+        - 'name': The offending identifier as written in the query.
+        - 'table': Canonical table name the column was checked against (columns only, may be None).
+        - 'suggestions': Nearest valid names by edit distance.
+        - 'message': A SkyServer-style error message including suggestions.
+    """
+    if schema_index is None or not sql_query:
+        return []
+
+    tokens = tokenize_sql(sql_query)
+    sources, consumed = extract_table_references(tokens)
+    errors: List[Dict[str, Any]] = []
+    reported: Set[Tuple[str, str]] = set()
+
+    def add_error(error_type: str, name: str, message: str, suggestions: List[str], table: Optional[str] = None):
+        key = (error_type, name.lower())
+        if key in reported:
+            return
+        reported.add(key)
+        errors.append({
+            "type": error_type,
+            "name": name,
+            "table": table,
+            "suggestions": suggestions,
+            "message": _with_suggestions(message, suggestions),
+        })
+
+    # Resolve sources: qualifier (alias or table name, lowercase) -> base table key (None = unknown columns).
+    cte_names = {s["name"].lower() for s in sources if s["kind"] == "cte"}
+    qualifiers: Dict[str, Optional[str]] = {}
+    all_sources_known = True
+    for source in sources:
+        if source["kind"] == "cte":
+            continue
+        table_key = None
+        if source["kind"] == "table" and source["name"]:
+            name = source["name"]
+            if name.lower() in cte_names or name.startswith("#"):
+                pass
+            else:
+                table_key = schema_index.resolve_table(name)
+                if table_key is None:
+                    suggestions = closest_names(name, schema_index.object_candidates())
+                    add_error("invalid_object", name, f"Invalid object name '{name}'.", suggestions)
+        if table_key is None:
+            all_sources_known = False
+        if source["alias"]:
+            qualifiers[source["alias"].lower()] = table_key
+        if source["name"]:
+            qualifiers.setdefault(source["name"].lower(), table_key)
+
+    known_tables = sorted({key for key in qualifiers.values() if key is not None})
+    scope_columns: Dict[str, str] = {}
+    for table_key in known_tables:
+        scope_columns.update(schema_index.columns.get(table_key, {}))
+
+    # Select-list aliases (explicit `AS name` or implicit `expr name`) may be referenced later, e.g. in ORDER BY.
+    expression_end_kinds = ("number", "string")
+    output_aliases: Set[str] = set()
+    alias_positions: Set[int] = set()
+    for idx, token in enumerate(tokens):
+        if token[0] != "name" or len(token[1]) != 1 or idx in consumed or _is_keyword(token):
+            continue
+        prev = tokens[idx - 1] if idx > 0 else None
+        is_alias = False
+        if prev is not None and _is_keyword(prev, "as"):
+            is_alias = True
+        elif idx >= 2 and _is_keyword(tokens[idx - 2], "top") and prev[0] == "number":
+            is_alias = False  # `SELECT TOP 10 ra`: the number belongs to TOP, not to an expression.
+        elif prev is not None and (
+            prev[0] in expression_end_kinds
+            or prev == ("op", ")")
+            or _is_keyword(prev, "end")  # `CASE ... END name`
+            or (prev[0] == "name" and not _is_keyword(prev) and prev[1][-1] != "*")
+        ):
+            is_alias = True
+        if is_alias:
+            output_aliases.add(token[1][0].lower())
+            alias_positions.add(idx)
+
+    # `DATEADD(day, 1, mjd)`: the datepart is a keyword argument, not a column.
+    datepart_positions = {
+        idx + 2 for idx, token in enumerate(tokens[:-2])
+        if token[0] == "name" and token[1][-1].lower() in DATEPART_FUNCTIONS
+        and tokens[idx + 1] == ("op", "(") and tokens[idx + 2][0] == "name" and len(tokens[idx + 2][1]) == 1
+    }
+
+    for idx, token in enumerate(tokens):
+        if token[0] != "name" or idx in consumed or idx in alias_positions or idx in datepart_positions:
+            continue
+        parts = token[1]
+        if len(parts) == 1 and (_is_keyword(token) or parts[0].lower() in SQL_TYPE_NAMES):
+            continue
+        if idx + 1 < len(tokens) and tokens[idx + 1] == ("op", "("):
+            continue  # Function call, e.g. COUNT(...) or dbo.fPhotoFlags(...)
+        column = parts[-1]
+        if len(parts) >= 2:
+            qualifier = parts[-2].lower()
+            if qualifier not in qualifiers:
+                if qualifier in cte_names or len(parts) > 2:
+                    continue
+                add_error(
+                    "unbound_identifier", ".".join(parts),
+                    f"The multi-part identifier '{'.'.join(parts)}' could not be bound.",
+                    suggest_names(parts[-2], [s["alias"] or s["name"] for s in sources if s["alias"] or s["name"]]),
+                )
+                continue
+            table_key = qualifiers[qualifier]
+            if table_key is None or column == "*":
+                continue
+            table_columns = schema_index.columns.get(table_key, {})
+            if column.lower() not in table_columns:
+                add_error(
+                    "invalid_column", column, f"Invalid column name '{column}'.",
+                    closest_names(column, schema_index.column_candidates(table_key)),
+                    table=schema_index.canonical_table_name(table_key),
+                )
+            continue
+        # Unqualified column: only checkable when every source in scope has known columns.
+        lowered = column.lower()
+        if lowered in qualifiers or lowered in output_aliases or lowered in cte_names:
+            continue
+        if not all_sources_known or not known_tables:
+            continue
+        if lowered not in scope_columns:
+            table_name = schema_index.canonical_table_name(known_tables[0]) if len(known_tables) == 1 else None
+            add_error(
+                "invalid_column", column, f"Invalid column name '{column}'.",
+                closest_names(column, schema_index.column_candidates(*known_tables)), table=table_name,
+            )
+
+    if errors:
+        logger.info(f"Local SQL validation found {len(errors)} problem(s): {[e['message'] for e in errors]}")
+    else:
+        logger.debug("Local SQL validation passed.")
+    return errors
+
+
+def format_validation_errors(errors: List[Dict[str, Any]]) -> str:
+    """
+    Formats validation errors as a single message suitable for `generate_and_correct_sql`.
+
+    Args:
+        errors: Errors returned by `validate_sql`.
+
+    Returns:
+        A multi-line error message, or an empty string if there are no errors.
+    """
+    if not errors:
+        return ""
+    lines = ["Local schema validation failed (the query was not sent to SkyServer):"]
+    for error in errors:
+        table_hint = f" (checked against table {error['table']})" if error.get("table") else ""
+        lines.append(f"- {error['message']}{table_hint}")
+    return "\n".join(lines)
@@ -9,32 +9,43 @@ and displays the results and an explanation of the SQL.
 """
 import streamlit as st
 import pandas as pd
+import os
+import json
 import time
+import uuid
 import logging # Import logging module
+from typing import Any, Callable, Dict, Optional
 
-# Configure basic logging for the application
-# This should be done once, preferably at the very beginning of the app's entry point.
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+# Configure logging for the application (once per process; LOG_MODE=async moves log I/O off the request path)
+from log_utils import configure_logging
+configure_logging(logging.INFO)
 
 logger = logging.getLogger(__name__) # Get a logger for this module
 
 import config
 from rag_core import (
     initialize_rag_schema,
-    retrieve_relevant_schema,
-    build_rag_prompt_for_sql_generation,
-    generate_and_correct_sql,
-    explain_sql_query
+    get_llm_usage_stats,
+)
+from sql_repair import get_repair_stats
+from model_router import get_router_stats
+from request_context import RequestContext
+from tracing import span_tree_rows, spans_to_jsonl, spans_to_otlp
+from metrics import start_metrics_server
+from agent import (
+    Agent,
+    STATUS_SUCCESS,
+    STATUS_CANCELLED,
+    make_probe_sql,
+    verify_data_structure,
 )
 
 # Attempt to import the real database query function.
 # If it fails, use a simulated version for local testing or when sdss_db.py is unavailable.
 try:
-    from sdss_db import query_sdss
+    from sdss_db import query_sdss, iter_query_pages, get_sql_coalescing_stats, get_endpoint_stats
+    from skyserver_scheduler import get_scheduler_stats
+    from local_replica import get_replica_stats
     logger.info("Successfully imported query_sdss from sdss_db.")
 except ImportError:
     logger.error("CRITICAL: `sdss_db.py` not found or `query_sdss` function is missing. Real database queries are disabled.")
@@ -44,7 +55,7 @@ except ImportError:
         "Please check the application setup."
     )
     # Define a fallback simulated query_sdss function
-    def query_sdss(sql: str) -> pd.DataFrame:
+    def query_sdss(sql: str, ctx: Optional[RequestContext] = None, priority: Optional[str] = None) -> pd.DataFrame:
         """Simulated version of query_sdss for fallback."""
         logger.warning(f"SIMULATING SQL EXECUTION (fallback): {sql[:100]}...")
         st.warning(f"SIMULATING SQL EXECUTION: {sql[:100]}...") # Keep UI warning
@@ -59,42 +70,86 @@ except ImportError:
         logger.info(f"Simulated execution successful, returning data: {sim_data}")
         return pd.DataFrame(sim_data)
 
-def verify_data_structure(df: pd.DataFrame) -> bool:
+    def iter_query_pages(plan, ctx=None):
+        """Simulated pagination is never used: `make_pagination_plan` is only consulted after a real probe."""
+        raise RuntimeError("Paginated fetching requires sdss_db.")
+
+    def get_sql_coalescing_stats():
+        """Simulated queries are never coalesced."""
+        return {"coalesced": 0}
+
+    def get_scheduler_stats():
+        """Simulated queries are not scheduled."""
+        return None
+
+    def get_endpoint_stats():
+        """Simulated queries use no SkyServer endpoints."""
+        return None
+
+    def get_replica_stats():
+        """Simulated queries never use the local replica."""
+        return None
+
+AGENT = Agent(query_fn=query_sdss, pages_fn=iter_query_pages)
+"""The UI-free agent engine; this app is a thin client that renders its progress events."""
+
+def make_agent_event_handler(progress_bar, status_text, live_placeholder, rag_container, results_column) -> Callable[[str, Dict[str, Any]], None]:
     """
-    Performs basic verification of the structure of the DataFrame returned by a query.
+    Builds the `on_event` callback that renders the agent's progress in the Streamlit UI.
 
-    This helps catch cases where the LLM might generate SQL that returns
-    a single long string, an error message, or an empty/malformed result.
+    Rows of a paginated fetch are kept in `st.session_state.partial_results`, so pressing
+    "Stop fetching" (which reruns the script and ends this run) keeps them on screen.
 
     Args:
-        df: The Pandas DataFrame to verify.
+        progress_bar: The `st.progress` bar.
+        status_text: An `st.empty()` placeholder for status messages.
+        live_placeholder: An `st.empty()` placeholder for probe previews and pages as they arrive.
+        rag_container: The container showing the RAG context.
+        results_column: The column in which verified results are displayed.
 
     Returns:
-        True if the data structure seems valid, False otherwise.
+        The event callback for `Agent.run`.
     """
-    logger.info(f"Verifying data structure. Shape: {df.shape}, Head:\n{df.head().to_string()}")
-    if df.empty:
-        logger.warning("Data Verification: Failed because DataFrame is empty.")
-        return False
-    if len(df.columns) == 0:
-        logger.warning("Data Verification: Failed because DataFrame has no columns.")
-        return False
-    
-    # Check for a common failure mode: a single cell containing a long string or error message
-    if len(df) == 1 and len(df.columns) == 1:
-        first_cell_value = str(df.iloc[0,0])
-        # Heuristic: very long string with few spaces might be a concatenated error or unparsed data
-        if len(first_cell_value) > 200 and first_cell_value.count(' ') < 5:
-            logger.warning(f"Data Verification: Failed because it looks like a single long string. Preview: {first_cell_value[:100]}...")
-            return False
-        # Heuristic: common error phrases in the single cell
-        error_phrases = ["error", "failed", "unable", "cannot", "syntax", "invalid", "incorrect"]
-        if any(phrase in first_cell_value.lower() for phrase in error_phrases) and len(first_cell_value) < 150: # Arbitrary length for short errors
-            logger.warning(f"Data Verification: Failed because first cell contains potential error message: {first_cell_value[:100]}...")
-            return False
-            
-    logger.info("Data Verification: Basic structure appears valid.")
-    return True
+    page_view: Dict[str, Any] = {}
+
+    def on_event(name: str, payload: Dict[str, Any]) -> None:
+        if name == "status":
+            getattr(status_text, payload["level"])(payload["message"])
+        elif name == "progress":
+            progress_bar.progress(payload["value"], text=payload["text"])
+        elif name == "rag_context":
+            display_rag_context(rag_container, payload["tables"]) # Display RAG context immediately
+            rag_container.caption(f"Prompt size: {payload['prompt_tokens']} tokens (schema context budget: {config.PROMPT_CONTEXT_TOKEN_BUDGET}).")
+        elif name == "attempt":
+            st.session_state.query_log.append(payload["entry"]) # Updated in place as the attempt progresses
+        elif name == "probe_preview":
+            with live_placeholder.container():
+                st.subheader(f"⚡ Preview (first {len(payload['rows'])} rows)")
+                st.dataframe(payload["rows"], use_container_width=True)
+                st.caption("Fetching all requested rows...")
+        elif name == "page":
+            if not page_view:
+                with live_placeholder.container():
+                    st.button("⏹️ Stop fetching", key="stop_fetching", help="Keep the rows fetched so far and stop the query.")
+                    page_view["table"] = st.empty()
+                    page_view["progress"] = st.empty()
+            st.session_state.partial_results = payload["rows"]
+            page_view["table"].dataframe(payload["rows"], use_container_width=True)
+            page_view["progress"].caption(f"Fetched {len(payload['rows'])} of up to {payload['total_rows']} rows...")
+        elif name == "results":
+            live_placeholder.empty()
+            st.session_state.partial_results = None
+            with results_column:
+                st.subheader("📊 Query Results")
+                st.dataframe(payload["rows"], height=300, use_container_width=True)
+                normalization = payload["rows"].attrs.get("dtype_normalization")
+                if normalization:
+                    st.caption(
+                        f"Memory: {normalization['bytes_before'] / 1024:.1f} KB → {normalization['bytes_after'] / 1024:.1f} KB "
+                        f"({normalization['sentinels_replaced']} SDSS sentinel values shown as missing)."
+                    )
+
+    return on_event
 
 def display_rag_context(container, rag_results: list):
     """Displays the RAG context (retrieved table schemas) in the Streamlit UI."""
@@ -126,6 +181,14 @@ def display_query_log(container):
             
             with st.expander(exp_title, expanded=is_last_expanded):
                 st.code(log_entry.get("sql", "N/A"), language="sql")
+                if log_entry.get("model_tier"):
+                    st.caption(f"Generated by the '{log_entry['model_tier']}' model tier.")
+                if log_entry.get("paginated_by"):
+                    st.caption(f"Results fetched in pages ordered by {log_entry['paginated_by']}.")
+                if "probe_rows" in log_entry:
+                    st.caption(f"Probe (TOP {config.PROBE_TOP_N}) returned {log_entry['probe_rows']} rows.")
+                if log_entry.get("repair_rules"):
+                    st.caption(f"Local repair rules applied: {', '.join(log_entry['repair_rules'])}")
                 if "error" in log_entry and log_entry["error"]:
                     st.error(f"Error: {log_entry['error']}")
                 if "data_preview" in log_entry and log_entry["data_preview"]:
@@ -134,6 +197,41 @@ def display_query_log(container):
                 if "explanation" in log_entry and log_entry["explanation"]:
                     st.info(f"Explanation (for final successful SQL): {log_entry['explanation']}")
 
+        if st.session_state.get('trace'):
+            display_trace(st.session_state.trace)
+        if st.session_state.get('profile'):
+            display_profile(st.session_state.profile)
+
+
+def display_trace(spans: list):
+    """Displays the run's tracing spans as an indented table with JSONL and OpenTelemetry downloads."""
+    with st.expander("⏱️ Timing Trace", expanded=False):
+        st.dataframe(pd.DataFrame(span_tree_rows(spans)), use_container_width=True, hide_index=True)
+        trace_id = spans[0]["trace_id"]
+        col_jsonl, col_otlp = st.columns(2)
+        col_jsonl.download_button(
+            "Download spans (JSONL)", spans_to_jsonl(spans), file_name=f"trace-{trace_id}.jsonl", mime="application/jsonl",
+        )
+        col_otlp.download_button(
+            "Download OpenTelemetry (OTLP JSON)", json.dumps(spans_to_otlp(spans)), file_name=f"trace-{trace_id}.otlp.json",
+            mime="application/json",
+        )
+
+
+def display_profile(profile: dict):
+    """Shows a run's profile: its top functions and a download of the flamegraph (or pstats) file."""
+    with st.expander(f"🔥 Profile ({profile['mode']}, {profile['elapsed_s']:.2f}s)", expanded=False):
+        st.dataframe(pd.DataFrame(profile["top"]), use_container_width=True, hide_index=True)
+        try:
+            with open(profile["path"], "rb") as f:
+                data = f.read()
+        except OSError:
+            st.caption(f"Profile file not readable: {profile['path']}")
+            return
+        label = "Download collapsed stacks (flamegraph)" if profile["mode"] == "sample" else "Download pstats profile"
+        st.download_button(label, data, file_name=os.path.basename(profile["path"]), mime="application/octet-stream")
+        st.caption(f"Saved to {profile['path']} (top functions: {profile['stats_path']}).")
+
 
 def run_streamlit_app():
     """
@@ -160,11 +258,24 @@ def run_streamlit_app():
         logger.critical(f"Failed to initialize RAG schema: {e}", exc_info=True)
         st.error(f"A critical error occurred during RAG schema initialization: {e}. The application might not function correctly.")
         return # Stop further execution if RAG schema fails
+    start_metrics_server() # Prometheus /metrics on config.METRICS_PORT; a no-op after the first run
 
     # Initialize session state variables
     if 'query_log' not in st.session_state:
         st.session_state.query_log = []
         logger.debug("Initialized 'query_log' in session state.")
+    if 'trace' not in st.session_state:
+        st.session_state.trace = [] # Tracing spans of the last question
+    if 'profile' not in st.session_state:
+        st.session_state.profile = None # Profile summary of the last question, if profiled
+    if 'partial_results' not in st.session_state:
+        st.session_state.partial_results = None # Rows of a paginated fetch that was stopped
+    if 'user_id' not in st.session_state:
+        st.session_state.user_id = uuid.uuid4().hex[:12] # Fair-share identity of this browser session
+    if 'active_request' not in st.session_state:
+        st.session_state.active_request = None # RequestContext of the question being processed
+    if st.session_state.get("stop_fetching") and st.session_state.active_request:
+        st.session_state.active_request.cancel("stopped by user")
     
     # UI Layout
     left_column, right_column = st.columns([0.6, 0.4]) # Main layout columns
@@ -191,6 +302,10 @@ def run_streamlit_app():
                 help="Maximum number of times the agent will attempt to correct a failing SQL query."
             )
         
+        profile_question = st.checkbox(
+            "Profile this question", value=config.ENABLE_PROFILING, key="profile_checkbox",
+            help=f"Records a {config.PROFILE_MODE} profile of the run (retrieval, LLM calls, SkyServer) in {config.PROFILE_OUTPUT_DIR}/.",
+        )
         submit_button = st.button("🚀 Generate & Execute SQL", use_container_width=True, type="primary")
 
     results_placeholder = st.container() # Placeholder for results, allowing RAG context to be moved
@@ -201,138 +316,96 @@ def run_streamlit_app():
     if submit_button and user_query:
         logger.info(f"Submit button clicked. User query: '{user_query}', TOP N: {top_n_results}, Max Retries: {max_retries}")
         st.session_state.query_log = [] # Reset log for new query
+        st.session_state.trace = []
+        st.session_state.profile = None
+        st.session_state.partial_results = None
+        if st.session_state.active_request:
+            # Background work of the previous question (LLM calls, SkyServer pages) is abandoned.
+            st.session_state.active_request.cancel("superseded by a new question")
+        ctx = RequestContext(timeout_s=config.REQUEST_DEADLINE_S, user_id=st.session_state.user_id)
+        st.session_state.active_request = ctx
         
-        # Initialize state for the current run
-        current_sql_query: Optional[str] = None
-        db_error_message: Optional[str] = None
-        data_structure_ok: bool = False
-        last_failed_data_sample: Optional[str] = None
-        top_tables_for_rag: list = [] # Ensure it's initialized for this run
-
         with results_placeholder: # Processing messages will appear here
             st.subheader("⚙️ Agent Processing...")
             progress_bar = st.progress(0, text="Initializing...") # Text for progress bar
             status_text = st.empty() # For dynamic status updates
+            with left_column:
+                live_placeholder = st.empty() # Probe preview and pages while the query runs
+
+            on_event = make_agent_event_handler(progress_bar, status_text, live_placeholder, rag_context_placeholder_right, left_column)
+            result = AGENT.run(user_query, top_n_results, max_retries, ctx=ctx, on_event=on_event, profile=profile_question)
+            st.session_state.trace = result["trace"]
+            st.session_state.profile = result["profile"]
+            live_placeholder.empty()
+
+            if result["status"] == STATUS_SUCCESS:
+                with left_column: # Results were shown by the "results" event; add the explanation
+                    st.subheader("📖 SQL Explanation")
+                    st.info(result["explanation"] if result["explanation"] else "Could not retrieve explanation.")
+                st.balloons()
+            elif result["status"] == STATUS_CANCELLED:
+                status_text.warning(f"⏹️ {result['message']}")
+            elif result["sql"]:
+                status_text.error(f"🚫 {result['message']}\n```sql\n{result['sql']}\n```")
+                if result["results"] is not None: # Still show the problematic data
+                    with left_column:
+                        st.subheader("📊 Final (Problematic) Query Results")
+                        st.dataframe(result["results"], height=300, use_container_width=True)
+            else:
+                status_text.error(f"🚫 {result['message']}")
 
-            # --- Step 1: Retrieve RAG Context ---
-            status_text.info("🔍 Step 1/4: Retrieving relevant schema context (RAG)...")
-            progress_bar.progress(10, text="RAG: Retrieving schema...")
-            logger.debug("Attempting to retrieve relevant schema via RAG.")
-            top_tables_for_rag = retrieve_relevant_schema(user_query) 
-            
-            if not top_tables_for_rag:
-                logger.warning("RAG could not determine relevant table schema for the query.")
-                status_text.error("🚫 Could not determine relevant table schema for your query using RAG. Please try rephrasing your question or check if the schema is loaded correctly.")
-                st.stop() # Stop processing if no RAG context
-            
-            logger.info(f"RAG retrieved {len(top_tables_for_rag)} table(s) for context.")
-            display_rag_context(rag_context_placeholder_right, top_tables_for_rag) # Display RAG context immediately
-
-            # --- Step 2: Build RAG Prompt & LLM Interaction Loop ---
-            rag_llm_prompt = build_rag_prompt_for_sql_generation(
-                user_query, top_tables_for_rag, top_n_results
+            progress_bar.progress(100, text="Processing complete.") # Ensure progress bar completes
+            repair_stats = get_repair_stats()
+            st.caption(
+                f"Local SQL repairs: {repair_stats['repaired']} of {repair_stats['attempts']} attempts "
+                f"(LLM calls avoided so far: {repair_stats['llm_calls_avoided']})."
             )
-            
-            max_attempts = max_retries + 1
-            for attempt in range(max_attempts):
-                attempt_num = attempt + 1
-                logger.info(f"Attempt {attempt_num}/{max_attempts} for query: '{user_query[:50]}...'")
-                
-                status_text.info(f"🛠️ Step 2/4: LLM Generating SQL (Attempt {attempt_num}/{max_attempts})...")
-                progress_value_llm_start = 20 + int(60 * (attempt / max_attempts)) # Progress for LLM stage
-                progress_bar.progress(progress_value_llm_start, text=f"LLM: Generating SQL (Attempt {attempt_num})")
-
-                current_sql_query = generate_and_correct_sql(
-                    original_user_query=user_query,
-                    rag_prompt_for_llm=rag_llm_prompt, # Used only on first attempt
-                    top_n_results=top_n_results,
-                    error_message=db_error_message, # From previous failed attempt
-                    prior_sql=st.session_state.query_log[-1]["sql"] if st.session_state.query_log and attempt > 0 else None,
-                    data_verification_failed=not data_structure_ok and attempt > 0, # If prev verification failed
-                    failed_data_sample=last_failed_data_sample
+            llm_usage = get_llm_usage_stats()
+            st.caption(
+                f"LLM usage so far: {llm_usage['prompt_tokens']} prompt tokens, "
+                f"{llm_usage['cached_tokens']} served from the provider's prompt cache "
+                f"({llm_usage['cached_token_ratio']:.0%})."
+            )
+            question_flights, sql_flights = AGENT.get_coalescing_stats(), get_sql_coalescing_stats()
+            if question_flights["coalesced"] or sql_flights["coalesced"]:
+                st.caption(
+                    f"Shared in-flight work so far: {question_flights['coalesced']} identical questions and "
+                    f"{sql_flights['coalesced']} identical SkyServer queries were answered by a single run."
                 )
-                
-                # Reset error/data states for this new attempt
-                db_error_message = None
-                data_structure_ok = False 
-                last_failed_data_sample = None
-
-                if not current_sql_query:
-                    logger.error(f"LLM failed to generate SQL on attempt {attempt_num}.")
-                    status_text.error(f"😔 Attempt {attempt_num}: LLM failed to generate SQL. Check logs for details.")
-                    st.session_state.query_log.append({"attempt": attempt_num, "sql": "LLM failed to generate SQL", "status": "LLM Error", "error": "No SQL returned by LLM."})
-                    if attempt < max_retries: continue # Go to next retry
-                    else: break # Max retries reached for LLM generation
-
-                log_entry_base = {"attempt": attempt_num, "sql": current_sql_query, "status": "Generated by LLM"}
-                st.session_state.query_log.append(log_entry_base)
-                logger.debug(f"Attempt {attempt_num} generated SQL: {current_sql_query}")
-                
-                # --- Step 3: Execute SQL ---
-                status_text.info(f"Executing SQL (Attempt {attempt_num})...")
-                progress_bar.progress(progress_value_llm_start + int(10 / max_attempts) , text=f"DB: Executing SQL (Attempt {attempt_num})")
-                try:
-                    df_results = query_sdss(current_sql_query)
-                    st.session_state.query_log[-1]["status"] = "Executed Successfully"
-                    logger.info(f"Attempt {attempt_num} SQL executed. Result shape: {df_results.shape}")
-                    
-                    # --- Step 4: Verify Data Structure ---
-                    status_text.info(f"Verifying data structure (Attempt {attempt_num})...")
-                    progress_bar.progress(progress_value_llm_start + int(20 / max_attempts), text=f"Agent: Verifying data (Attempt {attempt_num})")
-                    data_structure_ok = verify_data_structure(df_results)
-
-                    if data_structure_ok:
-                        logger.info(f"Attempt {attempt_num}: Data structure verified successfully.")
-                        status_text.success("✅ Query successful and data structure looks good!")
-                        st.session_state.query_log[-1]["status"] = "Success & Verified"
-                        st.session_state.query_log[-1]["data_preview"] = df_results.head(config.MAX_DF_PREVIEW_ROWS).to_markdown(index=False)
-                        
-                        with left_column: # Display results in the main (left) column area
-                            st.subheader("📊 Query Results")
-                            st.dataframe(df_results, height=300, use_container_width=True)
-                            
-                            st.subheader("📖 SQL Explanation")
-                            with st.spinner("Getting SQL explanation from LLM..."):
-                                explanation = explain_sql_query(current_sql_query)
-                            st.info(explanation if explanation else "Could not retrieve explanation.")
-                        st.session_state.query_log[-1]["explanation"] = explanation
-                        
-                        progress_bar.progress(100, text="Completed!")
-                        st.balloons()
-                        break # Successful attempt, exit loop
-                    else:
-                        logger.warning(f"Attempt {attempt_num}: Data structure verification failed.")
-                        st.session_state.query_log[-1]["status"] = "Executed, Data Structure Issue"
-                        st.session_state.query_log[-1]["error"] = "Returned data structure seems invalid, empty, or like an error message."
-                        last_failed_data_sample = df_results.head(config.MAX_DF_PREVIEW_ROWS_IN_LOG).to_string(index=False,max_colwidth=50) if not df_results.empty else "DataFrame was empty."
-                        st.session_state.query_log[-1]["data_preview"] = last_failed_data_sample
-
-                        if attempt < max_retries:
-                            status_text.warning(f"⚠️ Data structure verification failed for attempt {attempt_num}. The agent will try to correct the SQL. Retrying...")
-                            time.sleep(1) # Brief pause for user to see message
-                        else: # Max retries reached
-                            status_text.error(f"🚫 Max retries reached. Data structure issue for SQL:\n```sql\n{current_sql_query}\n```")
-                            logger.error("Max retries reached due to data structure issue.")
-                            with left_column: # Still show the problematic data
-                                st.subheader("📊 Final (Problematic) Query Results")
-                                st.dataframe(df_results, height=300, use_container_width=True)
-                            break # Exit loop
-
-                except Exception as e:
-                    logger.error(f"Attempt {attempt_num}: SQL execution failed: {e}", exc_info=True)
-                    db_error_message = str(e)
-                    st.session_state.query_log[-1]["status"] = "Execution Error"
-                    st.session_state.query_log[-1]["error"] = db_error_message
-                    if attempt < max_retries:
-                        status_text.warning(f"Attempt {attempt_num}: SQL execution failed: {db_error_message}. The agent will try to correct it. Retrying...")
-                        time.sleep(1) # Brief pause
-                    else: # Max retries reached
-                        status_text.error(f"🚫 Max retries reached. Final SQL execution failed for:\n```sql\n{current_sql_query}\n```\nError: {db_error_message}")
-                        logger.error("Max retries reached due to SQL execution error.")
-                        break # Exit loop
-            
-            progress_bar.progress(100, text="Processing complete.") # Ensure progress bar completes
+            scheduler_stats = get_scheduler_stats()
+            if scheduler_stats:
+                interactive, bulk = scheduler_stats["interactive"], scheduler_stats["bulk"]
+                st.caption(
+                    f"SkyServer scheduler: {interactive['granted']} interactive / {bulk['granted']} bulk queries, "
+                    f"{interactive['throttled'] + bulk['throttled']} delayed by the rate limit, mean queue wait "
+                    f"{interactive['queue_wait_ms_mean']:.0f} ms interactive / {bulk['queue_wait_ms_mean']:.0f} ms bulk."
+                )
+            replica_stats = get_replica_stats()
+            if replica_stats and replica_stats["local"]:
+                st.caption(
+                    f"Local replica: {replica_stats['local']} of {replica_stats['checked']} queries answered locally "
+                    f"(mean {replica_stats['local_ms_mean']:.0f} ms)."
+                )
+            endpoint_stats = get_endpoint_stats()
+            if endpoint_stats and (endpoint_stats["hedges"] or endpoint_stats["failovers"]):
+                open_circuits = sum(endpoint["circuit"] != "closed" for endpoint in endpoint_stats["endpoints"])
+                st.caption(
+                    f"SkyServer endpoints: {endpoint_stats['hedges']} hedged and {endpoint_stats['failovers']} failed-over "
+                    f"queries, {open_circuits} of {len(endpoint_stats['endpoints'])} endpoint circuits open."
+                )
+            for tier, tier_stats in get_router_stats().items():
+                if tier_stats["calls"]:
+                    success_rate = f"{tier_stats['success_rate']:.0%}" if tier_stats["success_rate"] is not None else "n/a"
+                    st.caption(
+                        f"Model tier '{tier}' ({tier_stats['model']}): {tier_stats['calls']} calls, "
+                        f"median latency {tier_stats['median_latency_ms']:.0f} ms, success rate {success_rate}."
+                    )
             logger.info("Agent processing loop finished.")
+    elif st.session_state.partial_results is not None:
+        # A paginated fetch was stopped by the user: keep showing what was fetched.
+        with results_placeholder:
+            st.subheader(f"📊 Partial Query Results ({len(st.session_state.partial_results)} rows, fetching stopped)")
+            st.dataframe(st.session_state.partial_results, height=300, use_container_width=True)
 
     # --- Right Column: RAG Context and Agent Log ---
     # Display RAG context if not already shown (e.g., if query hasn't run yet)
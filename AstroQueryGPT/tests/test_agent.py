@@ -0,0 +1,216 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+from AstroQueryGPT import agent
+
+PHOTO_TABLE = {"name": "PhotoObj", "description": "Photometric objects", "fields": []}
+
+
+@pytest.fixture
+def offline_agent(mocker):
+    """Patches the RAG and LLM steps so the loop runs without a schema, model or network."""
+    mocker.patch.object(agent.config, "ENABLE_LOCAL_SQL_VALIDATION", False)
+    mocker.patch.object(agent.config, "ENABLE_LOCAL_SQL_REPAIR", False)
+    mocker.patch.object(agent.config, "ENABLE_PROBE_EXECUTION", False)
+    mocker.patch.object(agent, "retrieve_relevant_schema", return_value=[(PHOTO_TABLE, 0.9)])
+    mocker.patch.object(agent, "build_rag_prompt_for_sql_generation", return_value="schema context")
+    mocker.patch.object(agent, "explain_sql_query", return_value="Selects coordinates.")
+    mocker.patch.object(agent, "record_attempt_outcome")
+    mocker.patch.object(agent.time, "sleep")
+    return mocker.patch.object(agent, "generate_and_correct_sql")
+
+
+def test_run_corrects_failed_execution(offline_agent):
+    """An execution error is fed back to the LLM and the corrected SQL succeeds."""
+    pytest.importorskip("tabulate") # The verified data preview uses DataFrame.to_markdown.
+    offline_agent.side_effect = ["SELECT TOP 10 bad FROM PhotoObj", "SELECT TOP 10 ra, dec FROM PhotoObj"]
+
+    def query_fn(sql, ctx=None):
+        if "bad" in sql:
+            raise ValueError("Invalid column name 'bad'.")
+        return pd.DataFrame({"ra": [1.0, 2.0], "dec": [3.0, 4.0]})
+
+    events = []
+    result = agent.Agent(query_fn=query_fn, pages_fn=lambda plan, ctx=None: iter(())).run(
+        "positions of objects", 10, 2, ctx=agent.RequestContext(timeout_s=30),
+        on_event=lambda name, payload: events.append(name),
+    )
+
+    assert result["status"] == agent.STATUS_SUCCESS
+    assert result["sql"] == "SELECT TOP 10 ra, dec FROM PhotoObj"
+    assert list(result["results"].columns) == ["ra", "dec"]
+    assert result["explanation"] == "Selects coordinates."
+    assert [a["status"] for a in result["attempts"]] == ["Execution Error", "Success & Verified"]
+    assert offline_agent.call_args_list[1].kwargs["error_message"] == "Invalid column name 'bad'."
+    assert events.count("attempt") == 2 and "results" in events and "rag_context" in events
+
+
+def test_run_reports_exhausted_retries(offline_agent):
+    """Persistently bad results end as failed, keeping the last result and the full attempt log."""
+    offline_agent.return_value = "SELECT TOP 10 ra FROM PhotoObj"
+    empty = agent.Agent(query_fn=lambda sql, ctx=None: pd.DataFrame(), pages_fn=lambda plan, ctx=None: iter(()))
+    result = empty.run("anything", 10, 1)
+    assert result["status"] == agent.STATUS_FAILED
+    assert result["message"].startswith("Max retries reached.")
+    assert len(result["attempts"]) == 2
+    assert result["results"] is not None and result["results"].empty
+
+
+def test_sentinel_only_result_is_corrected_with_its_profile(offline_agent):
+    """Rows of SDSS sentinel values fail verification and the LLM gets the column profile, not a row dump."""
+    offline_agent.return_value = "SELECT TOP 10 objID, petroRad_u, deVRad_u FROM PhotoObj"
+    sentinels = pd.DataFrame({
+        "objID": [1237657584942448656, 1237657584942448657],
+        "petroRad_u": [-9999.0, -9999.0],
+        "deVRad_u": [-1000.0, float("nan")],
+    })
+    engine = agent.Agent(query_fn=lambda sql, ctx=None: sentinels, pages_fn=lambda plan, ctx=None: iter(()))
+    result = engine.run("galaxy radii", 10, 1)
+
+    assert result["status"] == agent.STATUS_FAILED
+    assert result["attempts"][0]["status"] == "Executed, Data Structure Issue"
+    correction = offline_agent.call_args_list[1].kwargs
+    assert correction["data_verification_failed"] is True
+    assert "petroRad_u, deVRad_u" in correction["failed_data_sample"]
+    assert "- deVRad_u: 50% null, 50% sentinel, no usable values" in correction["failed_data_sample"]
+    assert "1237657584942448656" in correction["failed_data_sample"] # IDs are profiled exactly.
+
+
+@pytest.mark.parametrize("df", [
+    pd.DataFrame({"objID": [1, 2, 3], "ra": [150.1, 150.2, 150.3], "dec": [1.0, 2.0, 3.0], "z": [-9999.0] * 3}),
+    pd.DataFrame({"objID": [1, 2], "ra": [150.1, 150.2], "petroMag_u": [-9999.0] * 2, "petroMag_g": [-9999.0] * 2}),
+])
+def test_dead_measurement_fails_verification_next_to_ids_and_coordinates(df):
+    """A measurement column with no usable value fails verification even when most columns are filled."""
+    assert agent.verify_data_structure(df) is False
+
+
+def test_partly_missing_measurement_passes_verification():
+    """Sentinels in some rows of a measurement column are normal SDSS data."""
+    df = pd.DataFrame({"objID": [1, 2], "ra": [150.1, 150.2], "z": [0.1, -9999.0], "specObjID": [-9999, -9999]})
+    assert agent.verify_data_structure(df) is True
+
+
+def test_run_stops_on_missing_schema_and_cancellation(offline_agent, mocker):
+    """No RAG context and a cancelled request end the run without calling the LLM."""
+    query_fn = mocker.Mock()
+    engine = agent.Agent(query_fn=query_fn, pages_fn=lambda plan, ctx=None: iter(()))
+
+    ctx = agent.RequestContext()
+    ctx.cancel("superseded by a new question")
+    cancelled = engine.run("anything", 10, 2, ctx=ctx)
+    assert cancelled["status"] == agent.STATUS_CANCELLED
+    assert "superseded" in cancelled["message"]
+
+    agent.retrieve_relevant_schema.return_value = []
+    assert engine.run("anything", 10, 2)["status"] == agent.STATUS_NO_SCHEMA
+    offline_agent.assert_not_called()
+    query_fn.assert_not_called()
+
+
+def test_concurrent_identical_questions_share_one_run(offline_agent, mocker):
+    """Identical normalized questions in flight at the same time trigger one LLM and one SkyServer call."""
+    mocker.patch.object(agent.config, "ENABLE_SINGLE_FLIGHT", True)
+    release = threading.Event()
+
+    def slow_generate(**kwargs):
+        release.wait(5)
+        return "SELECT TOP 10 ra FROM PhotoObj"
+
+    offline_agent.side_effect = slow_generate
+    query_fn = mocker.Mock(return_value=pd.DataFrame())
+    engine = agent.Agent(query_fn=query_fn, pages_fn=lambda plan, ctx=None: iter(()))
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = [pool.submit(engine.run, q, 10, 0) for q in ("Bright galaxies?", "bright  galaxies", "BRIGHT GALAXIES")]
+        while engine.get_coalescing_stats()["coalesced"] < 2:
+            release.wait(0.01)
+        release.set()
+        results = [f.result() for f in futures]
+
+    assert all(r is results[0] for r in results)
+    assert len(results[0]["attempts"]) == 1
+    offline_agent.assert_called_once()
+    query_fn.assert_called_once()
+
+
+def test_run_records_nested_trace_spans(offline_agent, tmp_path, mocker):
+    """Each run carries its spans: a root span with the stages (and their own spans) nested under it."""
+    offline_agent.return_value = "SELECT TOP 10 ra FROM PhotoObj"
+    export_path = tmp_path / "traces.jsonl"
+    export_trace = agent.export_trace
+    mocker.patch.object(agent, "export_trace", lambda trace: export_trace(trace, str(export_path), "jsonl"))
+
+    def query_fn(sql, ctx=None):
+        with agent.span("skyserver.query", sql=sql): # The tracing module the agent uses.
+            return pd.DataFrame()
+
+    result = agent.Agent(query_fn=query_fn, pages_fn=lambda plan, ctx=None: iter(())).run("anything", 10, 1)
+
+    spans = result["trace"]
+    root = spans[0]
+    assert root["name"] == "agent.run" and root["parent_id"] is None
+    assert root["attributes"]["status"] == agent.STATUS_FAILED and root["attributes"]["attempts"] == 2
+    by_name = {}
+    for record in spans:
+        by_name.setdefault(record["name"], []).append(record)
+    assert [s["attributes"]["attempt"] for s in by_name["agent.execution"]] == [1, 2]
+    assert all(s["parent_id"] == root["span_id"] for s in by_name["agent.retrieval"] + by_name["agent.verification"])
+    execution_ids = {s["span_id"] for s in by_name["agent.execution"]}
+    assert all(s["parent_id"] in execution_ids for s in by_name["skyserver.query"])
+    assert all(s["duration_ms"] is not None and s["trace_id"] == root["trace_id"] for s in spans)
+    assert len(export_path.read_text().splitlines()) == len(spans)
+
+
+def test_run_records_metrics(offline_agent):
+    """Stage durations, attempts per question and correction reasons are aggregated across runs."""
+    offline_agent.return_value = "SELECT TOP 10 ra FROM PhotoObj"
+    calls = []
+
+    def query_fn(sql, ctx=None):
+        calls.append(sql)
+        if len(calls) == 1:
+            raise ValueError("SDSS SQL Error (detected in HTML response): Incorrect syntax error near 'FROM'.")
+        return pd.DataFrame()
+
+    corrections, attempts, stages = agent.AGENT_CORRECTIONS, agent.AGENT_ATTEMPTS, agent.AGENT_STAGE_SECONDS
+    before = {
+        reason: corrections.value(reason=reason) for reason in ("error_near", "html_error", "empty_result")
+    }
+    failed_runs = attempts.snapshot(status=agent.STATUS_FAILED)
+    retrievals = stages.snapshot(stage="retrieval")["count"]
+
+    result = agent.Agent(query_fn=query_fn, pages_fn=lambda plan, ctx=None: iter(())).run("anything", 10, 1)
+
+    assert result["status"] == agent.STATUS_FAILED
+    assert corrections.value(reason="error_near") == before["error_near"] + 1
+    assert corrections.value(reason="html_error") == before["html_error"]
+    assert corrections.value(reason="empty_result") == before["empty_result"] + 1
+    after = attempts.snapshot(status=agent.STATUS_FAILED)
+    assert after["count"] == failed_runs["count"] + 1 and after["sum"] == failed_runs["sum"] + 2
+    assert after["buckets"][1.0] == failed_runs["buckets"][1.0] # Two attempts fall into the le="2" bucket.
+    assert stages.snapshot(stage="retrieval")["count"] == retrievals + 1
+
+
+def test_run_can_be_profiled(offline_agent, tmp_path, monkeypatch):
+    """A profiled run carries its top functions and writes a flamegraph file; runs are not profiled by default."""
+    monkeypatch.chdir(tmp_path) # Profiles go to config.PROFILE_OUTPUT_DIR, relative to the working directory.
+    offline_agent.return_value = "SELECT TOP 10 ra FROM PhotoObj"
+
+    def slow_query(sql, ctx=None):
+        threading.Event().wait(0.1) # time.sleep is patched by the fixture.
+        return pd.DataFrame()
+
+    engine = agent.Agent(query_fn=slow_query, pages_fn=lambda plan, ctx=None: iter(()))
+    assert engine.run("anything", 10, 0)["profile"] is None
+
+    ctx = agent.RequestContext()
+    result = engine.run("anything", 10, 0, ctx=ctx, profile=True)
+    profile = result["profile"]
+    assert profile is not None and profile["samples"] > 0
+    assert any(row["function"].startswith("slow_query (test_agent.py:") for row in profile["top"])
+    assert (tmp_path / agent.config.PROFILE_OUTPUT_DIR / f"{ctx.request_id}.top.txt").exists()
+    assert (tmp_path / profile["path"]).exists()
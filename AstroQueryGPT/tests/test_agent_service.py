@@ -0,0 +1,178 @@
+import json
+import asyncio
+import threading
+
+import pandas as pd
+import pytest
+
+from AstroQueryGPT import agent_service, query_jobs, tracing
+from AstroQueryGPT.agent import STATUS_SUCCESS, STATUS_CANCELLED
+
+
+class _FakeAgent:
+    """Agent stand-in that optionally blocks until released or cancelled."""
+
+    def __init__(self, block=False):
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def get_coalescing_stats(self):
+        return {"coalesced": 0}
+
+    def run(self, question, top_n_results, max_retries, ctx=None):
+        while not self.release.wait(0.01):
+            if ctx.cancelled:
+                return {"status": STATUS_CANCELLED, "message": ctx.cancel_reason, "attempts": []}
+        with tracing.start_trace("agent.run", question=question) as trace:
+            with tracing.span("agent.execution", attempt=1):
+                pass
+        return {
+            "trace": trace.spans,
+            "status": STATUS_SUCCESS, "message": "ok", "sql": f"SELECT TOP {top_n_results} ra FROM PhotoObj",
+            "results": pd.DataFrame({"ra": [1.5, float("nan")]}), "partial_results": None,
+            "explanation": "Selects ra.", "attempts": [{"attempt": 1, "status": "Success & Verified"}],
+            "rag_tables": [({"name": "PhotoObj"}, 0.91)], "prompt_tokens": 100, "elapsed_ms": 5.0,
+        }
+
+
+def _request(app, method, path, body=None):
+    """Sends one HTTP request to the ASGI app and returns (status, decoded JSON)."""
+    messages = [{"type": "http.request", "body": json.dumps(body).encode() if body is not None else b"", "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    path, _, query_string = path.partition("?")
+    asyncio.run(app({"type": "http", "method": method, "path": path, "query_string": query_string.encode()}, receive, send))
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+
+@pytest.fixture
+def make_service():
+    managers = []
+
+    def factory(agent, workers=2, queue_size=4):
+        manager = agent_service.JobManager(agent, workers=workers, queue_size=queue_size)
+        manager.start()
+        managers.append(manager)
+        return agent_service.AgentService(manager)
+
+    yield factory
+    for manager in managers:
+        manager.shutdown()
+
+
+def test_submit_and_wait_returns_result_with_attempt_log(make_service):
+    """A waited submission returns the result rows, SQL and per-attempt log as JSON."""
+    app = make_service(_FakeAgent())
+    status, payload = _request(app, "POST", "/v1/queries", {"question": "bright galaxies", "top_n": 5, "wait": True})
+    assert status == 200
+    assert payload["status"] == agent_service.JOB_DONE
+    result = payload["result"]
+    assert result["status"] == STATUS_SUCCESS
+    assert result["sql"] == "SELECT TOP 5 ra FROM PhotoObj"
+    assert result["results"] == {"columns": ["ra"], "data": [[1.5], [None]]}
+    assert result["attempts"] == [{"attempt": 1, "status": "Success & Verified"}]
+    assert result["rag_tables"] == [{"name": "PhotoObj", "score": 0.91}]
+
+    status, polled = _request(app, "GET", f"/v1/queries/{payload['job_id']}")
+    assert status == 200 and polled["result"]["status"] == STATUS_SUCCESS
+
+    status, trace = _request(app, "GET", f"/v1/queries/{payload['job_id']}/trace")
+    assert status == 200 and [span["name"] for span in trace["spans"]] == ["agent.run", "agent.execution"]
+    assert trace["spans"][1]["parent_id"] == trace["spans"][0]["span_id"]
+    status, otlp = _request(app, "GET", f"/v1/queries/{payload['job_id']}/trace?format=otlp")
+    spans = otlp["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert status == 200 and spans[0]["traceId"] == trace["trace_id"] and spans[1]["parentSpanId"] == spans[0]["spanId"]
+
+
+def test_queue_full_is_rejected_and_jobs_can_be_cancelled(make_service):
+    """Submissions beyond the queue bound get 503; a running job can be cancelled."""
+    fake = _FakeAgent(block=True)
+    app = make_service(fake, workers=1, queue_size=1)
+    status, running = _request(app, "POST", "/v1/queries", {"question": "q1"})
+    assert status == 202
+    for _ in range(100): # Wait until the worker has taken the first job off the queue.
+        if _request(app, "GET", "/health")[1]["running"] == 1:
+            break
+        threading.Event().wait(0.01)
+    assert _request(app, "POST", "/v1/queries", {"question": "q2"})[0] == 202
+    status, payload = _request(app, "POST", "/v1/queries", {"question": "q3"})
+    assert status == 503 and "queue is full" in payload["error"]
+
+    assert _request(app, "DELETE", f"/v1/queries/{running['job_id']}")[0] == 200
+    job = app.manager.get(running["job_id"])
+    assert job["done"].wait(2)
+    assert job["result"]["status"] == STATUS_CANCELLED
+    fake.release.set()
+
+
+@pytest.mark.parametrize("body", [{}, {"question": ""}, {"question": "q", "top_n": 0}, {"question": "q", "max_retries": 9}, ["q"]])
+def test_invalid_submissions_and_unknown_jobs(make_service, body):
+    """Malformed bodies get 400 and unknown jobs 404."""
+    app = make_service(_FakeAgent())
+    assert _request(app, "POST", "/v1/queries", body)[0] == 400
+    assert _request(app, "GET", "/v1/queries/doesnotexist")[0] == 404
+    assert _request(app, "GET", "/v1/queries/doesnotexist/trace")[0] == 404
+
+
+def test_metrics_endpoint_serves_prometheus_text(make_service):
+    app = make_service(_FakeAgent())
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app({"type": "http", "method": "GET", "path": "/metrics", "query_string": b""}, receive, send))
+    assert sent[0]["status"] == 200
+    assert (b"content-type", agent_service.PROMETHEUS_CONTENT_TYPE.encode()) in sent[0]["headers"]
+    assert b"# TYPE astroquerygpt_agent_corrections_total counter" in sent[1]["body"]
+
+
+class _InstantJobBackend(query_jobs.JobBackend):
+    """Job backend whose jobs finish immediately with three rows."""
+
+    def submit(self, job_sql, task_name):
+        return "42"
+
+    def status(self, backend_job_id):
+        return query_jobs.JOB_FINISHED, ""
+
+    def cancel(self, backend_job_id):
+        pass
+
+    def fetch_rows(self, output_table, after_row, limit):
+        rows = [row for row in (1, 2, 3) if row > after_row][:limit]
+        return pd.DataFrame({query_jobs.JOB_ROW_COLUMN: rows, "ra": [row * 1.5 for row in rows]})
+
+    def drop_output(self, output_table):
+        pass
+
+
+def test_extract_jobs_are_submitted_polled_and_read_in_chunks(make_service, tmp_path):
+    extract_jobs = query_jobs.QueryJobManager(_InstantJobBackend(), state_path=str(tmp_path / "jobs.json"), poll_initial_s=0.01)
+    app = make_service(_FakeAgent())
+    app.extract_jobs = extract_jobs
+    try:
+        status, job = _request(app, "POST", "/v1/extracts", {"sql": "SELECT ra FROM PhotoObj"})
+        assert status == 202 and job["status"] == query_jobs.JOB_SUBMITTED
+        assert _request(app, "POST", "/v1/extracts", {"sql": "SELECT DISTINCT ra FROM PhotoObj"})[0] == 400
+
+        extract_jobs.wait(job["job_id"], timeout_s=5)
+        assert _request(app, "GET", f"/v1/extracts/{job['job_id']}")[1]["status"] == query_jobs.JOB_FINISHED
+
+        status, chunk = _request(app, "GET", f"/v1/extracts/{job['job_id']}/rows?after=0&limit=2")
+        assert status == 200 and chunk["rows"]["data"] == [[1.5], [3.0]] and not chunk["done"]
+        status, chunk = _request(app, "GET", f"/v1/extracts/{job['job_id']}/rows?after={chunk['next_after']}&limit=2")
+        assert chunk["rows"]["data"] == [[4.5]] and chunk["done"]
+        assert _request(app, "GET", "/v1/extracts/unknown")[0] == 404
+    finally:
+        extract_jobs.shutdown()
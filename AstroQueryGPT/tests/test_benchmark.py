@@ -0,0 +1,60 @@
+import requests
+import pytest
+
+from AstroQueryGPT import benchmark, benchmark_stubs
+
+
+def test_summarize_runs_orders_stages_and_collects_failures():
+    runs = [
+        {"question": "q1", "status": "success", "message": "ok", "elapsed_ms": 100.0 + i,
+         "stage_ms": {"generation": 50.0 + i, "retrieval": 10.0, "custom": 1.0}}
+        for i in range(10)
+    ] + [{"question": "q2", "status": "failed", "message": "SQL error", "elapsed_ms": 300.0, "stage_ms": {"retrieval": 12.0}}] * 2
+
+    summary = benchmark.summarize_runs(runs, wall_s=4.0, stage_order=("retrieval", "prompt", "generation"))
+
+    assert list(summary["stages"]) == ["retrieval", "generation", "custom", "total"]
+    assert summary["stages"]["generation"]["count"] == 10
+    assert summary["stages"]["generation"]["p50_ms"] == pytest.approx(54.5)
+    assert summary["stages"]["total"]["p99_ms"] == pytest.approx(300.0)
+    assert summary["throughput_qps"] == 3.0
+    assert summary["status_counts"] == {"success": 10, "failed": 2}
+    assert summary["failures"] == {"q2": ["SQL error"]}
+
+
+def test_compare_reports_gives_relative_changes():
+    baseline = {"commit": "abc123", "throughput_qps": 4.0, "stages": {"execution": {"p50_ms": 100.0, "p95_ms": 200.0, "p99_ms": 400.0}}}
+    report = {"throughput_qps": 5.0, "stages": {
+        "execution": {"p50_ms": 110.0, "p95_ms": 150.0, "p99_ms": 400.0}, "explanation": {"p50_ms": 5.0},
+    }}
+
+    comparison = benchmark.compare_reports(report, baseline)
+
+    assert comparison["baseline_commit"] == "abc123"
+    assert comparison["stages"]["execution"] == {"p50_change_pct": 10.0, "p95_change_pct": -25.0, "p99_change_pct": 0.0}
+    assert comparison["stages"]["explanation"]["p50_change_pct"] is None
+    assert comparison["throughput_change_pct"] == 25.0
+
+
+def test_canned_sql_of_the_question_set_returns_rows_from_the_fixtures():
+    question_set = benchmark.load_question_set()
+    skyserver = benchmark_stubs.StubSkyServer(question_set["tables"], latency_s=0.0)
+    try:
+        for entry in question_set["questions"]:
+            response = requests.get(skyserver.url, params={"cmd": entry["sql"][-1], "format": "csv"})
+            assert response.text.startswith("#Table1\n"), entry["question"]
+            assert len(response.text.splitlines()) > 2, entry["question"]
+    finally:
+        skyserver.close()
+
+
+def test_logging_overhead_compares_eager_and_lazy_logging():
+    overhead = benchmark.measure_logging_overhead(iterations=40)
+
+    assert set(overhead) == {
+        "debug_off_eager_fstring", "debug_off_lazy_payload", "info_eager_dataframe_head", "debug_off_lazy_dataframe_head",
+        "info_sync", "info_async", "info_sync_slow_sink", "info_async_slow_sink",
+    }
+    assert overhead["debug_off_lazy_payload"] < overhead["debug_off_eager_fstring"]
+    assert overhead["debug_off_lazy_dataframe_head"] < overhead["info_eager_dataframe_head"]
+    assert overhead["info_async_slow_sink"] < overhead["info_sync_slow_sink"]
@@ -0,0 +1,64 @@
+import requests
+import openai
+import pytest
+
+from AstroQueryGPT import benchmark_stubs
+
+QUESTION = "Find galaxies that are elliptical"
+
+
+def _sql_prompt(question):
+    return f'Provided Table Schema Context:\n...\n\nUser\'s Request: "{question}"\n\nSQL Query:'
+
+
+@pytest.fixture
+def llm():
+    stub = benchmark_stubs.StubLLMServer(
+        {QUESTION: ["SELECT TOP 5 objID FROM PhotoObjAll WHERE bad = 1", "SELECT TOP 5 objID FROM PhotoObjAll"]},
+        latency_s=0.0,
+    )
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def skyserver(tmp_path):
+    fixture = tmp_path / "galaxies.csv"
+    fixture.write_text("objID,ra,dec\n" + "".join(f"{1237648720693755900 + i},{i * 10.5},{i - 3}\n" for i in range(8)))
+    stub = benchmark_stubs.StubSkyServer({"PhotoObjAll": str(fixture)}, latency_s=0.0)
+    yield stub
+    stub.close()
+
+
+def test_llm_stub_answers_each_attempt_with_its_canned_sql(llm):
+    client = openai.OpenAI(base_url=llm.url, api_key="test", max_retries=0)
+    messages = [{"role": "system", "content": "rules"}, {"role": "user", "content": _sql_prompt("find  GALAXIES that are elliptical")}]
+
+    first = client.chat.completions.create(model="m", messages=messages)
+    assert first.choices[0].message.content == "```sql\nSELECT TOP 5 objID FROM PhotoObjAll WHERE bad = 1\n```"
+    assert first.usage.prompt_tokens > 0
+
+    messages += [{"role": "assistant", "content": "SELECT ..."}, {"role": "user", "content": "Error: bad column."}]
+    correction = client.chat.completions.create(model="m", messages=messages)
+    assert "WHERE" not in correction.choices[0].message.content
+
+    explanation = client.chat.completions.create(
+        model="m", messages=[{"role": "user", "content": "Please explain this SDSS SQL query in a way that's easy to understand:"}]
+    )
+    assert explanation.choices[0].message.content == benchmark_stubs.DEFAULT_EXPLANATION
+
+    with pytest.raises(openai.NotFoundError):
+        client.chat.completions.create(model="m", messages=[{"role": "user", "content": _sql_prompt("Unknown question")}])
+    assert llm.get_stats() == {"requests": 4, "errors": 1}
+
+
+def test_skyserver_stub_runs_tsql_on_fixtures(skyserver):
+    response = requests.get(skyserver.url, params={"cmd": "SELECT TOP 3 objID, ra FROM dbo.PhotoObjAll WHERE dec >= 0", "format": "csv"})
+
+    assert response.text.splitlines() == [
+        "#Table1", "objID,ra", "1237648720693755903,31.5", "1237648720693755904,42.0", "1237648720693755905,52.5",
+    ]
+
+    error = requests.get(skyserver.url, params={"cmd": "SELECT TOP 3 nope FROM PhotoObjAll"})
+    assert "error near" in error.text.lower()
+    assert skyserver.get_stats() == {"requests": 2, "errors": 1}
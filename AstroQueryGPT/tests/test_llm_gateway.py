@@ -0,0 +1,140 @@
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+
+from AstroQueryGPT import llm_gateway
+from AstroQueryGPT.request_context import RequestContext, RequestCancelled
+
+
+class _StubOpenAIHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible `/chat/completions` endpoint."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.requests.append(body)
+            status = server.statuses.pop(0) if server.statuses else 200
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(server.delay_s)
+        with server.lock:
+            server.in_flight -= 1
+        if status != 200:
+            payload = json.dumps({"error": {"message": "stub error", "type": "stub"}}).encode()
+        else:
+            payload = json.dumps({
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "SELECT TOP 10 ra FROM PhotoObj"}}],
+                "usage": {"prompt_tokens": 20, "completion_tokens": 8, "total_tokens": 28,
+                          "prompt_tokens_details": {"cached_tokens": 0}},
+            }).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    """Runs the stub endpoint on a free local port."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubOpenAIHandler)
+    server.lock = threading.Lock()
+    server.requests, server.statuses = [], []
+    server.delay_s, server.in_flight, server.max_in_flight = 0.0, 0, 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def gateway(stub_server):
+    """A gateway pointed at the stub with fast retries."""
+    gw = llm_gateway.LLMGateway(
+        max_concurrency=2, max_retries=2, retry_base_delay_s=0.01, retry_max_delay_s=0.05,
+        api_key="test", base_url=f"http://127.0.0.1:{stub_server.server_address[1]}/v1",
+    )
+    yield gw
+    gw.close()
+
+
+def test_chat_completion_retries_rate_limits_and_server_errors(gateway, stub_server):
+    """429 and 5xx responses are retried until the call succeeds."""
+    stub_server.statuses = [429, 503]
+    response = gateway.chat_completion(model="stub-model", messages=[{"role": "user", "content": "hi"}])
+    assert response.choices[0].message.content == "SELECT TOP 10 ra FROM PhotoObj"
+    assert len(stub_server.requests) == 3
+    assert gateway.stats["retries"] == 2
+    assert gateway.stats["failures"] == 0
+
+
+def test_chat_completion_does_not_retry_client_errors(gateway, stub_server):
+    """A 400 response fails immediately."""
+    stub_server.statuses = [400]
+    with pytest.raises(openai.BadRequestError):
+        gateway.chat_completion(model="stub-model", messages=[{"role": "user", "content": "hi"}])
+    assert len(stub_server.requests) == 1
+    assert gateway.stats["failures"] == 1
+
+
+def test_chat_completion_gives_up_after_max_retries(gateway, stub_server):
+    """Retries are bounded by the retry budget."""
+    stub_server.statuses = [500, 500, 500, 500]
+    with pytest.raises(openai.InternalServerError):
+        gateway.chat_completion(model="stub-model", messages=[{"role": "user", "content": "hi"}])
+    assert len(stub_server.requests) == 3
+
+
+def test_achat_completion_concurrent_calls(gateway, stub_server):
+    """The asyncio interface serves concurrent calls through the same gateway."""
+    async def run():
+        return await asyncio.gather(*[
+            gateway.achat_completion(model="stub-model", messages=[{"role": "user", "content": str(i)}])
+            for i in range(5)
+        ])
+
+    responses = asyncio.run(run())
+    assert len(responses) == 5
+    assert len(stub_server.requests) == 5
+
+
+def test_abandoned_calls_keep_their_concurrency_slot(gateway, stub_server):
+    """A call abandoned by a cancelled request still counts against the cap until its HTTP request ends."""
+    stub_server.delay_s = 0.5
+    contexts = [RequestContext(timeout_s=10) for _ in range(2)]
+    errors = []
+
+    def abandoned(ctx):
+        try:
+            gateway.chat_completion(ctx=ctx, model="stub-model", messages=[{"role": "user", "content": "slow"}])
+        except RequestCancelled as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=abandoned, args=(ctx,)) for ctx in contexts]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    for ctx in contexts:
+        ctx.cancel("superseded")
+    for thread in threads:
+        thread.join(timeout=2)
+    assert len(errors) == 2
+
+    start = time.monotonic()
+    gateway.chat_completion(model="stub-model", messages=[{"role": "user", "content": "next"}])
+    assert time.monotonic() - start >= 0.2  # Waited for an abandoned call to end.
+    assert stub_server.max_in_flight == 2
@@ -0,0 +1,108 @@
+import pandas as pd
+import pytest
+
+from AstroQueryGPT import local_replica, sdss_db
+
+
+@pytest.fixture
+def replica(tmp_path):
+    replica = local_replica.LocalReplica(str(tmp_path / "replica.sqlite"))
+    galaxies = pd.DataFrame({
+        "objID": ["1237648720693755918", "1237648720693755919", "1237648720693755920"],
+        "ra": [150.5, 151.0, 159.0],
+        "dec": [1.0, 2.0, 3.0],
+        "r": [16.5, 17.5, 18.0],
+    })
+    replica.load_extract("Galaxy", galaxies, region=(150.0, 160.0, 0.0, 5.0))
+    spectra = pd.DataFrame({"specObjID": ["1", "2"], "class": ["GALAXY", "QSO"], "z": [0.1, 2.0]})
+    replica.load_extract("SpecObjAll", spectra, all_columns=True)
+    return replica
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT TOP 10 objID, r FROM Galaxy WHERE ra BETWEEN 150 AND 155 AND dec BETWEEN 0 AND 5",
+    "SELECT g.objID FROM Galaxy AS g WHERE g.ra > 151 AND g.ra < 152 AND g.dec >= 1 AND 4 >= g.dec",
+    "SELECT * FROM SpecObjAll WHERE class = 'qso'",
+])
+def test_covered_queries_are_planned(replica, sql):
+    assert replica.plan(sql) is not None
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT objID FROM Galaxy WHERE ra BETWEEN 150 AND 170 AND dec BETWEEN 0 AND 5",
+    "SELECT objID FROM Galaxy WHERE ra BETWEEN 150 AND 155",
+    "SELECT objID FROM Galaxy WHERE ra BETWEEN 150 AND 155 AND dec BETWEEN 0 AND 5 OR r < 15",
+    "SELECT objID FROM Galaxy WHERE ra + 10 > 150 AND ra < 155 AND dec BETWEEN 0 AND 5",
+    "SELECT petroRad_r FROM Galaxy WHERE ra BETWEEN 150 AND 155 AND dec BETWEEN 0 AND 5",
+    "SELECT * FROM Galaxy WHERE ra BETWEEN 150 AND 155 AND dec BETWEEN 0 AND 5",
+    "SELECT objID FROM PhotoObjAll WHERE ra BETWEEN 150 AND 155 AND dec BETWEEN 0 AND 5",
+    "SELECT TOP 10 * FROM dbo.fGetNearbyObjEq(150, 1, 1)",
+    "SELECT COUNT(*) AS n, SUM(CASE WHEN ra BETWEEN 150 AND 160 AND dec BETWEEN 0 AND 5 THEN 1 ELSE 0 END) FROM Galaxy",
+    "SELECT objID FROM Galaxy WHERE r < 17 ORDER BY CASE WHEN ra BETWEEN 150 AND 155 AND dec BETWEEN 0 AND 5 THEN 0 ELSE 1 END",
+])
+def test_uncovered_queries_go_to_skyserver(replica, sql):
+    assert replica.plan(sql) is None
+
+
+def test_region_bounds_come_from_the_top_level_where_clause(tmp_path):
+    replica = local_replica.LocalReplica(str(tmp_path / "replica.sqlite"))
+    galaxies = pd.DataFrame({"objID": ["1", "2"], "ra": [12.0, 15.0], "dec": [1.0, 2.0]})
+    replica.load_extract("Galaxy", galaxies, region=(10.0, 20.0, 0.0, 5.0))
+
+    sql = "SELECT COUNT(*) AS n, SUM(CASE WHEN ra BETWEEN 10 AND 20 AND dec BETWEEN 0 AND 5 THEN 1 ELSE 0 END) FROM Galaxy"
+    assert replica.plan(sql) is None
+    assert replica.uncovered_reason(sql) == "the query is not limited to the extracted sky region of Galaxy"
+    assert replica.plan(
+        "SELECT COUNT(*) AS n FROM Galaxy WHERE ra BETWEEN 10 AND 20 AND dec BETWEEN 0 AND 5 GROUP BY ra HAVING MAX(dec) < 1"
+    ) is not None
+
+
+def test_local_execution_matches_skyserver_types(replica):
+    df = replica.execute(replica.plan("SELECT TOP 2 objID, r FROM Galaxy WHERE ra BETWEEN 150 AND 160 AND dec BETWEEN 0 AND 5 ORDER BY r"))
+    assert list(df["r"]) == [16.5, 17.5]
+    assert df["objID"].iloc[0] == 1237648720693755918  # Stored as an integer, converted to str by sdss_db.
+
+    assert len(replica.execute(replica.plan("SELECT z FROM SpecObjAll WHERE class = 'qso'"))) == 1
+    assert replica.get_stats()["local"] == 2
+
+
+def test_ids_beyond_int64_are_stored_as_text(tmp_path):
+    replica = local_replica.LocalReplica(str(tmp_path / "replica.sqlite"))
+    spectra = pd.DataFrame({
+        "specObjID": ["14127171374474727424", "299489677444933632"],
+        "bestObjID": ["1237648720693755918", None],
+        "z": [0.1, 2.0],
+    })
+    replica.load_extract("SpecObjAll", spectra, all_columns=True)
+    galaxies = pd.DataFrame({"objID": ["1237648720693755918"], "r": [16.5]})
+    replica.load_extract("PhotoObjAll", galaxies)
+
+    df = replica.execute(replica.plan("SELECT TOP 10 specObjID AS id, z FROM SpecObjAll WHERE z > 1"))
+    assert list(df["id"]) == ["299489677444933632"]
+    df = replica.execute(replica.plan(
+        "SELECT s.specObjID, p.r FROM SpecObjAll s JOIN PhotoObjAll p ON s.bestObjID = p.objID WHERE p.objID = 1237648720693755918"
+    ))
+    assert list(df["specObjID"]) == ["14127171374474727424"]
+    assert len(replica.execute(replica.plan("SELECT * FROM SpecObjAll WHERE bestObjID IS NULL"))) == 1
+
+    for sql in [
+        "SELECT z FROM SpecObjAll WHERE specObjID = 14127171374474727424",
+        "SELECT specObjID FROM SpecObjAll ORDER BY specObjID",
+        "SELECT specObjID AS id FROM SpecObjAll ORDER BY id",
+        "SELECT MAX(specObjID) FROM SpecObjAll",
+    ]:
+        assert replica.plan(sql) is None, sql
+
+
+def test_query_sdss_uses_replica_and_falls_back(replica, mocker):
+    mocker.patch.object(sdss_db, "LOCAL_REPLICA", replica)
+    mocker.patch.object(sdss_db.config, "ENABLE_LOCAL_REPLICA", True)
+    skyserver = mocker.patch.object(sdss_db, "_execute_sdss_query", return_value=pd.DataFrame({"objID": ["9"]}))
+
+    df = sdss_db.query_sdss("SELECT objID FROM Galaxy WHERE ra BETWEEN 150 AND 152 AND dec BETWEEN 0 AND 5")
+    assert list(df["objID"]) == ["1237648720693755918", "1237648720693755919"]
+    skyserver.assert_not_called()
+
+    df = sdss_db.query_sdss("SELECT objID FROM Galaxy WHERE ra BETWEEN 150 AND 170 AND dec BETWEEN 0 AND 5")
+    assert list(df["objID"]) == ["9"]
+    skyserver.assert_called_once()
@@ -0,0 +1,57 @@
+import logging
+import threading
+
+import pytest
+
+from AstroQueryGPT import log_utils
+
+
+class _Collect(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.emitting_threads = set()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.emitting_threads.add(threading.current_thread())
+
+
+def test_payload_is_rendered_lazily_capped_and_sampled():
+    renders = []
+
+    def render(value):
+        renders.append(value)
+        return "x" * 50
+
+    quiet = logging.getLogger("test_log_utils.quiet")
+    quiet.setLevel(logging.INFO)
+    quiet.debug("Payload: %s", log_utils.log_payload("value", render=render))
+    assert renders == [] # Never rendered while DEBUG is off.
+
+    assert str(log_utils.log_payload("value", render=render, max_chars=10, sample_rate=1.0)) == "xxxxxxxxxx... <40 more chars>"
+    assert str(log_utils.log_payload("short", max_chars=10, sample_rate=1.0)) == "short"
+    assert str(log_utils.log_payload("value", render=render, sample_rate=0.0)) == "<payload not sampled>"
+    assert len(renders) == 1
+
+
+def test_async_mode_writes_from_a_listener_thread():
+    root = logging.getLogger()
+    level = root.level
+    collect = _Collect()
+    try:
+        listener = log_utils.configure_logging(logging.INFO, mode="async", handler=collect, force=True)
+        assert listener is not None
+        assert log_utils.configure_logging(logging.DEBUG, mode="sync") is listener # Later calls keep the setup.
+        logging.getLogger("test_log_utils.async").info("Attempt %d failed", 2)
+        logging.getLogger("test_log_utils.async").debug("not emitted")
+        log_utils.stop_logging() # Flushes the queue.
+        assert collect.messages == ["Attempt 2 failed"]
+        assert threading.current_thread() not in collect.emitting_threads
+
+        with pytest.raises(ValueError):
+            log_utils.configure_logging(mode="threaded", force=True)
+    finally:
+        log_utils.stop_logging()
+        root.setLevel(level)
+    assert collect not in root.handlers
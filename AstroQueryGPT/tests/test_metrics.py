@@ -0,0 +1,68 @@
+import math
+import socket
+import urllib.request
+
+import pytest
+
+from AstroQueryGPT import metrics
+
+
+def test_registry_renders_prometheus_text_format():
+    registry = metrics.MetricsRegistry()
+    requests_total = registry.counter("demo_requests_total", "Requests by path.", ("path",))
+    latency = registry.histogram("demo_latency_seconds", "Latency.", (0.1, 1.0))
+
+    requests_total.inc(path='/a"b')
+    requests_total.inc(2, path='/a"b')
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value)
+
+    assert requests_total.value(path='/a"b') == 3
+    assert latency.snapshot() == {"count": 4, "sum": pytest.approx(3.65), "buckets": {0.1: 2, 1.0: 3, math.inf: 4}}
+    assert registry.render().splitlines() == [
+        "# HELP demo_requests_total Requests by path.",
+        "# TYPE demo_requests_total counter",
+        'demo_requests_total{path="/a\\"b"} 3',
+        "# HELP demo_latency_seconds Latency.",
+        "# TYPE demo_latency_seconds histogram",
+        'demo_latency_seconds_bucket{le="0.1"} 2',
+        'demo_latency_seconds_bucket{le="1"} 3',
+        'demo_latency_seconds_bucket{le="+Inf"} 4',
+        "demo_latency_seconds_sum 3.65",
+        "demo_latency_seconds_count 4",
+    ]
+
+    with pytest.raises(ValueError):
+        requests_total.inc(-1, path="/")
+    with pytest.raises(ValueError):
+        requests_total.inc(method="GET")
+    with pytest.raises(ValueError):
+        registry.counter("demo_requests_total", "Duplicate.")
+
+
+def test_classify_execution_error():
+    assert metrics.classify_execution_error("SDSS SQL Error (detected in HTML response): Incorrect syntax near 'x' error near") == "error_near"
+    assert metrics.classify_execution_error("SDSS returned an HTML page (Content-Type: text/html), not CSV.") == "html_error"
+    assert metrics.classify_execution_error("SDSS query timed out after 60 seconds.") == "timeout"
+    assert metrics.classify_execution_error("500 Server Error") == "execution_error"
+    assert set(metrics.CORRECTION_REASONS) >= {"error_near", "html_error", "timeout", "execution_error"}
+
+
+def test_metrics_server_serves_the_registry():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    metrics.record_cache_lookup("local_replica", hit=True)
+
+    server = metrics.start_metrics_server(port=port, host="127.0.0.1")
+    try:
+        assert server is not None
+        assert metrics.start_metrics_server(port=port, host="127.0.0.1") is server
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            body = response.read().decode("utf-8")
+            assert response.headers["Content-Type"] == metrics.PROMETHEUS_CONTENT_TYPE
+        assert "# TYPE astroquerygpt_llm_request_duration_seconds histogram" in body
+        assert 'astroquerygpt_cache_requests_total{cache="local_replica",result="hit"}' in body
+    finally:
+        server.shutdown()
+        server.server_close()
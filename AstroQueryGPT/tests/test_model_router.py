@@ -0,0 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from AstroQueryGPT import model_router
+
+
+@pytest.fixture(autouse=True)
+def reset_router_stats(mocker):
+    """Isolate the module-level counters between tests."""
+    mocker.patch.object(model_router, "ROUTER_STATS", {
+        model_router.MODEL_TIER_FAST: model_router._new_tier_stats(),
+        model_router.MODEL_TIER_STRONG: model_router._new_tier_stats(),
+    })
+
+
+def test_select_model_tier_escalates_only_for_corrections():
+    """Generation goes to the fast tier, correction to the strong tier."""
+    assert model_router.select_model_tier(correction=False) == model_router.MODEL_TIER_FAST
+    assert model_router.select_model_tier(correction=True) == model_router.MODEL_TIER_STRONG
+
+
+def test_get_model_for_tier_strips_provider_prefix(mocker):
+    """Tier models come from config, without the provider prefix."""
+    mocker.patch.object(model_router.config, "LLM_FAST_MODEL", "openai/gpt-4o-mini")
+    mocker.patch.object(model_router.config, "LLM_STRONG_MODEL", "gpt-4o")
+    assert model_router.get_model_for_tier(model_router.MODEL_TIER_FAST) == "gpt-4o-mini"
+    assert model_router.get_model_for_tier(model_router.MODEL_TIER_STRONG) == "gpt-4o"
+
+
+def test_router_stats_latency_and_success_rate():
+    """Per-tier latency percentiles and success rates are summarised."""
+    for latency in (100, 200, 300):
+        model_router.record_llm_call(model_router.MODEL_TIER_FAST, latency)
+    model_router.record_llm_call(model_router.MODEL_TIER_STRONG, 50, error=True)
+    model_router.record_attempt_outcome(model_router.MODEL_TIER_FAST, success=True)
+    model_router.record_attempt_outcome(model_router.MODEL_TIER_FAST, success=True)
+    model_router.record_attempt_outcome(model_router.MODEL_TIER_FAST, success=False)
+    stats = model_router.get_router_stats()
+    assert stats["fast"]["calls"] == 3
+    assert stats["fast"]["median_latency_ms"] == 200
+    assert stats["fast"]["success_rate"] == pytest.approx(2 / 3)
+    assert stats["strong"]["errors"] == 1
+    assert stats["strong"]["success_rate"] is None
+
+
+def test_router_stats_are_thread_safe():
+    """Calls recorded from worker threads are all counted while stats are read."""
+    def record(_):
+        model_router.record_llm_call(model_router.MODEL_TIER_FAST, 10)
+        model_router.get_router_stats()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(record, range(400)))
+    assert model_router.get_router_stats()["fast"]["calls"] == 400
@@ -0,0 +1,45 @@
+import time
+import pstats
+
+import pytest
+
+from AstroQueryGPT import profiling
+
+
+def _slow_lookup():
+    time.sleep(0.15)
+
+
+def test_sampling_profile_writes_collapsed_stacks(tmp_path):
+    with profiling.RunProfiler("req1", mode="sample", output_dir=str(tmp_path), interval_s=0.005, top_n=5) as profiler:
+        _slow_lookup()
+
+    profile = profiler.profile
+    assert profile["mode"] == "sample" and profile["samples"] > 5
+    assert profile["path"] == str(tmp_path / "req1.folded")
+    lines = (tmp_path / "req1.folded").read_text().splitlines()
+    stack, count = lines[0].rsplit(" ", 1)
+    frames = stack.split(";")
+    # Stacks start at the frame that entered the profiler, not at pytest's frames.
+    assert frames[0].startswith("test_sampling_profile_writes_collapsed_stacks (test_profiling.py:")
+    assert frames[1].startswith("_slow_lookup (test_profiling.py:") and int(count) > 0
+    assert {row["function"] for row in profile["top"][:2]} == set(frames[:2])
+    assert profile["top"][0]["self_s"] == pytest.approx(profile["elapsed_s"], rel=0.2) # Sleeping counts: wall clock.
+    assert "_slow_lookup (test_profiling.py:" in (tmp_path / "req1.top.txt").read_text()
+
+
+def test_cprofile_profile_writes_pstats(tmp_path):
+    with profiling.RunProfiler("req2", mode="cprofile", output_dir=str(tmp_path), top_n=50) as profiler:
+        for _ in range(3):
+            _slow_lookup()
+
+    profile = profiler.profile
+    assert profile["path"] == str(tmp_path / "req2.prof")
+    assert any(name == "_slow_lookup" for (_, _, name) in pstats.Stats(profile["path"]).stats)
+    lookup = next(row for row in profile["top"] if row["function"].startswith("_slow_lookup "))
+    assert lookup["calls"] == 3 and lookup["total_s"] >= 0.4
+
+    with profiling.profile_run("req3", enabled=False) as disabled:
+        assert disabled is None
+    with pytest.raises(ValueError):
+        profiling.RunProfiler("req4", mode="perf")
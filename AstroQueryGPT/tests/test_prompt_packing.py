@@ -0,0 +1,57 @@
+import pytest
+
+from AstroQueryGPT import prompt_packing
+
+
+@pytest.fixture
+def photo_table():
+    """A table with one relevant field and many verbose, irrelevant ones."""
+    fields = [{"name": "objID", "type": "bigint", "description": "Unique SDSS identifier (Primary key)"}]
+    fields += [
+        {"name": f"aux{i}", "type": "real", "description": "Calibration bookkeeping value " + "lorem " * 20}
+        for i in range(30)
+    ]
+    fields.append({"name": "petroRad_r", "type": "real", "description": "Petrosian radius"})
+    return {"name": "PhotoObjAll", "description": "Photometric objects", "fields": fields}
+
+
+def test_count_tokens_is_cached_and_monotonic():
+    """Token counts grow with text and repeated strings hit the cache."""
+    prompt_packing.count_tokens.cache_clear()
+    short = prompt_packing.count_tokens("Petrosian radius")
+    long = prompt_packing.count_tokens("Petrosian radius in the r band, measured in arcseconds")
+    assert 0 < short < long
+    prompt_packing.count_tokens("Petrosian radius")
+    assert prompt_packing.count_tokens.cache_info().hits >= 1
+    assert prompt_packing.count_tokens("") == 0
+
+
+def test_pack_schema_context_prefers_relevant_fields(photo_table):
+    """Under a tight budget, the query-relevant field and the key survive; filler is dropped."""
+    packed, used = prompt_packing.pack_schema_context(
+        "galaxies with large petrosian radius", [(photo_table, 0.6, photo_table["fields"])], token_budget=60
+    )
+    names = [f["name"] for f in packed[0]]
+    assert "petroRad_r" in names
+    assert "objID" in names
+    assert len(names) < len(photo_table["fields"])
+    assert used <= 60
+
+
+def test_pack_schema_context_keeps_schema_order(photo_table):
+    """Selected fields are rendered in the table's own order."""
+    packed, _ = prompt_packing.pack_schema_context(
+        "petrosian radius", [(photo_table, 0.6, photo_table["fields"])], token_budget=10_000
+    )
+    assert packed[0] == photo_table["fields"]
+
+
+def test_pack_schema_context_spreads_budget_across_tables(photo_table):
+    """A short table can still contribute fields next to a wide one."""
+    spec_table = {"name": "SpecObjAll", "fields": [{"name": "z", "type": "real", "description": "Final redshift"}]}
+    packed, _ = prompt_packing.pack_schema_context(
+        "redshift and petrosian radius",
+        [(photo_table, 0.7, photo_table["fields"]), (spec_table, 0.5, spec_table["fields"])],
+        token_budget=80,
+    )
+    assert [f["name"] for f in packed[1]] == ["z"]
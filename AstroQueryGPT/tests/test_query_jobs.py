@@ -0,0 +1,227 @@
+import re
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from AstroQueryGPT import query_jobs
+
+
+class _StubCasJobs:
+    """Local CasJobs-like REST server: jobs finish after `run_s` and produce `rows` numbered rows."""
+
+    def __init__(self, run_s=0.2, rows=25):
+        self.run_s = run_s
+        self.rows = rows
+        self.jobs = {}
+        self.status_calls = []
+        self.dropped = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, body, content_type="application/json"):
+                payload = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _body(self):
+                return json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+            def do_PUT(self):
+                query = self._body()["Query"]
+                job_id = str(len(stub.jobs) + 1)
+                stub.jobs[job_id] = {"query": query, "started": time.monotonic(), "cancelled": False}
+                self._reply(200, job_id, "text/plain")
+
+            def do_GET(self):
+                job = stub.jobs[self.path.rsplit("/", 1)[-1]]
+                stub.status_calls.append(time.monotonic())
+                if job["cancelled"]:
+                    status = 3
+                elif "fail_me" in job["query"]:
+                    status = 4
+                else:
+                    status = 5 if time.monotonic() - job["started"] >= stub.run_s else 1
+                self._reply(200, json.dumps({"Status": status, "Message": "", "Error": "Boom." if status == 4 else None}))
+
+            def do_DELETE(self):
+                stub.jobs[self.path.rsplit("/", 1)[-1]]["cancelled"] = True
+                self._reply(200, "")
+
+            def do_POST(self):
+                query = self._body()["Query"]
+                drop = re.search(r"DROP TABLE (\w+)", query)
+                if drop:
+                    stub.dropped.append(drop.group(1))
+                    return self._reply(200, "", "text/plain")
+                limit, after = map(int, re.search(r"TOP (\d+) \* FROM \w+ WHERE _job_row > (\d+)", query).groups())
+                lines = ["_job_row,objID,ra"] + [
+                    f"{row},{1237648720693755900 + row},{row * 1.5}"
+                    for row in range(after + 1, min(stub.rows, after + limit) + 1)
+                ]
+                self._reply(200, "\n".join(lines) + "\n", "text/plain")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/RestApi"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def casjobs():
+    stub = _StubCasJobs()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def make_manager(casjobs, tmp_path):
+    managers = []
+
+    def factory(retention_s=3600):
+        manager = query_jobs.QueryJobManager(
+            query_jobs.CasJobsBackend(base_url=casjobs.url, token="token", context="DR16"),
+            state_path=str(tmp_path / "jobs.json"),
+            poll_initial_s=0.02, poll_max_s=0.1, poll_backoff=2.0, retention_s=retention_s,
+        )
+        managers.append(manager)
+        return manager
+
+    yield factory
+    for manager in managers:
+        manager.shutdown()
+
+
+def test_make_job_sql_numbers_rows_into_mydb_table():
+    assert query_jobs.make_job_sql("SELECT TOP 10 objID, ra FROM PhotoObj WHERE ra > 1", "t") == (
+        "SELECT TOP 10 IDENTITY(bigint, 1, 1) AS _job_row, objID, ra INTO mydb.t FROM PhotoObj WHERE ra > 1"
+    )
+    assert query_jobs.make_job_sql(
+        "WITH g AS (SELECT objID FROM Galaxy) SELECT objID FROM g", "t"
+    ) == "WITH g AS (SELECT objID FROM Galaxy) SELECT IDENTITY(bigint, 1, 1) AS _job_row, objID INTO mydb.t FROM g"
+
+    for sql in ("SELECT DISTINCT class FROM SpecObj", "SELECT ra FROM Star UNION SELECT ra FROM Galaxy", "SELECT 1"):
+        with pytest.raises(ValueError):
+            query_jobs.make_job_sql(sql, "t")
+
+
+def test_job_is_polled_with_backoff_and_fetched_in_chunks(casjobs, make_manager):
+    manager = make_manager()
+    job = manager.submit("SELECT objID, ra FROM PhotoObj WHERE ra > 1", user_id="alice")
+
+    assert casjobs.jobs["1"]["query"].startswith("SELECT IDENTITY(bigint, 1, 1) AS _job_row")
+    finished = manager.wait(job["job_id"], timeout_s=5)
+    assert finished["state"] == query_jobs.JOB_FINISHED
+
+    gaps = [b - a for a, b in zip(casjobs.status_calls, casjobs.status_calls[1:])]
+    assert gaps and gaps[-1] > gaps[0]  # The poll interval grows.
+
+    chunks = list(manager.iter_results(job["job_id"], chunk_rows=10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert list(chunks[0].columns) == ["objID", "ra"]
+    assert chunks[0]["objID"].iloc[0] == "1237648720693755901"
+
+
+def test_jobs_survive_restart(casjobs, make_manager):
+    casjobs.run_s = 0.5
+    first = make_manager()
+    job_id = first.submit("SELECT objID FROM PhotoObj")["job_id"]
+    first.shutdown()
+
+    resumed = make_manager()
+    assert resumed.get(job_id)["state"] in query_jobs.ACTIVE_JOB_STATES
+    resumed.start()
+    assert resumed.wait(job_id, timeout_s=5)["state"] == query_jobs.JOB_FINISHED
+    chunk, cursor = resumed.fetch_chunk(job_id, 0, 100)
+    assert len(chunk) == 25 and cursor == 25
+
+
+def test_cancelled_and_failed_jobs_have_no_results(casjobs, make_manager):
+    casjobs.run_s = 60
+    manager = make_manager()
+    job_id = manager.submit("SELECT objID FROM PhotoObj")["job_id"]
+
+    assert manager.cancel(job_id)["state"] == query_jobs.JOB_CANCELLED
+    with pytest.raises(query_jobs.JobNotReady):
+        manager.fetch_chunk(job_id)
+
+    failed = manager.wait(manager.submit("SELECT fail_me FROM PhotoObj")["job_id"], timeout_s=5)
+    assert failed["state"] == query_jobs.JOB_FAILED and failed["message"] == "Boom."
+    assert manager.get_stats()["active"] == 0
+
+    deadline = time.monotonic() + 5
+    while manager.get_stats()["outputs_dropped"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert set(casjobs.dropped) == {manager.get(job_id)["output_table"], failed["output_table"]}
+    assert manager.get(job_id)["output_dropped"]
+
+
+def test_expired_jobs_drop_their_output_table(casjobs, make_manager):
+    casjobs.run_s = 0
+    manager = make_manager(retention_s=0.3)
+    job = manager.submit("SELECT objID FROM PhotoObj")
+    assert manager.wait(job["job_id"], timeout_s=5)["state"] == query_jobs.JOB_FINISHED
+    assert len(manager.fetch_chunk(job["job_id"])[0]) == 25  # Kept until it expires.
+
+    deadline = time.monotonic() + 5
+    while manager.get(job["job_id"]) is not None and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert manager.get(job["job_id"]) is None
+    assert casjobs.dropped == [job["output_table"]]
+
+
+def test_incomplete_backend_cannot_be_instantiated():
+    class NoDrop(query_jobs.JobBackend):
+        def submit(self, job_sql, task_name):
+            return "1"
+
+        def status(self, backend_job_id):
+            return query_jobs.JOB_FINISHED, ""
+
+        def cancel(self, backend_job_id):
+            pass
+
+        def fetch_rows(self, output_table, after_row, limit):
+            return None
+
+    with pytest.raises(TypeError, match="drop_output"):
+        NoDrop()
+
+
+def test_unexpected_errors_do_not_stop_the_poller(casjobs, make_manager, monkeypatch):
+    casjobs.run_s = 0
+    manager = make_manager()
+    backend = manager.backend
+    failures = {"status": 1, "drop": 1}
+
+    def flaky(name, method):
+        def call(*args):
+            if failures[name]:
+                failures[name] -= 1
+                raise (ValueError("unexpected reply") if name == "status" else OSError("disk full"))
+            return method(*args)
+        return call
+
+    monkeypatch.setattr(backend, "status", flaky("status", backend.status))
+    monkeypatch.setattr(backend, "drop_output", flaky("drop", backend.drop_output))
+
+    job_id = manager.submit("SELECT fail_me FROM PhotoObj")["job_id"]
+    assert manager.wait(job_id, timeout_s=5)["state"] == query_jobs.JOB_FAILED
+    deadline = time.monotonic() + 5
+    while not manager.get(job_id)["output_dropped"] and time.monotonic() < deadline:
+        time.sleep(0.02)
+    stats = manager.get_stats()
+    assert manager.get(job_id)["output_dropped"]
+    assert stats["poll_errors"] == 1 and stats["drop_errors"] == 1
@@ -22,9 +22,11 @@ def manage_global_schema(mocker):
 
 @pytest.fixture
 def mock_llm_client(mocker):
-    """Fixture to mock the llm_client used in rag_core."""
+    """Fixture to mock the LLM gateway used in rag_core."""
     client = MagicMock()
-    mocker.patch('AstroQueryGPT.rag_core.llm_client', client)
+    # rag_core calls `gateway.chat_completion`; route it to the OpenAI-style mock the tests configure.
+    client.chat_completion = client.chat.completions.create
+    mocker.patch('AstroQueryGPT.rag_core.llm_gateway', client)
     return client
 
 # Tests for load_sdss_schema
@@ -340,3 +342,53 @@ def test_get_retriever_model_loading_exception(mocker, caplog):
     assert "Error loading sentence transformer model" in caplog.text
     assert "Model load failed" in caplog.text
     assert "RAG features will be impaired" in caplog.text
+
+# Tests for the prefix-cache-friendly prompt layout
+def test_build_rag_prompt_schema_prefix_is_stable():
+    """Schema context is sorted by table name; scores and TOP N only appear after it."""
+    photo = {"name": "PhotoObj", "description": "Photometric objects", "fields": [{"name": "ra", "type": "float", "description": "Right Ascension"}]}
+    spec = {"name": "SpecObj", "description": "Spectroscopic objects", "fields": [{"name": "z", "type": "float", "description": "Redshift"}]}
+    prompt_a = rag_core.build_rag_prompt_for_sql_generation("redshift", [(spec, 0.8), (photo, 0.6)], 10)
+    prompt_b = rag_core.build_rag_prompt_for_sql_generation("redshift", [(photo, 0.7), (spec, 0.5)], 50)
+    prefix_a = prompt_a.split("Table relevance for this request:")[0]
+    assert prefix_a == prompt_b.split("Table relevance for this request:")[0]
+    assert prefix_a.index("Table Name: PhotoObj") < prefix_a.index("Table Name: SpecObj")
+    assert "TOP" not in prefix_a and "0.8" not in prefix_a
+    assert "- SpecObj (Semantic Relevance Score to user query: 0.80)" in prompt_a
+
+def test_generate_and_correct_sql_correction_reuses_prefix(mock_llm_client):
+    """Correction sends the same system prompt and RAG prompt first, then the prior SQL and the error."""
+    mock_llm_client.chat.completions.create.return_value.choices[0].message.content = "SELECT TOP 10 ra FROM PhotoObj"
+    rag_core.generate_and_correct_sql("query", "rag prompt", 10)
+    rag_core.generate_and_correct_sql("query", "rag prompt", 20, error_message="Invalid column name 'x'.", prior_sql="SELECT TOP 20 x FROM PhotoObj")
+    generation_messages = mock_llm_client.chat.completions.create.call_args_list[0].kwargs["messages"]
+    correction_messages = mock_llm_client.chat.completions.create.call_args_list[1].kwargs["messages"]
+    assert correction_messages[:2] == generation_messages
+    assert generation_messages[0]["content"] == rag_core.SQL_GENERATION_SYSTEM_PROMPT
+    assert correction_messages[2] == {"role": "assistant", "content": "SELECT TOP 20 x FROM PhotoObj"}
+    assert "Invalid column name 'x'." in correction_messages[3]["content"]
+    assert "TOP 20" in correction_messages[3]["content"]
+
+def test_generate_and_correct_sql_records_cached_tokens(mock_llm_client, mocker):
+    """Prompt, cached and completion tokens are read from the response usage."""
+    mocker.patch.object(rag_core, "LLM_USAGE_STATS", {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "latency_ms": 0})
+    response = mock_llm_client.chat.completions.create.return_value
+    response.choices[0].message.content = "SELECT TOP 10 ra FROM PhotoObj"
+    response.usage.prompt_tokens = 2048
+    response.usage.prompt_tokens_details.cached_tokens = 1536
+    response.usage.completion_tokens = 12
+    rag_core.generate_and_correct_sql("query", "rag prompt", 10)
+    stats = rag_core.get_llm_usage_stats()
+    assert stats["calls"] == 1
+    assert stats["cached_tokens"] == 1536
+    assert stats["cached_token_ratio"] == pytest.approx(0.75)
+
+def test_generate_and_correct_sql_routes_by_mode(mock_llm_client, mocker):
+    """Generation calls the fast model; correction escalates to the strong model."""
+    mocker.patch.object(rag_core.config, "LLM_FAST_MODEL", "fast-model")
+    mocker.patch.object(rag_core.config, "LLM_STRONG_MODEL", "strong-model")
+    mock_llm_client.chat.completions.create.return_value.choices[0].message.content = "SELECT TOP 10 ra FROM PhotoObj"
+    rag_core.generate_and_correct_sql("query", "rag prompt", 10)
+    rag_core.generate_and_correct_sql("query", "rag prompt", 10, error_message="Invalid column name 'x'.", prior_sql="SELECT TOP 10 x FROM PhotoObj")
+    models = [call.kwargs["model"] for call in mock_llm_client.chat.completions.create.call_args_list]
+    assert models == ["fast-model", "strong-model"]
@@ -0,0 +1,58 @@
+import time
+import threading
+
+import pytest
+
+from AstroQueryGPT.request_context import RequestContext, RequestCancelled, DeadlineExceeded
+
+
+def test_timeout_is_shrunk_to_remaining_budget():
+    """A stage's default timeout is capped by the time left in the request."""
+    ctx = RequestContext(timeout_s=2)
+    assert ctx.timeout(60) <= 2
+    assert ctx.timeout(0.5) == 0.5
+    assert RequestContext().timeout(60) == 60
+
+
+def test_check_raises_after_cancel_and_deadline():
+    """Cancellation and an exhausted budget are reported as distinct errors."""
+    ctx = RequestContext()
+    ctx.check("retrieval")
+    ctx.cancel("superseded by a new question")
+    with pytest.raises(RequestCancelled, match="superseded"):
+        ctx.check("retrieval")
+
+    expired = RequestContext(timeout_s=0.01)
+    time.sleep(0.02)
+    with pytest.raises(DeadlineExceeded):
+        expired.check("generation")
+    assert isinstance(DeadlineExceeded(), TimeoutError)
+
+
+def test_call_returns_promptly_when_cancelled():
+    """A blocking call is abandoned as soon as the request is cancelled."""
+    ctx = RequestContext(timeout_s=30)
+    release = threading.Event()
+    threading.Timer(0.1, ctx.cancel, args=("stopped by user",)).start()
+    start = time.monotonic()
+    with pytest.raises(RequestCancelled):
+        ctx.call(release.wait, 5, stage="SkyServer query")
+    assert time.monotonic() - start < 1
+    release.set()
+
+
+def test_call_and_sleep_respect_deadline():
+    """Neither a blocking call nor a retry pause outlives the request deadline."""
+    ctx = RequestContext(timeout_s=0.2)
+    assert ctx.call(lambda x: x * 2, 21) == 42
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        ctx.call(time.sleep, 5, stage="LLM call")
+    assert time.monotonic() - start < 1
+
+    sleeper = RequestContext()
+    threading.Timer(0.05, sleeper.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(RequestCancelled):
+        sleeper.sleep(5)
+    assert time.monotonic() - start < 1
@@ -0,0 +1,41 @@
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+from AstroQueryGPT import result_dtypes
+
+CSV = (
+    "objID,ra,petroRad_r,deVRad_u,flags,nChild,run\n"
+    "1237657584942448656,22.4497504938385,2.969554,-9999,105624251662680,0,2820\n"
+    "1237660750333018120,66.4181174233685,-1000,1.309084,387097114579216,0,3557\n"
+    "1237678578742263834,329.013093003648,0.3641909,-9999,545426788979032,2,-9999\n"
+)
+
+
+def test_normalize_maps_sentinels_and_downcasts():
+    """Sentinels become missing values, single-precision floats become float32 and integers shrink."""
+    df = pd.read_csv(StringIO(CSV))
+    report = result_dtypes.normalize_result_dtypes(df, sentinels=(-9999.0, -1000.0))
+
+    assert report["sentinels_replaced"] == 4
+    assert report["float32_columns"] == ["petroRad_r", "deVRad_u"]
+    assert df["petroRad_r"].dtype == np.float32 and df["petroRad_r"].isna().tolist() == [False, True, False]
+    assert df["deVRad_u"].isna().tolist() == [True, False, True]
+    assert report["int_columns"] == {"nChild": "int8", "run": "Int16"}
+    assert df["run"].isna().tolist() == [False, False, True] and df["run"].iloc[1] == 3557
+    assert df["flags"].dtype == np.int64
+    assert report["bytes_after"] == df.memory_usage(index=True).sum() < report["bytes_before"]
+    assert df.attrs["dtype_normalization"] is report
+
+
+def test_normalize_keeps_full_precision_and_id_columns():
+    """Columns printed with more than seven significant digits and ID columns are left as parsed."""
+    df = pd.read_csv(StringIO(CSV))
+    parsed = df.copy()
+    result_dtypes.normalize_result_dtypes(df, sentinels=(-9999.0, -1000.0))
+
+    assert df["ra"].dtype == np.float64
+    pd.testing.assert_series_equal(df["ra"], parsed["ra"])
+    pd.testing.assert_series_equal(df["objID"], parsed["objID"])
+    assert np.allclose(df["petroRad_r"].dropna(), parsed["petroRad_r"].iloc[[0, 2]], rtol=1e-7)
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from AstroQueryGPT import result_profiler
+
+
+def test_profile_counts_nulls_sentinels_ranges_and_constants():
+    """Per-column fractions and ranges ignore NULLs and sentinels; integer IDs keep full precision."""
+    df = pd.DataFrame({
+        "objID": np.array([1237657584942448656, 1237657584942448657, 1237657584942448658], dtype=np.int64),
+        "petroMag_r": [17.5, -9999.0, np.nan],
+        "flag": [-1000, -1000, -1000],
+        "type": [3, 3, 3],
+        "class": ["GALAXY", None, "GALAXY"],
+        "z": pd.array([0.1, None, 0.3], dtype="Float64"),
+    })
+    profile = result_profiler.profile_result(df, sentinels=(-9999.0, -1000.0))
+    columns = {column["name"]: column for column in profile["columns"]}
+
+    assert profile["rows"] == 3
+    assert columns["objID"]["min"] == 1237657584942448656 and columns["objID"]["max"] == 1237657584942448658
+    assert not columns["objID"]["constant"]
+    assert columns["petroMag_r"]["null_frac"] == columns["petroMag_r"]["sentinel_frac"] == 1 / 3
+    assert columns["petroMag_r"]["min"] == columns["petroMag_r"]["max"] == 17.5
+    assert columns["z"]["null_frac"] == 1 / 3 and columns["z"]["max"] == 0.3
+    assert columns["class"]["min"] is None and columns["class"]["null_frac"] == 1 / 3
+    assert profile["unusable_columns"] == ["flag"]
+    assert profile["constant_columns"] == ["petroMag_r", "type", "class"]
+    assert result_profiler.unusable_column_fraction(profile) == 1 / 6
+
+
+def test_format_lists_unusable_columns_first_and_caps_columns():
+    """The summary names sentinel-only columns, lists them first and stays within the column cap."""
+    df = pd.DataFrame({f"col{i}": [float(i), float(i + 1)] for i in range(5)})
+    df["petroRad_u"] = [-9999.0, -9999.0]
+    text = result_profiler.format_result_profile(result_profiler.profile_result(df, sentinels=(-9999.0,)), max_columns=3)
+    lines = text.splitlines()
+
+    assert lines[0] == "Result: 2 rows x 6 columns."
+    assert "only NULL or sentinel values (-9999, " in lines[1] and "petroRad_u" in lines[1]
+    assert lines[3] == "- petroRad_u: 0% null, 100% sentinel, no usable values"
+    assert lines[4] == "- col0: 0% null, 0% sentinel, 0..1"
+    assert lines[-1] == "... and 3 more columns."
+    assert "no rows" in result_profiler.format_result_profile(result_profiler.profile_result(df.iloc[:0]))
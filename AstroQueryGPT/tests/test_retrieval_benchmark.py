@@ -0,0 +1,81 @@
+import os
+import json
+import zlib
+
+import numpy as np
+import pytest
+
+from AstroQueryGPT import retrieval_benchmark
+
+SCHEMA_PATH = os.path.join(os.path.dirname(retrieval_benchmark.__file__), "sdss_schema_dr16.json")
+
+
+@pytest.fixture(scope="module")
+def schema():
+    with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class _HashingEncoder:
+    """Deterministic bag-of-words encoder with the `encode` interface of SentenceTransformer."""
+
+    def encode(self, texts, convert_to_tensor=False, show_progress_bar=False):
+        vectors = np.zeros((len(texts), 256), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().replace(".", " ").replace(",", " ").split():
+                vectors[row, zlib.crc32(word.encode()) % 256] += 1.0
+        return vectors
+
+
+def test_gold_set_labels_exist_in_the_dr16_schema(schema):
+    questions = retrieval_benchmark.load_gold_set()
+
+    assert len(questions) >= 200
+    assert retrieval_benchmark.validate_gold_set(questions, schema) == []
+    assert len({table for entry in questions for table in entry["tables"]}) >= 50
+
+    bad = [{"question": "q", "tables": ["PhotoObjAll", "NoSuchTable"], "columns": ["PhotoObjAll.nope", "SpecObjAll.z"]}] * 2
+    problems = retrieval_benchmark.validate_gold_set(bad, schema)
+    assert any("unknown table NoSuchTable" in p for p in problems)
+    assert any("unknown column PhotoObjAll.nope" in p for p in problems)
+    assert any("SpecObjAll.z of a table not in 'tables'" in p for p in problems)
+    assert any(p.startswith("Duplicate question") for p in problems)
+
+
+def test_ranking_metrics_and_column_coverage():
+    questions = [
+        {"question": "a", "tables": ["A"], "columns": ["A.x", "A.hidden"]},
+        {"question": "b", "tables": ["B", "C"], "columns": ["C.y"]},
+        {"question": "c", "tables": ["D"], "columns": []},
+    ]
+    rankings = [["A", "B", "C", "D"], ["C", "A", "B", "D"], ["A", "B", "C", "E"]]
+
+    metrics = retrieval_benchmark.ranking_metrics(rankings, questions, k_values=(1, 3))
+    assert metrics["recall@1"] == pytest.approx((1 + 0.5 + 0) / 3, abs=1e-4)
+    assert metrics["recall@3"] == pytest.approx((1 + 1 + 0) / 3, abs=1e-4)
+    assert metrics["mrr"] == pytest.approx((1 + 1 + 0) / 3, abs=1e-4)
+
+    described = {"A": {"x"}, "C": {"y"}}
+    coverage = retrieval_benchmark.column_coverage(rankings, questions, described, k_values=(1, 3))
+    assert coverage == {"column_coverage@1": pytest.approx(2 / 3, abs=1e-4), "column_coverage@3": pytest.approx(2 / 3, abs=1e-4)}
+
+
+def test_evaluate_configuration_reports_quality_and_speed(schema):
+    questions = [entry for entry in retrieval_benchmark.load_gold_set() if entry["tables"] == ["PhotoObjAll"]][:5]
+
+    result = retrieval_benchmark.evaluate_configuration(
+        _HashingEncoder(), schema, questions, max_fields=30, collapse=True, k_values=(1, 128), thresholds=(0.0, 2.0), top_k=2,
+    )
+
+    assert result["recall@128"] == 1.0 and 0 < result["mrr"] <= 1
+    assert result["query_latency"]["count"] == 5 and result["corpus_build_s"] > 0
+    assert result["corpus_embeddings_mb"] == pytest.approx(len(schema) * 256 * 4 / 2**20, abs=1e-3)
+    # Nothing reaches a threshold of 2.0, so only the fallback best match is returned.
+    assert result["thresholds"]["2.0"]["mean_tables"] == 1.0
+    assert result["thresholds"]["0.0"]["mean_tables"] == 2.0
+
+    # Collapsed band families let the same field budget describe more real columns.
+    collapsed = retrieval_benchmark.corpus_columns(schema, max_fields=30, collapse=True)["PhotoObjAll"]
+    raw = retrieval_benchmark.corpus_columns(schema, max_fields=30, collapse=False)["PhotoObjAll"]
+    assert len(raw) == 30 and len(collapsed) > len(raw)
+    assert {"psfmag_u", "psfmag_z"} <= collapsed
@@ -0,0 +1,41 @@
+import pytest
+
+from AstroQueryGPT import schema_preprocessing
+
+
+@pytest.fixture
+def photo_table():
+    """A table with a complete band family, a partial one and plain fields."""
+    fields = [{"name": "objID", "type": "bigint", "description": "Unique SDSS identifier (Primary key)"}]
+    fields += [{"name": f"psfMag_{b}", "type": "real", "description": "PSF magnitude"} for b in "ugriz"]
+    fields += [{"name": "ra", "type": "float", "description": "J2000 Right Ascension"}]
+    fields += [{"name": f"extinction_{b}", "type": "real", "description": f"Extinction in {b}-band"} for b in "gr"]
+    fields += [{"name": "u", "type": "real", "description": "Shorthand alias for modelMag_u"}]
+    return {"name": "PhotoObjAll", "description": "Photometric objects", "fields": fields}
+
+
+def test_collapse_band_families(photo_table):
+    """Band variants become one entry at the first member's position; other fields are kept."""
+    collapsed = schema_preprocessing.collapse_band_families(photo_table["fields"])
+    assert [f["name"] for f in collapsed] == ["objID", "psfMag_{u,g,r,i,z}", "ra", "extinction_{g,r}", "u"]
+    assert collapsed[1]["members"] == ["psfMag_u", "psfMag_g", "psfMag_r", "psfMag_i", "psfMag_z"]
+    assert collapsed[1]["description"] == "PSF magnitude"
+    assert collapsed[3]["description"] == "Extinction in <band>-band"
+    assert len(photo_table["fields"]) == 10  # The raw schema is not modified.
+
+
+def test_corpus_text_is_cached_per_table(photo_table):
+    """Corpus text is rendered once and rebuilt only when the table's fields change."""
+    schema_preprocessing.preprocess_schema([photo_table], max_corpus_fields=30)
+    text = schema_preprocessing.get_corpus_text(photo_table, 30)
+    assert "Field: psfMag_{u,g,r,i,z} (Type: real)" in text
+    assert "psfMag_g" not in text
+    assert schema_preprocessing.get_corpus_text(photo_table, 30) is text
+
+    photo_table["fields"] = photo_table["fields"][:1]
+    assert "psfMag" not in schema_preprocessing.get_corpus_text(photo_table, 30)
+
+
+def test_get_prompt_fields_without_collapsing(photo_table):
+    """Collapsing can be disabled, returning the raw fields."""
+    assert schema_preprocessing.get_prompt_fields(photo_table, 30, collapse=False) == photo_table["fields"]
@@ -0,0 +1,194 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from AstroQueryGPT import sdss_endpoints, skyserver_scheduler
+
+EndpointPool = sdss_endpoints.EndpointPool
+
+
+class _StubSkyServer:
+    """Local HTTP server answering every GET with a CSV table, after `delay_s`, with `status`."""
+
+    def __init__(self, name, delay_s=0.0, status=200):
+        self.name = name
+        self.delay_s = delay_s
+        self.status = status
+        self.hits = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.hits += 1
+                time.sleep(stub.delay_s)
+                body = f"#Table1\nobjid,source\n1,{stub.name}\n".encode()
+                self.send_response(stub.status)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except OSError:
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/x_sql.aspx"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stubs():
+    servers = []
+
+    def make(name, **kwargs):
+        server = _StubSkyServer(name, **kwargs)
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.close()
+
+
+def _pool(*servers, **kwargs):
+    kwargs.setdefault("hedge_initial_delay_s", 0.1)
+    kwargs.setdefault("hedge_min_delay_s", 0.05)
+    kwargs.setdefault("failure_threshold", 2)
+    kwargs.setdefault("reset_timeout_s", 0.3)
+    return EndpointPool([server.url for server in servers], **kwargs)
+
+
+def test_hedged_request_wins_over_slow_primary(stubs):
+    slow, fast = stubs("primary", delay_s=2.0), stubs("mirror")
+    pool = _pool(slow, fast)
+
+    start = time.perf_counter()
+    response = pool.get({"cmd": "SELECT 1"}, timeout=10)
+
+    assert time.perf_counter() - start < 1.0
+    assert "mirror" in response.text
+    stats = pool.get_stats()
+    assert stats["hedges"] == 1
+    assert stats["cancelled_losers"] == 1
+    assert stats["endpoints"][1]["hedges_won"] == 1
+
+
+def test_no_hedge_when_primary_is_fast(stubs):
+    primary, mirror = stubs("primary"), stubs("mirror")
+    pool = _pool(primary, mirror, hedge_initial_delay_s=1.0)
+
+    assert "primary" in pool.get({"cmd": "SELECT 1"}, timeout=10).text
+    assert pool.get_stats()["hedges"] == 0
+    assert mirror.hits == 0
+
+
+def test_fails_over_on_server_error_even_without_hedging(stubs):
+    broken, mirror = stubs("primary", status=503), stubs("mirror")
+    pool = _pool(broken, mirror, hedge_enabled=False)
+
+    response = pool.get({"cmd": "SELECT 1"}, timeout=10)
+
+    assert response.status_code == 200
+    assert "mirror" in response.text
+    assert pool.get_stats()["failovers"] == 1
+
+
+def test_returns_last_server_error_when_every_endpoint_fails(stubs):
+    pool = _pool(stubs("primary", status=500), stubs("mirror", status=503))
+
+    assert pool.get({"cmd": "SELECT 1"}, timeout=10).status_code in (500, 503)
+
+
+def test_circuit_opens_skips_endpoint_and_recovers_after_reset(stubs):
+    primary, mirror = stubs("primary", status=503), stubs("mirror")
+    pool = _pool(primary, mirror, hedge_enabled=False)
+
+    for _ in range(2):
+        pool.get({"cmd": "SELECT 1"}, timeout=10)
+    assert pool.get_stats()["endpoints"][0]["circuit"] == sdss_endpoints.BREAKER_OPEN
+
+    hits_when_opened = primary.hits
+    assert "mirror" in pool.get({"cmd": "SELECT 1"}, timeout=10).text
+    assert primary.hits == hits_when_opened
+
+    primary.status = 200
+    time.sleep(0.35)
+    assert "primary" in pool.get({"cmd": "SELECT 1"}, timeout=10).text
+    assert pool.get_stats()["endpoints"][0]["circuit"] == sdss_endpoints.BREAKER_CLOSED
+
+
+def test_all_circuits_open_raises_endpoint_unavailable(stubs):
+    pool = _pool(stubs("primary", status=503), failure_threshold=1, reset_timeout_s=60)
+    pool.get({"cmd": "SELECT 1"}, timeout=10)
+
+    with pytest.raises(sdss_endpoints.EndpointUnavailable):
+        pool.get({"cmd": "SELECT 1"}, timeout=10)
+
+
+def test_hedge_delay_tracks_p95_latency_after_enough_samples():
+    pool = EndpointPool(["http://a", "http://b"], hedge_min_delay_s=0.05, hedge_initial_delay_s=5.0, hedge_min_samples=20)
+    endpoint = pool.endpoints[0]
+    assert pool.hedge_delay_s(endpoint) == 5.0
+
+    endpoint.latencies_s.extend([0.1] * 18 + [0.9, 1.0])
+    assert pool.hedge_delay_s(endpoint) == pytest.approx(1.0)
+
+    endpoint.latencies_s.clear()
+    endpoint.latencies_s.extend([0.01] * 20)
+    assert pool.hedge_delay_s(endpoint) == 0.05
+
+
+def test_cancelled_request_abandons_attempts(stubs):
+    slow = stubs("primary", delay_s=2.0)
+    pool = _pool(slow, hedge_enabled=False)
+    ctx = sdss_endpoints.RequestContext()
+    threading.Timer(0.1, ctx.cancel).start()
+
+    start = time.perf_counter()
+    with pytest.raises(Exception, match="cancelled"):
+        pool.get({"cmd": "SELECT 1"}, timeout=10, ctx=ctx)
+    assert time.perf_counter() - start < 1.0
+    assert pool.get_stats()["cancelled_losers"] == 1
+
+
+def test_hedges_are_charged_to_the_scheduler(stubs):
+    slow, fast = stubs("primary", delay_s=0.5), stubs("mirror")
+    pool = _pool(slow, fast)
+    scheduler = skyserver_scheduler.SkyServerScheduler(rate_per_s=1000, burst=10, max_concurrent=2)
+
+    with scheduler.slot(user_id="alice"):
+        assert "mirror" in pool.get({"cmd": "SELECT 1"}, timeout=10, scheduler=scheduler).text
+        deadline = time.monotonic() + 2.0
+        while scheduler.get_stats()["in_flight"] > 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert scheduler.get_stats()["in_flight"] == 1
+    assert scheduler.get_stats()["extra_attempts"] == 1
+
+    busy = skyserver_scheduler.SkyServerScheduler(rate_per_s=1000, burst=10, max_concurrent=1)
+    with busy.slot(user_id="alice"):
+        assert "primary" in pool.get({"cmd": "SELECT 1"}, timeout=10, scheduler=busy).text
+    assert pool.get_stats()["hedges_throttled"] == 1
+    assert busy.get_stats()["hedges_refused"] == 1
+    assert fast.hits == 1
+
+
+def test_failovers_wait_for_a_scheduler_token(stubs):
+    broken, mirror = stubs("primary", status=503), stubs("mirror")
+    pool = _pool(broken, mirror, hedge_enabled=False)
+    scheduler = skyserver_scheduler.SkyServerScheduler(rate_per_s=5, burst=1, max_concurrent=1)
+
+    start = time.perf_counter()
+    with scheduler.slot(user_id="alice"):
+        assert "mirror" in pool.get({"cmd": "SELECT 1"}, timeout=10, scheduler=scheduler).text
+    assert time.perf_counter() - start >= 0.15
+    assert scheduler.get_stats()["extra_attempts"] == 1
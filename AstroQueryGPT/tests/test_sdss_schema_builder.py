@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+
+from AstroQueryGPT import sdss_schema_builder
+
+
+def fake_skyserver(sql, str_columns=None, allow_local=True):
+    """Answers the three catalog queries the way SkyServer's CSV would come back (escaped text)."""
+    assert allow_local is False
+    if "FROM DBObjects" in sql:
+        return pd.DataFrame({
+            "name": ["PhotoObjAll", "zooSpec"],
+            "description": ["The full photometric catalog\x1f quantities.", "Galaxy Zoo <b>votes</b>"],
+        })
+    if "FROM DBColumns" in sql:
+        return pd.DataFrame({
+            "tablename": ["photoobjall", "PhotoObjAll", "zooSpec"],
+            "name": ["ra", "objID", "p_el"],
+            "unit": ["deg", None, None],
+            "ucd": ["pos.eq.ra", "meta.id", None],
+            "description": ["J2000 right ascension (r')", "Unique SDSS identifier\x1f see \x1ehelp\x1e", "Elliptical fraction &gt; 0"],
+        })
+    return pd.DataFrame({
+        "tablename": ["PhotoObjAll", "PhotoObjAll", "PhotoObjAll", "zooSpec", "zooSpec", "Galaxy"],
+        "name": ["ra", "objID", "run", "p_el", "specobjid", "ra"],
+        "type": ["float", "bigint", "smallint", "real", "numeric", "float"],
+        "octets": [None, None, None, None, None, None],
+        "num_precision": [53, 19, 5, 24, 20, 53],
+        "position": [2, 1, 3, 2, 1, 1],
+    })
+
+
+def test_build_schema_joins_catalog_queries_into_schema_format():
+    """Tables, column order, types, byte lengths and restored descriptions match the scraped JSON format."""
+    schema = sdss_schema_builder.build_schema(fake_skyserver)
+
+    assert [table["name"] for table in schema] == ["PhotoObjAll", "zooSpec"] # Views are not tables.
+    assert schema[0]["description"] == "The full photometric catalog, quantities."
+    assert schema[1]["description"] == "Galaxy Zoo votes"
+    assert schema[0]["fields"] == [
+        {"name": "objID", "type": "bigint", "length": "8", "unit": "", "ucd": "meta.id", "description": 'Unique SDSS identifier, see "help"'},
+        {"name": "ra", "type": "float", "length": "8", "unit": "deg", "ucd": "pos.eq.ra", "description": "J2000 right ascension (r')"},
+        {"name": "run", "type": "smallint", "length": "2", "unit": "", "ucd": "", "description": ""},
+    ]
+    assert [(f["name"], f["length"], f["description"]) for f in schema[1]["fields"]] == [
+        ("specobjid", "13", ""), ("p_el", "4", "Elliptical fraction > 0"),
+    ]
+    assert [table["name"] for table in sdss_schema_builder.build_schema(fake_skyserver, tables=["zoospec"])] == ["zooSpec"]
+    assert sdss_schema_builder.storage_length("varchar", 64.0, None) == "64"
+    assert sdss_schema_builder.storage_length("varbinary", -1, None) == "-1"
+
+
+def test_failed_bulk_queries_fall_back_to_the_browser_scraper(mocker):
+    """A SkyServer error switches to the Playwright scraper unless the fallback is off."""
+    def failing_skyserver(sql, str_columns=None, allow_local=True):
+        raise ValueError("SDSS SQL Error: permission denied on INFORMATION_SCHEMA")
+
+    scraped = [{"name": "PhotoObjAll", "description": "scraped", "fields": []}]
+    scraper = mocker.patch.object(sdss_schema_builder, "_scrape_with_browser", return_value=scraped)
+    assert sdss_schema_builder.build_schema_with_fallback(failing_skyserver) == scraped
+    scraper.assert_called_once()
+
+    with pytest.raises(ValueError, match="permission denied"):
+        sdss_schema_builder.build_schema_with_fallback(failing_skyserver, fallback=False)
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from AstroQueryGPT import single_flight
+
+# Contexts must come from the same module object single_flight imported.
+RequestContext = single_flight.RequestContext
+RequestCancelled = single_flight.RequestCancelled
+
+
+def _run_concurrently(flights, key, fn, callers, **kwargs):
+    """Starts one caller, waits until the rest have joined its flight, then lets the work finish."""
+    release = threading.Event()
+
+    def work():
+        release.wait(5)
+        return fn()
+
+    with ThreadPoolExecutor(max_workers=callers) as pool:
+        futures = [pool.submit(flights.do, key, work, **kwargs)]
+        for _ in range(100):
+            if flights.get_stats()["in_flight"]:
+                break
+            threading.Event().wait(0.01)
+        futures += [pool.submit(flights.do, key, work, **kwargs) for _ in range(callers - 1)]
+        while flights.get_stats()["coalesced"] < callers - 1:
+            threading.Event().wait(0.01)
+        release.set()
+        return [f.exception() or f.result() for f in futures]
+
+
+def test_concurrent_identical_calls_share_one_result_object():
+    """Concurrent callers with the same key get the very same result from one execution."""
+    flights = single_flight.SingleFlight("test")
+    executions = []
+    outcomes = _run_concurrently(flights, "q", lambda: executions.append(1) or {"rows": 3}, callers=5)
+
+    results = [result for result, _ in outcomes]
+    assert len(executions) == 1
+    assert all(result is results[0] for result in results)
+    assert sorted(shared for _, shared in outcomes) == [False, True, True, True, True]
+    assert flights.get_stats() == {"calls": 5, "executions": 1, "coalesced": 4, "reruns": 0, "in_flight": 0}
+
+    # Nothing is cached: a later call runs again.
+    flights.do("q", lambda: executions.append(1))
+    assert len(executions) == 2
+
+
+def test_errors_are_shared_with_waiters():
+    """The executing caller's exception is raised in every waiting caller."""
+    flights = single_flight.SingleFlight("test")
+
+    def fail():
+        raise ValueError("SQL error")
+
+    outcomes = _run_concurrently(flights, "bad", fail, callers=3)
+    assert all(isinstance(outcome, ValueError) for outcome in outcomes)
+    assert flights.get_stats()["executions"] == 1
+
+
+def test_waiter_reruns_when_the_executing_request_is_cancelled():
+    """A waiter does not inherit another caller's cancellation; it runs the work itself."""
+    flights = single_flight.SingleFlight("test")
+    leader_ctx = RequestContext()
+    started, calls = threading.Event(), []
+
+    def leader_work():
+        started.set()
+        while not leader_ctx.cancelled:
+            threading.Event().wait(0.01)
+        leader_ctx.check("work")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flights.do, "q", leader_work, ctx=leader_ctx)
+        started.wait(5)
+        waiter = pool.submit(flights.do, "q", lambda: calls.append(1) or "fresh", ctx=RequestContext(timeout_s=5))
+        while flights.get_stats()["coalesced"] < 1:
+            threading.Event().wait(0.01)
+        leader_ctx.cancel("stopped by user")
+        with pytest.raises(RequestCancelled):
+            leader.result()
+        assert waiter.result() == ("fresh", False)
+    assert flights.get_stats()["reruns"] == 1
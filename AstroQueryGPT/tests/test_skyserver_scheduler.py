@@ -0,0 +1,102 @@
+import time
+import threading
+
+import pytest
+
+from AstroQueryGPT import skyserver_scheduler
+
+RequestContext = skyserver_scheduler.RequestContext
+PRIORITY_BULK = skyserver_scheduler.PRIORITY_BULK
+PRIORITY_INTERACTIVE = skyserver_scheduler.PRIORITY_INTERACTIVE
+
+
+def _queue_behind_held_slot(scheduler, requests):
+    """Holds the only slot, queues `requests` ((user, priority) pairs) in order, then releases it.
+
+    Returns the order in which the queued requests were dispatched.
+    """
+    order, threads = [], []
+    release = threading.Event()
+
+    def hold():
+        with scheduler.slot(user_id="holder"):
+            release.wait(5)
+
+    def request(user, priority):
+        with scheduler.slot(user_id=user, priority=priority):
+            order.append((user, priority))
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    while scheduler.get_stats()["in_flight"] < 1:
+        time.sleep(0.005)
+    for user, priority in requests:
+        thread = threading.Thread(target=request, args=(user, priority))
+        thread.start()
+        threads.append(thread)
+        while scheduler.get_stats()["waiting"] < len(threads):
+            time.sleep(0.005)
+    release.set()
+    for thread in [holder, *threads]:
+        thread.join(5)
+    return order
+
+
+def test_token_bucket_limits_rate_and_counts_throttling():
+    """After the burst, queries are spaced by the sustained rate and counted as throttled."""
+    scheduler = skyserver_scheduler.SkyServerScheduler(rate_per_s=20, burst=2, max_concurrent=4)
+    start = time.monotonic()
+    for _ in range(6):
+        with scheduler.slot(user_id="alice"):
+            pass
+    assert time.monotonic() - start >= 0.18 # 4 tokens at 20/s after a burst of 2
+    stats = scheduler.get_stats()
+    assert stats["interactive"]["granted"] == 6
+    assert stats["interactive"]["throttled"] == 4
+    assert stats["users"] == {"alice": 6}
+
+
+def test_interactive_queries_go_before_bulk():
+    """Queued interactive probes are dispatched before bulk work that queued earlier."""
+    scheduler = skyserver_scheduler.SkyServerScheduler(rate_per_s=1000, burst=100, max_concurrent=1)
+    order = _queue_behind_held_slot(scheduler, [("bulk-user", PRIORITY_BULK), ("alice", PRIORITY_INTERACTIVE)])
+    assert order == [("alice", PRIORITY_INTERACTIVE), ("bulk-user", PRIORITY_BULK)]
+    assert scheduler.get_stats()["bulk"]["queued"] == 1
+
+
+def test_users_are_served_fairly():
+    """A user with many queued queries does not delay another user's single query behind all of them."""
+    scheduler = skyserver_scheduler.SkyServerScheduler(rate_per_s=1000, burst=100, max_concurrent=1)
+    order = _queue_behind_held_slot(scheduler, [("storm", None), ("storm", None), ("storm", None), ("alice", None)])
+    assert [user for user, _ in order] == ["storm", "alice", "storm", "storm"]
+
+
+def test_cancelled_request_leaves_the_queue():
+    """A request cancelled while queued raises and does not take a slot."""
+    scheduler = skyserver_scheduler.SkyServerScheduler(rate_per_s=1000, burst=100, max_concurrent=1)
+    ctx = RequestContext()
+    with scheduler.slot(user_id="holder"):
+        threading.Timer(0.05, ctx.cancel).start()
+        with pytest.raises(Exception, match="cancelled before SkyServer queue"):
+            with scheduler.slot(ctx=ctx):
+                pass
+    stats = scheduler.get_stats()
+    assert stats["waiting"] == 0 and stats["in_flight"] == 0
+    assert stats["cancelled_while_queued"] == 1
+
+
+def test_per_user_state_stays_bounded(monkeypatch):
+    """Finish tags of users the virtual time has passed are forgotten and per-user counts are capped."""
+    monkeypatch.setattr(skyserver_scheduler, "MAX_TRACKED_USERS", 3)
+    scheduler = skyserver_scheduler.SkyServerScheduler(rate_per_s=1000, burst=100, max_concurrent=1)
+    for i in range(10):
+        with scheduler.slot(user_id=f"client-{i}"):
+            pass
+    assert len(scheduler._user_finish_tags) <= 1
+    assert len(scheduler._finish_tag_heap) <= 1
+    stats = scheduler.get_stats()
+    assert stats["users"] == {"client-7": 1, "client-8": 1, "client-9": 1}
+    assert stats["users_dropped"] == 7
+
+    order = _queue_behind_held_slot(scheduler, [("storm", None), ("storm", None), ("storm", None), ("alice", None)])
+    assert [user for user, _ in order] == ["storm", "alice", "storm", "storm"]
@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+from AstroQueryGPT import sql_dialect
+
+translate = sql_dialect.translate_tsql_to_sqlite
+
+
+@pytest.mark.parametrize("tsql, expected", [
+    ("SELECT TOP 10 ra, dec FROM Galaxy WHERE r < 17", "SELECT ra, dec FROM Galaxy WHERE r < 17 LIMIT 10"),
+    ("SELECT DISTINCT TOP (5) [class] FROM dbo.SpecObjAll;", 'SELECT DISTINCT "class" FROM SpecObjAll LIMIT 5'),
+    ("SELECT z FROM SpecObjAll WITH (NOLOCK) WHERE class = N'GALAXY'", "SELECT z FROM SpecObjAll WHERE class = 'GALAXY'"),
+    ("SELECT ISNULL(z, 0), LEN(class), COUNT_BIG(*) FROM SpecObjAll", "SELECT IFNULL(z, 0), LENGTH(class), COUNT(*) FROM SpecObjAll"),
+    ("SELECT TOP 3 LOG(r), CEILING(ra) FROM Galaxy -- brightest", "SELECT TSQL_LOG(r), TSQL_CEILING(ra) FROM Galaxy LIMIT 3"),
+])
+def test_translates_common_tsql(tsql, expected):
+    assert " ".join(translate(tsql).split()) == expected
+
+
+@pytest.mark.parametrize("tsql", [
+    "SELECT TOP 10 * FROM dbo.fGetNearbyObjEq(180, 0, 1)",
+    "SELECT p.objID, dbo.fPhotoTypeN(p.type) FROM PhotoObj p",
+    "SELECT TOP 10 PERCENT ra FROM Galaxy",
+    "SELECT ra FROM Galaxy WHERE objID IN (SELECT TOP 5 objID FROM Galaxy)",
+    "SELECT TOP 5 ra FROM Galaxy UNION SELECT ra FROM Star",
+    "SELECT ra INTO mydb.t FROM Galaxy",
+    "SELECT CONVERT(varchar, objID) FROM Galaxy",
+    "SELECT ra FROM Galaxy WHERE r < @limit",
+    "SELECT 'J' + CAST(objID AS varchar) FROM Galaxy",
+    "DELETE FROM Galaxy",
+])
+def test_rejects_constructs_without_local_equivalent(tsql):
+    with pytest.raises(sql_dialect.UnsupportedDialect):
+        translate(tsql)
+
+
+def test_registered_functions_follow_tsql_semantics():
+    connection = sqlite3.connect(":memory:")
+    sql_dialect.register_tsql_functions(connection)
+
+    row = connection.execute(translate("SELECT LOG(EXP(2)), LOG10(100), SQUARE(3), ATN2(1, 1), CEILING(1.2), LOG(NULL)")).fetchone()
+
+    assert row[0] == pytest.approx(2.0)
+    assert row[1] == pytest.approx(2.0)
+    assert row[2] == 9
+    assert row[3] == pytest.approx(0.7853981633974483)
+    assert row[4] == 2
+    assert row[5] is None
@@ -0,0 +1,73 @@
+import pandas as pd
+import pytest
+
+from AstroQueryGPT import sql_pagination, sql_validator, sdss_db
+
+
+@pytest.fixture
+def schema():
+    """PhotoObjAll keyed by its first column, SpecObjAll by an explicit primary key, and a keyless table."""
+    return [
+        {"name": "PhotoObjAll", "fields": [{"name": "objID", "type": "bigint"}, {"name": "ra", "type": "float"}, {"name": "r", "type": "real"}]},
+        {"name": "SpecObjAll", "fields": [{"name": "bestObjID", "type": "bigint"}, {"name": "specObjID", "type": "numeric", "description": "Unique ID (Primary key)"}, {"name": "z", "type": "real"}]},
+        {"name": "Neighbors", "fields": [{"name": "distance", "type": "float"}]},
+    ]
+
+
+@pytest.fixture
+def schema_index(schema):
+    return sql_validator.build_schema_index(schema)
+
+
+def test_find_table_key(schema):
+    """Explicit primary keys win; otherwise the leading integer ID column is used."""
+    assert sql_pagination.find_table_key(schema[0]) == "objID"
+    assert sql_pagination.find_table_key(schema[1]) == "specObjID"
+    assert sql_pagination.find_table_key(schema[2]) is None
+
+
+def test_plan_and_page_sql(schema, schema_index):
+    """A view query is paginated on its base table's key, keeping the WHERE clause."""
+    plan = sql_pagination.plan_keyset_pagination(
+        "SELECT TOP 1000 p.ra, p.r FROM PhotoObj AS p WHERE p.r < 17", schema_index, schema, 200
+    )
+    assert plan["key_expr"] == "p.objID"
+    assert sql_pagination.build_page_sql(plan, None, 200) == (
+        "SELECT TOP 200 p.ra, p.r, p.objID AS _page_key FROM PhotoObj AS p WHERE (p.r < 17) ORDER BY p.objID"
+    )
+    assert sql_pagination.build_page_sql(plan, "1237645876861272465", 100) == (
+        "SELECT TOP 100 p.ra, p.r, p.objID AS _page_key FROM PhotoObj AS p "
+        "WHERE (p.r < 17) AND p.objID > 1237645876861272465 ORDER BY p.objID"
+    )
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT TOP 1000 ra FROM PhotoObjAll ORDER BY r",
+    "SELECT TOP 1000 COUNT(*) FROM PhotoObjAll",
+    "SELECT TOP 1000 DISTINCT ra FROM PhotoObjAll",
+    "SELECT TOP 1000 p.ra, s.z FROM PhotoObjAll p JOIN SpecObjAll s ON s.bestObjID = p.objID",
+    "SELECT TOP 1000 ra FROM PhotoObjAll WHERE objID IN (SELECT bestObjID FROM SpecObjAll)",
+    "SELECT TOP 1000 distance FROM Neighbors",
+    "SELECT TOP 100 ra FROM PhotoObjAll",
+])
+def test_plan_rejects_unsafe_or_small_queries(schema, schema_index, sql):
+    """Queries whose results would change under keyset paging (or fit in one page) run unpaginated."""
+    assert sql_pagination.plan_keyset_pagination(sql, schema_index, schema, 200) is None
+
+
+def test_iter_query_pages_follows_last_key(mocker):
+    """Each page starts after the previous page's last key; the key column is dropped."""
+    plan = {"columns": "ra", "from_clause": "PhotoObjAll", "where": None, "key_column": "objID",
+            "key_expr": "PhotoObjAll.objID", "total_rows": 5, "page_size": 2}
+    pages = [
+        pd.DataFrame({"ra": [1.0, 2.0], "_page_key": ["10", "11"]}),
+        pd.DataFrame({"ra": [3.0, 4.0], "_page_key": ["12", "13"]}),
+        pd.DataFrame({"ra": [5.0], "_page_key": ["14"]}),
+    ]
+    mock_query = mocker.patch.object(sdss_db, "query_sdss", side_effect=pages)
+    result = list(sdss_db.iter_query_pages(plan))
+    assert [len(p) for p in result] == [2, 2, 1]
+    assert list(result[0].columns) == ["ra"]
+    sqls = [call.args[0] for call in mock_query.call_args_list]
+    assert "WHERE" not in sqls[0]
+    assert "PhotoObjAll.objID > 11" in sqls[1] and sqls[2].startswith("SELECT TOP 1 ")
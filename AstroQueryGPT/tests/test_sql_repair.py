@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from AstroQueryGPT import sql_repair, sql_validator
+
+
+@pytest.fixture
+def schema_index():
+    """A small schema index for name repairs."""
+    schema = [
+        {"name": "PhotoObjAll", "fields": [{"name": "objID"}, {"name": "ra"}, {"name": "dec"}, {"name": "petroRad_r"}, {"name": "psfMag_r"}, {"name": "psfMag_g"}]},
+        {"name": "SpecObjAll", "fields": [{"name": "specObjID"}, {"name": "bestObjID"}, {"name": "z"}, {"name": "class"}]},
+    ]
+    return sql_validator.build_schema_index(schema)
+
+
+@pytest.fixture(autouse=True)
+def reset_repair_stats(mocker):
+    """Isolate the module-level counters between tests."""
+    mocker.patch.object(sql_repair, "REPAIR_STATS", {"attempts": 0, "repaired": 0, "llm_calls_avoided": 0, "rules": {}})
+
+
+@pytest.mark.parametrize("sql, top_n, expected", [
+    ("SELECT * FROM TableA", 10, "SELECT TOP 10 * FROM TableA"),
+    ("SELECT TOP 5 * FROM TableB", 10, "SELECT TOP 10 * FROM TableB"),
+    ("SELECT DISTINCT name FROM Stars", 3, "SELECT DISTINCT TOP 3 name FROM Stars"),
+    ("UPDATE x SET y = 1", 10, None),
+])
+def test_enforce_top_n_clause(sql, top_n, expected):
+    """TOP N is inserted or corrected; non-SELECT statements are rejected."""
+    assert sql_repair.enforce_top_n_clause(sql, top_n) == expected
+
+
+def test_parse_sql_error_extracts_names():
+    """SkyServer and validator messages are parsed into actionable parts."""
+    info = sql_repair.parse_sql_error(
+        "SDSS Error: Invalid column name 'petroRad_x'. Invalid object name 'PhotoObjAl'. Incorrect syntax near 'LIMIT'."
+    )
+    assert info["invalid_columns"] == ["petroRad_x"]
+    assert info["invalid_objects"] == ["PhotoObjAl"]
+    assert set(info) == {"invalid_columns", "invalid_objects"}
+
+
+def test_repair_sql_limit_and_semicolon(schema_index):
+    """`LIMIT n` and trailing semicolons are rewritten without the LLM."""
+    result = sql_repair.repair_sql(
+        "SELECT ra, dec FROM PhotoObjAll WHERE ra > 10 LIMIT 20;", "error near 'LIMIT'", schema_index, 20
+    )
+    assert result["sql"] == "SELECT TOP 20 ra, dec FROM PhotoObjAll WHERE ra > 10"
+    assert result["rules"] == ["strip_residue", "limit_to_top"]
+
+
+def test_repair_sql_markdown_residue(schema_index):
+    """Markdown fences around the query are removed."""
+    result = sql_repair.repair_sql("```sql\nSELECT TOP 10 ra FROM PhotoObjAll\n```", "error near '`'", schema_index, 10)
+    assert result["sql"] == "SELECT TOP 10 ra FROM PhotoObjAll"
+
+
+def test_repair_sql_misspelled_column_and_table(schema_index):
+    """Misspelled names with a unique close match are replaced, string literals are untouched."""
+    result = sql_repair.repair_sql(
+        "SELECT TOP 10 p.petroRad_rr FROM PhotoObjAl p WHERE p.ra > 1 AND 'petroRad_rr' = 'petroRad_rr'",
+        "Invalid object name 'PhotoObjAl'. Invalid column name 'petroRad_rr'.",
+        schema_index, 10,
+    )
+    assert result["sql"] == "SELECT TOP 10 p.petroRad_r FROM PhotoObjAll p WHERE p.ra > 1 AND 'petroRad_rr' = 'petroRad_rr'"
+    assert "rename:petroRad_rr->petroRad_r" in result["rules"]
+
+
+def test_repair_sql_ambiguous_column_falls_back_to_llm(schema_index):
+    """An ambiguous close match (psfMag_g vs psfMag_r) is left to the LLM."""
+    result = sql_repair.repair_sql(
+        "SELECT TOP 10 psfMag_x FROM PhotoObjAll", "Invalid column name 'psfMag_x'.", schema_index, 10
+    )
+    assert result is None
+
+
+def test_repair_sql_counts_avoided_llm_calls(schema_index):
+    """Counters record attempts and LLM calls avoided."""
+    sql_repair.repair_sql("SELECT ra FROM PhotoObjAll", "some error", schema_index, 10)
+    sql_repair.repair_sql("SELECT TOP 10 ra FROM PhotoObjAll", "some error", schema_index, 10)
+    stats = sql_repair.get_repair_stats()
+    assert stats["attempts"] == 2
+    assert stats["repaired"] == 1
+    assert stats["llm_calls_avoided"] == 1
+    assert stats["rules"] == {"enforce_top": 1}
+
+
+def test_repair_sql_discards_already_attempted_queries(schema_index):
+    """A repair that reproduces an earlier attempt is left to the LLM and not counted as an avoided call."""
+    attempted = {"SELECT TOP 20 ra FROM PhotoObjAll"}
+    result = sql_repair.repair_sql("SELECT ra FROM PhotoObjAll LIMIT 20", "error near 'LIMIT'", schema_index, 20, attempted)
+    assert result is None
+    stats = sql_repair.get_repair_stats()
+    assert stats["attempts"] == 1
+    assert stats["repaired"] == stats["llm_calls_avoided"] == 0
+    assert stats["rules"] == {}
+
+def test_repair_stats_are_thread_safe(schema_index):
+    """Concurrent repairs from worker threads lose no counts."""
+    def repair(_):
+        sql_repair.repair_sql("SELECT ra FROM PhotoObjAll LIMIT 5", "error near 'LIMIT'", schema_index, 5)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(repair, range(400)))
+    stats = sql_repair.get_repair_stats()
+    assert stats["attempts"] == stats["repaired"] == 400
+    assert stats["rules"]["limit_to_top"] == 400
@@ -0,0 +1,149 @@
+import pytest
+import time
+
+from AstroQueryGPT import sql_validator
+
+
+@pytest.fixture
+def schema_index():
+    """A small schema index with the tables most queries touch."""
+    schema = [
+        {"name": "PhotoObjAll", "description": "Photometric objects", "fields": [
+            {"name": "objID"}, {"name": "ra"}, {"name": "dec"}, {"name": "type"},
+            {"name": "psfMag_u"}, {"name": "psfMag_g"}, {"name": "psfMag_r"}, {"name": "flags"},
+        ]},
+        {"name": "SpecObjAll", "description": "Spectra", "fields": [
+            {"name": "specObjID"}, {"name": "bestObjID"}, {"name": "z"}, {"name": "class"},
+        ]},
+        {"name": "PlateX", "description": "Plates", "fields": [
+            {"name": "plate"}, {"name": "mjd"}, {"name": "ra"}, {"name": "dec"}, {"name": "ha"},
+        ]},
+    ]
+    return sql_validator.build_schema_index(schema)
+
+
+def test_tokenize_sql_folds_dotted_and_bracketed_names():
+    """Dotted identifiers become one token and brackets are stripped."""
+    tokens = sql_validator.tokenize_sql("SELECT p.ra, [dec], p.* FROM dbo.PhotoObj p WHERE x = 'a.b'")
+    names = [value for kind, value in tokens if kind == "name"]
+    assert ("p", "ra") in names
+    assert ("dec",) in names
+    assert ("p", "*") in names
+    assert ("dbo", "PhotoObj") in names
+    assert ("string", "'a.b'") in tokens
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT TOP 10 p.objID, p.ra, s.z FROM PhotoObj AS p JOIN SpecObj s ON s.bestObjID = p.objID WHERE s.z > 0.3 ORDER BY s.z DESC",
+    "SELECT TOP 10 ra, dec FROM PhotoObjAll WHERE psfMag_r < 18",
+    "SELECT TOP 10 COUNT(*) AS n, class FROM SpecObj GROUP BY class ORDER BY n",
+    "SELECT TOP 10 p.ra r, CAST(p.dec AS float) d FROM Galaxy p WHERE p.ra BETWEEN 10 AND 20 ORDER BY r",
+    "SELECT TOP 10 objID, CASE WHEN psfMag_r < 17 THEN 1 ELSE 0 END bright FROM PhotoObjAll ORDER BY bright",
+    "SELECT TOP 10 x.ra FROM (SELECT ra FROM PhotoObj) x WHERE x.anything > 1",
+    "WITH cte AS (SELECT objID, ra FROM PhotoObj) SELECT TOP 10 c.ra, c.other FROM cte c",
+    "SELECT TOP 5 n.objID FROM dbo.fGetNearbyObjEq(180, 0, 1) AS n JOIN PhotoObj p ON p.objID = n.objID",
+    "SELECT TOP 10 [ra], [dec] FROM [PhotoObj] WHERE dbo.fPhotoFlags('SATURATED') & flags = 0",
+    "SELECT TOP 10 * FROM SpecObjAll WHERE class = 'GALAXY' -- comment with bogus_name",
+    "SELECT TOP 10 plate, DATEADD(day, 1, mjd) FROM PlateX",
+    "SELECT TOP 10 p.plate, DATEDIFF(dd, p.mjd, 55000) AS age, DATEPART(month, p.mjd) m FROM PlateX p",
+    "SELECT TOP 10 DATENAME(weekday, mjd) FROM PlateX WHERE DATEPART(year, mjd) > 2000",
+])
+def test_validate_sql_accepts_valid_queries(schema_index, sql):
+    """Valid queries (including views, CTEs, derived tables and functions) produce no errors."""
+    assert sql_validator.validate_sql(sql, schema_index) == []
+
+
+def test_validate_sql_invalid_table_with_suggestion(schema_index):
+    """Unknown tables are reported with SkyServer-style messages and close-name suggestions."""
+    errors = sql_validator.validate_sql("SELECT TOP 10 ra FROM PhotoObjAl", schema_index)
+    assert len(errors) == 1
+    assert errors[0]["type"] == "invalid_object"
+    assert errors[0]["name"] == "PhotoObjAl"
+    assert errors[0]["suggestions"][0] == "PhotoObjAll"
+    assert errors[0]["message"].startswith("Invalid object name 'PhotoObjAl'.")
+
+
+def test_validate_sql_invalid_qualified_column(schema_index):
+    """Qualified columns are checked against the aliased table."""
+    errors = sql_validator.validate_sql(
+        "SELECT TOP 10 p.ra, p.psfmag_x FROM PhotoObj p JOIN SpecObj s ON s.bestObjID = p.objID", schema_index
+    )
+    assert [e["type"] for e in errors] == ["invalid_column"]
+    assert errors[0]["table"] == "PhotoObjAll"
+    assert "psfMag_g" in errors[0]["suggestions"]
+
+
+def test_validate_sql_invalid_unqualified_column(schema_index):
+    """Unqualified columns are checked when all sources are known tables."""
+    errors = sql_validator.validate_sql("SELECT TOP 10 ra, redshift FROM SpecObjAll", schema_index)
+    assert {e["name"] for e in errors} == {"ra", "redshift"}
+
+
+def test_validate_sql_unbound_qualifier(schema_index):
+    """Qualifiers that are neither an alias nor a table are reported."""
+    errors = sql_validator.validate_sql("SELECT TOP 10 q.ra FROM PhotoObj p", schema_index)
+    assert errors[0]["type"] == "unbound_identifier"
+    assert "could not be bound" in errors[0]["message"]
+
+
+def test_validate_sql_without_index_is_noop():
+    """No index means no validation."""
+    assert sql_validator.validate_sql("SELECT nonsense FROM nowhere", None) == []
+
+
+def test_format_validation_errors(schema_index):
+    """Formatted errors carry every message and the checked table."""
+    errors = sql_validator.validate_sql("SELECT TOP 10 psfmag_x FROM PhotoObjAll", schema_index)
+    message = sql_validator.format_validation_errors(errors)
+    assert "not sent to SkyServer" in message
+    assert "Invalid column name 'psfmag_x'." in message
+    assert "(checked against table PhotoObjAll)" in message
+    assert sql_validator.format_validation_errors([]) == ""
+
+
+def test_edit_distance_bounded():
+    """Edit distance is case-insensitive and stops early past the bound."""
+    assert sql_validator.edit_distance("psfMag_r", "PSFMAG_R") == 0
+    assert sql_validator.edit_distance("kitten", "sitting") == 3
+    assert sql_validator.edit_distance("a", "abcdef", max_distance=2) == 3
+
+
+def test_validate_sql_is_fast_for_valid_queries(schema_index):
+    """Validation of a typical valid query stays well under a millisecond on average."""
+    sql = "SELECT TOP 10 p.objID, p.ra, s.z FROM PhotoObj AS p JOIN SpecObj s ON s.bestObjID = p.objID WHERE s.z > 0.3"
+    runs = 200
+    start = time.perf_counter()
+    for _ in range(runs):
+        sql_validator.validate_sql(sql, schema_index)
+    assert (time.perf_counter() - start) / runs < 0.001
+
+
+def test_validate_sql_is_fast_for_invalid_queries():
+    """Suggestions over a PhotoObjAll-sized table stay well under a millisecond on average."""
+    fields = [
+        {"name": f"{prefix}{kind}_{band}"}
+        for prefix in ("psf", "fiber", "fiber2", "petro", "model", "cModel", "deV", "exp")
+        for kind in ("Mag", "MagErr", "Flux", "FluxIvar", "Rad", "RadErr", "AB", "Phi", "Theta", "Q", "U", "L")
+        for band in "ugriz"
+    ]
+    index = sql_validator.build_schema_index([{"name": "PhotoObjAll", "fields": fields}])
+    sql = "SELECT TOP 10 psfmag_rr, modelmagerr_gg FROM PhotoObjAll"
+    errors = sql_validator.validate_sql(sql, index)
+    assert errors[0]["suggestions"] == ["psfMag_r", "psfMag_g", "psfMag_i"]
+    assert errors[1]["suggestions"][0] == "modelMagErr_g"
+
+    # Best of several batches, so threads left running by other tests do not skew the timing.
+    runs = 20
+    timings = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(runs):
+            sql_validator.validate_sql(sql, index)
+        timings.append((time.perf_counter() - start) / runs)
+    assert min(timings) < 0.001
+
+
+def test_validate_sql_still_checks_other_date_function_arguments(schema_index):
+    """Only the datepart is skipped; the other arguments are checked as usual."""
+    errors = sql_validator.validate_sql("SELECT TOP 10 DATEADD(day, 1, mjdd) FROM PlateX", schema_index)
+    assert [e["name"] for e in errors] == ["mjdd"]
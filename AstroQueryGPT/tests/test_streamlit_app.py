@@ -137,3 +137,17 @@ def test_verify_data_structure_one_row_one_col_looks_like_error_but_long(caplog)
 #     # assert at.title[0].value == "🔭 SDSS Agentic RAG SQL Generator"
 #     # assert not at.session_state.query_log
     pass
+
+# Tests for make_probe_sql
+def test_make_probe_sql_rewrites_top_n(mocker):
+    """Large TOP N queries are probed with PROBE_TOP_N rows."""
+    mocker.patch.object(streamlit_app.config, "ENABLE_PROBE_EXECUTION", True)
+    probe = streamlit_app.make_probe_sql("SELECT TOP 500 ra, dec FROM PhotoObj WHERE r < 17", 500)
+    assert probe == f"SELECT TOP {streamlit_app.config.PROBE_TOP_N} ra, dec FROM PhotoObj WHERE r < 17"
+
+def test_make_probe_sql_skips_small_queries(mocker):
+    """A probe is pointless when the query already asks for few rows, or when probing is disabled."""
+    mocker.patch.object(streamlit_app.config, "ENABLE_PROBE_EXECUTION", True)
+    assert streamlit_app.make_probe_sql("SELECT TOP 3 ra FROM PhotoObj", 3) is None
+    mocker.patch.object(streamlit_app.config, "ENABLE_PROBE_EXECUTION", False)
+    assert streamlit_app.make_probe_sql("SELECT TOP 500 ra FROM PhotoObj", 500) is None
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from AstroQueryGPT import tracing
+from AstroQueryGPT.request_context import RequestContext
+
+
+def test_spans_nest_across_threads_and_record_errors():
+    with tracing.span("outside") as outside:
+        assert outside is None  # No trace is running.
+
+    def blocking_call():
+        with tracing.span("http", endpoint="x") as record:
+            tracing.set_span_attributes(status_code=200)
+            return record
+
+    with tracing.start_trace("agent.run", question="q") as trace:
+        with tracing.span("execution", attempt=1) as execution:
+            http = RequestContext().call(blocking_call)  # Runs in a worker thread.
+        with pytest.raises(ValueError):
+            with tracing.span("parse"):
+                raise ValueError("bad csv")
+
+    root, execution_span, http_span, parse = trace.spans
+    assert root["name"] == "agent.run" and root["parent_id"] is None
+    assert execution_span is execution and execution["parent_id"] == root["span_id"]
+    assert http_span is http and http["parent_id"] == execution["span_id"]
+    assert http["thread"] != root["thread"]
+    assert http["attributes"] == {"endpoint": "x", "status_code": 200}
+    assert parse["status"] == tracing.SPAN_STATUS_ERROR and parse["error"] == "ValueError: bad csv"
+    assert root["duration_ms"] >= execution["duration_ms"] >= http["duration_ms"]
+    assert tracing.current_trace() is None
+
+    rows = tracing.span_tree_rows(trace.spans)
+    assert [row["span"] for row in rows] == ["agent.run", "  execution", "    http", "  parse"]
+    assert rows[2]["details"] == "endpoint=x, status_code=200"
+
+
+def test_jsonl_and_otlp_export(tmp_path, mocker):
+    with tracing.start_trace("agent.run", top_n=10, ratio=0.5, cached=True, missing=None) as trace:
+        with tracing.span("llm.chat_completion", model="gpt"):
+            pass
+
+    lines = trace.to_jsonl().splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["agent.run", "llm.chat_completion"]
+
+    otlp = trace.to_otlp(service_name="svc")
+    resource_spans = otlp["resourceSpans"][0]
+    assert resource_spans["resource"]["attributes"] == [{"key": "service.name", "value": {"stringValue": "svc"}}]
+    root, child = resource_spans["scopeSpans"][0]["spans"]
+    assert len(root["traceId"]) == 32 and len(root["spanId"]) == 16 and "parentSpanId" not in root
+    assert child["parentSpanId"] == root["spanId"]
+    assert int(root["endTimeUnixNano"]) >= int(child["endTimeUnixNano"]) >= int(child["startTimeUnixNano"])
+    attributes = {a["key"]: a["value"] for a in root["attributes"]}
+    assert attributes["top_n"] == {"intValue": "10"} and attributes["ratio"] == {"doubleValue": 0.5}
+    assert attributes["cached"] == {"boolValue": True} and "missing" not in attributes
+    assert root["status"] == {"code": 1}
+
+    path = tmp_path / "traces.otlp.jsonl"
+    tracing.export_trace(trace, str(path), "otlp")
+    tracing.export_trace(trace, str(path), "otlp")
+    assert [json.loads(line) for line in path.read_text().splitlines()] == [json.loads(json.dumps(trace.to_otlp()))] * 2
+
+    mocker.patch.object(tracing.config, "ENABLE_TRACING", False)
+    with tracing.start_trace("agent.run") as disabled:
+        assert disabled is None
@@ -0,0 +1,268 @@
+"""
+Lightweight tracing of the agent pipeline.
+
+A `Trace` collects nested spans for one agent run: schema load, corpus and query
+embedding, prompt build, each LLM call (with token usage), SkyServer HTTP requests,
+CSV parsing, ID conversion and verification. The active trace and span are kept in
+context variables, so instrumented code opens spans with `span(...)` without a trace
+being passed around; outside a trace (or with `config.ENABLE_TRACING` off) `span`
+only costs a context variable lookup. Thread pools that run work for a request
+(`RequestContext.call`, the SkyServer endpoint pool) copy the caller's context, so
+spans opened in their threads nest under the caller's span.
+
+Spans are plain dicts ('trace_id', 'span_id', 'parent_id', 'name', 'start_unix_ns',
+'end_unix_ns', 'duration_ms', 'attributes', 'status', 'error', 'thread'). A trace can
+be exported as JSONL (one span per line) or as an OTLP/JSON `ExportTraceServiceRequest`
+(the OpenTelemetry protocol's JSON encoding) that collectors and trace viewers read.
+"""
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+SPAN_STATUS_OK = "ok"
+SPAN_STATUS_ERROR = "error"
+
+_OTLP_STATUS_CODES = {SPAN_STATUS_OK: 1, SPAN_STATUS_ERROR: 2}
+_OTLP_SPAN_KIND_INTERNAL = 1
+_OTLP_SCOPE_NAME = "astroquerygpt.tracing"
+
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("current_trace", default=None)
+_current_span: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("current_span", default=None)
+
+_export_lock = threading.Lock()
+
+
+class Trace:
+    """
+    The spans of one agent run, in start order (parents before their children).
+
+    Attributes:
+        trace_id: 32 hex characters, as in OpenTelemetry.
+        spans: The span dicts. Spans still running have no 'end_unix_ns' yet.
+    """
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def _add(self, span_record: Dict[str, Any]) -> None:
+        with self._lock:
+            self.spans.append(span_record)
+
+    def to_jsonl(self) -> str:
+        """Returns the spans as JSON lines."""
+        return spans_to_jsonl(self.spans)
+
+    def to_otlp(self, service_name: str = config.TRACE_SERVICE_NAME) -> Dict[str, Any]:
+        """Returns the spans as an OTLP/JSON export request (see `spans_to_otlp`)."""
+        return spans_to_otlp(self.spans, service_name)
+
+
+def current_trace() -> Optional[Trace]:
+    """Returns the trace of the running agent run, or None outside a trace."""
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(name: str, **attributes: Any) -> Iterator[Optional[Trace]]:
+    """
+    Starts a trace whose root span covers the `with` block.
+
+    Args:
+        name: Name of the root span (e.g. "agent.run").
+        **attributes: Attributes of the root span.
+
+    Yields:
+        The new Trace, or None if tracing is disabled.
+    """
+    if not config.ENABLE_TRACING:
+        yield None
+        return
+    trace = Trace()
+    token = _current_trace.set(trace)
+    try:
+        with span(name, **attributes):
+            yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Dict[str, Any]]]:
+    """
+    Records the `with` block as a span of the current trace, nested under the current span.
+
+    An exception leaving the block marks the span as failed (and is re-raised).
+
+    Args:
+        name: Span name, dotted by component (e.g. "llm.chat_completion").
+        **attributes: Initial attributes. Add more later with `set_span_attributes`.
+
+    Yields:
+        The span dict, or None outside a trace.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _current_span.get()
+    record = {
+        "trace_id": trace.trace_id,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "start_unix_ns": time.time_ns(),
+        "end_unix_ns": None,
+        "duration_ms": None,
+        "attributes": dict(attributes),
+        "status": SPAN_STATUS_OK,
+        "error": None,
+        "thread": threading.current_thread().name,
+    }
+    trace._add(record)
+    token = _current_span.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["status"] = SPAN_STATUS_ERROR
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        elapsed_ns = int((time.perf_counter() - start) * 1e9)
+        record["end_unix_ns"] = record["start_unix_ns"] + elapsed_ns
+        record["duration_ms"] = round(elapsed_ns / 1e6, 3)
+        _current_span.reset(token)
+
+
+def set_span_attributes(**attributes: Any) -> None:
+    """Adds attributes (e.g. token usage, row counts) to the current span. No-op outside a trace."""
+    record = _current_span.get()
+    if record is not None:
+        record["attributes"].update(attributes)
+
+
+def span_tree_rows(spans: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Flattens spans into display rows, depth first, with names indented by nesting depth.
+
+    Returns:
+        One dict per span with 'span' (indented name), 'duration_ms', 'status' and
+        'details' (attributes and error as "key=value" text).
+    """
+    children: Dict[Optional[str], List[Dict[str, Any]]] = {}
+    span_ids = {record["span_id"] for record in spans}
+    for record in spans:
+        parent_id = record["parent_id"] if record["parent_id"] in span_ids else None
+        children.setdefault(parent_id, []).append(record)
+
+    rows: List[Dict[str, Any]] = []
+
+    def visit(record: Dict[str, Any], depth: int) -> None:
+        details = [f"{key}={value}" for key, value in record["attributes"].items() if value is not None]
+        if record["error"]:
+            details.append(f"error={record['error']}")
+        rows.append({
+            "span": "  " * depth + record["name"],
+            "duration_ms": record["duration_ms"],
+            "status": record["status"],
+            "details": ", ".join(details),
+        })
+        for child in children.get(record["span_id"], []):
+            visit(child, depth + 1)
+
+    for root in children.get(None, []):
+        visit(root, 0)
+    return rows
+
+
+def spans_to_jsonl(spans: List[Dict[str, Any]]) -> str:
+    """Returns spans as JSON lines (one span dict per line, non-JSON attribute values as strings)."""
+    return "".join(json.dumps(record, default=str) + "\n" for record in spans)
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    """Encodes an attribute value as an OTLP `AnyValue`."""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)} # int64 values are JSON strings in OTLP/JSON.
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def spans_to_otlp(spans: List[Dict[str, Any]], service_name: str = config.TRACE_SERVICE_NAME) -> Dict[str, Any]:
+    """
+    Converts spans to an OTLP/JSON `ExportTraceServiceRequest`.
+
+    Args:
+        spans: Span dicts (of one or more traces).
+        service_name: The `service.name` resource attribute.
+
+    Returns:
+        A dict with 'resourceSpans', ready for `json.dumps` and an OTLP/HTTP JSON endpoint
+        or the OpenTelemetry Collector's file receiver.
+    """
+    otlp_spans = []
+    for record in spans:
+        end_unix_ns = record["end_unix_ns"] or time.time_ns() # Still running: cut at export time.
+        otlp_span = {
+            "traceId": record["trace_id"],
+            "spanId": record["span_id"],
+            "name": record["name"],
+            "kind": _OTLP_SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(record["start_unix_ns"]),
+            "endTimeUnixNano": str(end_unix_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in {**record["attributes"], "thread.name": record["thread"]}.items()
+                if value is not None
+            ],
+            "status": {"code": _OTLP_STATUS_CODES[record["status"]]},
+        }
+        if record["parent_id"]:
+            otlp_span["parentSpanId"] = record["parent_id"]
+        if record["error"]:
+            otlp_span["status"]["message"] = record["error"]
+        otlp_spans.append(otlp_span)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{"scope": {"name": _OTLP_SCOPE_NAME}, "spans": otlp_spans}],
+        }]
+    }
+
+
+def export_trace(
+    trace: Optional[Trace], path: str = config.TRACE_EXPORT_PATH, export_format: str = config.TRACE_EXPORT_FORMAT,
+) -> None:
+    """
+    Appends a finished trace to an export file.
+
+    Args:
+        trace: The trace; nothing is written for None.
+        path: The file to append to; nothing is written if empty.
+        export_format: 'jsonl' (one span per line) or 'otlp' (one export request per line).
+    """
+    if trace is None or not path:
+        return
+    if export_format == "otlp":
+        payload = json.dumps(trace.to_otlp()) + "\n"
+    else:
+        payload = trace.to_jsonl()
+    try:
+        with _export_lock, open(path, "a", encoding="utf-8") as f:
+            f.write(payload)
+    except OSError as e:
+        logger.warning(f"Could not export trace {trace.trace_id} to {path}: {e}")